@@ -1,5 +1,4 @@
-from .buttermanager.buttermanager import PasswordWindow
-from PyQt5.QtWidgets import QApplication
+from .buttermanager import cli
 import sys
 
 
@@ -10,7 +9,16 @@ def main():
     script. This script will be copied from setup.py using setuptools and it will be invoked from the script
     created within /usr/bin/buttermanager once the application is installed via sudo python setup.py install
 
+    If a command is given (f.i.: buttermanager status), the command line interface is run and PyQt5 is never
+    imported. Otherwise, the GUI is started.
+
     """
+    if cli.is_command_line(sys.argv[1:]):
+        sys.exit(cli.main(sys.argv[1:]))
+
+    from .buttermanager.buttermanager import PasswordWindow
+    from PyQt5.QtWidgets import QApplication
+
     # Creating application instance
     application = QApplication(sys.argv)
     # Creating main window instance
@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+import pathlib
+import sys
+import time
+
+# Constants
+# They must be kept in sync with utils.ConfigManager and filesystem.timeline
+APPLICATION_DIRECTORY = ".buttermanager"
+STATE_FILE = "timeline.json"
+DEFAULT_TICK = 300
+
+
+def is_due():
+    """Checks if the next timeline run is due reading only the state stored by the scheduler, so the rest of
+    ButterManager is imported only when there is something to do.
+
+    Returns:
+        bool: True if the scheduler has to be run.
+    """
+    state_path = os.path.join(str(pathlib.Path.home()), APPLICATION_DIRECTORY, STATE_FILE)
+    try:
+        with open(state_path, 'r') as state_file:
+            return time.time() >= json.load(state_file).get("next_run", 0)
+    except (OSError, ValueError, AttributeError):
+        return True
+
+
+def main():
+    """Main wrapper for taking timeline snapshots without the graphical interface.
+
+    This script is invoked from the script created within /usr/bin/buttermanager-timeline once the application
+    is installed via sudo python setup.py install. It never imports PyQt5, so it can be run from a systemd timer
+    (every tick) or as a systemd service (--daemon).
+
+    """
+    parser = argparse.ArgumentParser(description="Takes BTRFS timeline snapshots of the subvolumes defined in "
+                                                 "ButterManager")
+    parser.add_argument("--daemon", action="store_true", help="keep running and check every TICK seconds")
+    parser.add_argument("--tick", type=int, default=DEFAULT_TICK, help="seconds between two checks in daemon mode")
+    arguments = parser.parse_args()
+
+    if not arguments.daemon and not is_due():
+        return 0
+
+    from .buttermanager.filesystem import timeline
+    from .buttermanager.util import settings, utils
+
+    # Loading the configuration stored in buttermanager.yaml
+    utils.ConfigManager().load_settings()
+    if not settings.timeline:
+        sys.stdout.write("Timeline snapshots are disabled. Set 'timeline: 1' in buttermanager.yaml\n")
+        return 0
+
+    scheduler = timeline.TimelineScheduler(settings.timeline_interval)
+    scheduler.tick()
+    while arguments.daemon:
+        time.sleep(arguments.tick)
+        scheduler.tick()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
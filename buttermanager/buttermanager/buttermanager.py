@@ -17,24 +17,27 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from .exception import exception
-from .filesystem import filesystem, snapshot
-from .manager import upgrader
+from .filesystem import catalog, filesystem, ioctl, qgroup, snapshot, watchdog
+from .manager import balancer, differentiator, upgrader
 from .util import utils, settings
 from .window import windows
 import os
 import subprocess
 import sys
+import threading
 import time
 from functools import partial
-from PyQt5.QtWidgets import QMainWindow, QDesktopWidget
+from PyQt5.QtWidgets import QMainWindow, QDesktopWidget, QTreeWidgetItem
 from PyQt5.QtGui import QCursor, QTextCursor, QIcon, QPixmap, QDesktopServices, QFontMetrics
 from PyQt5 import uic, QtTest, QtWidgets
-from PyQt5.QtCore import Qt, pyqtSignal, QObject, QSize, QUrl
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QSize, QThread, QUrl
 
 
 # Constants
 SNAP_COMMAND = "snap"
 FLATPAK_COMMAND = "flatpak"
+# Seconds between two checks of the space watchdog
+SPACE_WATCHDOG_INTERVAL = 300
 
 
 class EmittingStream(QObject):
@@ -48,6 +51,100 @@ class EmittingStream(QObject):
         pass
 
 
+class SnapshotItem(QTreeWidgetItem):
+    """Row of the snapshots list.
+
+    Size columns are sorted by their number of bytes instead of by their text.
+    """
+    def __lt__(self, other):
+        column = self.treeWidget().sortColumn()
+        value = self.data(column, Qt.UserRole)
+        other_value = other.data(column, Qt.UserRole)
+        if value is None or other_value is None:
+            return QTreeWidgetItem.__lt__(self, other)
+        return value < other_value
+
+
+class QgroupRescanner(QThread):
+    """Independent thread that will rescan the quota groups of the filesystems.
+
+    """
+    # Attributes
+
+    # pyqtSignal that will be emitted with the progress of the rescan
+    progress = pyqtSignal(str)
+
+    # pyqtSignal that will be emitted when this class requires that main
+    # window refreshes GUI
+    refresh_gui = pyqtSignal()
+
+    # Constructor
+    def __init__(self, qgroup_caches):
+        QThread.__init__(self)
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        # Caches of the filesystems to rescan
+        self.__qgroup_caches = qgroup_caches
+
+    def run(self):
+        """Rescans the quota groups of every filesystem.
+
+        """
+        for qgroup_cache in self.__qgroup_caches:
+            try:
+                qgroup_cache.rescan(
+                    lambda current_key: self.progress.emit("Rescanning quota groups... (current key {key})".format(
+                        key=current_key)))
+            except OSError as os_error_exception:
+                self.__logger.error("Error rescanning quota groups: {error}".format(error=str(os_error_exception)))
+        self.progress.emit("")
+        self.refresh_gui.emit()
+
+
+class SpaceWatchdogThread(QThread):
+    """Independent thread that will check periodically the space left in the filesystems.
+
+    """
+    # Attributes
+
+    # pyqtSignal that will be emitted when the watchdog has freed space, so main
+    # window refreshes GUI
+    refresh_gui = pyqtSignal()
+
+    # pyqtSignals that will be emitted before and after every check, so main
+    # window disables its buttons meanwhile
+    check_started = pyqtSignal()
+    check_finished = pyqtSignal()
+
+    # Constructor
+    def __init__(self, operation_lock):
+        QThread.__init__(self)
+        # Lock held by the GUI while it is running an operation and by the watchdog while it is checking the
+        # filesystems, so the watchdog never prunes or balances at the same time. Checks are skipped if the GUI
+        # holds it
+        self.__operation_lock = operation_lock
+
+    def run(self):
+        """Runs the space watchdog until the thread is interrupted.
+
+        """
+        while not self.isInterruptionRequested():
+            if self.__operation_lock.acquire(blocking=False):
+                self.check_started.emit()
+                try:
+                    steps = watchdog.check_filesystems()
+                finally:
+                    self.__operation_lock.release()
+                    self.check_finished.emit()
+                if any(steps.values()):
+                    self.refresh_gui.emit()
+            # Sleeping in short periods, so the thread can be interrupted quickly
+            for _ in range(SPACE_WATCHDOG_INTERVAL):
+                if self.isInterruptionRequested():
+                    break
+                self.sleep(1)
+
+
 class PasswordWindow(QMainWindow):
     """Window to let the user type his/her password.
 
@@ -64,6 +161,8 @@ class PasswordWindow(QMainWindow):
         settings.ui_dir = os.path.join(os.path.dirname(__file__), 'ui')
         settings.images_dir = os.path.join(os.path.dirname(__file__), 'images')
 
+        # Main window (it will be created once the user types the password)
+        self.__main_window = None
         # UI elements
         self.__ui_elements = []
         # Logger
@@ -172,11 +271,13 @@ class PasswordWindow(QMainWindow):
 
         # Creating main window
         # Main window will only be displayed if everything goes right
-        ButtermanagerMainWindow(self)
+        self.__main_window = ButtermanagerMainWindow(self)
 
     def exit(self):
         # Exits the application
         self.hide()
+        if self.__main_window is not None:
+            self.__main_window.stop_space_watchdog()
         sys.exit()
 
 
@@ -204,6 +305,19 @@ class ButtermanagerMainWindow(QMainWindow):
         self.__upgrader = None
         # Updates checker that will check for updates if it is needed
         self.__updates_checker = None
+        # Quota groups rescanner that will refresh the size of the snapshots if it is needed
+        self.__qgroup_rescanner = None
+        # Caches of the size of the snapshots (one per directory where snapshots are stored)
+        self.__qgroup_caches = {}
+        # Space watchdog that will prune and balance the filesystems if the user has enabled it
+        self.__space_watchdog = None
+        # Held while the buttons are disabled because an operation is running, or while the space watchdog is
+        # checking the filesystems
+        self.__operation_lock = threading.Lock()
+        self.__operation_lock_held = False
+        self.__operation_lock_waiting = False
+        # True from the moment the GUI starts an operation until it finishes
+        self.__operation_running = False
         # Root snapshot checker
         self.__root_snapshot_checker = snapshot.RootSnapshotChecker(self)
         # UI elements
@@ -416,6 +530,7 @@ class ButtermanagerMainWindow(QMainWindow):
                 folder_icon = os.path.join(settings.images_dir, 'folder_16px_icon.png')
                 self.button_folder.setIcon(QIcon(folder_icon))
                 self.button_folder.setIconSize(QSize(16, 16))
+                self.list_snapshots.sortByColumn(0, Qt.AscendingOrder)
 
                 # Logs buttons
                 view_icon = os.path.join(settings.images_dir, 'view_24px_icon.png')
@@ -450,6 +565,10 @@ class ButtermanagerMainWindow(QMainWindow):
                 self.button_delete_snapshot.clicked.connect(self.delete_snapshots)
                 self.button_diff.clicked.connect(self.find_diffs)
                 self.button_folder.clicked.connect(self.open_file_explorer)
+                self.button_restore.clicked.connect(self.restore_files)
+                self.button_search.clicked.connect(self.search_files)
+                self.button_rescan_sizes.clicked.connect(self.rescan_sizes)
+                self.button_free_space.clicked.connect(self.free_space)
                 self.button_delete_log.clicked.connect(self.delete_logs)
                 self.button_view_log.clicked.connect(self.view_log)
                 self.checkbox_edit_dont_remove_snapshots.clicked.connect(self.dont_remove_snapshots)
@@ -485,6 +604,14 @@ class ButtermanagerMainWindow(QMainWindow):
                 # If everything goes right, the main window is displayed
                 self.show()
 
+                # Starts the space watchdog if the user has enabled it
+                if settings.space_watchdog:
+                    self.__space_watchdog = SpaceWatchdogThread(self.__operation_lock)
+                    self.__space_watchdog.refresh_gui.connect(self.refresh_gui)
+                    self.__space_watchdog.check_started.connect(partial(self.__disable_buttons, operation=False))
+                    self.__space_watchdog.check_finished.connect(partial(self.__enable_buttons, operation=False))
+                    self.__space_watchdog.start()
+
                 # Checks for root snapshot mounted
                 root_snapshot_default = self.__root_snapshot_checker.check_root_snapshot()
                 if root_snapshot_default:
@@ -572,9 +699,9 @@ class ButtermanagerMainWindow(QMainWindow):
         """Runs the balance method.
 
         """
-        self.__balancer = filesystem.BalanceManager(self.__current_filesystem.data_percentage,
-                                                               self.__current_filesystem.metadata_percentage,
-                                                               self.__current_filesystem.mounted_points[0])
+        self.__balancer = balancer.BalanceManager(self.__current_filesystem.data_percentage,
+                                                 self.__current_filesystem.metadata_percentage,
+                                                 self.__current_filesystem.mounted_points[0])
         self.__balancer.show_one_window.connect(self.manage_window)
         # Connecting the signal emitted by the balancer with this slot
         self.__balancer.refresh_filesystem_statistics.connect(self.refresh_filesystem_statistics)
@@ -706,10 +833,34 @@ class ButtermanagerMainWindow(QMainWindow):
         except Exception as exception:
             self.__logger.info("Error saving the log: " + str(exception))
 
-    def __disable_buttons(self):
+    def stop_space_watchdog(self):
+        """Stops the space watchdog and waits until its current check finishes, so a step is never interrupted.
+
+        """
+        if self.__space_watchdog is not None:
+            self.__logger.info("Stopping the space watchdog")
+            self.__space_watchdog.requestInterruption()
+            self.__space_watchdog.wait()
+            self.__space_watchdog = None
+
+    def closeEvent(self, event):
+        """Stops the background threads before the main window is closed.
+
+        Arguments:
+            event (QCloseEvent): The close event.
+        """
+        self.stop_space_watchdog()
+        QMainWindow.closeEvent(self, event)
+
+    def __disable_buttons(self, operation=True):
         """Disables all the buttons of the GUI.
 
+        Arguments:
+            operation (boolean): The GUI is going to run an operation, so it waits until the space watchdog
+            finishes its current check (default True).
         """
+        if operation:
+            self.__operation_running = True
         self.combobox_filesystem.setEnabled(False)
         self.button_balance.setEnabled(False)
         self.button_upgrade_system.setEnabled(False)
@@ -730,6 +881,10 @@ class ButtermanagerMainWindow(QMainWindow):
         self.button_delete_snapshot.setEnabled(False)
         self.button_diff.setEnabled(False)
         self.button_folder.setEnabled(False)
+        self.button_restore.setEnabled(False)
+        self.button_search.setEnabled(False)
+        self.button_rescan_sizes.setEnabled(False)
+        self.button_free_space.setEnabled(False)
         self.button_add_subvolume.setEnabled(False)
         self.button_delete_subvolume.setEnabled(False)
         self.button_edit_subvolume.setEnabled(False)
@@ -737,11 +892,30 @@ class ButtermanagerMainWindow(QMainWindow):
         self.button_view_log.setEnabled(False)
         self.button_delete_log.setEnabled(False)
         self.button_regenerate_grub.setEnabled(False)
+        if operation and not self.__operation_lock_held and not self.__operation_lock_waiting:
+            # Events are processed meanwhile, so the GUI is not frozen
+            self.__operation_lock_waiting = True
+            try:
+                while not self.__operation_lock.acquire(timeout=0.1):
+                    QtWidgets.QApplication.processEvents()
+            finally:
+                self.__operation_lock_waiting = False
+            if self.__operation_running:
+                self.__operation_lock_held = True
+            else:
+                # The operation finished while the lock was being acquired
+                self.__operation_lock.release()
 
-    def __enable_buttons(self):
+    def __enable_buttons(self, operation=True):
         """Enable all the buttons of the GUI.
 
+        Arguments:
+            operation (boolean): An operation of the GUI has finished (default True). Otherwise, the buttons are
+            kept disabled while an operation of the GUI is running.
         """
+        if not operation and self.__operation_running:
+            return
+        self.__operation_running = False
         self.combobox_filesystem.setEnabled(True)
         self.button_balance.setEnabled(True)
         self.button_upgrade_system.setEnabled(True)
@@ -762,6 +936,10 @@ class ButtermanagerMainWindow(QMainWindow):
         self.button_delete_snapshot.setEnabled(True)
         self.button_diff.setEnabled(True)
         self.button_folder.setEnabled(True)
+        self.button_restore.setEnabled(True)
+        self.button_search.setEnabled(True)
+        self.button_rescan_sizes.setEnabled(True)
+        self.button_free_space.setEnabled(True)
         self.button_add_subvolume.setEnabled(True)
         self.button_delete_subvolume.setEnabled(True)
         self.button_edit_subvolume.setEnabled(True)
@@ -769,6 +947,9 @@ class ButtermanagerMainWindow(QMainWindow):
         self.button_view_log.setEnabled(True)
         self.button_delete_log.setEnabled(True)
         self.button_regenerate_grub.setEnabled(True)
+        if self.__operation_lock_held:
+            self.__operation_lock_held = False
+            self.__operation_lock.release()
 
     def take_snapshot(self):
         """Takes a BTRFS subvolume snapshot.
@@ -796,8 +977,7 @@ class ButtermanagerMainWindow(QMainWindow):
         QtTest.QTest.qWait(10)
 
         snapshots_to_delete = self.list_snapshots.selectedItems()
-        for snap in snapshots_to_delete:
-            snapshot.delete_specific_snapshot(snap.text())
+        snapshot.delete_specific_snapshots([snap.text(0) for snap in snapshots_to_delete], console=False)
 
         # Refreshing GUI
         self.refresh_gui()
@@ -805,17 +985,67 @@ class ButtermanagerMainWindow(QMainWindow):
         # Enabling buttons
         self.__enable_buttons()
 
+    def free_space(self):
+        """Deletes the smallest set of snapshots needed to free a specific amount of space.
+
+        """
+        # Disabling buttons
+        self.__disable_buttons()
+
+        # The user has to introduce the space to free and accept the plan
+        pruning_window = windows.PruningWindow(self)
+        if pruning_window.exec_() == 1:
+            # Waiting 10 msec in order to let the pruning window to be closed
+            QtTest.QTest.qWait(10)
+            pruning_window.pruning_plan.apply()
+
+            # Refreshing GUI
+            self.refresh_gui()
+
+        # Enabling buttons
+        self.__enable_buttons()
+
     def find_diffs(self):
         """Find differences between the snapshot selected and the current state of the subvolume related to it.
+        If two snapshots are selected, the differences between both snapshots will be found.
 
         """
         snapshot_to_diff = self.list_snapshots.selectedItems()
-        if len(snapshot_to_diff) != 1:
-            # Only one snapshot can be selected
-            info_dialog = windows.GeneralInfoWindow(self, "Please, select one (and only one) snapshot\n"
-                                                                 "in order to find the differences between\n"
-                                                                 "it and the current subvolume.")
+        if len(snapshot_to_diff) not in (1, 2):
+            # Only one or two snapshots can be selected
+            info_dialog = windows.GeneralInfoWindow(self, "Please, select one snapshot in order to find\n"
+                                                                 "the differences between it and the current\n"
+                                                                 "subvolume, or two snapshots in order to\n"
+                                                                 "find the differences between them.")
             info_dialog.show()
+        elif len(snapshot_to_diff) == 2:
+            # Both snapshots are compared using their file indexes, so they must be snapshots of the same
+            # subvolume. The newest one (by creation generation) is compared against the oldest one
+            snapshots_info = [(ioctl.get_subvolume_info(item.text(0)), item.text(0)) for item in snapshot_to_diff]
+            if any(info is None for info, _ in snapshots_info) or \
+                    snapshots_info[0][0].parent_uuid != snapshots_info[1][0].parent_uuid:
+                info_dialog = windows.GeneralInfoWindow(self, "Please, select two snapshots of the same\n"
+                                                              "subvolume in order to find the differences\n"
+                                                              "between them.")
+                info_dialog.show()
+                return
+
+            # Disabling buttons
+            self.__disable_buttons()
+
+            snapshots_info.sort(key=lambda snapshot_info: (snapshot_info[0].otransid or 0, snapshot_info[0].otime or 0))
+            oldest_snapshot, newest_snapshot = [snapshot_full_path for _, snapshot_full_path in snapshots_info]
+            self.__differentiator = differentiator.Differentiator(
+                oldest_snapshot,
+                differentiator.Differentiator.OPERATION_SNAPSHOTS,
+                newest_snapshot)
+            self.__differentiator.show_one_window.connect(self.manage_window)
+            self.__differentiator.differences_found.connect(self.show_differences)
+            self.__differentiator.differences_failed.connect(self.show_differences_error)
+            self.__differentiator.start()
+
+            # Enabling buttons
+            self.__enable_buttons()
         else:
             # Disabling buttons
             self.__disable_buttons()
@@ -833,16 +1063,23 @@ class ButtermanagerMainWindow(QMainWindow):
             diff_process = diff_window.exec_()
             if diff_process == 1:
                 # A full operation will be done
-                self.__differentiator = snapshot.Differentiator(
-                    snapshot_to_diff[0].text(),
-                    snapshot.Differentiator.OPERATION_FULL)
+                self.__differentiator = differentiator.Differentiator(
+                    snapshot_to_diff[0].text(0),
+                    differentiator.Differentiator.OPERATION_FULL)
             elif diff_process == 2:
                 # A partial operation will be done
-                self.__differentiator = snapshot.Differentiator(
-                    snapshot_to_diff[0].text(),
-                    snapshot.Differentiator.OPERATION_PARTIAL)
+                self.__differentiator = differentiator.Differentiator(
+                    snapshot_to_diff[0].text(0),
+                    differentiator.Differentiator.OPERATION_PARTIAL)
+            elif diff_process == 3:
+                # A full operation will be done parsing the send stream
+                self.__differentiator = differentiator.Differentiator(
+                    snapshot_to_diff[0].text(0),
+                    differentiator.Differentiator.OPERATION_SEND)
 
             self.__differentiator.show_one_window.connect(self.manage_window)
+            self.__differentiator.differences_found.connect(self.show_differences)
+            self.__differentiator.differences_failed.connect(self.show_differences_error)
             self.__differentiator.start()
 
             # Refreshing GUI
@@ -854,6 +1091,36 @@ class ButtermanagerMainWindow(QMainWindow):
             # Showing main window again
             self.show()
 
+    def show_differences(self, results_path):
+        """Shows the differences found in a new window.
+
+        Arguments:
+            results_path (str): Full path to the file which stores the differences.
+        """
+        diff_viewer_window = windows.DiffViewerWindow(self, results_path)
+        diff_viewer_window.show()
+
+    def show_differences_error(self, error):
+        """Shows the error found calculating the differences.
+
+        Arguments:
+            error (str): Error found.
+        """
+        self.__logger.error("Error calculating differences: {error}".format(error=error))
+        info_dialog = windows.GeneralInfoWindow(self, "The differences couldn't be calculated.\n"
+                                                      "Error: {error}".format(error=error))
+        info_dialog.show()
+
+    def search_files(self):
+        """Searches files by name across all the snapshots of the subvolumes defined.
+
+        """
+        snapshots_full_paths = []
+        for subvolume_key in settings.subvolumes:
+            snapshots_full_paths.extend(settings.subvolumes[subvolume_key].get_all_snapshots_with_the_same_name())
+        search_window = windows.SearchWindow(self, snapshots_full_paths)
+        search_window.exec_()
+
     def open_file_explorer(self):
         """Opens a file explorer to see all the files within a snapshot.
 
@@ -865,7 +1132,44 @@ class ButtermanagerMainWindow(QMainWindow):
                                                                  "in order to open the file explorer.")
             info_dialog.show()
         else:
-            subprocess.call(['xdg-open', snapshots_selected[0].text()])
+            subprocess.call(['xdg-open', snapshots_selected[0].text(0)])
+
+    def restore_files(self):
+        """Restores a file or a directory from the snapshot selected into its subvolume.
+
+        """
+        snapshots_selected = self.list_snapshots.selectedItems()
+        subvolume = snapshot.get_subvolume_by_snapshot_name(snapshots_selected[0].text(0)) \
+            if len(snapshots_selected) == 1 else None
+        if subvolume is None:
+            # Only one snapshot can be selected
+            info_dialog = windows.GeneralInfoWindow(self, "Please, select one (and only one) snapshot \n"
+                                                                 "in order to restore files from it.")
+            info_dialog.show()
+            return
+
+        # Disabling buttons
+        self.__disable_buttons()
+
+        # The user has to introduce the path to restore and accept the plan
+        restore_window = windows.RestoreWindow(self, snapshots_selected[0].text(0), subvolume)
+        if restore_window.exec_() == 1:
+            # Waiting 10 msec in order to let the restore window to be closed
+            QtTest.QTest.qWait(10)
+            restore_plan = restore_window.restore_plan
+            restored = restore_plan.apply()
+            information = "{restored} entries restored: {cloned} files cloned \nand {copied} copied.".format(
+                restored=len(restored), cloned=restore_plan.cloned, copied=restore_plan.copied)
+            if restore_plan.errors:
+                information += "\n{errors} errors found. Please, check the log.".format(
+                    errors=len(restore_plan.errors))
+                self.__logger.error("Errors restoring files:\n{errors}".format(errors="\n".join(
+                    "{0}: {1}".format(path, error) for path, error in sorted(restore_plan.errors.items()))))
+            info_dialog = windows.GeneralInfoWindow(self, information)
+            info_dialog.show()
+
+        # Enabling buttons
+        self.__enable_buttons()
 
     def delete_logs(self):
         """Deletes one or several logs.
@@ -1079,13 +1383,65 @@ class ButtermanagerMainWindow(QMainWindow):
         # Clearing the list
         self.list_snapshots.clear()
 
-        # Adding the snapshots to the list
-        snapshots = []
-        self.list_snapshots.addItems(snapshots)
         # Loading the snapshots detected
-        for subvolume in settings.subvolumes:
-            snapshots.extend(settings.subvolumes[subvolume].get_all_snapshots_with_the_same_name())
-        self.list_snapshots.addItems(snapshots)
+        snapshot_catalog = catalog.SnapshotCatalog()
+        snapshot_catalog.refresh()
+        # Sorting is disabled while the list is filled, so rows are not moved while they are added
+        self.list_snapshots.setSortingEnabled(False)
+        for entry in snapshot_catalog.entries:
+            item = SnapshotItem([entry.snapshot_full_path, "", ""])
+            qgroup_cache = self.__get_qgroup_cache(entry.subvolume.subvolume_dest)
+            usage = qgroup_cache.get(entry.subvolume_id) if qgroup_cache is not None else None
+            if usage is not None:
+                for column, size in ((1, usage.referenced), (2, usage.exclusive)):
+                    item.setText(column, utils.convert_from_bytes(size))
+                    item.setData(column, Qt.UserRole, size)
+                    item.setTextAlignment(column, Qt.AlignRight | Qt.AlignVCenter)
+            self.list_snapshots.addTopLevelItem(item)
+        self.list_snapshots.setSortingEnabled(True)
+        self.list_snapshots.resizeColumnToContents(0)
+
+    def __get_qgroup_cache(self, path):
+        """Gets the cache of the size of the snapshots of the filesystem a path belongs to. The cache is refreshed
+        the first time it is requested after refreshing the GUI.
+
+        Arguments:
+            path (str): Path within the filesystem, f.i.: /mnt/defvol/_snapshots.
+
+        Returns:
+            filesystem.qgroup.QgroupCache: The cache. None if the size of the snapshots can't be retrieved.
+        """
+        if path not in self.__qgroup_caches:
+            try:
+                qgroup_cache = qgroup.QgroupCache(path)
+                qgroup_cache.refresh()
+            except OSError as os_error_exception:
+                self.__logger.error("Error retrieving the size of the snapshots: {error}".format(
+                    error=str(os_error_exception)))
+                qgroup_cache = None
+            self.__qgroup_caches[path] = qgroup_cache
+        return self.__qgroup_caches[path]
+
+    def rescan_sizes(self):
+        """Rescans the quota groups in order to refresh the size of the snapshots.
+
+        """
+        # Every filesystem is rescanned only once
+        qgroup_caches = list({qgroup_cache.uuid: qgroup_cache for qgroup_cache in self.__qgroup_caches.values()
+                              if qgroup_cache is not None and qgroup_cache.enabled}.values())
+        if not qgroup_caches:
+            info_dialog = windows.GeneralInfoWindow(self, "Quotas are not enabled, so the size of the snapshots\n"
+                                                          "can't be calculated. Please, enable them using\n"
+                                                          "'btrfs quota enable' command.")
+            info_dialog.show()
+        else:
+            # Disabling buttons
+            self.__disable_buttons()
+            self.__qgroup_rescanner = QgroupRescanner(qgroup_caches)
+            self.__qgroup_rescanner.progress.connect(self.statusbar.showMessage)
+            self.__qgroup_rescanner.refresh_gui.connect(self.refresh_gui)
+            self.__qgroup_rescanner.finished.connect(self.__enable_buttons)
+            self.__qgroup_rescanner.start()
 
     def fill_logs(self):
         """Fills logs in the GUI.
@@ -1164,6 +1520,8 @@ class ButtermanagerMainWindow(QMainWindow):
 
         """
         self.refresh_filesystem_statistics()
+        # The size of the snapshots will be refreshed
+        self.__qgroup_caches = {}
         self.fill_snapshots()
         self.fill_logs()
         self.fill_subvolumes()
@@ -1212,7 +1570,8 @@ class ButtermanagerMainWindow(QMainWindow):
         QtTest.QTest.qWait(100)
 
         # Run grub-btrfs in order to regenerate GRUB entries
-        utils.execute_command(snapshot.GRUB_BTRFS_COMMAND, console=True, root=True)
+        # The user has asked for it explicitly, so the whole menu is generated again
+        elapsed = settings.grub_regenerator.regenerate(full=True)
 
         # Refreshing GUI
         self.refresh_gui()
@@ -1221,5 +1580,6 @@ class ButtermanagerMainWindow(QMainWindow):
         self.__enable_buttons()
 
         # Displaying info
-        info_dialog = windows.GeneralInfoWindow(self, "GRUB menu has been regenerated.")
+        info_dialog = windows.GeneralInfoWindow(self, "GRUB menu has been regenerated in {elapsed:.2f} "
+                                                      "seconds.".format(elapsed=elapsed))
         info_dialog.show()
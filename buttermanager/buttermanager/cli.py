@@ -0,0 +1,890 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to the command line interface.
+
+It never imports PyQt5, and the rest of ButterManager is imported only when a subcommand needs it, so it starts
+fast enough to be run from cron, ssh sessions or package manager hooks on systems without a display.
+"""
+import argparse
+import contextlib
+import json
+import os
+import re
+import sys
+
+# Constants
+STATUS = "status"
+SNAPSHOT = "snapshot"
+PRUNE = "prune"
+BALANCE = "balance"
+DIFF = "diff"
+UPGRADE = "upgrade"
+HOOK = "hook"
+SEARCH = "search"
+HISTORY = "history"
+RESTORE = "restore"
+COMMANDS = (STATUS, SNAPSHOT, PRUNE, BALANCE, DIFF, UPGRADE, HOOK, SEARCH, HISTORY, RESTORE)
+# Options that make buttermanager run the command line interface instead of the GUI
+CLI_OPTIONS = ("-h", "--help", "--json")
+# Sizes accepted by prune command, f.i.: 10GiB, 512MiB, 1073741824
+SIZE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*(GiB|MiB|KiB|B)?\s*$")
+SUDO_CHECK_COMMAND = ["sudo", "-n", "true"]
+SUDO_VALIDATE_COMMAND = ["sudo", "-S", "-v"]
+# Package managers whose transactions can be hooked
+HOOK_SOURCES = ("pacman", "apt", "dnf", "zypper")
+# Processes that start a package manager transaction (their PID identifies the transaction)
+TRANSACTION_PROCESSES = ("pacman", "apt", "apt-get", "aptitude", "dnf", "dnf-3", "yum", "zypper")
+# Hooks run as root, so their lock and state live in /run and they are forgotten on reboot
+HOOK_LOCK_PATH = "/run/buttermanager-hook.lock"
+HOOK_STATE_PATH = "/run/buttermanager-hook.json"
+# Seconds after a hook snapshot while new hooks whose transaction can't be identified are coalesced
+HOOK_COALESCE_WINDOW = 30
+
+
+# Module's methods
+def is_command_line(arguments):
+    """Checks if the arguments given to buttermanager ask for the command line interface.
+
+    Arguments:
+        arguments (:obj:`list` of :obj:`str`): Arguments without the name of the program (sys.argv[1:]).
+
+    Returns:
+        bool: True if the command line interface has to be run; False if the GUI has to be started.
+    """
+    return bool(arguments) and (arguments[0] in COMMANDS or arguments[0] in CLI_OPTIONS)
+
+
+def get_parser():
+    """Builds the parser of the command line interface.
+
+    Returns:
+        argparse.ArgumentParser: The parser.
+    """
+    parser = argparse.ArgumentParser(prog="buttermanager",
+                                     description="Manages BTRFS filesystems, subvolumes and snapshots. "
+                                                 "Run it without arguments to start the graphical interface.")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    subparsers.add_parser(STATUS, help="show the space used by the filesystems and the snapshots of every subvolume")
+
+    snapshot_parser = subparsers.add_parser(SNAPSHOT, help="take a snapshot of the subvolumes")
+    snapshot_parser.add_argument("subvolumes", nargs="*", metavar="subvolume",
+                                 help="origin of the subvolumes (default all the subvolumes defined)")
+    snapshot_parser.add_argument("--no-delete", action="store_true", help="don't delete the old snapshots")
+
+    prune_parser = subparsers.add_parser(PRUNE, help="delete snapshots in order to free space or according to the "
+                                                     "retention policies")
+    prune_parser.add_argument("size", nargs="?", help="space to free, f.i.: 10GiB, 512MiB or a number of bytes")
+    prune_parser.add_argument("--retention", action="store_true",
+                              help="delete the snapshots not kept by the retention policies of the subvolumes instead")
+    prune_parser.add_argument("--dry-run", action="store_true", help="only show the snapshots that would be deleted")
+
+    balance_parser = subparsers.add_parser(BALANCE, help="balance the filesystems")
+    balance_parser.add_argument("mount_points", nargs="*", metavar="mount_point",
+                                help="mount point of the filesystems (default all the mounted BTRFS filesystems)")
+    balance_parser.add_argument("--data", type=int, help="usage filter for data chunks (default current usage)")
+    balance_parser.add_argument("--metadata", type=int,
+                                help="usage filter for metadata chunks (default current usage)")
+
+    diff_parser = subparsers.add_parser(DIFF, help="list the files modified since a snapshot was taken")
+    diff_parser.add_argument("snapshot", help="full path to the snapshot")
+    diff_parser.add_argument("--full", action="store_true",
+                             help="compare both trees, so files created and deleted are listed too")
+    diff_parser.add_argument("--send", action="store_true",
+                             help="like --full, but parsing the metadata sent by 'btrfs send --no-data'")
+    diff_parser.add_argument("--against", metavar="SNAPSHOT",
+                             help="compare with another snapshot using their file indexes instead of the subvolume")
+    diff_parser.add_argument("--bytes", action="store_true",
+                             help="list also the bytes written in every file modified (not with --full)")
+    diff_parser.add_argument("--no-cache", action="store_true",
+                             help="calculate the differences again even if they are in the diff cache")
+    diff_parser.add_argument("--subvolume", metavar="SUBVOLUME",
+                             help="full path to the subvolume compared with the snapshot (default the subvolume "
+                                  "the snapshot belongs to)")
+    diff_parser.add_argument("--stream", action="store_true",
+                             help="print every difference found by a full comparison as soon as it is found, as a "
+                                  "JSON array per line (the diff cache is not used)")
+
+    upgrade_parser = subparsers.add_parser(UPGRADE, help="upgrade the system")
+    upgrade_parser.add_argument("--no-snapshots", action="store_true", help="don't take snapshots before upgrading")
+    upgrade_parser.add_argument("--no-aur", action="store_true", help="don't upgrade AUR packages")
+    upgrade_parser.add_argument("--no-snap", action="store_true", help="don't upgrade snap packages")
+    upgrade_parser.add_argument("--no-flatpak", action="store_true", help="don't upgrade flatpak packages")
+
+    search_parser = subparsers.add_parser(SEARCH, help="search files across the snapshots of the subvolumes")
+    search_parser.add_argument("query", help="name (f.i.: '*.conf') or path (f.i.: 'etc/pacman.d/*') of the files")
+    search_parser.add_argument("--regex", action="store_true", help="the query is a regular expression")
+    search_parser.add_argument("--no-index", action="store_true",
+                               help="don't index the snapshots which are not indexed yet, so they are skipped")
+
+    history_parser = subparsers.add_parser(HISTORY, help="list every distinct version of a file across the "
+                                                         "snapshots of its subvolume")
+    history_parser.add_argument("path", help="path of the file, f.i.: /etc/nginx/nginx.conf")
+    history_parser.add_argument("--no-diff", action="store_true",
+                                help="don't show the differences between consecutive versions")
+
+    restore_parser = subparsers.add_parser(RESTORE, help="restore a file or directory from a snapshot into its "
+                                                         "subvolume")
+    restore_parser.add_argument("snapshot", help="full path to the snapshot")
+    restore_parser.add_argument("path", help="path of the file or directory within the snapshot, f.i.: /etc/nginx")
+    restore_parser.add_argument("--conflicts", choices=("overwrite", "skip", "backup"), default="overwrite",
+                                help="what to do with the files which exist and are different within the subvolume: "
+                                     "overwrite them, keep them or keep them with a numbered backup name "
+                                     "(default overwrite)")
+    restore_parser.add_argument("--dry-run", action="store_true", help="only show what would be restored")
+
+    hook_parser = subparsers.add_parser(HOOK, help="take the snapshots before a package manager transaction "
+                                                   "(used by the package manager hooks)")
+    hook_parser.add_argument("source", choices=HOOK_SOURCES, help="package manager that runs the hook")
+    hook_parser.add_argument("--post", action="store_true",
+                             help="run after the transaction: delete the old snapshots and regenerate GRUB entries")
+    return parser
+
+
+def get_command(arguments):
+    """Builds the command which runs the command line interface in another process using the same Python
+    interpreter, f.i.: to run it as root through sudo.
+
+    Arguments:
+        arguments (:obj:`list` of :obj:`str`): Arguments of the command line interface.
+
+    Returns:
+        tuple (:obj:`list` of :obj:`str`, str): the command and the directory it has to be run from, so the
+        package is found even if ButterManager is not installed.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for _ in __package__.split("."):
+        directory = os.path.dirname(directory)
+    return [sys.executable, "-m", "{package}.cli".format(package=__package__)] + arguments, directory
+
+
+def request_privileges():
+    """Makes sure the commands run through sudo will work. If the user is not root and sudo needs a password,
+    it is asked once and stored in settings.user_password as the password window does.
+
+    Returns:
+        bool: True if the commands can be run as root.
+    """
+    from .util import settings
+    import getpass
+    import subprocess
+
+    if os.geteuid() == 0:
+        return True
+    if subprocess.run(SUDO_CHECK_COMMAND, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+        return True
+    if not sys.stdin.isatty():
+        return False
+    settings.user_password = getpass.getpass("[sudo] password for {user}: ".format(user=getpass.getuser()))
+    result = subprocess.run(SUDO_VALIDATE_COMMAND, input=settings.user_password + "\n", stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL, universal_newlines=True)
+    return result.returncode == 0
+
+
+def parse_size(size):
+    """Converts a size given by the user into bytes.
+
+    Arguments:
+        size (str): Size, f.i.: 10GiB, 512MiB or 1073741824.
+
+    Returns:
+        int: Number of bytes.
+
+    >>> parse_size("1GiB")
+    1073741824
+    """
+    from .util import utils
+
+    match = SIZE_PATTERN.match(size)
+    if match is None:
+        raise ValueError("Invalid size '{size}'. Use f.i.: 10GiB, 512MiB or a number of bytes".format(size=size))
+    return int(utils.convert_to_bytes({'number': float(match.group(1)), 'unit': match.group(2) or utils.B}))
+
+
+def get_transaction_id(pid=None):
+    """Identifies the package manager transaction that runs the hook, looking for the nearest ancestor process
+    which is a package manager. Start time is included, so a PID reused later is a different transaction.
+
+    Arguments:
+        pid (int): PID of the first process to check (default the parent process).
+
+    Returns:
+        str: Transaction identifier, f.i.: 1234-567890. None if no package manager is found.
+    """
+    pid = os.getppid() if pid is None else pid
+    while pid > 1:
+        try:
+            with open("/proc/{pid}/stat".format(pid=pid), 'r') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            return None
+        # pid (comm) state ppid ... starttime. comm can contain spaces and parentheses
+        name = stat[stat.index("(") + 1:stat.rindex(")")]
+        fields = stat[stat.rindex(")") + 2:].split()
+        if name in TRANSACTION_PROCESSES:
+            return "{pid}-{start}".format(pid=pid, start=fields[19])
+        pid = int(fields[1])
+    return None
+
+
+def run_status(arguments):
+    """Retrieves the space used by every mounted BTRFS filesystem and the snapshots of every subvolume.
+    Space is read from sysfs, so no privilege is needed.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        dictionary: The status.
+    """
+    from .filesystem import timeline, watchdog
+    from .util import settings
+
+    filesystems = []
+    for uuid, mount_point in sorted(watchdog.get_mount_points().items(), key=lambda item: item[1]):
+        try:
+            usage = watchdog.read_space_usage(uuid)
+        except OSError:
+            continue
+        filesystems.append({"uuid": uuid, "mount_point": mount_point, "total": usage.total,
+                            "allocated": usage.allocated, "allocated_percentage": usage.allocated_percentage,
+                            "data_total": usage.data_total, "data_used": usage.data_used,
+                            "metadata_total": usage.metadata_total, "metadata_used": usage.metadata_used,
+                            "metadata_percentage": usage.metadata_percentage})
+
+    subvolumes = []
+    for subvolume_origin in sorted(settings.subvolumes):
+        subvolume = settings.subvolumes[subvolume_origin]
+        try:
+            snapshots = subvolume.get_all_snapshots_with_the_same_name()
+        except OSError:
+            snapshots = []
+        subvolumes.append({"origin": subvolume.subvolume_origin, "destination": subvolume.subvolume_dest,
+                           "snapshots": len(snapshots), "latest": snapshots[-1] if snapshots else None})
+
+    next_run = None
+    try:
+        with open(os.path.join(settings.application_path, timeline.STATE_FILE), 'r') as state_file:
+            next_run = json.load(state_file).get("next_run")
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    return {"filesystems": filesystems, "subvolumes": subvolumes,
+            "timeline": {"enabled": bool(settings.timeline), "next_run": next_run},
+            "space_watchdog": bool(settings.space_watchdog)}
+
+
+def run_snapshot(arguments):
+    """Takes a snapshot of the subvolumes and deletes the old ones.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        dictionary: Subvolumes whose snapshot has been taken and errors found.
+    """
+    from .util import settings
+
+    origins = [origin if origin.endswith('/') else origin + '/' for origin in arguments.subvolumes]
+    unknown = [origin for origin in origins if origin not in settings.subvolumes]
+    if unknown:
+        raise ValueError("Subvolumes not defined in ButterManager: {subvolumes}".format(subvolumes=", ".join(unknown)))
+
+    snapshots = []
+    errors = {}
+    # GRUB entries will be regenerated only once, when all the snapshots have been taken
+    settings.grub_regenerator.hold()
+    try:
+        for subvolume_origin in origins or sorted(settings.subvolumes):
+            subvolume = settings.subvolumes[subvolume_origin]
+            try:
+                subvolume.create_snapshot()
+                if not arguments.no_delete:
+                    subvolume.delete_snapshots()
+                snapshots.append(subvolume.subvolume_origin)
+            except Exception as general_exception:
+                errors[subvolume.subvolume_origin] = str(general_exception)
+    finally:
+        settings.grub_regenerator.release()
+        settings.grub_regenerator.flush()
+    return {"subvolumes": snapshots, "errors": errors}
+
+
+def run_prune(arguments):
+    """Deletes the smallest set of snapshots needed to free the space requested or, if --retention is used, the
+    snapshots not kept by the retention policies.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        dictionary: The pruning plan and the snapshots deleted.
+    """
+    from .filesystem import pruning
+    from .util import settings
+
+    if arguments.retention:
+        return run_retention(arguments)
+    if arguments.size is None:
+        raise ValueError("The space to free is needed unless --retention is used")
+
+    pruning_plan = pruning.PruningPlanner().plan(parse_size(arguments.size))
+    deleted = []
+    if not arguments.dry_run:
+        settings.grub_regenerator.hold()
+        try:
+            deleted = pruning_plan.apply()
+        finally:
+            settings.grub_regenerator.release()
+            settings.grub_regenerator.flush()
+    return {"target": pruning_plan.target, "reclaimed": pruning_plan.reclaimed, "reached": pruning_plan.reached,
+            "snapshots": [{"path": candidate.snapshot_full_path, "exclusive": candidate.exclusive}
+                          for candidate in pruning_plan.candidates],
+            "deleted": deleted, "dry_run": arguments.dry_run}
+
+
+def run_retention(arguments):
+    """Deletes the snapshots not kept by the retention policies of the subvolumes. Subvolumes without a retention
+    policy are skipped.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        dictionary: The snapshots kept and deleted (or that would be deleted) of every subvolume.
+    """
+    from .filesystem import retention
+    from .util import settings
+
+    subvolumes = []
+    # GRUB entries will be regenerated only once, when the snapshots of all the subvolumes have been deleted
+    settings.grub_regenerator.hold()
+    try:
+        for subvolume_origin in sorted(settings.subvolumes):
+            subvolume = settings.subvolumes[subvolume_origin]
+            if subvolume.retention is None:
+                continue
+            snapshots = subvolume.get_all_snapshots_with_the_same_name()
+            deleted = retention.RetentionEngine(subvolume, subvolume.retention).apply(dry_run=arguments.dry_run)
+            subvolumes.append({"origin": subvolume.subvolume_origin, "policy": str(subvolume.retention),
+                               "kept": [snapshot_full_path for snapshot_full_path in snapshots
+                                        if snapshot_full_path not in deleted],
+                               "deleted": deleted})
+    finally:
+        settings.grub_regenerator.release()
+        settings.grub_regenerator.flush()
+    return {"retention": True, "subvolumes": subvolumes, "dry_run": arguments.dry_run}
+
+
+def run_balance(arguments):
+    """Balances the filesystems using usage filters. By default, the current usage percentages are used as the
+    filters, like the balance button of the main window does.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        dictionary: Filters used for every mount point balanced.
+    """
+    from .filesystem import filesystem, watchdog
+
+    mount_points = dict((mount_point, uuid) for uuid, mount_point in watchdog.get_mount_points().items())
+    balanced = []
+    for mount_point in arguments.mount_points or sorted(mount_points):
+        data = arguments.data
+        metadata = arguments.metadata
+        uuid = mount_points.get(mount_point)
+        if (data is None or metadata is None) and uuid is not None:
+            usage = watchdog.read_space_usage(uuid)
+            if data is None:
+                data = int(usage.data_used * 100 / usage.data_total) if usage.data_total else 0
+            if metadata is None:
+                metadata = usage.metadata_percentage
+        data = 50 if data is None else data
+        metadata = 50 if metadata is None else metadata
+        filesystem.balance_filesystem(filesystem.BTRFS_BALANCE_DATA_USAGE_FILTER, data, mount_point)
+        filesystem.balance_filesystem(filesystem.BTRFS_BALANCE_METADATA_USAGE_FILTER, metadata, mount_point)
+        balanced.append({"mount_point": mount_point, "data": data, "metadata": metadata})
+    return {"balanced": balanced}
+
+
+def get_diff_origin(arguments):
+    """Calculates what the snapshot given to the diff command has to be compared with.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        tuple (str, str): full path to the subvolume (or the other snapshot) and kind of comparison.
+    """
+    from .filesystem import diffcache, snapshot
+
+    if arguments.against:
+        # Both snapshots are compared, so the other snapshot takes the place of the subvolume
+        return arguments.against.rstrip('/'), diffcache.INDEX
+    if arguments.subvolume:
+        origin = arguments.subvolume.rstrip('/') or "/"
+    else:
+        subvolume = snapshot.get_subvolume_by_snapshot_name(arguments.snapshot.rstrip('/'))
+        if subvolume is None:
+            raise ValueError("{snapshot} is not a snapshot of any subvolume defined in ButterManager".format(
+                snapshot=arguments.snapshot.rstrip('/')))
+        origin = subvolume.subvolume_origin
+    return origin, diffcache.SEND if arguments.send else diffcache.FULL if arguments.full else diffcache.PARTIAL
+
+
+def run_diff(arguments):
+    """Lists the files modified in a subvolume since one of its snapshots was taken. A full (or send stream)
+    comparison lists also the files that only exist in the subvolume or in the snapshot. Two snapshots can be
+    compared too: the second one ('--against') takes the place of the subvolume.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        dictionary: The subvolume and the files modified.
+    """
+    from .filesystem import diff, diffcache
+
+    snapshot_full_path = arguments.snapshot.rstrip('/')
+    origin, mode = get_diff_origin(arguments)
+    differences = diff.get_differences(origin, snapshot_full_path, mode, use_cache=not arguments.no_cache)
+    result = {"snapshot": snapshot_full_path, "subvolume": origin}
+    result.update(differences)
+    if mode == diffcache.PARTIAL and not arguments.bytes:
+        result.pop("bytes")
+    return result
+
+
+def stream_diff(arguments):
+    """Prints the differences found by a full comparison as soon as they are found, one [category, path] JSON
+    array per line. The GUI runs it through sudo, so both trees are walked as root without keeping the
+    differences in memory.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        int: Exit status.
+    """
+    from .filesystem import diff, diffcache
+
+    try:
+        origin, mode = get_diff_origin(arguments)
+        if mode != diffcache.FULL:
+            raise ValueError("Only full comparisons (--full) can be streamed")
+        for category, file_path in diff.compare_trees(origin, arguments.snapshot.rstrip('/')):
+            sys.stdout.write(json.dumps([category, file_path]) + "\n")
+        sys.stdout.flush()
+    except Exception as general_exception:
+        sys.stderr.write("Error: {error}\n".format(error=str(general_exception)))
+        return 1
+    return 0
+
+
+def run_search(arguments):
+    """Searches files across the snapshots of all the subvolumes defined. Snapshots which are not indexed yet
+    are indexed first.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        dictionary: The snapshots which contain every file found and the snapshots not searched.
+    """
+    from .filesystem import fileindex
+    from .util import settings
+
+    snapshots_full_paths = []
+    for subvolume_key in settings.subvolumes:
+        snapshots_full_paths.extend(settings.subvolumes[subvolume_key].get_all_snapshots_with_the_same_name())
+    if not arguments.no_index:
+        for snapshot_full_path in snapshots_full_paths:
+            index_path = fileindex.get_stored_index_path(snapshot_full_path)
+            if index_path is not None and not os.path.exists(index_path):
+                fileindex.store_index(snapshot_full_path, index_path)
+
+    found, not_indexed = fileindex.search_snapshots(snapshots_full_paths, arguments.query, arguments.regex)
+    files = {}
+    for file_path in sorted(found):
+        files[file_path] = [{"snapshot": snapshot_full_path, "size": size, "mtime": mtime / 1e9}
+                            for snapshot_full_path, size, mtime, _ in found[file_path]]
+    return {"query": arguments.query, "files": files, "not_indexed": not_indexed}
+
+
+def run_history(arguments):
+    """Lists every distinct version of a file across the snapshots of its subvolume (and the subvolume itself),
+    with the differences between consecutive versions.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        dictionary: The subvolume, the path of the file within it and its versions, oldest first.
+    """
+    from .filesystem import history
+
+    subvolume, relative_path = history.get_relative_path(arguments.path)
+    if subvolume is None:
+        raise ValueError("{path} is not within any subvolume defined in ButterManager".format(path=arguments.path))
+    versions = history.get_file_history(subvolume.get_all_snapshots_with_the_same_name(), relative_path,
+                                        subvolume.subvolume_origin)
+    result = {"subvolume": subvolume.subvolume_origin, "path": relative_path, "versions": []}
+    for position, version in enumerate(versions):
+        version_result = {"snapshots": version.snapshots, "size": version.size, "mtime": version.mtime / 1e9,
+                          "mode": version.mode}
+        if position > 0 and not arguments.no_diff:
+            version_result["diff"] = history.get_version_diff(versions[position - 1], version)
+        result["versions"].append(version_result)
+    return result
+
+
+def run_restore(arguments):
+    """Restores a file or a directory from a snapshot into its subvolume, cloning the files when possible.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        dictionary: The entries of the plan, the entries restored, how they were restored and the errors found.
+    """
+    from .filesystem import restore, snapshot
+
+    snapshot_full_path = arguments.snapshot.rstrip('/')
+    subvolume = snapshot.get_subvolume_by_snapshot_name(snapshot_full_path)
+    if subvolume is None:
+        raise ValueError("{snapshot} is not a snapshot of any subvolume defined in ButterManager".format(
+            snapshot=snapshot_full_path))
+    restore_plan = restore.plan_restore(snapshot_full_path, subvolume.subvolume_origin, arguments.path,
+                                        arguments.conflicts)
+    result = {"snapshot": snapshot_full_path, "subvolume": subvolume.subvolume_origin,
+              "path": restore_plan.relative_path, "conflicts": restore_plan.conflicts, "dry_run": arguments.dry_run,
+              "entries": [{"path": entry.relative_path, "action": entry.action, "size": entry.size}
+                          for entry in restore_plan.entries if entry.action != restore.UNCHANGED],
+              "size": restore_plan.size}
+    if not arguments.dry_run:
+        result["restored"] = restore_plan.apply()
+        result["cloned"] = restore_plan.cloned
+        result["copied"] = restore_plan.copied
+        result["errors"] = restore_plan.errors
+    return result
+
+
+def run_upgrade(arguments):
+    """Upgrades the system taking snapshots before, as the upgrade button of the main window does.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        dictionary: Was the system upgraded?.
+    """
+    from .manager import packages
+    from .util import settings
+
+    upgraded = packages.upgrade_system(settings.aur_repository and not arguments.no_aur,
+                                       settings.snap_packages and not arguments.no_snap,
+                                       settings.flatpak_packages and not arguments.no_flatpak,
+                                       not arguments.no_snapshots)
+    return {"upgraded": upgraded}
+
+
+def run_hook(arguments):
+    """Takes a snapshot of every subvolume before a package manager transaction. Run after the transaction
+    ('--post'), deletes the old snapshots and regenerates GRUB entries.
+
+    Every package operation waits for this command, so it never asks for a password and it does as little as
+    possible: a lock serializes the hooks and, while it is held, hooks of a transaction already snapshotted (or,
+    if their transaction can't be identified, run just after another snapshot) are coalesced before loading the
+    configuration. Before the transaction only the snapshots are taken; the rest of the work is left pending
+    until the post-transaction hook runs.
+
+    Arguments:
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        dictionary: Subvolumes whose snapshot has been taken (or whose old snapshots have been deleted) and
+        errors found.
+    """
+    import fcntl
+    import time
+
+    result = {"source": arguments.source, "post": arguments.post, "coalesced": False, "subvolumes": [],
+              "errors": {}}
+    if os.geteuid() != 0:
+        sys.stderr.write("ButterManager hooks must be run by the package manager as root. Skipping...\n")
+        return result
+
+    transaction_id = get_transaction_id()
+    with open(HOOK_LOCK_PATH, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        state = {}
+        try:
+            with open(HOOK_STATE_PATH, 'r') as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            pass
+
+        if arguments.post:
+            # Only the hook which took the snapshots leaves work pending
+            if not state.get("pending"):
+                result["coalesced"] = True
+                return result
+            from .util import utils
+            utils.ConfigManager().load_settings()
+            result.update(delete_old_snapshots())
+            state["pending"] = False
+            write_hook_state(state)
+            return result
+
+        now = time.time()
+        # Hooks whose transaction can't be identified are coalesced during a while after the last snapshot
+        if transaction_id is not None:
+            coalesced = transaction_id == state.get("transaction")
+        else:
+            coalesced = 0 <= now - state.get("last_run", 0) < HOOK_COALESCE_WINDOW
+        if coalesced:
+            result["coalesced"] = True
+            return result
+
+        from .util import settings, utils
+        utils.ConfigManager().load_settings()
+        if settings.package_manager_hooks:
+            # This hold is never released, so GRUB entries are regenerated by the post-transaction hook instead
+            settings.grub_regenerator.hold()
+            result.update(run_snapshot(argparse.Namespace(subvolumes=[], no_delete=True)))
+
+        write_hook_state({"transaction": transaction_id, "last_run": now, "source": arguments.source,
+                          "pending": bool(result["subvolumes"])})
+    return result
+
+
+def write_hook_state(state):
+    """Stores the state of the hooks. The file is replaced atomically.
+
+    Arguments:
+        state (dictionary): Last transaction snapshotted, when and by which package manager, and if the
+        post-transaction work is pending.
+    """
+    temporary_path = HOOK_STATE_PATH + ".tmp"
+    with open(temporary_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_path, HOOK_STATE_PATH)
+
+
+def delete_old_snapshots():
+    """Deletes the old snapshots of every subvolume and regenerates GRUB entries, so the snapshots taken
+    before a transaction appear in the boot menu.
+
+    Returns:
+        dictionary: Subvolumes whose old snapshots have been deleted and errors found.
+    """
+    from .util import settings
+
+    subvolumes = []
+    errors = {}
+    # GRUB entries will be regenerated only once, when all the snapshots have been deleted
+    settings.grub_regenerator.hold()
+    try:
+        for subvolume_origin in sorted(settings.subvolumes):
+            subvolume = settings.subvolumes[subvolume_origin]
+            try:
+                subvolume.delete_snapshots()
+                subvolumes.append(subvolume.subvolume_origin)
+            except Exception as general_exception:
+                errors[subvolume.subvolume_origin] = str(general_exception)
+        settings.grub_regenerator.mark_dirty()
+    finally:
+        settings.grub_regenerator.release()
+        settings.grub_regenerator.flush()
+    return {"subvolumes": subvolumes, "errors": errors}
+
+
+def format_result(command, result):
+    """Converts the result of a command into lines readable by humans.
+
+    Arguments:
+        command (str): Command run.
+        result (dictionary): Result of the command.
+
+    Returns:
+        str: The result.
+    """
+    from .util import utils
+    import time
+
+    lines = []
+    if command == STATUS:
+        for filesystem in result["filesystems"]:
+            lines.append("{mount_point} ({uuid})".format(**filesystem))
+            lines.append("  Allocated: {0} of {1} ({2}%)".format(utils.convert_from_bytes(filesystem["allocated"]),
+                                                                utils.convert_from_bytes(filesystem["total"]),
+                                                                filesystem["allocated_percentage"]))
+            lines.append("  Data: {0} of {1}".format(utils.convert_from_bytes(filesystem["data_used"]),
+                                                     utils.convert_from_bytes(filesystem["data_total"])))
+            lines.append("  Metadata: {0} of {1} ({2}%)".format(utils.convert_from_bytes(filesystem["metadata_used"]),
+                                                               utils.convert_from_bytes(filesystem["metadata_total"]),
+                                                               filesystem["metadata_percentage"]))
+        for subvolume in result["subvolumes"]:
+            lines.append("{origin} -> {destination}: {snapshots} snapshots, latest {latest}".format(**subvolume))
+        lines.append("Timeline snapshots: {0}".format("enabled" if result["timeline"]["enabled"] else "disabled"))
+        lines.append("Space watchdog: {0}".format("enabled" if result["space_watchdog"] else "disabled"))
+    elif command == SNAPSHOT:
+        lines.extend("Snapshot taken: {0}".format(origin) for origin in result["subvolumes"])
+        lines.extend("Error taking snapshot of {0}: {1}".format(origin, error)
+                     for origin, error in sorted(result["errors"].items()))
+    elif command == PRUNE and result.get("retention"):
+        for subvolume in result["subvolumes"]:
+            lines.append("{0} ({1}): {2} snapshots kept, {3} {4}".format(
+                subvolume["origin"], subvolume["policy"], len(subvolume["kept"]), len(subvolume["deleted"]),
+                "would be deleted" if result["dry_run"] else "deleted"))
+            lines.extend("  {0}".format(snapshot_full_path) for snapshot_full_path in subvolume["deleted"])
+    elif command == PRUNE:
+        lines.extend("{0} ({1})".format(snapshot["path"], utils.convert_from_bytes(snapshot["exclusive"]))
+                     for snapshot in result["snapshots"])
+        lines.append("Expected space freed: {0} of {1}".format(utils.convert_from_bytes(result["reclaimed"]),
+                                                               utils.convert_from_bytes(result["target"])))
+        if not result["dry_run"]:
+            lines.append("Snapshots deleted: {0}".format(len(result["deleted"])))
+    elif command == BALANCE:
+        lines.extend("Balanced {mount_point} (data usage {data}%, metadata usage {metadata}%)".format(**balanced)
+                     for balanced in result["balanced"])
+    elif command == DIFF:
+        # Full comparisons: + only in the subvolume, - only in the snapshot, M modified
+        lines.extend("+ {0}".format(file_path) for file_path in result.get("only_in_origin", []))
+        lines.extend("- {0}".format(file_path) for file_path in result.get("only_in_snapshot", []))
+        prefix = "M " if "only_in_origin" in result else ""
+        changed_bytes = result.get("bytes", {})
+        lines.extend(prefix + file_path + (" ({0})".format(utils.convert_from_bytes(changed_bytes[file_path]))
+                                           if file_path in changed_bytes else "")
+                     for file_path in result["modified"])
+    elif command == UPGRADE:
+        lines.append("System upgraded" if result["upgraded"] else "Your system is up to date")
+    elif command == SEARCH:
+        for file_path, snapshots in result["files"].items():
+            lines.append(file_path)
+            lines.extend("  {snapshot} ({size}, {mtime})".format(
+                snapshot=snapshot["snapshot"], size=utils.convert_from_bytes(snapshot["size"]),
+                mtime=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["mtime"])))
+                for snapshot in snapshots)
+        lines.extend("Not indexed: {0}".format(snapshot_full_path) for snapshot_full_path in result["not_indexed"])
+    elif command == HISTORY:
+        for version in result["versions"]:
+            lines.append("{mtime} ({size}): {first}{last}".format(
+                mtime=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(version["mtime"])),
+                size=utils.convert_from_bytes(version["size"]), first=version["snapshots"][0],
+                last=" .. {0}".format(version["snapshots"][-1]) if len(version["snapshots"]) > 1 else ""))
+            if version.get("diff") is not None:
+                lines.extend("  " + line for line in version["diff"])
+            elif "diff" in version:
+                lines.append("  Binary or too big to be compared")
+    elif command == RESTORE:
+        lines.extend("{action} /{path}".format(**entry) for entry in result["entries"])
+        lines.append("Data to restore: {0}; conflicts: {1} ({2})".format(
+            utils.convert_from_bytes(result["size"]),
+            len([entry for entry in result["entries"] if entry["action"] == "conflict"]), result["conflicts"]))
+        if not result["dry_run"]:
+            lines.append("Entries restored: {0} ({1} files cloned, {2} copied)".format(
+                len(result["restored"]), result["cloned"], result["copied"]))
+            lines.extend("Error restoring /{0}: {1}".format(path, error)
+                         for path, error in sorted(result["errors"].items()))
+    elif command == HOOK and result["post"]:
+        lines.extend("Old snapshots deleted: {0}".format(origin) for origin in result["subvolumes"])
+        lines.extend("Error deleting old snapshots of {0}: {1}".format(origin, error)
+                     for origin, error in sorted(result["errors"].items()))
+    elif command == HOOK:
+        lines.extend("Snapshot taken: {0}".format(origin) for origin in result["subvolumes"])
+        lines.extend("Error taking snapshot of {0}: {1}".format(origin, error)
+                     for origin, error in sorted(result["errors"].items()))
+    return "\n".join(lines)
+
+
+def main(arguments=None):
+    """Runs a command of the command line interface.
+
+    Arguments:
+        arguments (:obj:`list` of :obj:`str`): Arguments without the name of the program (default sys.argv[1:]).
+
+    Returns:
+        int: Exit status.
+    """
+    arguments = get_parser().parse_args(arguments)
+    commands = {STATUS: run_status, SNAPSHOT: run_snapshot, PRUNE: run_prune, BALANCE: run_balance,
+                DIFF: run_diff, UPGRADE: run_upgrade, HOOK: run_hook, SEARCH: run_search,
+                HISTORY: run_history, RESTORE: run_restore}
+
+    # Hooks load the configuration only if they are not coalesced
+    if arguments.command == HOOK:
+        return run_command(commands[HOOK], arguments)
+
+    from .util import utils
+
+    # Loading the configuration stored in buttermanager.yaml. Upgrading the system needs to know the OS too
+    config_manager = utils.ConfigManager()
+    if arguments.command == UPGRADE:
+        config_manager.configure()
+    else:
+        config_manager.load_settings()
+
+    if arguments.command != STATUS and not request_privileges():
+        sys.stderr.write("Root privileges are needed. Run buttermanager as root or configure sudo\n")
+        return 1
+
+    # Streamed differences are printed as they are found instead of returning a result
+    if arguments.command == DIFF and arguments.stream:
+        return stream_diff(arguments)
+
+    return run_command(commands[arguments.command], arguments)
+
+
+def run_command(command, arguments):
+    """Runs a command and prints its result.
+
+    Arguments:
+        command (function): Function that runs the command.
+        arguments (argparse.Namespace): Arguments of the command.
+
+    Returns:
+        int: Exit status.
+    """
+    try:
+        if arguments.json:
+            # Output of the external programs is sent to stderr, so stdout only contains JSON
+            with contextlib.redirect_stdout(sys.stderr):
+                result = command(arguments)
+        else:
+            result = command(arguments)
+    except Exception as general_exception:
+        sys.stderr.write("Error: {error}\n".format(error=str(general_exception)))
+        return 1
+
+    if arguments.json:
+        sys.stdout.write(json.dumps(result, indent=2) + "\n")
+    else:
+        output = format_result(arguments.command, result)
+        if output:
+            sys.stdout.write(output + "\n")
+    return 1 if result.get("errors") else 0
+
+
+if __name__ == "__main__":
+    # The GUI runs the command line interface as root through 'sudo python -m'
+    sys.exit(main())
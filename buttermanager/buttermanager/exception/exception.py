@@ -46,3 +46,31 @@ class BtrfsSnapshotDeletion(Exception):
             return 'MyCustomError, {0} '.format(self.message)
         else:
             return 'MyCustomError has been raised'
+
+
+class BtrfsSnapshotCreation(Exception):
+    """Exception raised when a snapshot can't be created.
+
+    """
+    pass
+
+
+class BtrfsRollback(Exception):
+    """Exception raised when the system can't be rolled back to a snapshot.
+
+    """
+    pass
+
+
+class FstabModification(Exception):
+    """Exception raised when a fstab file can't be modified.
+
+    """
+    pass
+
+
+class SendStreamParsing(Exception):
+    """Exception raised when a BTRFS send stream can't be parsed.
+
+    """
+    pass
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to the catalog of snapshots managed by buttermanager.
+
+It provides also SnapshotCatalog and SnapshotEntry classes.
+"""
+from ..util import settings, utils
+from . import ioctl, mountinfo
+
+
+# Classes
+class SnapshotEntry:
+    """Snapshot managed by buttermanager.
+
+    """
+    # Constructor
+    def __init__(self, snapshot_full_path, subvolume, info):
+        """ Constructor.
+
+        Arguments:
+            snapshot_full_path (str): Full path to the snapshot, f.i.: /mnt/defvol/_snapshots/root-20201021-0.
+            subvolume (filesystem.snapshot.Subvolume): Subvolume the snapshot was taken from.
+            info (filesystem.ioctl.SubvolumeInfo): Metadata of the snapshot. None if it couldn't be retrieved.
+        """
+        self.snapshot_full_path = snapshot_full_path
+        self.subvolume = subvolume
+        self.info = info
+
+    # Private attributes
+    # ID of the snapshot
+    @property
+    def subvolume_id(self):
+        return self.info.subvolume_id if self.info is not None else None
+
+    # Path of the snapshot relative to the top level subvolume
+    @property
+    def subvolume_path(self):
+        return self.info.path if self.info is not None else None
+
+    # Methods
+    def __str__(self):
+        """Reimplementation of the str method inherited from object class.
+
+        Returns:
+            string: String representation of the SnapshotEntry object.
+        """
+        return "SnapshotEntry -> Path: {0}; ID: {1}; Subvolume path: {2}".format(self.snapshot_full_path,
+                                                                                  self.subvolume_id,
+                                                                                  self.subvolume_path)
+
+
+class SnapshotCatalog:
+    """Catalog of all the snapshots of the subvolumes configured by the user.
+
+    Snapshots are indexed by their subvolume ID and by their path relative to the top level subvolume,
+    so any snapshot can be found with a single lookup.
+    """
+    # Constructor
+    def __init__(self, btrfs_ioctl=None):
+        """ Constructor.
+
+        Arguments:
+            btrfs_ioctl (filesystem.ioctl.BtrfsIoctl): Interface used to retrieve the metadata of the
+            snapshots (default a new BtrfsIoctl object).
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__btrfs_ioctl = btrfs_ioctl if btrfs_ioctl is not None else ioctl.BtrfsIoctl()
+        self.__entries = []
+        self.__entries_by_id = {}
+        self.__entries_by_path = {}
+
+    # Private attributes
+    # Entries
+    @property
+    def entries(self):
+        return self.__entries
+
+    # Methods
+    def refresh(self):
+        """Builds the catalog again from the snapshots currently stored for every subvolume.
+
+        Without privileges, the snapshots which can't be read are resolved listing the subvolumes of their
+        filesystem, so a single privileged command is executed per filesystem instead of one per snapshot.
+        """
+        self.__entries = []
+        self.__entries_by_id = {}
+        self.__entries_by_path = {}
+        mounts = mountinfo.get_mounts()
+        privileged = ioctl.is_privileged()
+        entries = []
+        unresolved_entries = []
+        for subvolume_key in settings.subvolumes:
+            subvolume = settings.subvolumes[subvolume_key]
+            for snapshot_full_path in subvolume.get_all_snapshots_with_the_same_name():
+                entry = SnapshotEntry(snapshot_full_path, subvolume, None)
+                try:
+                    entry.info = self.__btrfs_ioctl.get_subvolume_info(snapshot_full_path, mounts=mounts,
+                                                                       fallback=privileged)
+                except OSError as os_error_exception:
+                    if not privileged and os_error_exception.errno in ioctl.FALLBACK_ERRORS:
+                        unresolved_entries.append(entry)
+                    else:
+                        self.__logger.error("Error retrieving info of {snapshot}: {error}".format(
+                            snapshot=snapshot_full_path, error=str(os_error_exception)))
+                entries.append(entry)
+
+        # Subvolumes listed by filesystem (key: device of the mount)
+        subvolumes = {}
+        for entry in unresolved_entries:
+            mount = mountinfo.get_mount(entry.snapshot_full_path, mounts)
+            if mount is None:
+                continue
+            if mount.device not in subvolumes:
+                try:
+                    subvolumes[mount.device] = self.__btrfs_ioctl.list_subvolumes(entry.snapshot_full_path)
+                except OSError as os_error_exception:
+                    self.__logger.error("Error listing the subvolumes of {mount_point}: {error}".format(
+                        mount_point=mount.mount_point, error=str(os_error_exception)))
+                    subvolumes[mount.device] = {}
+            entry.info = subvolumes[mount.device].get(mountinfo.get_subvolume_path(entry.snapshot_full_path,
+                                                                                   mounts))
+
+        for entry in entries:
+            self.add(entry)
+        self.__logger.info("{number} snapshots found".format(number=len(self.__entries)))
+
+    def add(self, entry):
+        """Adds an entry to the catalog.
+
+        Arguments:
+            entry (SnapshotEntry): Snapshot to add.
+        """
+        self.__entries.append(entry)
+        if entry.subvolume_id is not None:
+            self.__entries_by_id[entry.subvolume_id] = entry
+        if entry.subvolume_path:
+            self.__entries_by_path[entry.subvolume_path.strip("/")] = entry
+
+    def get_by_id(self, subvolume_id):
+        """Gets a snapshot using its subvolume ID.
+
+        Arguments:
+            subvolume_id (int): ID of the snapshot.
+
+        Returns:
+            SnapshotEntry: The snapshot. None if it is not managed by buttermanager.
+        """
+        return self.__entries_by_id.get(subvolume_id)
+
+    def get_by_path(self, subvolume_path):
+        """Gets a snapshot using its path relative to the top level subvolume.
+
+        Arguments:
+            subvolume_path (str): Path of the snapshot, with or without the starting /.
+
+        Returns:
+            SnapshotEntry: The snapshot. None if it is not managed by buttermanager.
+        """
+        return self.__entries_by_path.get(subvolume_path.strip("/"))
+
+    def get_by_mount(self, mount):
+        """Gets the snapshot mounted in a mount point.
+
+        The snapshot is looked up by the subvolid option of the mount point and, if it is not found, by its
+        subvol option or the root of the mount.
+
+        Arguments:
+            mount (filesystem.mountinfo.Mount): Mount point, f.i.: the one returned by mountinfo.get_mount("/").
+
+        Returns:
+            SnapshotEntry: The snapshot mounted. None if the mount point is not a snapshot managed by buttermanager.
+        """
+        mounted_snapshot = None
+        mounted_snapshot_id = mount.get_option(mountinfo.SUBVOLID_OPTION)
+        if mounted_snapshot_id is not None and mounted_snapshot_id.isdigit():
+            mounted_snapshot = self.get_by_id(int(mounted_snapshot_id))
+        if mounted_snapshot is None:
+            mounted_snapshot = self.get_by_path(mount.get_option(mountinfo.SUBVOL_OPTION) or mount.root)
+        return mounted_snapshot
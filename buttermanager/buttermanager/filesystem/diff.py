@@ -0,0 +1,661 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to comparing a subvolume with one of its snapshots.
+
+Both trees are walked in parallel and entries are classified by their metadata first (type, size, inode,
+modification and change times). When the metadata can't tell if a file has been modified, the extents of both
+files are compared: a snapshot shares the extents of its subvolume, so the same physical extent mapped at the same
+offset proves that range hasn't changed. The content is only read for the ranges whose extents diverge.
+A cheaper comparison, which doesn't read any content, can be done parsing the send stream between the snapshot
+and a temporary snapshot of the subvolume. Two snapshots are compared merging their file indexes.
+It provides also TreeComparator class.
+"""
+from .. import cli
+from ..exception import exception
+from ..util import settings, utils
+from . import diffcache, fileindex, ioctl, sendstream, snapshot
+import concurrent.futures
+import json
+import os
+import stat
+import subprocess
+import sys
+
+# Constants
+ONLY_IN_ORIGIN = "only_in_origin"
+ONLY_IN_SNAPSHOT = "only_in_snapshot"
+MODIFIED = "modified"
+DEFAULT_WORKERS = min(16, (os.cpu_count() or 1) * 2)
+# Bytes read at once when the content of two files is compared
+CHUNK_SIZE = 1024 * 1024
+# Extents whose physical location doesn't identify their data
+UNTRUSTED_EXTENT_FLAGS = ioctl.FIEMAP_EXTENT_UNKNOWN | ioctl.FIEMAP_EXTENT_DELALLOC | \
+    ioctl.FIEMAP_EXTENT_DATA_INLINE | ioctl.FIEMAP_EXTENT_NOT_ALIGNED
+DIFF_COMMAND = ["diff", "-qr"]
+SEND_NO_DATA_COMMAND = ["btrfs", "send", "--no-data", "-q"]
+# Prefix of the temporary snapshots of the subvolume sent. They are hidden, so they are not listed as snapshots
+TEMPORARY_SNAPSHOT_PREFIX = ".buttermanager-diff-"
+
+
+# Classes
+class TreeComparator:
+    """Compares the current state of a subvolume with one of its snapshots.
+
+    Directories are scanned by a pool of threads and the differences are returned as soon as they are found,
+    so memory doesn't depend on the size of the trees. Like 'diff -qr', a directory that only exists in one
+    of the trees is reported once, without its content.
+    """
+    # Constructor
+    def __init__(self, origin, snapshot_full_path, workers=DEFAULT_WORKERS, btrfs_ioctl=None):
+        """ Constructor.
+
+        Arguments:
+            origin (str): Full path to the subvolume, f.i.: /mnt/defvol/_active/rootvol.
+            snapshot_full_path (str): Full path to the snapshot, f.i.: /mnt/defvol/_snapshots/root-20201021-0.
+            workers (int): Number of threads scanning directories and comparing files (default DEFAULT_WORKERS).
+            btrfs_ioctl (filesystem.ioctl.BtrfsIoctl): Interface used to retrieve the extents of the files
+            (default a new BtrfsIoctl object).
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__origin = origin.rstrip("/") or "/"
+        self.__snapshot_full_path = snapshot_full_path.rstrip("/") or "/"
+        self.__workers = max(1, workers)
+        self.__btrfs_ioctl = btrfs_ioctl if btrfs_ioctl is not None else ioctl.BtrfsIoctl()
+        # Number of files whose extents have been compared
+        self.__extents_compared = 0
+        # Number of files whose content has been read (partially or completely)
+        self.__contents_compared = 0
+        # Number of bytes read from every tree
+        self.__bytes_compared = 0
+
+    # Private attributes
+    # Number of files whose metadata was ambiguous and their extents have been compared
+    @property
+    def extents_compared(self):
+        return self.__extents_compared
+
+    # Number of files whose extents diverge and their content has been read
+    @property
+    def contents_compared(self):
+        return self.__contents_compared
+
+    # Number of bytes read from every tree
+    @property
+    def bytes_compared(self):
+        return self.__bytes_compared
+
+    # Methods
+    # Private methods
+    def __scan(self, directory):
+        """Scans a directory without following symbolic links.
+
+        Arguments:
+            directory (str): Full path to the directory.
+
+        Returns:
+            dictionary (key=:obj:'str', value=:obj:'os.stat_result'): metadata of every entry (key: name).
+        """
+        entries = {}
+        try:
+            with os.scandir(directory) as iterator:
+                for entry in iterator:
+                    try:
+                        entries[entry.name] = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        # The entry has disappeared while scanning
+                        pass
+        except OSError as os_error_exception:
+            self.__logger.error("Error scanning {directory}: {error}".format(directory=directory,
+                                                                            error=str(os_error_exception)))
+        return entries
+
+    def __compare_directory(self, relative_path):
+        """Compares a directory which exists in both trees.
+
+        Arguments:
+            relative_path (str): Path of the directory relative to both trees ('' for the top directory).
+
+        Returns:
+            tuple (:obj:`list` of :obj:`tuple`, :obj:`list` of :obj:`str`): differences found as (category,
+            path) tuples and relative paths of the subdirectories to compare.
+        """
+        origin_entries = self.__scan(os.path.join(self.__origin, relative_path))
+        snapshot_entries = self.__scan(os.path.join(self.__snapshot_full_path, relative_path))
+        differences = []
+        subdirectories = []
+        for name in sorted(origin_entries.keys() | snapshot_entries.keys()):
+            entry_path = os.path.join(relative_path, name)
+            origin_stat = origin_entries.get(name)
+            snapshot_stat = snapshot_entries.get(name)
+            if snapshot_stat is None:
+                differences.append((ONLY_IN_ORIGIN, "/" + entry_path))
+            elif origin_stat is None:
+                differences.append((ONLY_IN_SNAPSHOT, "/" + entry_path))
+            elif stat.S_ISDIR(origin_stat.st_mode) and stat.S_ISDIR(snapshot_stat.st_mode):
+                subdirectories.append(entry_path)
+            elif self.__is_modified(entry_path, origin_stat, snapshot_stat):
+                differences.append((MODIFIED, "/" + entry_path))
+        return differences, subdirectories
+
+    def __is_modified(self, relative_path, origin_stat, snapshot_stat):
+        """Checks if an entry which exists in both trees has been modified, using its metadata first.
+
+        Arguments:
+            relative_path (str): Path of the entry relative to both trees.
+            origin_stat (os.stat_result): Metadata of the entry in the subvolume.
+            snapshot_stat (os.stat_result): Metadata of the entry in the snapshot.
+
+        Returns:
+            bool: True if the entry has been modified.
+        """
+        if stat.S_IFMT(origin_stat.st_mode) != stat.S_IFMT(snapshot_stat.st_mode):
+            return True
+        origin_path = os.path.join(self.__origin, relative_path)
+        snapshot_path = os.path.join(self.__snapshot_full_path, relative_path)
+        if stat.S_ISLNK(origin_stat.st_mode):
+            try:
+                return os.readlink(origin_path) != os.readlink(snapshot_path)
+            except OSError:
+                return True
+        if not stat.S_ISREG(origin_stat.st_mode):
+            # Devices, fifos and sockets have no content
+            return origin_stat.st_rdev != snapshot_stat.st_rdev
+        if origin_stat.st_size != snapshot_stat.st_size:
+            return True
+        # Snapshots keep the inode numbers and times of the subvolume, so an inode that hasn't been written nor
+        # changed since the snapshot was taken has the same content
+        if origin_stat.st_ino == snapshot_stat.st_ino and origin_stat.st_mtime_ns == snapshot_stat.st_mtime_ns \
+                and origin_stat.st_ctime_ns == snapshot_stat.st_ctime_ns:
+            return False
+        ranges = self.__get_differing_ranges(origin_path, snapshot_path, origin_stat.st_size)
+        if not ranges:
+            return False
+        return not self.__same_content(origin_path, snapshot_path, ranges)
+
+    def __get_differing_ranges(self, origin_path, snapshot_path, size):
+        """Compares the extents of two files with the same size.
+
+        Arguments:
+            origin_path (str): Full path to the file in the subvolume.
+            snapshot_path (str): Full path to the file in the snapshot.
+            size (int): Size of both files.
+
+        Returns:
+            list (:obj:`list` of :obj:`tuple`): ranges as (offset, length) tuples whose content has to be
+            compared. The whole file if the extents can't be retrieved.
+        """
+        try:
+            # Data of the subvolume pending to be written is flushed, so it has extents. Snapshots are read-only
+            origin_extents = self.__btrfs_ioctl.get_file_extents(origin_path, sync=True)
+            snapshot_extents = self.__btrfs_ioctl.get_file_extents(snapshot_path)
+        except OSError:
+            return [(0, size)]
+        self.__extents_compared += 1
+        return get_differing_ranges(origin_extents, snapshot_extents, size)
+
+    def __same_content(self, origin_path, snapshot_path, ranges):
+        """Compares the content of two files within some ranges.
+
+        Arguments:
+            origin_path (str): Full path to the file in the subvolume.
+            snapshot_path (str): Full path to the file in the snapshot.
+            ranges (:obj:`list` of :obj:`tuple`): ranges as (offset, length) tuples to compare.
+
+        Returns:
+            bool: True if both files have the same content within the ranges.
+        """
+        self.__contents_compared += 1
+        try:
+            origin_descriptor = os.open(origin_path, os.O_RDONLY | os.O_NOFOLLOW)
+            try:
+                snapshot_descriptor = os.open(snapshot_path, os.O_RDONLY | os.O_NOFOLLOW)
+                try:
+                    for offset, length in ranges:
+                        end = offset + length
+                        while offset < end:
+                            origin_chunk = os.pread(origin_descriptor, min(CHUNK_SIZE, end - offset), offset)
+                            self.__bytes_compared += len(origin_chunk)
+                            if origin_chunk != os.pread(snapshot_descriptor, len(origin_chunk) or 1, offset):
+                                return False
+                            if not origin_chunk:
+                                break
+                            offset += len(origin_chunk)
+                    return True
+                finally:
+                    os.close(snapshot_descriptor)
+            finally:
+                os.close(origin_descriptor)
+        except OSError:
+            return False
+
+    # Public methods
+    def compare(self):
+        """Compares both trees.
+
+        Returns:
+            generator (:obj:`tuple` of :obj:`str`): differences as (category, path) tuples. Category is
+            ONLY_IN_ORIGIN, ONLY_IN_SNAPSHOT or MODIFIED and path is relative to the trees, f.i.: /etc/fstab.
+        """
+        self.__logger.info("Comparing {origin} with {snapshot} using {workers} threads".format(
+            origin=self.__origin, snapshot=self.__snapshot_full_path, workers=self.__workers))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__workers) as executor:
+            pending = {executor.submit(self.__compare_directory, "")}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    differences, subdirectories = future.result()
+                    for subdirectory in subdirectories:
+                        pending.add(executor.submit(self.__compare_directory, subdirectory))
+                    for difference in differences:
+                        yield difference
+        self.__logger.info("Comparison finished. Extents of {extents} files compared; {contents} files read "
+                           "({bytes})".format(extents=self.__extents_compared, contents=self.__contents_compared,
+                                              bytes=utils.convert_from_bytes(self.__bytes_compared)))
+
+
+# Module's methods
+def get_differences(origin, snapshot_full_path, mode=diffcache.FULL, use_cache=True):
+    """Calculates the differences between a subvolume and one of its snapshots, or retrieves them from the
+    diff cache if neither of them has changed since they were calculated.
+
+    Arguments:
+        origin (str): Full path to the subvolume.
+        snapshot_full_path (str): Full path to the snapshot.
+        mode (str): diffcache.PARTIAL (find-new), diffcache.FULL (compare_trees), diffcache.SEND
+        (compare_trees_with_send_stream) or diffcache.INDEX (compare_snapshots, origin is another snapshot)
+        (default diffcache.FULL).
+        use_cache (bool): The diff cache will be used (default True).
+
+    Returns:
+        dictionary (key=:obj:'str', value=:obj:'list'): paths by category (ONLY_IN_ORIGIN, ONLY_IN_SNAPSHOT
+        and MODIFIED), sorted. Partial comparisons only find MODIFIED paths and the bytes written in every one
+        of them are included too (key: 'bytes').
+    """
+    key, permanent = diffcache.get_cache_key(snapshot_full_path, origin, mode) if use_cache else (None, False)
+    cache = diffcache.DiffCache()
+    if key is not None:
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+    if mode == diffcache.PARTIAL:
+        changed_bytes = snapshot.get_changed_bytes(snapshot_full_path, origin)
+        result = {MODIFIED: sorted(changed_bytes), "bytes": changed_bytes}
+    else:
+        result = {ONLY_IN_ORIGIN: [], ONLY_IN_SNAPSHOT: [], MODIFIED: []}
+        compare = {diffcache.SEND: compare_trees_with_send_stream,
+                   diffcache.INDEX: compare_snapshots}.get(mode, compare_trees)
+        for category, file_path in compare(origin, snapshot_full_path):
+            result[category].append(file_path)
+        for paths in result.values():
+            paths.sort()
+
+    if key is not None:
+        cache.put(key, result, permanent)
+    return result
+
+
+def compare_trees(origin, snapshot_full_path):
+    """Compares the current state of a subvolume with one of its snapshots.
+
+    TreeComparator is used. If buttermanager is not running as root, it is run by the command line interface
+    executed using sudo.
+
+    Arguments:
+        origin (str): Full path to the subvolume.
+        snapshot_full_path (str): Full path to the snapshot.
+
+    Returns:
+        generator (:obj:`tuple` of :obj:`str`): differences as (category, path) tuples.
+    """
+    if ioctl.is_privileged():
+        return TreeComparator(origin, snapshot_full_path).compare()
+    return compare_trees_with_sudo(origin, snapshot_full_path)
+
+
+def compare_trees_with_sudo(origin, snapshot_full_path):
+    """Compares the current state of a subvolume with one of its snapshots running 'buttermanager diff --full
+    --stream' as root using sudo, so TreeComparator walks both trees. Differences are read as soon as they are
+    printed. If the command can't be run, 'diff -qr' is used instead.
+
+    Arguments:
+        origin (str): Full path to the subvolume.
+        snapshot_full_path (str): Full path to the snapshot.
+
+    Returns:
+        generator (:obj:`tuple` of :obj:`str`): differences as (category, path) tuples.
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    logger.info("Comparing {origin} with {snapshot} as root".format(origin=origin, snapshot=snapshot_full_path))
+    command, directory = cli.get_command([cli.DIFF, snapshot_full_path, "--full", "--stream",
+                                          "--subvolume", origin])
+    # -H: the configuration and the logs of root are used, so no file of the user becomes owned by root
+    result = subprocess.Popen(["sudo", "-S", "-H"] + command, cwd=directory, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    result.stdin.write(settings.user_password + "\n")
+    result.stdin.close()
+    found = False
+    try:
+        for line in result.stdout:
+            category, file_path = json.loads(line)
+            found = True
+            yield category, file_path
+    finally:
+        result.stdout.close()
+        error = result.stderr.read().strip()
+        result.wait()
+    if result.returncode != 0:
+        if found:
+            # The differences found so far are incomplete
+            raise OSError("Error comparing {origin} with {snapshot}: {error}".format(
+                origin=origin, snapshot=snapshot_full_path, error=error))
+        logger.error("Error comparing as root: {error}. Comparing using diff instead".format(error=error))
+        yield from compare_trees_with_diff(origin, snapshot_full_path)
+
+
+def get_differing_ranges(origin_extents, snapshot_extents, size):
+    """Calculates the ranges of two files that may have different content comparing their extents.
+
+    A range is proven unchanged when both files map it to the same physical location, or when it is a hole
+    in both files. Compressed extents don't map every logical byte to its own physical byte, so they are
+    only considered the same when both files have the very same extent.
+
+    Arguments:
+        origin_extents (:obj:`list` of :obj:`tuple`): Extents of the first file as returned by
+        BtrfsIoctl.get_file_extents.
+        snapshot_extents (:obj:`list` of :obj:`tuple`): Extents of the second file.
+        size (int): Size of both files.
+
+    Returns:
+        list (:obj:`list` of :obj:`tuple`): ranges as (offset, length) tuples, sorted. Empty if the extents
+        prove both files have the same content.
+
+    >>> get_differing_ranges([(0, 8192, 8192, 1)], [(0, 8192, 4096, 0), (4096, 65536, 4096, 1)], 8192)
+    [(4096, 4096)]
+    """
+    # Ranges proven unchanged. Extents of a file don't overlap, so they are found sorted
+    unchanged = []
+    origin_index = 0
+    snapshot_index = 0
+    while origin_index < len(origin_extents) and snapshot_index < len(snapshot_extents):
+        origin_logical, origin_physical, origin_length, origin_flags = origin_extents[origin_index]
+        snapshot_logical, snapshot_physical, snapshot_length, snapshot_flags = snapshot_extents[snapshot_index]
+        start = max(origin_logical, snapshot_logical)
+        end = min(origin_logical + origin_length, snapshot_logical + snapshot_length)
+        if start < end and not (origin_flags | snapshot_flags) & UNTRUSTED_EXTENT_FLAGS:
+            if (origin_flags | snapshot_flags) & ioctl.FIEMAP_EXTENT_ENCODED:
+                same = (origin_logical, origin_physical, origin_length) == \
+                       (snapshot_logical, snapshot_physical, snapshot_length)
+            else:
+                same = origin_physical - origin_logical == snapshot_physical - snapshot_logical
+            if same:
+                unchanged.append((start, end))
+        if origin_logical + origin_length <= snapshot_logical + snapshot_length:
+            origin_index += 1
+        else:
+            snapshot_index += 1
+
+    # Ranges mapped in any of the files (holes in both files are unchanged)
+    mapped = []
+    for logical, _, length, _ in sorted(origin_extents + snapshot_extents):
+        if mapped and logical <= mapped[-1][1]:
+            mapped[-1][1] = max(mapped[-1][1], logical + length)
+        else:
+            mapped.append([logical, logical + length])
+
+    ranges = []
+    unchanged_index = 0
+    for start, end in mapped:
+        end = min(end, size)
+        while start < end:
+            # Skipping the unchanged ranges placed before start
+            while unchanged_index < len(unchanged) and unchanged[unchanged_index][1] <= start:
+                unchanged_index += 1
+            if unchanged_index < len(unchanged) and unchanged[unchanged_index][0] <= start:
+                start = unchanged[unchanged_index][1]
+                continue
+            next_unchanged = unchanged[unchanged_index][0] if unchanged_index < len(unchanged) else end
+            range_end = min(end, next_unchanged)
+            if ranges and ranges[-1][0] + ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], range_end - ranges[-1][0])
+            else:
+                ranges.append((start, range_end - start))
+            start = range_end
+    return ranges
+
+
+def compare_snapshots(origin, snapshot_full_path):
+    """Compares two snapshots (or a subvolume and a snapshot) using their file indexes, so their trees are
+    only walked the first time a read-only snapshot is indexed.
+
+    Arguments:
+        origin (str): Full path to the first snapshot, f.i.: the newest one.
+        snapshot_full_path (str): Full path to the second snapshot.
+
+    Returns:
+        generator (:obj:`tuple` of :obj:`str`): differences as (category, path) tuples. ONLY_IN_ORIGIN paths
+        are only in the first snapshot.
+    """
+    return compare_indexes(fileindex.get_index(origin), fileindex.get_index(snapshot_full_path))
+
+
+def compare_indexes(origin_index, snapshot_index):
+    """Compares two file indexes merging them. Like 'diff -qr', a directory that only exists in one of them is
+    reported once, without its content. Files are considered modified when their type, size, modification time
+    or inode differ.
+
+    Arguments:
+        origin_index (filesystem.fileindex.FileIndex): Index of the first tree.
+        snapshot_index (filesystem.fileindex.FileIndex): Index of the second tree.
+
+    Returns:
+        generator (:obj:`tuple` of :obj:`str`): differences as (category, path) tuples.
+    """
+    origin_paths = origin_index.paths
+    snapshot_paths = snapshot_index.paths
+    origin_position = 0
+    snapshot_position = 0
+    while origin_position < len(origin_paths) or snapshot_position < len(snapshot_paths):
+        if snapshot_position >= len(snapshot_paths):
+            origin_key, snapshot_key = 0, 1
+        elif origin_position >= len(origin_paths):
+            origin_key, snapshot_key = 1, 0
+        else:
+            origin_key = fileindex.get_sort_key(origin_paths[origin_position])
+            snapshot_key = fileindex.get_sort_key(snapshot_paths[snapshot_position])
+
+        if origin_key < snapshot_key:
+            yield ONLY_IN_ORIGIN, "/" + origin_paths[origin_position]
+            origin_position = skip_content(origin_paths, origin_position)
+        elif snapshot_key < origin_key:
+            yield ONLY_IN_SNAPSHOT, "/" + snapshot_paths[snapshot_position]
+            snapshot_position = skip_content(snapshot_paths, snapshot_position)
+        else:
+            origin_mode = origin_index.modes[origin_position]
+            snapshot_mode = snapshot_index.modes[snapshot_position]
+            if stat.S_IFMT(origin_mode) != stat.S_IFMT(snapshot_mode):
+                yield MODIFIED, "/" + origin_paths[origin_position]
+                # Content of a directory replaced by any other kind of file is not compared
+                if stat.S_ISDIR(origin_mode):
+                    origin_position = skip_content(origin_paths, origin_position) - 1
+                if stat.S_ISDIR(snapshot_mode):
+                    snapshot_position = skip_content(snapshot_paths, snapshot_position) - 1
+            elif not stat.S_ISDIR(origin_mode) and \
+                    (origin_index.sizes[origin_position], origin_index.mtimes[origin_position],
+                     origin_index.inodes[origin_position]) != \
+                    (snapshot_index.sizes[snapshot_position], snapshot_index.mtimes[snapshot_position],
+                     snapshot_index.inodes[snapshot_position]):
+                yield MODIFIED, "/" + origin_paths[origin_position]
+            origin_position += 1
+            snapshot_position += 1
+
+
+def skip_content(paths, position):
+    """Skips the content of a directory within the sorted paths of an index.
+
+    Arguments:
+        paths (:obj:`list` of :obj:`str`): Paths of the index.
+        position (int): Position of the directory (or any other entry) within the paths.
+
+    Returns:
+        int: Position of the first path which is not within the entry.
+
+    >>> skip_content(["etc", "etc/fstab", "etc/pacman.d/mirrorlist", "etc-backup"], 0)
+    3
+    """
+    prefix = paths[position] + "/"
+    position += 1
+    while position < len(paths) and paths[position].startswith(prefix):
+        position += 1
+    return position
+
+
+def compare_trees_with_diff(origin, snapshot_full_path):
+    """Compares the current state of a subvolume with one of its snapshots using 'sudo diff -qr'. The content
+    of every file present in both trees is read.
+
+    Arguments:
+        origin (str): Full path to the subvolume.
+        snapshot_full_path (str): Full path to the snapshot.
+
+    Returns:
+        generator (:obj:`tuple` of :obj:`str`): differences as (category, path) tuples.
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    origin = origin.rstrip("/")
+    snapshot_full_path = snapshot_full_path.rstrip("/")
+    logger.info("Comparing {origin} with {snapshot} using diff".format(origin=origin, snapshot=snapshot_full_path))
+    result = subprocess.Popen(["sudo", "-S"] + DIFF_COMMAND + [origin + "/", snapshot_full_path + "/"],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True)
+    result.stdin.write(settings.user_password + "\n")
+    result.stdin.close()
+    # The most specific tree is checked first, as one of them may be within the other (f.i.: origin is /)
+    trees = sorted(((ONLY_IN_ORIGIN, origin), (ONLY_IN_SNAPSHOT, snapshot_full_path)),
+                   key=lambda tree: len(tree[1]), reverse=True)
+    for line in result.stdout:
+        line = line.rstrip("\n")
+        if line.startswith("Only in ") and ": " in line:
+            # Only in /mnt/defvol/_active/rootvol/etc: hosts
+            directory, name = line[len("Only in "):].split(": ", 1)
+            for category, tree in trees:
+                relative_directory = get_tree_path(directory, tree)
+                if relative_directory is not None:
+                    yield category, "{directory}/{name}".format(directory=relative_directory, name=name)
+                    break
+        elif line.startswith("Files ") and line.endswith(" differ"):
+            # Files /mnt/defvol/_active/rootvol/etc/fstab and /mnt/defvol/_snapshots/root/etc/fstab differ
+            # The path is the same in both trees, so its length is known even if it contains ' and '
+            length = (len(line) - len("Files  and  differ") - len(origin) - len(snapshot_full_path)) // 2
+            start = len("Files ") + len(origin)
+            if line[len("Files "):start] == origin and line[start:start + length].startswith("/"):
+                yield MODIFIED, line[start:start + length]
+        elif line.startswith("File ") and " is a " in line:
+            # File /mnt/defvol/_active/rootvol/x is a directory while file /mnt/.../x is a regular file
+            relative_path = get_tree_path(line[len("File "):].split(" is a ")[0], origin)
+            if relative_path:
+                yield MODIFIED, relative_path
+    result.wait()
+
+
+def get_tree_path(path, tree):
+    """Calculates the path of an entry relative to the tree which contains it, as 'diff' prints them.
+
+    Arguments:
+        path (str): Full path to the entry, f.i.: /mnt/defvol/_active/rootvol/etc.
+        tree (str): Full path to the tree without the trailing slash ('' for the root directory).
+
+    Returns:
+        str: Path relative to the tree starting with a slash ('' for the tree itself). None if the entry is
+        not within the tree.
+
+    >>> get_tree_path("/mnt/defvol/_active/rootvol/etc", "/mnt/defvol/_active/rootvol")
+    '/etc'
+    >>> get_tree_path("/mnt/defvol/_active/rootvol-backup/etc", "/mnt/defvol/_active/rootvol") is None
+    True
+    >>> get_tree_path("/", "")
+    ''
+    """
+    if path == tree or path == tree + "/":
+        return ""
+    if path.startswith(tree + "/"):
+        return path[len(tree):]
+    return None
+
+
+def compare_trees_with_send_stream(origin, snapshot_full_path):
+    """Compares the current state of a subvolume with one of its snapshots parsing the stream generated by
+    'btrfs send --no-data'. A temporary read-only snapshot of the subvolume is sent using the snapshot as parent,
+    so only metadata is read. If the stream can't be generated, the trees are compared using compare_trees.
+
+    Arguments:
+        origin (str): Full path to the subvolume.
+        snapshot_full_path (str): Full path to the snapshot. It must be read-only.
+
+    Returns:
+        generator (:obj:`tuple` of :obj:`str`): differences as (category, path) tuples.
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    snapshot_full_path = snapshot_full_path.rstrip("/")
+    temporary_snapshot = os.path.join(os.path.dirname(snapshot_full_path), "{prefix}{pid}".format(
+        prefix=TEMPORARY_SNAPSHOT_PREFIX, pid=os.getpid()))
+    logger.info("Comparing {origin} with {snapshot} using send stream".format(origin=origin,
+                                                                              snapshot=snapshot_full_path))
+    tracker = sendstream.ChangeTracker()
+    try:
+        snapshot.create_subvolume_snapshot(origin, temporary_snapshot)
+        command = SEND_NO_DATA_COMMAND + ["-p", snapshot_full_path, temporary_snapshot]
+        privileged = ioctl.is_privileged()
+        result = subprocess.Popen(command if privileged else ["sudo", "-S"] + command, stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if not privileged:
+            result.stdin.write((settings.user_password + "\n").encode())
+        result.stdin.close()
+        try:
+            for command in sendstream.SendStreamParser(result.stdout).commands():
+                tracker.track(command)
+        finally:
+            result.stdout.close()
+            error = result.stderr.read().decode(errors="replace").strip()
+            result.wait()
+        if result.returncode != 0:
+            raise exception.SendStreamParsing(error)
+    except (OSError, exception.BtrfsSnapshotCreation, exception.SendStreamParsing) as send_exception:
+        logger.error("Error comparing using send stream: {error}. Comparing both trees instead".format(
+            error=str(send_exception)))
+        tracker = None
+    finally:
+        if os.path.lexists(temporary_snapshot):
+            try:
+                snapshot.delete_subvolume(temporary_snapshot, console=False)
+            except exception.BtrfsSnapshotDeletion as btrfs_snapshot_exception:
+                logger.error(str(btrfs_snapshot_exception))
+
+    if tracker is None:
+        yield from compare_trees(origin, snapshot_full_path)
+        return
+    only_in_origin, only_in_snapshot, modified = tracker.get_changes()
+    for category, paths in ((ONLY_IN_ORIGIN, only_in_origin), (ONLY_IN_SNAPSHOT, only_in_snapshot),
+                            (MODIFIED, modified)):
+        for path in paths:
+            yield category, "/" + path
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to caching the differences calculated between a snapshot
+and a subvolume (or another snapshot).
+
+Results are identified by the UUID of the snapshot, the UUID and generation of the other subvolume and the
+kind of comparison. The generation changes every time a subvolume is written, so a cached result is never
+stale. Read-only snapshots never change, so the differences between two of them are kept until the cache
+runs out of space. It provides also DiffCache class.
+"""
+from ..util import settings, utils
+from . import ioctl
+import gzip
+import hashlib
+import json
+import os
+import time
+
+# Constants
+CACHE_DIR = "diff-cache"
+PARTIAL = "partial"
+FULL = "full"
+SEND = "send"
+INDEX = "index"
+# Results which will never be stale use a different suffix, so they are not evicted by age
+PERMANENT_SUFFIX = ".permanent.json.gz"
+SUFFIX = ".json.gz"
+
+
+# Classes
+class DiffCache:
+    """Stores the differences calculated as compressed JSON files within the application directory.
+
+    Every result is a dictionary which can be serialized as JSON (f.i. lists of paths by category).
+    Entries are evicted when they are older than the maximum age (except the permanent ones) and, starting
+    from the least recently used, when the cache is bigger than its maximum size.
+    """
+    # Constructor
+    def __init__(self, cache_path=None, max_age=None, max_size=None):
+        """ Constructor.
+
+        Arguments:
+            cache_path (str): Directory of the cache (default diff-cache within the application directory).
+            max_age (int): Days a non permanent entry is kept (default settings.diff_cache_max_age).
+            max_size (int): Maximum size of the cache in MiB (default settings.diff_cache_max_size).
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__cache_path = cache_path if cache_path is not None else os.path.join(settings.application_path,
+                                                                                   CACHE_DIR)
+        self.__max_age = (max_age if max_age is not None else settings.diff_cache_max_age) * 24 * 3600
+        self.__max_size = (max_size if max_size is not None else settings.diff_cache_max_size) * 1024 * 1024
+
+    # Methods
+    # Private methods
+    def __get_entry_path(self, key, permanent):
+        """Calculates the path of the file which stores an entry.
+
+        Arguments:
+            key (str): Key of the entry.
+            permanent (bool): The entry will never be stale.
+
+        Returns:
+            str: Full path to the file.
+        """
+        name = hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(self.__cache_path, name + (PERMANENT_SUFFIX if permanent else SUFFIX))
+
+    # Public methods
+    def get(self, key):
+        """Retrieves a result from the cache.
+
+        Arguments:
+            key (str): Key of the result, as returned by get_cache_key.
+
+        Returns:
+            dictionary: The result. None if it is not cached.
+        """
+        for permanent in (True, False):
+            entry_path = self.__get_entry_path(key, permanent)
+            try:
+                with gzip.open(entry_path, 'rt', encoding='utf-8', errors='surrogateescape') as entry_file:
+                    entry = json.load(entry_file)
+            except (OSError, ValueError, EOFError):
+                continue
+            if entry.get("key") != key:
+                continue
+            # Access time is not reliable (noatime, relatime), so modification time tracks the last use
+            try:
+                os.utime(entry_path)
+            except OSError:
+                pass
+            self.__logger.info("Differences found in the cache: {key}".format(key=key))
+            return entry.get("result")
+        return None
+
+    def put(self, key, result, permanent=False):
+        """Stores a result in the cache and evicts the stale entries.
+
+        Arguments:
+            key (str): Key of the result, as returned by get_cache_key.
+            result (dictionary): Result to store.
+            permanent (bool): The result will never be stale (default False).
+        """
+        entry_path = self.__get_entry_path(key, permanent)
+        temporary_path = "{path}.{pid}.tmp".format(path=entry_path, pid=os.getpid())
+        try:
+            os.makedirs(self.__cache_path, exist_ok=True)
+            with gzip.open(temporary_path, 'wt', encoding='utf-8', errors='surrogateescape') as entry_file:
+                json.dump({"key": key, "result": result}, entry_file, separators=(",", ":"))
+            os.replace(temporary_path, entry_path)
+        except OSError as os_error_exception:
+            self.__logger.error("Error storing differences in the cache: {error}".format(
+                error=str(os_error_exception)))
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self, now=None):
+        """Deletes the entries older than the maximum age and the least recently used ones while the cache
+        is bigger than its maximum size.
+
+        Arguments:
+            now (float): Current time (default time.time()).
+
+        Returns:
+            int: Number of entries deleted.
+        """
+        now = time.time() if now is None else now
+        entries = []
+        try:
+            with os.scandir(self.__cache_path) as iterator:
+                for entry in iterator:
+                    if entry.name.endswith(SUFFIX):
+                        try:
+                            entry_stat = entry.stat()
+                        except OSError:
+                            continue
+                        entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path,
+                                        entry.name.endswith(PERMANENT_SUFFIX)))
+        except OSError:
+            return 0
+
+        entries.sort()
+        total_size = sum(entry[1] for entry in entries)
+        deleted = 0
+        for last_use, size, entry_path, permanent in entries:
+            if total_size <= self.__max_size and (permanent or now - last_use <= self.__max_age):
+                continue
+            try:
+                os.remove(entry_path)
+                total_size -= size
+                deleted += 1
+            except OSError:
+                pass
+        if deleted:
+            self.__logger.info("{deleted} entries evicted from the diff cache".format(deleted=deleted))
+        return deleted
+
+
+# Module's methods
+def get_cache_key(snapshot_full_path, origin, mode):
+    """Calculates the key of the differences between a snapshot and a subvolume (or another snapshot).
+
+    The transaction of the filesystem is committed first, so the generation of the subvolume includes
+    every change written until now.
+
+    Arguments:
+        snapshot_full_path (str): Full path to the snapshot.
+        origin (str): Full path to the subvolume (or snapshot) compared.
+        mode (str): Kind of comparison (PARTIAL, FULL, SEND or INDEX).
+
+    Returns:
+        tuple (str, bool): the key and if the result will never be stale. (None, False) if the subvolumes
+        can't be identified.
+    """
+    btrfs_ioctl = ioctl.BtrfsIoctl()
+    try:
+        btrfs_ioctl.sync_filesystem(origin)
+    except OSError:
+        pass
+    identifiers = []
+    permanent = True
+    for path in (snapshot_full_path, origin):
+        try:
+            subvolume_info = btrfs_ioctl.get_subvolume_info(path)
+        except OSError:
+            subvolume_info = None
+        if subvolume_info is None or not subvolume_info.uuid:
+            return None, False
+        if subvolume_info.readonly:
+            identifiers.append(subvolume_info.uuid)
+        else:
+            identifiers.append("{uuid}@{generation}".format(uuid=subvolume_info.uuid,
+                                                            generation=subvolume_info.generation))
+            permanent = False
+    return "{snapshot}:{origin}:{mode}".format(snapshot=identifiers[0], origin=identifiers[1], mode=mode), permanent
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to storing and browsing the differences found between a snapshot
+and a subvolume (or another snapshot).
+
+The paths of every category are stored sorted (a directory is followed by its content) together with an array of
+their offsets, so the file is mapped in memory and any path is read in constant time without loading the rest.
+The content of a directory is a contiguous range of paths found using binary search, so a directory is browsed,
+counted or exported without reading the paths outside it. It provides also DiffResults class.
+"""
+from . import diff, fileindex
+import array
+import json
+import mmap
+import os
+import struct
+
+# Constants
+RESULTS_FILE = "differences.bmdiff"
+RESULTS_MAGIC = b"BMDIFF01"
+# Magic, length of the metadata and number of paths of every category
+RESULTS_HEADER = struct.Struct("<8sQQQQ")
+OFFSET_TYPE = "Q"
+VALUE_TYPE = "Q"
+CATEGORIES = (diff.ONLY_IN_ORIGIN, diff.ONLY_IN_SNAPSHOT, diff.MODIFIED)
+# Prefixes used when the differences are exported, as 'buttermanager diff' prints them
+EXPORT_PREFIXES = {diff.ONLY_IN_ORIGIN: "+ ", diff.ONLY_IN_SNAPSHOT: "- ", diff.MODIFIED: "M "}
+
+
+# Classes
+class DiffResults:
+    """Differences stored by write_results, mapped in memory.
+
+    Rows are the positions of the paths within their category. Paths start with a slash, f.i.: /etc/fstab, and
+    the root directory is ''. Every path may have a value (the bytes written in partial comparisons).
+    """
+    # Constructor
+    def __init__(self, results_path):
+        """ Constructor. Only the header is read.
+
+        Arguments:
+            results_path (str): Full path to the file.
+        """
+        self.__offset_size = array.array(OFFSET_TYPE).itemsize
+        self.__value_size = array.array(VALUE_TYPE).itemsize
+        with open(results_path, "rb") as results_file:
+            self.__map = mmap.mmap(results_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, metadata_length, *counts = RESULTS_HEADER.unpack_from(self.__map, 0)
+        if magic != RESULTS_MAGIC:
+            self.__map.close()
+            raise ValueError("{path} doesn't contain differences".format(path=results_path))
+        position = RESULTS_HEADER.size
+        self.__metadata = json.loads(self.__map[position:position + metadata_length].decode('utf-8'))
+        position += metadata_length
+        # Positions of the offsets, the values and the paths of every category
+        self.__counts = {}
+        self.__sections = {}
+        for category, count in zip(CATEGORIES, counts):
+            offsets_position = position
+            values_position = offsets_position + (count + 1) * self.__offset_size
+            paths_position = values_position + count * self.__value_size
+            self.__counts[category] = count
+            self.__sections[category] = (offsets_position, values_position, paths_position)
+            position = paths_position + self.__read_offset(category, count)
+
+    # Private attributes
+    # Subvolume (or snapshot) and snapshot compared, and kind of comparison
+    @property
+    def metadata(self):
+        return self.__metadata
+
+    # Methods
+    # Private methods
+    def __read_offset(self, category, row):
+        """Reads where a path starts within the paths of its category.
+
+        Arguments:
+            category (str): Category of the path.
+            row (int): Row of the path.
+
+        Returns:
+            int: Offset of the path.
+        """
+        return struct.unpack_from(OFFSET_TYPE, self.__map,
+                                  self.__sections[category][0] + row * self.__offset_size)[0]
+
+    def __get_component(self, category, row, depth):
+        """Gets a component of a path.
+
+        Arguments:
+            category (str): Category of the path.
+            row (int): Row of the path.
+            depth (int): Position of the component (0 is the empty component before the first slash).
+
+        Returns:
+            str: The component. None if the path has fewer components.
+        """
+        components = fileindex.get_sort_key(self.get_path(category, row))
+        return components[depth] if depth < len(components) else None
+
+    def __search(self, category, low, high, predicate):
+        """Finds the first row whose path satisfies a condition, which is satisfied by all the rows after it.
+
+        Arguments:
+            category (str): Category of the paths.
+            low (int): First row of the search.
+            high (int): Row after the last row of the search.
+            predicate (function): Condition which receives the components of a path.
+
+        Returns:
+            int: The first row found. high if no row satisfies the condition.
+        """
+        while low < high:
+            middle = (low + high) // 2
+            if predicate(fileindex.get_sort_key(self.get_path(category, middle))):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    # Public methods
+    def count(self, category):
+        """Gets the number of paths of a category.
+
+        Arguments:
+            category (str): ONLY_IN_ORIGIN, ONLY_IN_SNAPSHOT or MODIFIED.
+
+        Returns:
+            int: Number of paths.
+        """
+        return self.__counts[category]
+
+    def get_path(self, category, row):
+        """Reads a path.
+
+        Arguments:
+            category (str): Category of the path.
+            row (int): Row of the path.
+
+        Returns:
+            str: The path, f.i.: /etc/fstab.
+        """
+        paths_position = self.__sections[category][2]
+        return os.fsdecode(self.__map[paths_position + self.__read_offset(category, row):
+                                      paths_position + self.__read_offset(category, row + 1)])
+
+    def get_value(self, category, row):
+        """Reads the value of a path.
+
+        Arguments:
+            category (str): Category of the path.
+            row (int): Row of the path.
+
+        Returns:
+            int: The value (the bytes written in partial comparisons; 0 otherwise).
+        """
+        return struct.unpack_from(VALUE_TYPE, self.__map, self.__sections[category][1] + row * self.__value_size)[0]
+
+    def get_range(self, category, directory):
+        """Finds the paths of a category within a directory, including the directory itself.
+
+        Arguments:
+            category (str): Category of the paths.
+            directory (str): Path of the directory, f.i.: /etc ('' for the root directory).
+
+        Returns:
+            tuple (int, int): the first row and the row after the last one.
+        """
+        key = fileindex.get_sort_key(directory)
+        depth = len(key)
+        start = self.__search(category, 0, self.__counts[category], lambda components: components[:depth] >= key)
+        end = self.__search(category, start, self.__counts[category], lambda components: components[:depth] > key)
+        return start, end
+
+    def get_children(self, directory, ranges):
+        """Groups the paths within a directory by its children, merging the categories.
+
+        Every child costs a binary search per category, so a directory is browsed without reading all the paths
+        within it.
+
+        Arguments:
+            directory (str): Path of the directory ('' for the root directory).
+            ranges (dictionary): rows within the directory by category as (first, after last) tuples, as returned
+            by get_range. Rows of the directory itself are skipped.
+
+        Returns:
+            generator (:obj:`tuple`): children as (name, ranges, category) tuples sorted by name. Ranges are the
+            rows within the child by category and category is the category of the child itself (None if it is only
+            a directory which contains other paths).
+        """
+        depth = len(fileindex.get_sort_key(directory))
+        positions = {}
+        for category, (start, end) in ranges.items():
+            # The directory itself precedes its content
+            if start < end and self.__get_component(category, start, depth) is None:
+                start += 1
+            positions[category] = (start, end)
+        while True:
+            names = [self.__get_component(category, start, depth) for category, (start, end) in positions.items()
+                     if start < end]
+            if not names:
+                return
+            name = min(names)
+            child_ranges = {}
+            child_category = None
+            for category, (start, end) in positions.items():
+                if start < end and self.__get_component(category, start, depth) == name:
+                    child_end = self.__search(category, start, end,
+                                              lambda components: components[depth] > name)
+                    if self.__get_component(category, start, depth + 1) is None:
+                        child_category = category
+                    child_ranges[category] = (start, child_end)
+                    positions[category] = (child_end, end)
+                else:
+                    child_ranges[category] = (start, start)
+            yield name, child_ranges, child_category
+
+    def export(self, output_path, categories=CATEGORIES, directory=""):
+        """Writes the paths within a directory to a text file, one per line and prefixed by their category as
+        'buttermanager diff' prints them. Paths are streamed, so memory doesn't depend on their number.
+
+        Arguments:
+            output_path (str): Full path to the text file.
+            categories (:obj:`list` of :obj:`str`): Categories to export (default all the categories).
+            directory (str): Path of the directory ('' for the root directory) (default '').
+
+        Returns:
+            int: Number of paths exported.
+        """
+        exported = 0
+        with open(output_path, "w", encoding="utf-8", errors="surrogateescape") as output_file:
+            for category in categories:
+                start, end = self.get_range(category, directory)
+                for row in range(start, end):
+                    output_file.write(EXPORT_PREFIXES[category] + self.get_path(category, row) + "\n")
+                exported += end - start
+        return exported
+
+    def close(self):
+        """Unmaps the file.
+
+        """
+        self.__map.close()
+
+
+# Module's methods
+def write_results(differences, results_path, metadata=None):
+    """Stores the differences found by diff.get_differences so they can be browsed using DiffResults.
+    The file is replaced atomically.
+
+    Arguments:
+        differences (dictionary): paths by category. The bytes written in every path (key: 'bytes') are stored as
+        their values.
+        results_path (str): Full path to the file.
+        metadata (dictionary): Information about the comparison which can be serialized as JSON (default None).
+    """
+    encoded_metadata = json.dumps(metadata or {}).encode('utf-8')
+    values = differences.get("bytes", {})
+    sorted_paths = [sorted(differences.get(category, []), key=fileindex.get_sort_key) for category in CATEGORIES]
+    temporary_path = "{path}.{pid}.tmp".format(path=results_path, pid=os.getpid())
+    try:
+        with open(temporary_path, "wb") as results_file:
+            results_file.write(RESULTS_HEADER.pack(RESULTS_MAGIC, len(encoded_metadata),
+                                                   *(len(paths) for paths in sorted_paths)))
+            results_file.write(encoded_metadata)
+            for paths in sorted_paths:
+                encoded_paths = [os.fsencode(path) for path in paths]
+                offsets = array.array(OFFSET_TYPE, [0])
+                for encoded_path in encoded_paths:
+                    offsets.append(offsets[-1] + len(encoded_path))
+                offsets.tofile(results_file)
+                array.array(VALUE_TYPE, (values.get(path, 0) for path in paths)).tofile(results_file)
+                results_file.writelines(encoded_paths)
+        os.replace(temporary_path, results_path)
+    except OSError:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
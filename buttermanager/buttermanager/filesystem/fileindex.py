@@ -0,0 +1,621 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to indexing the files of a snapshot.
+
+An index stores the path, size, modification time, inode and mode of every entry of a snapshot, sorted by
+path (a directory is followed by its content). Read-only snapshots never change, so their indexes are built
+once and stored in the application directory using their UUID as name. Comparing or searching snapshots
+reads their indexes instead of walking their trees: a search maps the index in memory and runs a single regular
+expression over all its paths at once, without loading the rest of the index. It provides also FileIndex class.
+"""
+from ..util import settings, utils
+from . import ioctl
+import array
+import bisect
+import errno
+import mmap
+import os
+import re
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+
+# Constants
+INDEX_DIR = "indexes"
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"BMINDEX2"
+# Magic, number of entries and length of the paths in bytes
+INDEX_HEADER = struct.Struct("<8sQQ")
+# Paths are stored one after another separated by new lines, so they are searched as they are stored ('^' and
+# '$' match the beginning and the end of every path). The offsets delimit paths containing new lines. The rest
+# of the attributes are stored as arrays (offsets of the paths, sizes, modification times in ns, inodes and modes)
+PATH_SEPARATOR = b"\n"
+OFFSET_TYPE = "Q"
+SIZE_TYPE = "Q"
+MTIME_TYPE = "q"
+INODE_TYPE = "Q"
+MODE_TYPE = "L"
+# Fields printed by find: type, permissions, inode, size, modification time and path relative to the tree
+FIND_ARGUMENTS = ["find"]
+FIND_PRINTF = "%y %m %i %s %T@ %P\\0"
+FIND_TYPES = {"f": stat.S_IFREG, "d": stat.S_IFDIR, "l": stat.S_IFLNK, "b": stat.S_IFBLK, "c": stat.S_IFCHR,
+              "p": stat.S_IFIFO, "s": stat.S_IFSOCK}
+
+
+# Classes
+class FileIndex:
+    """Metadata of every entry of a tree, sorted by path.
+
+    Paths are relative to the tree, f.i.: etc/fstab. The tree itself is not included.
+    """
+    # Constructor
+    def __init__(self, paths, sizes, mtimes, inodes, modes):
+        """ Constructor.
+
+        Arguments:
+            paths (:obj:`list` of :obj:`str`): Paths of the entries, sorted using get_sort_key.
+            sizes (array.array): Sizes of the entries in bytes.
+            mtimes (array.array): Modification times of the entries in nanoseconds since the epoch.
+            inodes (array.array): Inodes of the entries.
+            modes (array.array): Modes (type and permissions) of the entries.
+        """
+        self.__paths = paths
+        self.__sizes = sizes
+        self.__mtimes = mtimes
+        self.__inodes = inodes
+        self.__modes = modes
+
+    # Private attributes
+    # Paths of the entries
+    @property
+    def paths(self):
+        return self.__paths
+
+    # Sizes of the entries
+    @property
+    def sizes(self):
+        return self.__sizes
+
+    # Modification times of the entries (ns)
+    @property
+    def mtimes(self):
+        return self.__mtimes
+
+    # Inodes of the entries
+    @property
+    def inodes(self):
+        return self.__inodes
+
+    # Modes of the entries
+    @property
+    def modes(self):
+        return self.__modes
+
+    # Methods
+    def __len__(self):
+        return len(self.__paths)
+
+    def save(self, index_path):
+        """Stores the index in a file. The file is replaced atomically.
+
+        Arguments:
+            index_path (str): Full path to the file.
+        """
+        encoded_paths = PATH_SEPARATOR.join(os.fsencode(path) for path in self.__paths)
+        offsets = array.array(OFFSET_TYPE)
+        offset = 0
+        for path in self.__paths:
+            offsets.append(offset)
+            offset += len(os.fsencode(path)) + 1
+        temporary_path = "{path}.{pid}.tmp".format(path=index_path, pid=os.getpid())
+        try:
+            with open(temporary_path, "wb") as index_file:
+                index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(self.__paths), len(encoded_paths)))
+                index_file.write(encoded_paths)
+                for values in (offsets, self.__sizes, self.__mtimes, self.__inodes, self.__modes):
+                    values.tofile(index_file)
+            os.replace(temporary_path, index_path)
+        except OSError:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+
+# Module's methods
+def get_sort_key(path):
+    """Calculates the key used to sort the paths of an index, so a directory is followed by its content.
+
+    Arguments:
+        path (str): Path relative to the tree.
+
+    Returns:
+        list (:obj:`list` of :obj:`str`): components of the path.
+
+    >>> sorted(["etc-backup", "etc/fstab", "etc"], key=get_sort_key)
+    ['etc', 'etc/fstab', 'etc-backup']
+    """
+    return path.split("/")
+
+
+def build_index(tree_path):
+    """Builds the index of a tree. Nested subvolumes and mount points are not indexed.
+
+    If buttermanager is running as root, the tree is walked directly. Otherwise, find is executed using sudo.
+
+    Arguments:
+        tree_path (str): Full path to the tree, f.i.: /mnt/defvol/_snapshots/root-20201021-0.
+
+    Returns:
+        FileIndex: The index.
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    logger.info("Indexing {tree}".format(tree=tree_path))
+    entries = walk_tree(tree_path) if ioctl.is_privileged() else find_tree(tree_path)
+    entries.sort(key=lambda entry: get_sort_key(entry[0]))
+    index = FileIndex([entry[0] for entry in entries],
+                      array.array(SIZE_TYPE, (entry[1] for entry in entries)),
+                      array.array(MTIME_TYPE, (entry[2] for entry in entries)),
+                      array.array(INODE_TYPE, (entry[3] for entry in entries)),
+                      array.array(MODE_TYPE, (entry[4] for entry in entries)))
+    logger.info("{tree} indexed: {entries} entries".format(tree=tree_path, entries=len(index)))
+    return index
+
+
+def walk_tree(tree_path):
+    """Retrieves the metadata of every entry of a tree walking it without following symbolic links.
+
+    Arguments:
+        tree_path (str): Full path to the tree.
+
+    Returns:
+        list (:obj:`list` of :obj:`tuple`): entries as (path, size, mtime, inode, mode) tuples, unsorted.
+    """
+    entries = []
+    device = os.lstat(tree_path).st_dev
+    pending = [""]
+    while pending:
+        relative_path = pending.pop()
+        try:
+            with os.scandir(os.path.join(tree_path, relative_path)) as iterator:
+                for entry in iterator:
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    entry_path = os.path.join(relative_path, entry.name)
+                    entries.append((entry_path, entry_stat.st_size, entry_stat.st_mtime_ns, entry_stat.st_ino,
+                                    entry_stat.st_mode))
+                    if stat.S_ISDIR(entry_stat.st_mode) and entry_stat.st_dev == device:
+                        pending.append(entry_path)
+        except OSError:
+            pass
+    return entries
+
+
+def find_tree(tree_path):
+    """Retrieves the metadata of every entry of a tree using 'sudo find'.
+
+    Arguments:
+        tree_path (str): Full path to the tree.
+
+    Returns:
+        list (:obj:`list` of :obj:`tuple`): entries as (path, size, mtime, inode, mode) tuples, unsorted.
+
+    Raises:
+        OSError: find (or sudo) failed, so the entries may be incomplete.
+    """
+    # Errors are written to a temporary file, so find is never blocked while its output is read
+    with tempfile.TemporaryFile() as error_file:
+        result = subprocess.Popen(["sudo", "-S"] + FIND_ARGUMENTS + [tree_path.rstrip("/") + "/", "-xdev",
+                                                                     "-mindepth", "1", "-printf", FIND_PRINTF],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=error_file)
+        result.stdin.write((settings.user_password + "\n").encode())
+        result.stdin.close()
+        entries = []
+        pending = b""
+        for chunk in iter(lambda: result.stdout.read(64 * 1024), b""):
+            records = (pending + chunk).split(b"\0")
+            pending = records.pop()
+            for record in records:
+                entry = parse_find_record(record)
+                if entry is not None:
+                    entries.append(entry)
+        if result.wait() != 0:
+            error_file.seek(0)
+            error = error_file.read().decode(errors="replace").strip()
+            raise OSError(errno.EIO, "Error indexing {tree}: {error}".format(tree=tree_path,
+                                                                             error=error or "find failed"))
+    return entries
+
+
+def parse_find_record(record):
+    """Parses an entry printed by find using FIND_PRINTF.
+
+    Arguments:
+        record (bytes): Entry printed by find, without the NUL at the end.
+
+    Returns:
+        tuple: (path, size, mtime, inode, mode). None if the record can't be parsed.
+
+    >>> parse_find_record(b"f 644 257 1024 1603276800.5000000000 etc/my fstab")
+    ('etc/my fstab', 1024, 1603276800500000000, 257, 33188)
+    """
+    fields = record.split(b" ", 5)
+    if len(fields) != 6 or not fields[5]:
+        return None
+    try:
+        file_type, permissions, inode, size, mtime = (field.decode() for field in fields[:5])
+        seconds, _, fraction = mtime.partition(".")
+        mtime_ns = int(seconds) * 1000000000 + int((fraction + "000000000")[:9])
+        mode = FIND_TYPES.get(file_type, 0) | int(permissions, 8)
+        return os.fsdecode(fields[5]), int(size), mtime_ns, int(inode), mode
+    except ValueError:
+        return None
+
+
+def read_index_header(index_file, index_path):
+    """Reads and checks the header of an index stored using FileIndex.save.
+
+    Arguments:
+        index_file (file): The index opened in binary mode, at the beginning.
+        index_path (str): Full path to the file.
+
+    Returns:
+        tuple (int, int): number of entries and length of the paths in bytes.
+    """
+    header = index_file.read(INDEX_HEADER.size)
+    if len(header) != INDEX_HEADER.size:
+        raise ValueError("Index {index} truncated".format(index=index_path))
+    magic, count, paths_length = INDEX_HEADER.unpack(header)
+    if magic != INDEX_MAGIC:
+        raise ValueError("{index} is not an index".format(index=index_path))
+    return count, paths_length
+
+
+def is_index_stored(index_path):
+    """Checks if an index has been stored using the current format.
+
+    Arguments:
+        index_path (str): Full path to the file.
+
+    Returns:
+        bool: True if the index exists and it can be read; False if it has to be built again.
+    """
+    try:
+        with open(index_path, "rb") as index_file:
+            read_index_header(index_file, index_path)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def load_index(index_path):
+    """Reads an index stored using FileIndex.save.
+
+    Arguments:
+        index_path (str): Full path to the file.
+
+    Returns:
+        FileIndex: The index.
+    """
+    with open(index_path, "rb") as index_file:
+        count, paths_length = read_index_header(index_file, index_path)
+        encoded_paths = index_file.read(paths_length)
+        attributes = []
+        for type_code in (OFFSET_TYPE, SIZE_TYPE, MTIME_TYPE, INODE_TYPE, MODE_TYPE):
+            values = array.array(type_code)
+            try:
+                values.fromfile(index_file, count)
+            except EOFError:
+                raise ValueError("Index {index} truncated".format(index=index_path))
+            attributes.append(values)
+    offsets = attributes[0]
+    paths = encoded_paths.split(PATH_SEPARATOR) if count else []
+    if len(paths) != count:
+        # Some paths contain new lines
+        paths = [encoded_paths[offsets[entry]:offsets[entry + 1] - 1] for entry in range(count - 1)] + \
+                [encoded_paths[offsets[-1]:]]
+    return FileIndex([os.fsdecode(path) for path in paths], *attributes[1:])
+
+
+def get_index_path(uuid):
+    """Calculates the path of the file which stores the index of a snapshot.
+
+    Arguments:
+        uuid (str): UUID of the snapshot.
+
+    Returns:
+        str: Full path to the file.
+    """
+    return os.path.join(settings.application_path, INDEX_DIR, uuid + INDEX_SUFFIX)
+
+
+def get_stored_index_path(snapshot_full_path):
+    """Calculates the path of the file which stores (or will store) the index of a snapshot.
+
+    Arguments:
+        snapshot_full_path (str): Full path to the snapshot.
+
+    Returns:
+        str: Full path to the file. None if the snapshot is not read-only, so its index can't be stored.
+    """
+    try:
+        subvolume_info = ioctl.get_subvolume_info(snapshot_full_path)
+    except OSError:
+        return None
+    if subvolume_info is None or not subvolume_info.readonly or not subvolume_info.uuid:
+        return None
+    return get_index_path(subvolume_info.uuid)
+
+
+def store_index(tree_path, index_path):
+    """Builds the index of a tree and stores it.
+
+    Arguments:
+        tree_path (str): Full path to the tree.
+        index_path (str): Full path to the file which will store the index.
+
+    Returns:
+        FileIndex: The index.
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    index = build_index(tree_path)
+    try:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        index.save(index_path)
+    except OSError as os_error_exception:
+        logger.error("Error storing the index of {tree}: {error}".format(tree=tree_path,
+                                                                         error=str(os_error_exception)))
+    return index
+
+
+def get_index(tree_path):
+    """Retrieves the index of a tree. The index of a read-only snapshot is built only once and stored in the
+    application directory; any other tree is indexed every time.
+
+    Arguments:
+        tree_path (str): Full path to the tree (a snapshot or a subvolume).
+
+    Returns:
+        FileIndex: The index.
+    """
+    index_path = get_stored_index_path(tree_path)
+    if index_path is None:
+        return build_index(tree_path)
+    try:
+        return load_index(index_path)
+    except (OSError, ValueError):
+        return store_index(tree_path, index_path)
+
+
+def delete_index(index_path):
+    """Deletes a stored index if it exists.
+
+    Arguments:
+        index_path (str): Full path to the file which stores the index.
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    try:
+        os.remove(index_path)
+        logger.info("Index {index} deleted".format(index=index_path))
+    except FileNotFoundError:
+        pass
+    except OSError as os_error_exception:
+        logger.error("Error deleting the index {index}: {error}".format(index=index_path,
+                                                                         error=str(os_error_exception)))
+
+
+def prune_indexes(index_paths):
+    """Deletes the stored indexes (and the temporary files left by interrupted indexings) except the given ones,
+    so the indexes of the snapshots deleted outside ButterManager don't stay forever.
+
+    Arguments:
+        index_paths (set): Full paths to the indexes to keep.
+
+    Returns:
+        list (:obj:`list` of :obj:`str`): full paths to the indexes deleted.
+    """
+    index_dir = os.path.join(settings.application_path, INDEX_DIR)
+    try:
+        names = os.listdir(index_dir)
+    except FileNotFoundError:
+        return []
+    deleted = []
+    for name in names:
+        index_path = os.path.join(index_dir, name)
+        if index_path not in index_paths:
+            delete_index(index_path)
+            deleted.append(index_path)
+    return deleted
+
+
+def compile_query(query, regex=False):
+    """Compiles the query used to search files within the indexes.
+
+    A glob without '/' is matched against the names of the files (f.i.: *.conf); otherwise it is matched against
+    the whole path relative to the snapshot (f.i.: etc/*.conf). A regular expression is searched within the
+    path relative to the snapshot. Paths are separated by new lines while they are searched, so '^' and '$'
+    match the beginning and the end of every path.
+
+    Arguments:
+        query (str): Glob or regular expression.
+        regex (bool): The query is a regular expression (default False).
+
+    Returns:
+        re.Pattern: The compiled query (bytes).
+
+    >>> bool(compile_query("*.conf").search(b"etc/pacman.conf"))
+    True
+    """
+    if regex:
+        return re.compile(os.fsencode(query), re.MULTILINE)
+    prefix = "^" if "/" in query else "(?:^|/)"
+    return re.compile(os.fsencode(prefix + translate_glob(query.lstrip("/")) + "$"), re.MULTILINE)
+
+
+def translate_glob(glob_pattern):
+    """Translates a glob into a regular expression. Unlike fnmatch.translate, wildcards don't match '/' nor
+    new lines, so they never match beyond a file name.
+
+    Arguments:
+        glob_pattern (str): Glob, f.i.: *.conf.
+
+    Returns:
+        str: The regular expression, without anchors.
+
+    >>> print(translate_glob("[!a]?.c*"))
+    [^a][^/\\n]\\.c[^/\\n]*
+    """
+    translated = []
+    position = 0
+    while position < len(glob_pattern):
+        character = glob_pattern[position]
+        position += 1
+        if character == "*":
+            translated.append("[^/\\n]*")
+        elif character == "?":
+            translated.append("[^/\\n]")
+        elif character == "[":
+            end = glob_pattern.find("]", position + 1 if glob_pattern[position:position + 1] in ("!", "]") else
+                                    position)
+            if end == -1:
+                translated.append("\\[")
+                continue
+            content = glob_pattern[position:end].replace("\\", "\\\\")
+            position = end + 1
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            elif content.startswith("^"):
+                content = "\\" + content
+            translated.append("[" + content + "]")
+        else:
+            translated.append(re.escape(character))
+    return "".join(translated)
+
+
+def get_glob_literal(glob_pattern):
+    """Retrieves the longest part of a glob without wildcards. Every path matched contains it, so it can be
+    searched before matching the whole glob.
+
+    Arguments:
+        glob_pattern (str): Glob, f.i.: *.conf.
+
+    Returns:
+        bytes: The longest literal, f.i.: b'.conf'. Empty if the glob has no literals.
+
+    >>> get_glob_literal("lib*/python3.[0-9]*")
+    b'/python3.'
+    """
+    literals = re.split(r"\*|\?|\[[^]]*\]?", glob_pattern.lstrip("/"))
+    return os.fsencode(max(literals, key=len))
+
+
+def search_index(index_path, pattern, literal=b""):
+    """Searches files within a stored index. The index is mapped in memory, so only the paths are scanned and
+    the attributes of the files found are the only ones read.
+
+    Arguments:
+        index_path (str): Full path to the file which stores the index.
+        pattern (re.Pattern): Query compiled using compile_query.
+        literal (bytes): Text every path matched contains (see get_glob_literal). Looking for it is much
+        faster than matching the pattern, so only the paths which contain it are matched (default b'').
+
+    Returns:
+        list (:obj:`list` of :obj:`tuple`): files found as (path, size, mtime, mode) tuples. Paths start with
+        '/' and mtime is expressed in nanoseconds since the epoch.
+    """
+    with open(index_path, "rb") as index_file:
+        count, paths_length = read_index_header(index_file, index_path)
+        if count == 0:
+            return []
+        # Positions of the paths and of every array of attributes
+        sections = [INDEX_HEADER.size, INDEX_HEADER.size + paths_length]
+        for type_code in (OFFSET_TYPE, SIZE_TYPE, MTIME_TYPE, INODE_TYPE, MODE_TYPE):
+            sections.append(sections[-1] + array.array(type_code).itemsize * count)
+        if os.fstat(index_file.fileno()).st_size < sections[-1]:
+            raise ValueError("Index {index} truncated".format(index=index_path))
+        with mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as index_map, \
+                memoryview(index_map) as index_view:
+            attributes = [index_view[start:end].cast(type_code) for start, end, type_code in
+                          zip(sections[1:], sections[2:], (OFFSET_TYPE, SIZE_TYPE, MTIME_TYPE, INODE_TYPE, MODE_TYPE))]
+            offsets, sizes, mtimes, _, modes = attributes
+            paths_start, paths_end = sections[0], sections[1]
+            found = []
+            try:
+                # '^' doesn't match where a search starts unless it follows a new line, so the first path is
+                # checked alone. The rest of the index is searched at once. Every match found is checked within
+                # its own path, so a match spanning several paths is discarded, and the search goes on from the
+                # next path
+                entry = 0
+                while True:
+                    path_end = paths_start + offsets[entry + 1] - 1 if entry + 1 < count else paths_end
+                    path = index_map[paths_start + offsets[entry]:path_end]
+                    if pattern.search(path):
+                        found.append(("/" + os.fsdecode(path), sizes[entry], mtimes[entry], modes[entry]))
+                    if path_end >= paths_end:
+                        break
+                    if literal:
+                        match_position = index_map.find(literal, path_end + 1, paths_end)
+                    else:
+                        match = pattern.search(index_map, path_end + 1, paths_end)
+                        match_position = match.start() if match is not None else -1
+                    if match_position == -1:
+                        break
+                    entry = bisect.bisect_right(offsets, match_position - paths_start) - 1
+            finally:
+                for values in attributes:
+                    values.release()
+    return found
+
+
+def search_snapshots(snapshots_full_paths, query, regex=False):
+    """Searches files across several snapshots using their stored indexes. Snapshots which have not been
+    indexed yet are skipped.
+
+    Arguments:
+        snapshots_full_paths (:obj:`list` of :obj:`str`): Full paths to the snapshots.
+        query (str): Glob or regular expression (see compile_query).
+        regex (bool): The query is a regular expression (default False).
+
+    Returns:
+        tuple (dictionary, :obj:`list` of :obj:`str`): snapshots which contain every file found (key: path,
+        value: list of (snapshot, size, mtime, mode) tuples) and snapshots which have not been searched
+        because they are not indexed yet.
+    """
+    pattern = compile_query(query, regex)
+    literal = b"" if regex else get_glob_literal(query)
+    found = {}
+    not_indexed = []
+    for snapshot_full_path in snapshots_full_paths:
+        index_path = get_stored_index_path(snapshot_full_path)
+        try:
+            if index_path is None:
+                raise OSError("{snapshot} is not read-only".format(snapshot=snapshot_full_path))
+            matches = search_index(index_path, pattern, literal)
+        except (OSError, ValueError):
+            not_indexed.append(snapshot_full_path)
+            continue
+        for path, size, mtime, mode in matches:
+            found.setdefault(path, []).append((snapshot_full_path, size, mtime, mode))
+    return found, not_indexed
@@ -21,10 +21,8 @@
 It provides also Filesystem class.
 """
 from ..exception import exception
-from ..window import windows
 import sys
 from ..util import utils
-from PyQt5.QtCore import QThread, pyqtSignal
 
 # Constants
 DEVID = "devid"
@@ -335,76 +333,3 @@ def balance_filesystem(filter, percentage, mounted_point):
     commandline_output = utils.execute_command(command, root=True)
     for line in commandline_output.split("\n"):
         logger.info(line)
-
-
-class BalanceManager(QThread):
-    """Independent thread that will run the filesystem balancing process.
-
-    """
-    # Attributes
-    # pyqtSignal that will be emitted when this class requires to display
-    # a single information window on the screen
-    show_one_window = pyqtSignal('bool')
-
-    # pyqtSignal that will be emitted when this class requires that main
-    # window refreshes current filesystem statistics
-    refresh_filesystem_statistics = pyqtSignal()
-
-    # Constructor
-    def __init__(self, data_percentage, metadata_percentage, mounted_point):
-        QThread.__init__(self)
-        self.__data_percentage = data_percentage
-        self.__metadata_percentage = metadata_percentage
-        self.__mounted_point = mounted_point
-
-    # Methods
-    def run(self):
-        # Main window will be hidden
-        self.on_show_one_window(True)
-        info_dialog = windows.InfoWindow(None, "Balancing '{mounted_point}' mounted point. \n"
-                                                      "This window will be closed automatically \n"
-                                                      "when the operation is done. \n \n"
-                                                      "Please wait...".format(mounted_point=self.__mounted_point))
-        # Displaying info window
-        info_dialog.show()
-
-        # Balances the filesystem
-        self.__balance_filesystem()
-
-        # Hiding info window
-        info_dialog.hide()
-
-        # Main window will be shown again
-        self.on_show_one_window(False)
-
-        # Refreshing current filesystem statistics
-        self.on_refresh_filesystem_statistics()
-
-    def __balance_filesystem(self):
-        """Wraps all the operations to balance the filesystem.
-
-        """
-        # Balancing data
-        balance_filesystem(
-            BTRFS_BALANCE_DATA_USAGE_FILTER,
-            self.__data_percentage,
-            self.__mounted_point)
-        # Balancing metadata
-        balance_filesystem(
-            BTRFS_BALANCE_METADATA_USAGE_FILTER,
-            self.__metadata_percentage,
-            self.__mounted_point)
-
-    def on_show_one_window(self, one_window):
-        """Emits a QT Signal to hide or show the rest of application windows.
-
-        Arguments:
-            one_window (boolean): Information window should be unique?.
-        """
-        self.show_one_window.emit(one_window)
-
-    def on_refresh_filesystem_statistics(self):
-        """Emits a QT Signal to refresh filesystem statistics in main window.
-
-        """
-        self.refresh_filesystem_statistics.emit()
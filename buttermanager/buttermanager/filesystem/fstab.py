@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to /etc/fstab files.
+
+It provides also Fstab and FstabEntry classes.
+"""
+from ..exception import exception
+from ..util import utils
+from . import mountinfo
+import os
+import stat
+import tempfile
+
+# Constants
+FSTAB_RELATIVE_PATH = "etc/fstab"
+ROOT_MOUNT_POINT = "/"
+DEFAULT_MODE = 0o644
+# Shell script executed with root privileges to replace fstab atomically. The paths are passed as
+# positional arguments, so they are never interpreted by the shell
+PRIVILEGED_WRITE_SCRIPT = 'install -m "$1" "$2" "$3.buttermanager-new" && mv -f "$3.buttermanager-new" "$3"'
+
+
+# Classes
+class FstabEntry:
+    """Line of a fstab file.
+
+    Comments and blank lines are kept untouched so the file can be written back exactly as it was
+    except for the modified entries.
+    """
+    # Constructor
+    def __init__(self, line):
+        """ Constructor.
+
+        Arguments:
+            line (str): Line of the fstab file (without the new line character).
+        """
+        self.__line = line
+        self.__modified = False
+        self.__fields = []
+        stripped_line = line.strip()
+        if stripped_line and not stripped_line.startswith("#"):
+            self.__fields = stripped_line.split()
+
+    # Private attributes
+    # Is it a comment or a blank line?
+    @property
+    def is_comment(self):
+        return len(self.__fields) < 4
+
+    # Device (or UUID=..., LABEL=...)
+    @property
+    def device(self):
+        return None if self.is_comment else self.__fields[0]
+
+    # Mount point
+    @property
+    def mount_point(self):
+        return None if self.is_comment else mountinfo.unescape(self.__fields[1])
+
+    # Filesystem type
+    @property
+    def fs_type(self):
+        return None if self.is_comment else self.__fields[2]
+
+    # Mount options
+    @property
+    def options(self):
+        return [] if self.is_comment else self.__fields[3].split(",")
+
+    # Methods
+    def get_option(self, option):
+        """Gets the value of a mount option.
+
+        Arguments:
+            option (str): Name of the option, f.i.: subvol.
+
+        Returns:
+            str: The value of the option. None if the option was not found.
+        """
+        for mount_option in self.options:
+            name, _, value = mount_option.partition("=")
+            if name == option:
+                return value
+        return None
+
+    def set_option(self, option, value):
+        """Sets the value of a mount option. The option is appended if it doesn't exist.
+
+        Arguments:
+            option (str): Name of the option, f.i.: subvol.
+            value (str): Value of the option. If it is None, the option will be removed.
+        """
+        options = []
+        found = False
+        for mount_option in self.options:
+            if mount_option.partition("=")[0] == option:
+                found = True
+                if value is not None:
+                    options.append("{option}={value}".format(option=option, value=value))
+            else:
+                options.append(mount_option)
+        if not found and value is not None:
+            options.append("{option}={value}".format(option=option, value=value))
+        self.__fields[3] = ",".join(options)
+        self.__modified = True
+
+    def __str__(self):
+        """Reimplementation of the str method inherited from object class.
+
+        Returns:
+            string: The line of the fstab file.
+        """
+        if self.__modified:
+            return "\t".join(self.__fields)
+        return self.__line
+
+
+class Fstab:
+    """Fstab file.
+
+    """
+    # Constructor
+    def __init__(self, path):
+        """ Constructor.
+
+        Arguments:
+            path (str): Path of the fstab file, f.i.: /mnt/defvol/_snapshots/root-20201021-0/etc/fstab.
+        """
+        self.__path = path
+        with open(path, 'r') as fstab_file:
+            self.__entries = [FstabEntry(line.rstrip("\n")) for line in fstab_file]
+
+    # Private attributes
+    # Path
+    @property
+    def path(self):
+        return self.__path
+
+    # Entries
+    @property
+    def entries(self):
+        return self.__entries
+
+    # Methods
+    def get_root_entry(self):
+        """Gets the entry of the root filesystem.
+
+        Returns:
+            FstabEntry: The entry whose mount point is /. None if it was not found.
+        """
+        for entry in self.__entries:
+            if not entry.is_comment and entry.mount_point == ROOT_MOUNT_POINT:
+                return entry
+        return None
+
+    def set_root_subvolume(self, subvolume_path, subvolume_id=None):
+        """Changes the subvolume mounted as root.
+
+        The subvol option of the root entry is replaced keeping its original format (with or without
+        the starting /). If the entry has a subvolid option, it is replaced by subvolume_id or removed if
+        subvolume_id is not specified, because it would not match the new subvolume.
+
+        Arguments:
+            subvolume_path (str): Path of the subvolume relative to the top level subvolume, f.i.:
+            _snapshots/root-20201021-0.
+            subvolume_id (int): ID of the subvolume (default None).
+
+        Returns:
+            str: The previous value of subvol option.
+        """
+        root_entry = self.get_root_entry()
+        if root_entry is None:
+            raise exception.FstabModification("There is no entry for / in {path}".format(path=self.__path))
+
+        previous_subvolume = root_entry.get_option(mountinfo.SUBVOL_OPTION)
+        subvolume_path = subvolume_path.strip("/")
+        if previous_subvolume is None or previous_subvolume.startswith("/"):
+            subvolume_path = "/" + subvolume_path
+        root_entry.set_option(mountinfo.SUBVOL_OPTION, subvolume_path)
+        if root_entry.get_option(mountinfo.SUBVOLID_OPTION) is not None:
+            root_entry.set_option(mountinfo.SUBVOLID_OPTION,
+                                  str(subvolume_id) if subvolume_id is not None else None)
+        return previous_subvolume
+
+    def write(self, path=None):
+        """Writes the fstab file atomically.
+
+        The new content is written into a temporary file which replaces the old one. If the current user
+        can't write the file, only one privileged command will be executed to do it.
+
+        Arguments:
+            path (str): Path where the file will be written. By default, the path it was read from.
+        """
+        path = path if path is not None else self.__path
+        content = str(self)
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            mode = DEFAULT_MODE
+
+        if os.access(os.path.dirname(path), os.W_OK):
+            file_descriptor, temporary_path = tempfile.mkstemp(prefix=".fstab", dir=os.path.dirname(path))
+            try:
+                with os.fdopen(file_descriptor, 'w') as temporary_file:
+                    temporary_file.write(content)
+                    temporary_file.flush()
+                    os.fsync(temporary_file.fileno())
+                os.chmod(temporary_path, mode)
+                os.replace(temporary_path, path)
+            except OSError as os_error_exception:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                raise exception.FstabModification("Error writing {path}: {error}".format(
+                    path=path, error=str(os_error_exception)))
+        else:
+            file_descriptor, temporary_path = tempfile.mkstemp(prefix="buttermanager-fstab")
+            try:
+                with os.fdopen(file_descriptor, 'w') as temporary_file:
+                    temporary_file.write(content)
+                result = utils.execute_command_list(["sh", "-c", PRIVILEGED_WRITE_SCRIPT, "sh",
+                                                     "{mode:o}".format(mode=mode), temporary_path, path],
+                                                    root=True)
+                if result.returncode != 0:
+                    raise exception.FstabModification("Error writing {path}: {error}".format(
+                        path=path, error=result.stderr.strip()))
+            finally:
+                os.remove(temporary_path)
+
+    def __str__(self):
+        """Reimplementation of the str method inherited from object class.
+
+        Returns:
+            string: Content of the fstab file.
+        """
+        return "".join(str(entry) + "\n" for entry in self.__entries)
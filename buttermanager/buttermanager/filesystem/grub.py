@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to the regeneration of GRUB entries.
+
+It provides also GrubRegenerator class.
+"""
+from ..exception import exception
+from ..util import settings, utils
+import os
+import sys
+import threading
+import time
+
+# Constants
+GRUB_CFG_PATH = "/boot/grub/grub.cfg"
+GRUB_BTRFS_COMMAND = "sudo -S grub-mkconfig -o /boot/grub/grub.cfg"
+# grub-btrfs script that generates the snapshots submenu (grub-btrfs.cfg) sourced from grub.cfg
+GRUB_BTRFS_SCRIPT = "/etc/grub.d/41_snapshots-btrfs"
+GRUB_BTRFS_SUBMENU_COMMAND = "sudo -S /etc/grub.d/41_snapshots-btrfs"
+GRUB_CFG_CHECK_COMMAND = "sudo -S grep -c 41_snapshots-btrfs /boot/grub/grub.cfg"
+# Seconds without new snapshot operations before GRUB entries are regenerated
+REGENERATION_DELAY = 5
+
+
+# Classes
+class GrubRegenerator:
+    """Coalesces all the GRUB regenerations requested by snapshot operations.
+
+    Snapshot operations only mark the boot menu as dirty. GRUB entries are regenerated once, when no
+    more operations have been requested for a while (the burst of operations has ended) or when
+    flush method is invoked explicitly. Long operations (f.i. the upgrading process) can hold the
+    regenerator in order to postpone the regeneration until they release it.
+
+    """
+    # Constructor
+    def __init__(self, delay=REGENERATION_DELAY):
+        """ Constructor.
+
+        Arguments:
+            delay (int): Seconds to wait since the last request before regenerating GRUB entries.
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__delay = delay
+        self.__dirty = False
+        self.__holds = 0
+        self.__timer = None
+        self.__last_regeneration_time = None
+        self.__regenerations = 0
+        # Protects the state of the regenerator
+        self.__lock = threading.Lock()
+        # Only one regeneration can run at the same time
+        self.__regeneration_lock = threading.Lock()
+
+    # Private attributes
+    # Dirty
+    @property
+    def dirty(self):
+        return self.__dirty
+
+    # Seconds spent in the last regeneration (None if there hasn't been any regeneration yet)
+    @property
+    def last_regeneration_time(self):
+        return self.__last_regeneration_time
+
+    # Number of regenerations done
+    @property
+    def regenerations(self):
+        return self.__regenerations
+
+    # Methods
+    # Private methods
+    def __schedule(self):
+        """Restarts the timer that will regenerate GRUB entries. The lock must be acquired.
+
+        """
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.__timer = threading.Timer(self.__delay, self.flush)
+        self.__timer.start()
+
+    def __cancel(self):
+        """Cancels the timer that will regenerate GRUB entries if it is running. The lock must be acquired.
+
+        """
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+    # Public methods
+    def mark_dirty(self):
+        """Marks the boot menu as dirty.
+
+        GRUB entries will be regenerated once the burst of snapshot operations ends. Nothing will be done
+        if grub-btrfs integration is not enabled.
+        """
+        if settings.properties_manager.get_property("grub_btrfs"):
+            with self.__lock:
+                self.__dirty = True
+                if self.__holds == 0:
+                    self.__schedule()
+
+    def hold(self):
+        """Postpones any regeneration until release method is invoked.
+
+        """
+        with self.__lock:
+            self.__holds += 1
+            self.__cancel()
+
+    def release(self):
+        """Releases a previous hold. If there are no more holds and the boot menu is dirty, the
+        regeneration will be scheduled again.
+
+        """
+        with self.__lock:
+            if self.__holds > 0:
+                self.__holds -= 1
+            if self.__holds == 0 and self.__dirty:
+                self.__schedule()
+
+    def flush(self):
+        """Regenerates GRUB entries right now if the boot menu is dirty.
+
+        """
+        with self.__lock:
+            self.__cancel()
+            if not self.__dirty or self.__holds > 0:
+                return
+            self.__dirty = False
+        self.regenerate()
+
+    def regenerate(self, full=False):
+        """Regenerates GRUB entries unconditionally.
+
+        If grub.cfg already sources the snapshots submenu generated by grub-btrfs, only that submenu is
+        rebuilt (os-prober and the rest of /etc/grub.d scripts are not executed). Otherwise, the whole
+        grub.cfg is generated again using grub-mkconfig.
+
+        Arguments:
+            full (bool): Always regenerate the whole grub.cfg (default False).
+
+        Returns:
+            float: Seconds spent regenerating GRUB entries.
+        """
+        with self.__regeneration_lock:
+            start = time.monotonic()
+            if not full and is_snapshots_submenu_sourced():
+                self.__logger.info("Regenerating GRUB snapshots submenu. Please wait...")
+                utils.execute_command(GRUB_BTRFS_SUBMENU_COMMAND, console=True, root=True)
+            else:
+                self.__logger.info("Regenerating GRUB entries. Please wait...")
+                utils.execute_command(GRUB_BTRFS_COMMAND, console=True, root=True)
+            elapsed = time.monotonic() - start
+            self.__last_regeneration_time = elapsed
+            self.__regenerations += 1
+            info_message = "GRUB entries regenerated in {elapsed:.2f} seconds.".format(elapsed=elapsed)
+            self.__logger.info(info_message)
+            sys.stdout.write(info_message)
+            sys.stdout.write("\n")
+            return elapsed
+
+
+# Module's methods
+def is_snapshots_submenu_sourced():
+    """Checks if grub.cfg sources the snapshots submenu generated by grub-btrfs script.
+
+    When grub.cfg has been generated with grub-btrfs installed, it includes the section created by
+    41_snapshots-btrfs script, which sources grub-btrfs.cfg. In that case, running the script alone is
+    enough to refresh the snapshots entries.
+
+    Returns:
+        bool: True if only the snapshots submenu needs to be regenerated; False otherwise.
+    """
+    if not os.access(GRUB_BTRFS_SCRIPT, os.X_OK):
+        return False
+    try:
+        with open(GRUB_CFG_PATH, 'r') as grub_cfg:
+            return any(os.path.basename(GRUB_BTRFS_SCRIPT) in line for line in grub_cfg)
+    except PermissionError:
+        # grub.cfg is only readable by root in some distributions
+        try:
+            commandline_output = utils.execute_command(GRUB_CFG_CHECK_COMMAND, root=True)
+        except exception.NoCommandFound:
+            return False
+        return commandline_output.strip() not in ("", "0")
+    except OSError:
+        return False
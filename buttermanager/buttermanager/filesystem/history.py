@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to the history of a file across the snapshots of its subvolume.
+
+Only the file is looked up in every snapshot (in parallel), so no tree is walked. Snapshots keep the inode
+numbers, generations, times and extents of their subvolume, so two consecutive snapshots contain the same version
+of the file when its metadata is the same or both of them share its extents. No content is read to find the
+versions: it is only read to show the differences between two of them. It provides also FileVersion class.
+"""
+from ..util import settings, utils
+from . import diff, fileindex, ioctl, mountinfo
+import concurrent.futures
+import difflib
+import os
+import stat
+import subprocess
+import sys
+
+# Constants
+# Versions bigger than this are not compared line by line
+MAX_DIFF_SIZE = 1024 * 1024
+# Bytes checked looking for a NUL character to decide if a version is binary
+BINARY_CHECK_SIZE = 8192
+FIND_STAT_ARGUMENTS = ["-maxdepth", "0", "-printf", "%y %m %i %s %T@ %p\\0"]
+CAT_ARGUMENTS = ["cat", "--"]
+
+
+# Classes
+class FileVersion:
+    """Distinct version of a file, found in one or more consecutive snapshots.
+
+    Generation, target and extents are None when they couldn't be retrieved (f.i. buttermanager is not running
+    as root, so the snapshots have been read using sudo).
+    """
+    # Constructor
+    def __init__(self, file_path, snapshot_full_path, mode, inode, size, mtime, generation=None, target=None,
+                 extents=None):
+        """ Constructor.
+
+        Arguments:
+            file_path (str): Full path to the file within the snapshot, f.i.:
+            /mnt/defvol/_snapshots/root-20201021-0/etc/fstab.
+            snapshot_full_path (str): Full path to the snapshot (or the subvolume).
+            mode (int): Mode of the file (type and permissions).
+            inode (int): Inode number.
+            size (int): Size in bytes.
+            mtime (int): Modification time in nanoseconds since the epoch.
+            generation (int): Generation of the inode.
+            target (str): Target of the symbolic link.
+            extents (:obj:`list` of :obj:`tuple`): Extents of the regular file as returned by
+            BtrfsIoctl.get_file_extents.
+        """
+        self.file_path = file_path
+        self.mode = mode
+        self.inode = inode
+        self.size = size
+        self.mtime = mtime
+        self.generation = generation
+        self.target = target
+        self.extents = extents
+        # Snapshots which contain this version, oldest first
+        self.snapshots = [snapshot_full_path]
+
+    # Methods
+    def is_same_version(self, other):
+        """Checks if another file is the same version of this one without reading their content.
+
+        Arguments:
+            other (FileVersion): File found in another snapshot.
+
+        Returns:
+            bool: True if the metadata of both files is the same or their extents prove they have the same
+            content.
+        """
+        if stat.S_IFMT(self.mode) != stat.S_IFMT(other.mode):
+            return False
+        if stat.S_ISLNK(self.mode) and self.target is not None and other.target is not None:
+            return self.target == other.target
+        if (self.inode, self.generation, self.size, self.mtime) == (other.inode, other.generation, other.size,
+                                                                    other.mtime):
+            return True
+        if stat.S_ISREG(self.mode) and self.size == other.size and self.extents is not None \
+                and other.extents is not None:
+            return not diff.get_differing_ranges(self.extents, other.extents, self.size)
+        return False
+
+    def __str__(self):
+        """Reimplementation of the str method inherited from object class.
+
+        Returns:
+            string: String representation of the FileVersion object.
+        """
+        return "FileVersion -> Path: {0}; Size: {1}; Modified: {2}; Snapshots: {3}".format(
+            self.file_path, self.size, self.mtime, len(self.snapshots))
+
+
+# Module's methods
+def get_relative_path(path):
+    """Finds the subvolume defined in ButterManager which contains a file and the path of the file within it.
+
+    The file can be given by its path in the running system (f.i.: /etc/nginx/nginx.conf) or within the
+    origin of the subvolume (f.i.: /mnt/defvol/_active/rootvol/etc/nginx/nginx.conf). It doesn't need to exist
+    anymore.
+
+    Arguments:
+        path (str): Path of the file.
+
+    Returns:
+        tuple (filesystem.snapshot.Subvolume, str): the subvolume and the path of the file relative to it,
+        f.i.: etc/nginx/nginx.conf. (None, None) if no subvolume contains the file.
+    """
+    path = os.path.abspath(path)
+    mounts = mountinfo.get_mounts()
+    # The file may be a symbolic link, so only its directory is resolved
+    file_mount = mountinfo.get_mount(os.path.dirname(path), mounts)
+    file_subvolume_path = mountinfo.get_subvolume_path(os.path.dirname(path), mounts)
+    found = (None, None)
+    found_length = -1
+    for subvolume_key in settings.subvolumes:
+        subvolume = settings.subvolumes[subvolume_key]
+        origin = subvolume.subvolume_origin.rstrip("/") or "/"
+        relative_path = None
+        if path.startswith(origin.rstrip("/") + "/"):
+            relative_path = path[len(origin.rstrip("/")) + 1:]
+        elif file_subvolume_path is not None:
+            origin_mount = mountinfo.get_mount(origin, mounts)
+            origin_subvolume_path = mountinfo.get_subvolume_path(origin, mounts)
+            if origin_subvolume_path is not None and origin_mount.source == file_mount.source:
+                file_relative_path = os.path.join(file_subvolume_path.strip("/"), os.path.basename(path))
+                prefix = origin_subvolume_path.strip("/")
+                if not prefix:
+                    relative_path = file_relative_path
+                elif file_relative_path.startswith(prefix + "/"):
+                    relative_path = file_relative_path[len(prefix) + 1:]
+        # Nested subvolumes are more specific than the subvolumes which contain them
+        if relative_path and len(origin) > found_length:
+            found = (subvolume, relative_path)
+            found_length = len(origin)
+    return found
+
+
+def get_file_version(file_path, snapshot_full_path, btrfs_ioctl, sync=False):
+    """Retrieves the metadata of a file within a snapshot.
+
+    Arguments:
+        file_path (str): Full path to the file within the snapshot.
+        snapshot_full_path (str): Full path to the snapshot.
+        btrfs_ioctl (filesystem.ioctl.BtrfsIoctl): Interface used to retrieve the generation and the extents.
+        sync (bool): Data pending to be written is flushed before retrieving the extents (default False).
+
+    Returns:
+        FileVersion: The file. None if it doesn't exist within the snapshot.
+    """
+    try:
+        file_stat = os.lstat(file_path)
+    except OSError:
+        return None
+    version = FileVersion(file_path, snapshot_full_path, file_stat.st_mode, file_stat.st_ino, file_stat.st_size,
+                          file_stat.st_mtime_ns)
+    try:
+        if stat.S_ISLNK(file_stat.st_mode):
+            version.target = os.readlink(file_path)
+        elif stat.S_ISREG(file_stat.st_mode) or stat.S_ISDIR(file_stat.st_mode):
+            version.generation = btrfs_ioctl.get_inode_generation(file_path)
+            if stat.S_ISREG(file_stat.st_mode):
+                version.extents = btrfs_ioctl.get_file_extents(file_path, sync=sync)
+    except OSError:
+        pass
+    return version
+
+
+def get_file_versions(snapshots_full_paths, relative_path, origin=None, workers=diff.DEFAULT_WORKERS):
+    """Looks up a file in every snapshot.
+
+    If buttermanager is running as root, the file is looked up by a pool of threads. Otherwise, a single
+    'find' is executed using sudo for all the snapshots.
+
+    Arguments:
+        snapshots_full_paths (:obj:`list` of :obj:`str`): Full paths to the snapshots.
+        relative_path (str): Path of the file relative to the snapshots, f.i.: etc/fstab.
+        origin (str): Full path to the subvolume. Its extents are flushed first (default None).
+        workers (int): Number of threads looking up the file (default diff.DEFAULT_WORKERS).
+
+    Returns:
+        list (:obj:`list` of :obj:`FileVersion`): the file found in every snapshot (None if it doesn't exist),
+        in the same order of the snapshots.
+    """
+    relative_path = relative_path.strip("/")
+    files_paths = [os.path.join(snapshot_full_path, relative_path) for snapshot_full_path in snapshots_full_paths]
+    if not ioctl.is_privileged():
+        return find_file_versions(files_paths, snapshots_full_paths)
+    btrfs_ioctl = ioctl.BtrfsIoctl()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(lambda paths: get_file_version(paths[0], paths[1], btrfs_ioctl,
+                                                                sync=paths[1] == origin),
+                                 zip(files_paths, snapshots_full_paths)))
+
+
+def find_file_versions(files_paths, snapshots_full_paths):
+    """Retrieves the metadata of a file within every snapshot using 'sudo find'.
+
+    Arguments:
+        files_paths (:obj:`list` of :obj:`str`): Full paths to the file within every snapshot.
+        snapshots_full_paths (:obj:`list` of :obj:`str`): Full paths to the snapshots.
+
+    Returns:
+        list (:obj:`list` of :obj:`FileVersion`): the file found in every snapshot (None if it doesn't exist).
+    """
+    if not files_paths:
+        return []
+    result = subprocess.run(["sudo", "-S", "find"] + files_paths + FIND_STAT_ARGUMENTS,
+                            input=(settings.user_password + "\n").encode(), stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    found = {}
+    for record in result.stdout.split(b"\0"):
+        entry = fileindex.parse_find_record(record)
+        if entry is not None:
+            found[entry[0]] = entry
+    versions = []
+    for file_path, snapshot_full_path in zip(files_paths, snapshots_full_paths):
+        entry = found.get(file_path)
+        versions.append(FileVersion(file_path, snapshot_full_path, entry[4], entry[3], entry[1], entry[2])
+                        if entry is not None else None)
+    return versions
+
+
+def get_file_history(snapshots_full_paths, relative_path, origin=None):
+    """Finds every distinct version of a file across the snapshots of a subvolume.
+
+    Arguments:
+        snapshots_full_paths (:obj:`list` of :obj:`str`): Full paths to the snapshots, oldest first.
+        relative_path (str): Path of the file relative to the subvolume, f.i.: etc/nginx/nginx.conf.
+        origin (str): Full path to the subvolume. If it is provided, the current version of the file is
+        included too as the newest one (default None).
+
+    Returns:
+        list (:obj:`list` of :obj:`FileVersion`): versions of the file, oldest first. Every one of them is
+        compared with the previous version found, so a file deleted and restored later is the same version.
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    snapshots_full_paths = list(snapshots_full_paths)
+    if origin is not None:
+        snapshots_full_paths.append(origin)
+    logger.info("Looking up {path} in {snapshots} snapshots".format(path=relative_path,
+                                                                    snapshots=len(snapshots_full_paths)))
+    versions = []
+    for version in get_file_versions(snapshots_full_paths, relative_path, origin):
+        if version is None:
+            continue
+        if versions and versions[-1].is_same_version(version):
+            versions[-1].snapshots.extend(version.snapshots)
+        else:
+            versions.append(version)
+    logger.info("{versions} versions of {path} found".format(versions=len(versions), path=relative_path))
+    return versions
+
+
+def read_version(version, max_size=MAX_DIFF_SIZE):
+    """Reads the content of a version of a file. If buttermanager is not running as root, sudo is used.
+
+    Arguments:
+        version (FileVersion): Version of the file.
+        max_size (int): Maximum number of bytes to read (default MAX_DIFF_SIZE).
+
+    Returns:
+        bytes: The content. None if it is not a regular file, it is bigger than max_size or it can't be read.
+    """
+    if not stat.S_ISREG(version.mode) or version.size > max_size:
+        return None
+    if ioctl.is_privileged():
+        try:
+            with open(version.file_path, 'rb') as version_file:
+                return version_file.read(max_size + 1)
+        except OSError:
+            return None
+    result = subprocess.run(["sudo", "-S"] + CAT_ARGUMENTS + [version.file_path],
+                            input=(settings.user_password + "\n").encode(), stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    return result.stdout if result.returncode == 0 else None
+
+
+def get_version_diff(old_version, new_version, max_size=MAX_DIFF_SIZE):
+    """Compares two versions of a text file line by line.
+
+    Arguments:
+        old_version (FileVersion): Previous version of the file.
+        new_version (FileVersion): Next version of the file.
+        max_size (int): Versions bigger than this are not compared (default MAX_DIFF_SIZE).
+
+    Returns:
+        list (:obj:`list` of :obj:`str`): lines of the unified diff. None if any of the versions is not a text file
+        or it is too big.
+    """
+    contents = []
+    for version in (old_version, new_version):
+        content = read_version(version, max_size)
+        if content is None or len(content) > max_size or b"\0" in content[:BINARY_CHECK_SIZE]:
+            return None
+        contents.append(content.decode('utf-8', 'replace').splitlines())
+    return list(difflib.unified_diff(contents[0], contents[1], fromfile=old_version.file_path,
+                                     tofile=new_version.file_path, lineterm=""))
@@ -0,0 +1,880 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to BTRFS ioctls.
+
+BTRFS metadata (subvolume IDs, paths, UUIDs, generations...) is read directly from the kernel, so
+no external process is needed. If the ioctls are not permitted (or not supported by the kernel),
+'btrfs subvolume show' command is used instead. It provides also BtrfsIoctl and SubvolumeInfo classes.
+"""
+from ..util import utils
+from . import mountinfo
+import ctypes
+import datetime
+import errno
+import fcntl
+import os
+import re
+import struct
+import uuid
+
+# Constants
+BTRFS_IOCTL_MAGIC = 0x94
+BTRFS_VOL_NAME_MAX = 255
+BTRFS_INO_LOOKUP_PATH_MAX = 4080
+BTRFS_UUID_SIZE = 16
+BTRFS_SUBVOL_NAME_MAX = 4039
+BTRFS_PATH_NAME_MAX = 4087
+# Well known objects and keys
+BTRFS_ROOT_TREE_OBJECTID = 1
+BTRFS_FS_TREE_OBJECTID = 5
+BTRFS_FIRST_FREE_OBJECTID = 256
+BTRFS_LAST_FREE_OBJECTID = 0xffffffffffffff00
+BTRFS_ROOT_ITEM_KEY = 132
+BTRFS_ROOT_BACKREF_KEY = 144
+BTRFS_SUBVOL_RDONLY = 1 << 1
+MAX_U8 = 0xff
+MAX_U32 = 0xffffffff
+MAX_U64 = 0xffffffffffffffff
+# Size of the buffer used by TREE_SEARCH_V2 ioctl to return items
+SEARCH_BUFFER_SIZE = 64 * 1024
+# Errors meaning that ioctls can't be used and the command line has to be used instead
+FALLBACK_ERRORS = (errno.EPERM, errno.EACCES, errno.ENOTTY, errno.EOPNOTSUPP, errno.EINVAL)
+BTRFS_SUBVOLUME_SHOW_COMMAND = ["btrfs", "subvolume", "show"]
+BTRFS_SUBVOLUME_LIST_COMMAND = ["btrfs", "subvolume", "list", "-c", "-u", "-q"]
+# ID 258 gen 2213 cgen 2210 top level 256 parent_uuid 7a6f... uuid 0c2d... path _snapshots/root-20201021-0
+SUBVOLUME_LIST_LINE = re.compile(r'^ID (\d+) gen (\d+) cgen (\d+) top level (\d+) parent_uuid (\S+)\s+uuid (\S+) '
+                                 r'path (.*)$')
+FS_TREE_PREFIX = "<FS_TREE>/"
+BTRFS_SHOW_TIME_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+# FIEMAP (generic ioctl, not only for BTRFS) flags
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST = 0x1
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_EXTENT_DELALLOC = 0x4
+FIEMAP_EXTENT_ENCODED = 0x8
+FIEMAP_EXTENT_NOT_ALIGNED = 0x100
+FIEMAP_EXTENT_DATA_INLINE = 0x200
+# Number of extents retrieved by every FIEMAP call
+FIEMAP_EXTENT_COUNT = 256
+
+
+# Structures (they have to match the ones defined in linux/btrfs.h)
+class BtrfsIoctlTimespec(ctypes.Structure):
+    _fields_ = [("sec", ctypes.c_uint64),
+                ("nsec", ctypes.c_uint32)]
+
+
+class BtrfsIoctlGetSubvolInfoArgs(ctypes.Structure):
+    _fields_ = [("treeid", ctypes.c_uint64),
+                ("name", ctypes.c_char * (BTRFS_VOL_NAME_MAX + 1)),
+                ("parent_id", ctypes.c_uint64),
+                ("dirid", ctypes.c_uint64),
+                ("generation", ctypes.c_uint64),
+                ("flags", ctypes.c_uint64),
+                ("uuid", ctypes.c_uint8 * BTRFS_UUID_SIZE),
+                ("parent_uuid", ctypes.c_uint8 * BTRFS_UUID_SIZE),
+                ("received_uuid", ctypes.c_uint8 * BTRFS_UUID_SIZE),
+                ("ctransid", ctypes.c_uint64),
+                ("otransid", ctypes.c_uint64),
+                ("stransid", ctypes.c_uint64),
+                ("rtransid", ctypes.c_uint64),
+                ("ctime", BtrfsIoctlTimespec),
+                ("otime", BtrfsIoctlTimespec),
+                ("stime", BtrfsIoctlTimespec),
+                ("rtime", BtrfsIoctlTimespec),
+                ("reserved", ctypes.c_uint64 * 8)]
+
+
+class BtrfsIoctlVolArgs(ctypes.Structure):
+    _fields_ = [("fd", ctypes.c_int64),
+                ("name", ctypes.c_char * (BTRFS_PATH_NAME_MAX + 1))]
+
+
+class BtrfsIoctlVolArgsV2(ctypes.Structure):
+    _fields_ = [("fd", ctypes.c_int64),
+                ("transid", ctypes.c_uint64),
+                ("flags", ctypes.c_uint64),
+                ("unused", ctypes.c_uint64 * 4),
+                ("name", ctypes.c_char * (BTRFS_SUBVOL_NAME_MAX + 1))]
+
+
+class BtrfsIoctlFsInfoArgs(ctypes.Structure):
+    _fields_ = [("max_id", ctypes.c_uint64),
+                ("num_devices", ctypes.c_uint64),
+                ("fsid", ctypes.c_uint8 * BTRFS_UUID_SIZE),
+                ("nodesize", ctypes.c_uint32),
+                ("sectorsize", ctypes.c_uint32),
+                ("clone_alignment", ctypes.c_uint32),
+                ("reserved", ctypes.c_uint8 * 980)]
+
+
+class BtrfsIoctlQuotaRescanArgs(ctypes.Structure):
+    _fields_ = [("flags", ctypes.c_uint64),
+                ("progress", ctypes.c_uint64),
+                ("reserved", ctypes.c_uint64 * 6)]
+
+
+class BtrfsIoctlInoLookupArgs(ctypes.Structure):
+    _fields_ = [("treeid", ctypes.c_uint64),
+                ("objectid", ctypes.c_uint64),
+                ("name", ctypes.c_char * BTRFS_INO_LOOKUP_PATH_MAX)]
+
+
+class BtrfsIoctlSearchKey(ctypes.Structure):
+    _fields_ = [("tree_id", ctypes.c_uint64),
+                ("min_objectid", ctypes.c_uint64),
+                ("max_objectid", ctypes.c_uint64),
+                ("min_offset", ctypes.c_uint64),
+                ("max_offset", ctypes.c_uint64),
+                ("min_transid", ctypes.c_uint64),
+                ("max_transid", ctypes.c_uint64),
+                ("min_type", ctypes.c_uint32),
+                ("max_type", ctypes.c_uint32),
+                ("nr_items", ctypes.c_uint32),
+                ("unused", ctypes.c_uint32),
+                ("unused1", ctypes.c_uint64),
+                ("unused2", ctypes.c_uint64),
+                ("unused3", ctypes.c_uint64),
+                ("unused4", ctypes.c_uint64)]
+
+
+class BtrfsIoctlSearchHeader(ctypes.Structure):
+    _fields_ = [("transid", ctypes.c_uint64),
+                ("objectid", ctypes.c_uint64),
+                ("offset", ctypes.c_uint64),
+                ("type", ctypes.c_uint32),
+                ("len", ctypes.c_uint32)]
+
+
+class BtrfsIoctlSearchArgsV2(ctypes.Structure):
+    # The items found are returned in a buffer of buf_size bytes placed right after this structure
+    _fields_ = [("key", BtrfsIoctlSearchKey),
+                ("buf_size", ctypes.c_uint64)]
+
+
+class Fiemap(ctypes.Structure):
+    # fm_extent_count FiemapExtent structures are placed right after this structure
+    _fields_ = [("fm_start", ctypes.c_uint64),
+                ("fm_length", ctypes.c_uint64),
+                ("fm_flags", ctypes.c_uint32),
+                ("fm_mapped_extents", ctypes.c_uint32),
+                ("fm_extent_count", ctypes.c_uint32),
+                ("fm_reserved", ctypes.c_uint32)]
+
+
+class FiemapExtent(ctypes.Structure):
+    _fields_ = [("fe_logical", ctypes.c_uint64),
+                ("fe_physical", ctypes.c_uint64),
+                ("fe_length", ctypes.c_uint64),
+                ("fe_reserved64", ctypes.c_uint64 * 2),
+                ("fe_flags", ctypes.c_uint32),
+                ("fe_reserved", ctypes.c_uint32 * 3)]
+
+
+# Module's methods used to calculate ioctl request numbers
+def _ioc(direction, number, size):
+    """Calculates an ioctl request number like _IOC macro does.
+
+    Arguments:
+        direction (int): 0 for none (_IO), 1 for write (_IOW), 2 for read (_IOR) and 3 for both (_IOWR).
+        number (int): Number of the ioctl.
+        size (int): Size of the argument in bytes.
+
+    Returns:
+        int: The ioctl request number.
+    """
+    return (direction << 30) | (size << 16) | (BTRFS_IOCTL_MAGIC << 8) | number
+
+
+BTRFS_IOC_SYNC = _ioc(0, 8, 0)
+# FICLONE (originally BTRFS_IOC_CLONE)
+BTRFS_IOC_CLONE = _ioc(1, 9, ctypes.sizeof(ctypes.c_int))
+BTRFS_IOC_SNAP_DESTROY = _ioc(1, 15, ctypes.sizeof(BtrfsIoctlVolArgs))
+BTRFS_IOC_TREE_SEARCH_V2 = _ioc(3, 17, ctypes.sizeof(BtrfsIoctlSearchArgsV2))
+BTRFS_IOC_INO_LOOKUP = _ioc(3, 18, ctypes.sizeof(BtrfsIoctlInoLookupArgs))
+BTRFS_IOC_DEFAULT_SUBVOL = _ioc(1, 19, ctypes.sizeof(ctypes.c_uint64))
+BTRFS_IOC_SNAP_CREATE_V2 = _ioc(1, 23, ctypes.sizeof(BtrfsIoctlVolArgsV2))
+BTRFS_IOC_FS_INFO = _ioc(2, 31, ctypes.sizeof(BtrfsIoctlFsInfoArgs))
+BTRFS_IOC_QUOTA_RESCAN = _ioc(1, 44, ctypes.sizeof(BtrfsIoctlQuotaRescanArgs))
+BTRFS_IOC_QUOTA_RESCAN_STATUS = _ioc(2, 45, ctypes.sizeof(BtrfsIoctlQuotaRescanArgs))
+BTRFS_IOC_GET_SUBVOL_INFO = _ioc(2, 60, ctypes.sizeof(BtrfsIoctlGetSubvolInfoArgs))
+BTRFS_IOC_SNAP_DESTROY_V2 = _ioc(1, 63, ctypes.sizeof(BtrfsIoctlVolArgsV2))
+# _IOWR('f', 11, struct fiemap)
+FS_IOC_FIEMAP = 0xC020660B
+# _IOR('v', 1, long)
+FS_IOC_GETVERSION = 0x80087601
+
+
+# Classes
+class SubvolumeInfo:
+    """Metadata of a BTRFS subvolume.
+
+    Times are expressed in seconds since the epoch. UUIDs are strings and they will be None if they are
+    not set (f.i. parent_uuid of a subvolume which is not a snapshot).
+    """
+    # Constructor
+    def __init__(self, subvolume_id, name, path=None, parent_id=None, directory_id=None, generation=None,
+                 flags=0, uuid=None, parent_uuid=None, received_uuid=None, ctransid=None, otransid=None,
+                 stransid=None, rtransid=None, ctime=None, otime=None, stime=None, rtime=None):
+        """ Constructor.
+
+        Arguments:
+            subvolume_id (int): ID of the subvolume.
+            name (str): Name of the subvolume.
+            path (str): Path of the subvolume relative to the top level subvolume, f.i.: _active/rootvol.
+            parent_id (int): ID of the subvolume which contains this subvolume.
+            directory_id (int): Inode of the directory which contains this subvolume.
+            generation (int): Current generation (transid) of the subvolume.
+            flags (int): Subvolume flags, f.i.: BTRFS_SUBVOL_RDONLY.
+            uuid (str): UUID of the subvolume.
+            parent_uuid (str): UUID of the subvolume the snapshot was taken from.
+            received_uuid (str): UUID of the subvolume the snapshot was received from.
+            ctransid (int): Generation of the last change.
+            otransid (int): Generation when the subvolume was created.
+            stransid (int): Generation when the subvolume was sent.
+            rtransid (int): Generation when the subvolume was received.
+            ctime (float): Time of the last change.
+            otime (float): Creation time.
+            stime (float): Time when the subvolume was sent.
+            rtime (float): Time when the subvolume was received.
+        """
+        self.subvolume_id = subvolume_id
+        self.name = name
+        self.path = path
+        self.parent_id = parent_id
+        self.directory_id = directory_id
+        self.generation = generation
+        self.flags = flags
+        self.uuid = uuid
+        self.parent_uuid = parent_uuid
+        self.received_uuid = received_uuid
+        self.ctransid = ctransid
+        self.otransid = otransid
+        self.stransid = stransid
+        self.rtransid = rtransid
+        self.ctime = ctime
+        self.otime = otime
+        self.stime = stime
+        self.rtime = rtime
+
+    # Private attributes
+    # Is it a read-only subvolume?
+    @property
+    def readonly(self):
+        return bool(self.flags & BTRFS_SUBVOL_RDONLY)
+
+    # Methods
+    def __str__(self):
+        """Reimplementation of the str method inherited from object class.
+
+        Returns:
+            string: String representation of the SubvolumeInfo object.
+        """
+        return "SubvolumeInfo -> ID: {0}; Path: {1}; UUID: {2}; Generation: {3}; Read-only: {4}".format(
+            self.subvolume_id, self.path, self.uuid, self.generation, self.readonly)
+
+
+class BtrfsIoctl:
+    """Interface to BTRFS ioctls.
+
+    The module used to invoke ioctls can be injected, so all the operations can be tested using a stubbed
+    fcntl module.
+    """
+    # Constructor
+    def __init__(self, fcntl_module=fcntl):
+        """ Constructor.
+
+        Arguments:
+            fcntl_module (module): Module which provides ioctl function (default fcntl).
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__fcntl = fcntl_module
+
+    # Methods
+    # Private methods
+    def __resolve_path(self, file_descriptor, subvolume_id):
+        """Calculates the path of a subvolume relative to the top level subvolume.
+
+        The root backreferences are followed up to the top level subvolume. It needs CAP_SYS_ADMIN.
+
+        Arguments:
+            file_descriptor (int): File descriptor of any file within the filesystem.
+            subvolume_id (int): ID of the subvolume.
+
+        Returns:
+            str: Path of the subvolume, f.i.: _active/rootvol. None if the subvolume is orphan.
+        """
+        path_components = []
+        while subvolume_id != BTRFS_FS_TREE_OBJECTID:
+            root_backref = next(self.search(file_descriptor, BTRFS_ROOT_TREE_OBJECTID, min_objectid=subvolume_id,
+                                            max_objectid=subvolume_id, min_type=BTRFS_ROOT_BACKREF_KEY,
+                                            max_type=BTRFS_ROOT_BACKREF_KEY), None)
+            if root_backref is None:
+                return None
+            header, data = root_backref
+            # struct btrfs_root_ref: directory inode, sequence and name length followed by the name
+            directory_id, _, name_length = struct.unpack_from("<QQH", data)
+            name = data[18:18 + name_length].decode('utf-8', 'surrogateescape')
+            directory = self.ino_lookup(file_descriptor, header.offset, directory_id)
+            path_components.insert(0, directory + name)
+            subvolume_id = header.offset
+        return "/".join(path_components) if path_components else "/"
+
+    def __get_subvolume_info_from_command(self, path):
+        """Retrieves the metadata of a subvolume using 'btrfs subvolume show' command.
+
+        Arguments:
+            path (str): Path of the subvolume.
+
+        Returns:
+            SubvolumeInfo: The metadata of the subvolume. None if it couldn't be retrieved.
+        """
+        self.__logger.info("BTRFS ioctls are not available. Using btrfs command for {path}".format(path=path))
+        try:
+            result = utils.execute_command_list(BTRFS_SUBVOLUME_SHOW_COMMAND + [path], root=True)
+        except OSError:
+            return None
+        if result.returncode != 0:
+            self.__logger.error("Error retrieving subvolume info of {path}: {error}".format(
+                path=path, error=result.stderr.strip()))
+            return None
+        return parse_subvolume_show(result.stdout)
+
+    # Public methods
+    def search(self, file_descriptor, tree_id, min_objectid=0, max_objectid=MAX_U64, min_type=0,
+               max_type=MAX_U32, min_offset=0, max_offset=MAX_U64, min_transid=0, max_transid=MAX_U64):
+        """Searches items in a BTRFS tree using TREE_SEARCH_V2 ioctl. It needs CAP_SYS_ADMIN.
+
+        Arguments:
+            file_descriptor (int): File descriptor of any file within the filesystem.
+            tree_id (int): ID of the tree to search. 0 means the tree of the subvolume of file_descriptor.
+            min_objectid, max_objectid, min_type, max_type, min_offset, max_offset, min_transid,
+            max_transid (int): Ranges of the keys to search.
+
+        Returns:
+            generator (:obj:`tuple` of :obj:`BtrfsIoctlSearchHeader` and :obj:`bytes`): the header and the
+            data of every item found, in key order.
+        """
+        buffer = bytearray(ctypes.sizeof(BtrfsIoctlSearchArgsV2) + SEARCH_BUFFER_SIZE)
+        search_args = BtrfsIoctlSearchArgsV2.from_buffer(buffer)
+        key = search_args.key
+        key.tree_id = tree_id
+        key.min_objectid = min_objectid
+        key.max_objectid = max_objectid
+        key.min_type = min_type
+        key.max_type = max_type
+        key.min_offset = min_offset
+        key.max_offset = max_offset
+        key.min_transid = min_transid
+        key.max_transid = max_transid
+        while True:
+            key.nr_items = MAX_U32
+            search_args.buf_size = SEARCH_BUFFER_SIZE
+            self.__fcntl.ioctl(file_descriptor, BTRFS_IOC_TREE_SEARCH_V2, buffer)
+            if key.nr_items == 0:
+                return
+            position = ctypes.sizeof(BtrfsIoctlSearchArgsV2)
+            for _ in range(key.nr_items):
+                header = BtrfsIoctlSearchHeader.from_buffer_copy(buffer, position)
+                position += ctypes.sizeof(BtrfsIoctlSearchHeader)
+                yield header, bytes(buffer[position:position + header.len])
+                position += header.len
+            # The next search starts right after the last key found
+            if header.offset < MAX_U64:
+                key.min_objectid, key.min_type, key.min_offset = header.objectid, header.type, header.offset + 1
+            elif header.type < MAX_U8:
+                key.min_objectid, key.min_type, key.min_offset = header.objectid, header.type + 1, 0
+            elif header.objectid < MAX_U64:
+                key.min_objectid, key.min_type, key.min_offset = header.objectid + 1, 0, 0
+            else:
+                return
+            if key.min_objectid > key.max_objectid:
+                return
+
+    def ino_lookup(self, file_descriptor, tree_id, objectid):
+        """Calculates the path of an inode relative to the root of its subvolume using INO_LOOKUP ioctl.
+
+        Arguments:
+            file_descriptor (int): File descriptor of any file within the filesystem.
+            tree_id (int): ID of the subvolume which contains the inode.
+            objectid (int): Inode.
+
+        Returns:
+            str: Path of the inode ended with /, f.i.: _active/. It will be empty for the root directory of
+            the subvolume.
+        """
+        lookup_args = BtrfsIoctlInoLookupArgs()
+        lookup_args.treeid = tree_id
+        lookup_args.objectid = objectid
+        self.__fcntl.ioctl(file_descriptor, BTRFS_IOC_INO_LOOKUP, lookup_args)
+        return lookup_args.name.decode('utf-8', 'surrogateescape')
+
+    def create_snapshot(self, subvolume_origin, snapshot_path, read_only=True):
+        """Creates a snapshot using SNAP_CREATE_V2 ioctl. It needs CAP_SYS_ADMIN.
+
+        Arguments:
+            subvolume_origin (str): Path of the subvolume.
+            snapshot_path (str): Path of the new snapshot. The parent directory must exist.
+            read_only (bool): The snapshot will be read-only (default True).
+        """
+        snapshot_path = snapshot_path.rstrip("/")
+        name = encode_name(os.path.basename(snapshot_path), BTRFS_SUBVOL_NAME_MAX)
+        origin_descriptor = os.open(subvolume_origin, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            parent_descriptor = os.open(os.path.dirname(snapshot_path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                vol_args = BtrfsIoctlVolArgsV2()
+                vol_args.fd = origin_descriptor
+                vol_args.flags = BTRFS_SUBVOL_RDONLY if read_only else 0
+                vol_args.name = name
+                self.__fcntl.ioctl(parent_descriptor, BTRFS_IOC_SNAP_CREATE_V2, vol_args)
+            finally:
+                os.close(parent_descriptor)
+        finally:
+            os.close(origin_descriptor)
+
+    def delete_subvolume(self, subvolume_path):
+        """Deletes a subvolume using SNAP_DESTROY_V2 ioctl (or SNAP_DESTROY in kernels older than 5.7).
+        It needs CAP_SYS_ADMIN.
+
+        Arguments:
+            subvolume_path (str): Path of the subvolume.
+        """
+        subvolume_path = subvolume_path.rstrip("/")
+        name = os.path.basename(subvolume_path)
+        parent_descriptor = os.open(os.path.dirname(subvolume_path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            vol_args = BtrfsIoctlVolArgsV2()
+            vol_args.name = encode_name(name, BTRFS_SUBVOL_NAME_MAX)
+            try:
+                self.__fcntl.ioctl(parent_descriptor, BTRFS_IOC_SNAP_DESTROY_V2, vol_args)
+            except OSError as os_error_exception:
+                if os_error_exception.errno != errno.ENOTTY:
+                    raise
+                legacy_vol_args = BtrfsIoctlVolArgs()
+                legacy_vol_args.name = encode_name(name, BTRFS_PATH_NAME_MAX)
+                self.__fcntl.ioctl(parent_descriptor, BTRFS_IOC_SNAP_DESTROY, legacy_vol_args)
+        finally:
+            os.close(parent_descriptor)
+
+    def get_child_subvolumes(self, path):
+        """Retrieves the subvolumes directly nested in a subvolume. It needs CAP_SYS_ADMIN.
+
+        Arguments:
+            path (str): Path of the subvolume.
+
+        Returns:
+            list (:obj:`list` of :obj:`str`): paths of the nested subvolumes relative to the subvolume,
+            f.i.: var/lib/machines.
+        """
+        file_descriptor = os.open(path, os.O_RDONLY)
+        try:
+            subvol_info_args = BtrfsIoctlGetSubvolInfoArgs()
+            self.__fcntl.ioctl(file_descriptor, BTRFS_IOC_GET_SUBVOL_INFO, subvol_info_args)
+            child_subvolumes = []
+            for header, data in self.search(file_descriptor, BTRFS_ROOT_TREE_OBJECTID,
+                                            min_objectid=BTRFS_FIRST_FREE_OBJECTID,
+                                            max_objectid=BTRFS_LAST_FREE_OBJECTID,
+                                            min_type=BTRFS_ROOT_BACKREF_KEY, max_type=BTRFS_ROOT_BACKREF_KEY):
+                # The offset of a root backreference is the ID of the subvolume which contains it
+                if header.type != BTRFS_ROOT_BACKREF_KEY or header.offset != subvol_info_args.treeid:
+                    continue
+                directory_id, _, name_length = struct.unpack_from("<QQH", data)
+                name = data[18:18 + name_length].decode('utf-8', 'surrogateescape')
+                child_subvolumes.append(self.ino_lookup(file_descriptor, subvol_info_args.treeid,
+                                                        directory_id) + name)
+            return child_subvolumes
+        finally:
+            os.close(file_descriptor)
+
+    def set_default_subvolume(self, path, subvolume_id):
+        """Sets the default subvolume of a filesystem (the one mounted when no subvol option is specified).
+        It needs CAP_SYS_ADMIN.
+
+        Arguments:
+            path (str): Path of any file within the filesystem.
+            subvolume_id (int): ID of the new default subvolume.
+        """
+        file_descriptor = os.open(path, os.O_RDONLY)
+        try:
+            self.__fcntl.ioctl(file_descriptor, BTRFS_IOC_DEFAULT_SUBVOL, ctypes.c_uint64(subvolume_id))
+        finally:
+            os.close(file_descriptor)
+
+    def get_filesystem_uuid(self, path):
+        """Retrieves the UUID of a BTRFS filesystem using FS_INFO ioctl. It doesn't need any privilege.
+
+        Arguments:
+            path (str): Path of any file within the filesystem.
+
+        Returns:
+            str: The UUID of the filesystem.
+        """
+        file_descriptor = os.open(path, os.O_RDONLY)
+        try:
+            fs_info_args = BtrfsIoctlFsInfoArgs()
+            self.__fcntl.ioctl(file_descriptor, BTRFS_IOC_FS_INFO, fs_info_args)
+            return to_uuid(bytes(fs_info_args.fsid))
+        finally:
+            os.close(file_descriptor)
+
+    def start_quota_rescan(self, path):
+        """Starts a rescan of the quota groups using QUOTA_RESCAN ioctl. It needs CAP_SYS_ADMIN.
+
+        Arguments:
+            path (str): Path of any file within the filesystem.
+        """
+        file_descriptor = os.open(path, os.O_RDONLY)
+        try:
+            self.__fcntl.ioctl(file_descriptor, BTRFS_IOC_QUOTA_RESCAN, BtrfsIoctlQuotaRescanArgs())
+        finally:
+            os.close(file_descriptor)
+
+    def get_quota_rescan_status(self, path):
+        """Retrieves the status of the rescan of the quota groups using QUOTA_RESCAN_STATUS ioctl. It needs
+        CAP_SYS_ADMIN.
+
+        Arguments:
+            path (str): Path of any file within the filesystem.
+
+        Returns:
+            int: The objectid of the last item scanned. None if there is no rescan running.
+        """
+        file_descriptor = os.open(path, os.O_RDONLY)
+        try:
+            rescan_args = BtrfsIoctlQuotaRescanArgs()
+            self.__fcntl.ioctl(file_descriptor, BTRFS_IOC_QUOTA_RESCAN_STATUS, rescan_args)
+            return rescan_args.progress if rescan_args.flags else None
+        finally:
+            os.close(file_descriptor)
+
+    def sync_filesystem(self, path):
+        """Commits the current transaction of a filesystem using SYNC ioctl, so the generation of its subvolumes
+        includes every change written until now. It doesn't need any privilege.
+
+        Arguments:
+            path (str): Path of any file within the filesystem.
+        """
+        file_descriptor = os.open(path, os.O_RDONLY)
+        try:
+            self.__fcntl.ioctl(file_descriptor, BTRFS_IOC_SYNC)
+        finally:
+            os.close(file_descriptor)
+
+    def get_file_extents(self, path, sync=False):
+        """Retrieves the map of the extents of a file using FIEMAP ioctl. It doesn't need any privilege.
+
+        Arguments:
+            path (str): Path of the file.
+            sync (bool): Data pending to be written is flushed first, so its extents are mapped too (default False).
+
+        Returns:
+            list (:obj:`list` of :obj:`tuple`): extents as (logical offset, physical offset, length, flags)
+            tuples sorted by their logical offset.
+        """
+        extents = []
+        buffer = bytearray(ctypes.sizeof(Fiemap) + FIEMAP_EXTENT_COUNT * ctypes.sizeof(FiemapExtent))
+        fiemap = Fiemap.from_buffer(buffer)
+        extents_array = (FiemapExtent * FIEMAP_EXTENT_COUNT).from_buffer(buffer, ctypes.sizeof(Fiemap))
+        file_descriptor = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+        try:
+            start = 0
+            while True:
+                fiemap.fm_start = start
+                fiemap.fm_length = MAX_U64 - start
+                fiemap.fm_flags = FIEMAP_FLAG_SYNC if sync else 0
+                fiemap.fm_extent_count = FIEMAP_EXTENT_COUNT
+                fiemap.fm_mapped_extents = 0
+                self.__fcntl.ioctl(file_descriptor, FS_IOC_FIEMAP, buffer)
+                if fiemap.fm_mapped_extents == 0:
+                    break
+                for extent in extents_array[:fiemap.fm_mapped_extents]:
+                    extents.append((extent.fe_logical, extent.fe_physical, extent.fe_length, extent.fe_flags))
+                last_extent = extents[-1]
+                if last_extent[3] & FIEMAP_EXTENT_LAST:
+                    break
+                start = last_extent[0] + last_extent[2]
+        finally:
+            del fiemap, extents_array
+            os.close(file_descriptor)
+        return extents
+
+    def clone_file(self, source_descriptor, destination_descriptor):
+        """Makes a file share all the extents of another file using FICLONE ioctl, so no data is copied.
+        It doesn't need any privilege.
+
+        Arguments:
+            source_descriptor (int): File descriptor of the file to clone, opened for reading.
+            destination_descriptor (int): File descriptor of the new file, opened for writing. Both files must be
+            within the same filesystem.
+        """
+        self.__fcntl.ioctl(destination_descriptor, BTRFS_IOC_CLONE, source_descriptor)
+
+    def get_inode_generation(self, path):
+        """Retrieves the generation of an inode using FS_IOC_GETVERSION ioctl. It doesn't need any privilege.
+
+        BTRFS sets it to the transaction which created the inode and snapshots keep it, so the inode number and
+        its generation identify the same file across the snapshots of a subvolume even if inode numbers are reused.
+
+        Arguments:
+            path (str): Path of a regular file or a directory.
+
+        Returns:
+            int: The generation of the inode.
+        """
+        generation = ctypes.c_long(0)
+        file_descriptor = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+        try:
+            self.__fcntl.ioctl(file_descriptor, FS_IOC_GETVERSION, generation)
+        finally:
+            os.close(file_descriptor)
+        return generation.value
+
+    def get_subvolume_info(self, path, mounts=None, fallback=True):
+        """Retrieves the metadata of the subvolume which contains a specific path.
+
+        GET_SUBVOL_INFO ioctl doesn't need any privilege. The path of the subvolume is calculated using
+        TREE_SEARCH_V2 and INO_LOOKUP ioctls, which need CAP_SYS_ADMIN, or obtained from the mounted
+        filesystems otherwise. If ioctls can't be used, 'btrfs subvolume show' command will be executed.
+
+        Arguments:
+            path (str): Path of the subvolume (or any file within it).
+            mounts (:obj:`list` of :obj:`filesystem.mountinfo.Mount`): mounted filesystems. They will be read
+            if they are needed and they are not provided.
+            fallback (bool): Execute 'btrfs subvolume show' command if ioctls can't be used. Otherwise, the
+            error is raised (default True).
+
+        Returns:
+            SubvolumeInfo: The metadata of the subvolume. None if it couldn't be retrieved.
+        """
+        try:
+            file_descriptor = os.open(path, os.O_RDONLY)
+        except OSError as os_error_exception:
+            if fallback and os_error_exception.errno in FALLBACK_ERRORS:
+                return self.__get_subvolume_info_from_command(path)
+            raise
+        try:
+            subvol_info_args = BtrfsIoctlGetSubvolInfoArgs()
+            try:
+                self.__fcntl.ioctl(file_descriptor, BTRFS_IOC_GET_SUBVOL_INFO, subvol_info_args)
+            except OSError as os_error_exception:
+                if fallback and os_error_exception.errno in FALLBACK_ERRORS:
+                    return self.__get_subvolume_info_from_command(path)
+                raise
+            subvolume_info = SubvolumeInfo(
+                subvolume_id=subvol_info_args.treeid,
+                name=subvol_info_args.name.decode('utf-8', 'surrogateescape'),
+                parent_id=subvol_info_args.parent_id,
+                directory_id=subvol_info_args.dirid,
+                generation=subvol_info_args.generation,
+                flags=subvol_info_args.flags,
+                uuid=to_uuid(bytes(subvol_info_args.uuid)),
+                parent_uuid=to_uuid(bytes(subvol_info_args.parent_uuid)),
+                received_uuid=to_uuid(bytes(subvol_info_args.received_uuid)),
+                ctransid=subvol_info_args.ctransid,
+                otransid=subvol_info_args.otransid,
+                stransid=subvol_info_args.stransid,
+                rtransid=subvol_info_args.rtransid,
+                ctime=to_seconds(subvol_info_args.ctime),
+                otime=to_seconds(subvol_info_args.otime),
+                stime=to_seconds(subvol_info_args.stime),
+                rtime=to_seconds(subvol_info_args.rtime))
+            try:
+                subvolume_info.path = self.__resolve_path(file_descriptor, subvolume_info.subvolume_id)
+            except OSError as os_error_exception:
+                if os_error_exception.errno not in FALLBACK_ERRORS:
+                    raise
+                # Without privileges, the path is obtained from the mounted filesystems
+                subvolume_info.path = mountinfo.get_subvolume_path(path, mounts)
+            return subvolume_info
+        finally:
+            os.close(file_descriptor)
+
+    def list_subvolumes(self, path):
+        """Retrieves the metadata of all the subvolumes of a filesystem at once using 'btrfs subvolume list'
+        command. Only IDs, paths, UUIDs and generations are retrieved.
+
+        Arguments:
+            path (str): Path of any file within the filesystem.
+
+        Returns:
+            dictionary: SubvolumeInfo objects by path relative to the top level subvolume, f.i.: _active/rootvol.
+        """
+        result = utils.execute_command_list(BTRFS_SUBVOLUME_LIST_COMMAND + [path], root=True)
+        if result.returncode != 0:
+            raise OSError(errno.EIO, result.stderr.strip())
+        return parse_subvolume_list(result.stdout)
+
+
+# Module's methods
+def encode_name(name, max_length):
+    """Encodes the name of a subvolume to be passed to an ioctl.
+
+    Arguments:
+        name (str): Name of the subvolume.
+        max_length (int): Maximum length of the name in bytes.
+
+    Returns:
+        bytes: The name encoded.
+    """
+    encoded_name = name.encode('utf-8', 'surrogateescape')
+    if not encoded_name or len(encoded_name) > max_length or b"/" in encoded_name:
+        raise OSError(errno.ENAMETOOLONG if encoded_name else errno.EINVAL,
+                      "Invalid subvolume name: {name}".format(name=name))
+    return encoded_name
+
+
+def is_privileged():
+    """Checks if the privileged ioctls (snapshot creation and deletion, tree searches) can be used.
+
+    Returns:
+        bool: True if buttermanager is running as root (f.i. within a privileged helper); False otherwise.
+    """
+    return os.geteuid() == 0
+
+
+def to_uuid(uuid_bytes):
+    """Converts a UUID returned by an ioctl into a string.
+
+    Arguments:
+        uuid_bytes (bytes): 16 bytes of the UUID.
+
+    Returns:
+        str: The UUID, f.i.: 7a1b2c3d-0000-4000-8000-0123456789ab. None if the UUID is not set (all zeros).
+    """
+    if not any(uuid_bytes):
+        return None
+    return str(uuid.UUID(bytes=uuid_bytes))
+
+
+def to_seconds(timespec):
+    """Converts a timespec returned by an ioctl into seconds since the epoch.
+
+    Arguments:
+        timespec (BtrfsIoctlTimespec): Time returned by the ioctl.
+
+    Returns:
+        float: Seconds since the epoch. None if the time is not set.
+    """
+    if timespec.sec == 0 and timespec.nsec == 0:
+        return None
+    return timespec.sec + timespec.nsec / 1e9
+
+
+def parse_subvolume_show(commandline_output):
+    """Parses the output of 'btrfs subvolume show' command.
+
+    Arguments:
+        commandline_output (str): Output of the command.
+
+    Returns:
+        SubvolumeInfo: The metadata of the subvolume. None if the output couldn't be parsed.
+    """
+    lines = commandline_output.splitlines()
+    if not lines:
+        return None
+    # The first line is the path of the subvolume relative to the top level subvolume
+    path = lines[0].strip()
+    if "toplevel subvolume" in path:
+        return SubvolumeInfo(subvolume_id=BTRFS_FS_TREE_OBJECTID, name="", path="/")
+    fields = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(":")
+        if separator:
+            value = value.strip()
+            fields[name.strip()] = value if value != "-" else None
+    if "Subvolume ID" not in fields:
+        return None
+
+    def to_integer(field):
+        return int(fields[field]) if fields.get(field) is not None else None
+
+    def to_time(field):
+        if fields.get(field) is None:
+            return None
+        try:
+            return datetime.datetime.strptime(fields[field], BTRFS_SHOW_TIME_FORMAT).timestamp()
+        except ValueError:
+            return None
+
+    return SubvolumeInfo(
+        subvolume_id=to_integer("Subvolume ID"),
+        name=fields.get("Name") or "",
+        path=path.strip("/") or "/",
+        parent_id=to_integer("Parent ID"),
+        generation=to_integer("Generation"),
+        flags=BTRFS_SUBVOL_RDONLY if "readonly" in (fields.get("Flags") or "") else 0,
+        uuid=fields.get("UUID"),
+        parent_uuid=fields.get("Parent UUID"),
+        received_uuid=fields.get("Received UUID"),
+        otransid=to_integer("Gen at creation"),
+        stransid=to_integer("Send transid"),
+        rtransid=to_integer("Receive transid"),
+        otime=to_time("Creation time"),
+        stime=to_time("Send time"),
+        rtime=to_time("Receive time"))
+
+
+def parse_subvolume_list(commandline_output):
+    """Parses the output of 'btrfs subvolume list -c -u -q' command.
+
+    Arguments:
+        commandline_output (str): Output of the command.
+
+    Returns:
+        dictionary: SubvolumeInfo objects by path relative to the top level subvolume.
+
+    >>> subvolumes = parse_subvolume_list("ID 258 gen 2213 cgen 2210 top level 5 parent_uuid - "
+    ...                                   "uuid 0c2d4a54-3a7c-d94a-8b3f-5d3e0a1b2c3d path _snapshots/root 1")
+    >>> info = subvolumes["_snapshots/root 1"]
+    >>> info.subvolume_id, info.name, info.parent_id, info.otransid, info.parent_uuid
+    (258, 'root 1', 5, 2210, None)
+    """
+    subvolumes = {}
+    for line in commandline_output.splitlines():
+        match = SUBVOLUME_LIST_LINE.match(line.strip())
+        if not match:
+            continue
+        path = match.group(7)
+        if path.startswith(FS_TREE_PREFIX):
+            path = path[len(FS_TREE_PREFIX):]
+        path = path.strip("/")
+        subvolumes[path] = SubvolumeInfo(
+            subvolume_id=int(match.group(1)),
+            name=os.path.basename(path),
+            path=path,
+            parent_id=int(match.group(4)),
+            generation=int(match.group(2)),
+            uuid=match.group(6) if match.group(6) != "-" else None,
+            parent_uuid=match.group(5) if match.group(5) != "-" else None,
+            otransid=int(match.group(3)))
+    return subvolumes
+
+
+def get_subvolume_info(path):
+    """Retrieves the metadata of the subvolume which contains a specific path.
+
+    Arguments:
+        path (str): Path of the subvolume (or any file within it).
+
+    Returns:
+        SubvolumeInfo: The metadata of the subvolume. None if it couldn't be retrieved.
+    """
+    return BtrfsIoctl().get_subvolume_info(path)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to the mounted filesystems of the system.
+
+It reads /proc/self/mountinfo directly, so no external process is needed. It provides also Mount class.
+"""
+import os
+import re
+
+# Constants
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+BTRFS = "btrfs"
+SUBVOL_OPTION = "subvol"
+SUBVOLID_OPTION = "subvolid"
+# Octal escapes used by the kernel for spaces, tabs, new lines and backslashes
+ESCAPED_CHARACTER = re.compile(r'\\([0-7]{3})')
+
+
+# Classes
+class Mount:
+    """Mounted filesystem (a line of /proc/self/mountinfo).
+
+    """
+    # Constructor
+    def __init__(self, line):
+        """ Constructor.
+
+        Arguments:
+            line (str): Line of /proc/self/mountinfo.
+        """
+        # Optional fields are terminated by a single hyphen
+        fields, super_fields = line.rstrip("\n").split(" - ", 1)
+        fields = fields.split(" ")
+        super_fields = super_fields.split(" ")
+        self.mount_id = int(fields[0])
+        self.parent_id = int(fields[1])
+        self.device = fields[2]
+        self.root = unescape(fields[3])
+        self.mount_point = unescape(fields[4])
+        self.mount_options = fields[5].split(",")
+        self.fs_type = super_fields[0]
+        self.source = unescape(super_fields[1])
+        self.super_options = super_fields[2].split(",") if len(super_fields) > 2 else []
+
+    # Methods
+    def get_option(self, option):
+        """Gets the value of a mount option.
+
+        Arguments:
+            option (str): Name of the option, f.i.: subvol.
+
+        Returns:
+            str: The value of the option. None if the option was not found.
+        """
+        for mount_option in self.super_options + self.mount_options:
+            name, _, value = mount_option.partition("=")
+            if name == option:
+                return value
+        return None
+
+    def __str__(self):
+        """Reimplementation of the str method inherited from object class.
+
+        Returns:
+            string: String representation of the Mount object.
+        """
+        return "Mount -> Source: {0}; Mount point: {1}; Root: {2}; Type: {3}".format(self.source, self.mount_point,
+                                                                                     self.root, self.fs_type)
+
+
+# Module's methods
+def unescape(field):
+    """Replaces the octal escapes used in /proc/self/mountinfo by the real characters.
+
+    Arguments:
+        field (str): Field of a line of /proc/self/mountinfo.
+
+    Returns:
+        str: Field unescaped, f.i.: /mnt/my\\040disk will be /mnt/my disk.
+    """
+    return ESCAPED_CHARACTER.sub(lambda match: chr(int(match.group(1), 8)), field)
+
+
+def get_mounts(mountinfo_path=MOUNTINFO_PATH):
+    """Retrieves all the mounted filesystems.
+
+    Arguments:
+        mountinfo_path (str): Path of the mountinfo file (default /proc/self/mountinfo).
+
+    Returns:
+        list (:obj:`list` of :obj:`Mount`): mounted filesystems in mount order.
+    """
+    with open(mountinfo_path, 'r') as mountinfo:
+        return [Mount(line) for line in mountinfo if line.strip()]
+
+
+def get_mount(path, mounts=None):
+    """Retrieves the mounted filesystem that contains a specific path.
+
+    Arguments:
+        path (str): Path to look for.
+        mounts (:obj:`list` of :obj:`Mount`): mounted filesystems. They will be read if they are not provided.
+
+    Returns:
+        Mount: The mounted filesystem which contains the path. None if it was not found.
+    """
+    if mounts is None:
+        mounts = get_mounts()
+    path = os.path.realpath(path)
+    mount_found = None
+    # The last mount over a mount point hides the previous ones, so all of them are checked
+    for mount in mounts:
+        if path == mount.mount_point or path.startswith(mount.mount_point.rstrip("/") + "/"):
+            if mount_found is None or len(mount.mount_point) >= len(mount_found.mount_point):
+                mount_found = mount
+    return mount_found
+
+
+def get_subvolume_path(path, mounts=None):
+    """Gets the path of a BTRFS subvolume relative to the top level subvolume of its filesystem.
+
+    The result has the same format of the first line of 'btrfs subvolume show' command output,
+    f.i.: _active/rootvol or @. It is calculated from /proc/self/mountinfo, so no external process
+    (and no root privileges) is needed.
+
+    Arguments:
+        path (str): Path where the subvolume is mounted or accessible.
+        mounts (:obj:`list` of :obj:`Mount`): mounted filesystems. They will be read if they are not provided.
+
+    Returns:
+        str: Path of the subvolume. None if the path is not within a BTRFS filesystem.
+    """
+    mount = get_mount(path, mounts)
+    if mount is None or mount.fs_type != BTRFS:
+        return None
+    relative_path = os.path.relpath(os.path.realpath(path), mount.mount_point)
+    subvolume_path = mount.root
+    if relative_path != ".":
+        subvolume_path = os.path.join(subvolume_path, relative_path)
+    subvolume_path = subvolume_path.strip("/")
+    return subvolume_path if subvolume_path else "/"
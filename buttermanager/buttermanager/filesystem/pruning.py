@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to pruning snapshots in order to free a specific amount of space.
+
+It provides also PruningCandidate, PruningPlan and PruningPlanner classes.
+"""
+from ..util import utils
+from . import catalog, ioctl, mountinfo, qgroup, snapshot
+import os
+
+
+# Classes
+class PruningCandidate:
+    """Snapshot that can be deleted in order to free space.
+
+    """
+    # Constructor
+    def __init__(self, snapshot_full_path, subvolume_origin, exclusive):
+        """ Constructor.
+
+        Arguments:
+            snapshot_full_path (str): Full path to the snapshot, f.i.: /mnt/defvol/_snapshots/root-20201021-0.
+            subvolume_origin (str): Full path to the subvolume the snapshot was taken from.
+            exclusive (int): Bytes only referenced by the snapshot (estimation of the space freed if it is deleted).
+        """
+        self.snapshot_full_path = snapshot_full_path
+        self.subvolume_origin = subvolume_origin
+        self.exclusive = exclusive
+
+
+class PruningPlan:
+    """Snapshots to delete in order to free a specific amount of space.
+
+    """
+    # Constructor
+    def __init__(self, target, candidates):
+        """ Constructor.
+
+        Arguments:
+            target (int): Bytes to free.
+            candidates (:obj:`list` of :obj:`PruningCandidate`): Snapshots to delete.
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.target = target
+        self.candidates = candidates
+
+    # Private attributes
+    # Bytes that are expected to be freed. Extents shared only among the deleted snapshots are not
+    # accounted as exclusive, so the real amount will be equal or greater
+    @property
+    def reclaimed(self):
+        return sum(candidate.exclusive for candidate in self.candidates)
+
+    # Will the target be reached?
+    @property
+    def reached(self):
+        return self.reclaimed >= self.target
+
+    # Methods
+    def apply(self):
+        """Deletes all the snapshots of the plan at once.
+
+        Returns:
+            list (:obj:`list` of :obj:`str`): paths of the snapshots deleted.
+        """
+        self.__logger.info("Pruning {number} snapshots in order to free {reclaimed}".format(
+            number=len(self.candidates), reclaimed=utils.convert_from_bytes(self.reclaimed)))
+        return snapshot.delete_specific_snapshots([candidate.snapshot_full_path for candidate in self.candidates],
+                                                  console=False)
+
+    def __str__(self):
+        """Reimplementation of the str method inherited from object class.
+
+        Returns:
+            string: The snapshots to delete and the space expected to be freed.
+        """
+        lines = ["{snapshot} ({exclusive})".format(snapshot=candidate.snapshot_full_path,
+                                                   exclusive=utils.convert_from_bytes(candidate.exclusive))
+                 for candidate in self.candidates]
+        lines.append("Expected space freed: {reclaimed} of {target}".format(
+            reclaimed=utils.convert_from_bytes(self.reclaimed), target=utils.convert_from_bytes(self.target)))
+        return "\n".join(lines)
+
+
+class PruningPlanner:
+    """Calculates which snapshots have to be deleted in order to free a specific amount of space.
+
+    The space freed by every snapshot is estimated by its exclusive size (quotas must be enabled). The newest
+    snapshot of every subvolume, the snapshot mounted as root and the minimum number of snapshots defined for
+    every subvolume are always kept.
+    """
+    # Constructor
+    def __init__(self, btrfs_ioctl=None):
+        """ Constructor.
+
+        Arguments:
+            btrfs_ioctl (filesystem.ioctl.BtrfsIoctl): Interface used to retrieve the metadata of the
+            snapshots (default a new BtrfsIoctl object).
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__btrfs_ioctl = btrfs_ioctl if btrfs_ioctl is not None else ioctl.BtrfsIoctl()
+
+    # Methods
+    # Private methods
+    def __get_booted_snapshot(self, snapshot_catalog):
+        """Gets the snapshot mounted as root.
+
+        Arguments:
+            snapshot_catalog (filesystem.catalog.SnapshotCatalog): Catalog of snapshots.
+
+        Returns:
+            filesystem.catalog.SnapshotEntry: The snapshot mounted as root. None if root is not a snapshot.
+        """
+        root_mount = mountinfo.get_mount("/")
+        if root_mount is None or root_mount.fs_type != mountinfo.BTRFS:
+            return None
+        return snapshot_catalog.get_by_mount(root_mount)
+
+    # Public methods
+    def get_candidates(self):
+        """Retrieves all the snapshots that can be deleted and how many of them can be deleted for every subvolume.
+
+        Returns:
+            tuple (:obj:`list` of :obj:`PruningCandidate`, :obj:`dict`): snapshots that can be deleted and the
+            maximum number of snapshots that can be deleted for every subvolume (key: subvolume origin).
+        """
+        snapshot_catalog = catalog.SnapshotCatalog(self.__btrfs_ioctl)
+        snapshot_catalog.refresh()
+        booted_snapshot = self.__get_booted_snapshot(snapshot_catalog)
+        entries_by_subvolume = {}
+        for entry in snapshot_catalog.entries:
+            entries_by_subvolume.setdefault(entry.subvolume.subvolume_origin, []).append(entry)
+
+        candidates = []
+        limits = {}
+        qgroup_caches = {}
+        for subvolume_origin, entries in entries_by_subvolume.items():
+            subvolume = entries[0].subvolume
+            # From the newest to the oldest
+            entries.sort(key=lambda entry: entry.info.otime if entry.info is not None and entry.info.otime
+                         else os.path.getmtime(entry.snapshot_full_path), reverse=True)
+            protected = [entries[0]]
+            if booted_snapshot is not None and booted_snapshot in entries[1:]:
+                protected.append(booted_snapshot)
+            limits[subvolume_origin] = max(0, len(entries) - max(subvolume.minimum_snapshots, len(protected)))
+
+            if subvolume.subvolume_dest not in qgroup_caches:
+                qgroup_cache = qgroup.QgroupCache(subvolume.subvolume_dest, self.__btrfs_ioctl)
+                qgroup_cache.refresh()
+                qgroup_caches[subvolume.subvolume_dest] = qgroup_cache
+            qgroup_cache = qgroup_caches[subvolume.subvolume_dest]
+            for entry in entries:
+                if entry in protected:
+                    continue
+                usage = qgroup_cache.get(entry.subvolume_id) if entry.subvolume_id is not None else None
+                if usage is None:
+                    self.__logger.info("Size of {snapshot} is unknown. Skipping it...".format(
+                        snapshot=entry.snapshot_full_path))
+                    continue
+                candidates.append(PruningCandidate(entry.snapshot_full_path, subvolume_origin, usage.exclusive))
+        return candidates, limits
+
+    def plan(self, target):
+        """Calculates the smallest set of snapshots to delete in order to free a specific amount of space.
+
+        Arguments:
+            target (int): Bytes to free.
+
+        Returns:
+            PruningPlan: The snapshots to delete. If the target can't be reached, all the snapshots that can be
+            deleted are included.
+        """
+        candidates, limits = self.get_candidates()
+        pruning_plan = PruningPlan(target, select_candidates(candidates, limits, target))
+        self.__logger.info("Pruning plan to free {target}: {number} snapshots, {reclaimed} expected".format(
+            target=utils.convert_from_bytes(target), number=len(pruning_plan.candidates),
+            reclaimed=utils.convert_from_bytes(pruning_plan.reclaimed)))
+        return pruning_plan
+
+
+# Module's methods
+def select_candidates(candidates, limits, target):
+    """Selects the smallest set of snapshots whose exclusive sizes add up to a target.
+
+    Snapshots are taken from the largest to the smallest, skipping those that belong to a subvolume which
+    has reached its limit of deletions. Taking always the largest snapshot allowed gives the greatest amount
+    of space for any number of snapshots, so the target is reached with as few deletions as possible.
+
+    Arguments:
+        candidates (:obj:`list` of :obj:`PruningCandidate`): Snapshots that can be deleted.
+        limits (:obj:`dict`): Maximum number of snapshots that can be deleted for every subvolume
+        (key: subvolume origin).
+        target (int): Bytes to free.
+
+    Returns:
+        list (:obj:`list` of :obj:`PruningCandidate`): Snapshots to delete, from the largest to the smallest.
+    """
+    selected = []
+    reclaimed = 0
+    remaining = dict(limits)
+    for candidate in sorted(candidates, key=lambda candidate: candidate.exclusive, reverse=True):
+        if reclaimed >= target or candidate.exclusive <= 0:
+            break
+        if remaining.get(candidate.subvolume_origin, 0) <= 0:
+            continue
+        remaining[candidate.subvolume_origin] -= 1
+        selected.append(candidate)
+        reclaimed += candidate.exclusive
+    return selected
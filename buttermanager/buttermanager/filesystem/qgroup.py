@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to BTRFS quota groups (qgroups).
+
+Quota groups provide the space referenced by every subvolume and the space used exclusively by it (the
+space that would be freed if the subvolume was deleted). It provides also QgroupUsage and QgroupCache classes.
+"""
+from ..util import settings, utils
+from . import ioctl
+import errno
+import json
+import os
+import re
+import struct
+import time
+
+# Constants
+BTRFS_QUOTA_TREE_OBJECTID = 8
+BTRFS_QGROUP_STATUS_KEY = 240
+BTRFS_QGROUP_INFO_KEY = 242
+BTRFS_QGROUP_STATUS_FLAG_ON = 1 << 0
+BTRFS_QGROUP_STATUS_FLAG_RESCAN = 1 << 1
+BTRFS_QGROUP_STATUS_FLAG_INCONSISTENT = 1 << 2
+# Quota groups are identified by level << 48 | ID. Subvolumes have level 0 quota groups
+QGROUP_LEVEL_SHIFT = 48
+SYSFS_QGROUPS_PATH = "/sys/fs/btrfs/{uuid}/qgroups"
+BTRFS_QGROUP_SHOW_COMMAND = ["btrfs", "qgroup", "show", "--raw"]
+BTRFS_QUOTA_RESCAN_COMMAND = ["btrfs", "quota", "rescan"]
+BTRFS_QUOTA_RESCAN_STATUS_COMMAND = ["btrfs", "quota", "rescan", "-s"]
+CACHE_FILE = "qgroups-{uuid}.json"
+QGROUP_SHOW_LINE = re.compile(r'^0/(\d+)\s+(\d+)\s+(\d+)')
+RESCAN_STATUS_LINE = re.compile(r'rescan operation running \(current key (\d+)\)')
+RESCAN_POLL_INTERVAL = 1
+
+
+# Classes
+class QgroupUsage:
+    """Space used by a subvolume according to its quota group.
+
+    """
+    # Constructor
+    def __init__(self, subvolume_id, referenced, exclusive, generation=0):
+        """ Constructor.
+
+        Arguments:
+            subvolume_id (int): ID of the subvolume.
+            referenced (int): Bytes referenced by the subvolume.
+            exclusive (int): Bytes only referenced by the subvolume (they would be freed if it was deleted).
+            generation (int): Generation when the quota group was updated for the last time (0 if unknown).
+        """
+        self.subvolume_id = subvolume_id
+        self.referenced = referenced
+        self.exclusive = exclusive
+        self.generation = generation
+
+
+class QgroupCache:
+    """Cache of the space used by every subvolume of a filesystem.
+
+    The cache is stored in the application directory, so sizes are available right after starting the
+    application. When buttermanager runs as root, only the quota groups modified since the last refresh are
+    read again (the quota tree is searched from the last generation seen). Otherwise, they are read from
+    sysfs or, in older kernels, using 'btrfs qgroup show' command.
+    """
+    # Constructor
+    def __init__(self, filesystem_path, btrfs_ioctl=None):
+        """ Constructor.
+
+        Arguments:
+            filesystem_path (str): Path of any file within the filesystem, f.i.: a subvolume.
+            btrfs_ioctl (filesystem.ioctl.BtrfsIoctl): Interface to BTRFS ioctls (default a new BtrfsIoctl object).
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__btrfs_ioctl = btrfs_ioctl if btrfs_ioctl is not None else ioctl.BtrfsIoctl()
+        self.__filesystem_path = filesystem_path
+        self.__uuid = self.__btrfs_ioctl.get_filesystem_uuid(filesystem_path)
+        self.__cache_path = os.path.join(settings.application_path, CACHE_FILE.format(uuid=self.__uuid))
+        self.__usages = {}
+        self.__generation = 0
+        self.__enabled = False
+        self.__inconsistent = False
+        self.__load()
+
+    # Private attributes
+    # UUID of the filesystem
+    @property
+    def uuid(self):
+        return self.__uuid
+
+    # Are quotas enabled?
+    @property
+    def enabled(self):
+        return self.__enabled
+
+    # Are the numbers inconsistent (a rescan is needed)?
+    @property
+    def inconsistent(self):
+        return self.__inconsistent
+
+    # Methods
+    # Private methods
+    def __load(self):
+        """Loads the cache stored in the application directory.
+
+        """
+        try:
+            with open(self.__cache_path, 'r') as cache_file:
+                cache = json.load(cache_file)
+            self.__generation = cache.get("generation", 0)
+            self.__enabled = cache.get("enabled", False)
+            for subvolume_id, (referenced, exclusive, generation) in cache.get("usages", {}).items():
+                self.__usages[int(subvolume_id)] = QgroupUsage(int(subvolume_id), referenced, exclusive, generation)
+        except (OSError, ValueError, TypeError):
+            self.__usages = {}
+            self.__generation = 0
+
+    def __save(self):
+        """Stores the cache in the application directory.
+
+        """
+        cache = {"generation": self.__generation,
+                 "enabled": self.__enabled,
+                 "usages": {str(usage.subvolume_id): [usage.referenced, usage.exclusive, usage.generation]
+                            for usage in self.__usages.values()}}
+        try:
+            temporary_path = self.__cache_path + ".tmp"
+            with open(temporary_path, 'w') as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(temporary_path, self.__cache_path)
+        except OSError as os_error_exception:
+            self.__logger.error("Error storing qgroups cache: {error}".format(error=str(os_error_exception)))
+
+    def __refresh_from_quota_tree(self):
+        """Reads the quota groups modified since the last refresh from the quota tree. It needs CAP_SYS_ADMIN.
+        If the tree has been modified, the quota groups which don't exist any more (f.i. the ones of deleted
+        snapshots) are dropped.
+
+        Returns:
+            int: Number of quota groups updated.
+        """
+        file_descriptor = os.open(self.__filesystem_path, os.O_RDONLY)
+        updated = 0
+        try:
+            generation = self.__generation
+            subvolume_ids = set()
+            # Only the leaves written since the last refresh are returned
+            for header, data in self.__btrfs_ioctl.search(file_descriptor, BTRFS_QUOTA_TREE_OBJECTID,
+                                                          min_type=BTRFS_QGROUP_STATUS_KEY,
+                                                          max_type=BTRFS_QGROUP_INFO_KEY,
+                                                          min_transid=self.__generation):
+                generation = max(generation, header.transid)
+                if header.type == BTRFS_QGROUP_STATUS_KEY:
+                    # struct btrfs_qgroup_status_item: version, generation, flags, rescan
+                    _, _, flags = struct.unpack_from("<QQQ", data)
+                    self.__inconsistent = bool(flags & BTRFS_QGROUP_STATUS_FLAG_INCONSISTENT)
+                elif header.type == BTRFS_QGROUP_INFO_KEY and header.offset >> QGROUP_LEVEL_SHIFT == 0:
+                    # struct btrfs_qgroup_info_item: generation, rfer, rfer_cmpr, excl, excl_cmpr
+                    qgroup_generation, referenced, _, exclusive, _ = struct.unpack_from("<QQQQQ", data)
+                    self.__usages[header.offset] = QgroupUsage(header.offset, referenced, exclusive,
+                                                               qgroup_generation)
+                    subvolume_ids.add(header.offset)
+                    updated += 1
+            if generation != self.__generation:
+                if self.__generation != 0:
+                    # Deleted items are not returned by the incremental search, so the existing ones are listed again
+                    subvolume_ids = {header.offset for header, _ in self.__btrfs_ioctl.search(
+                        file_descriptor, BTRFS_QUOTA_TREE_OBJECTID, max_objectid=0, min_type=BTRFS_QGROUP_INFO_KEY,
+                        max_type=BTRFS_QGROUP_INFO_KEY, max_offset=(1 << QGROUP_LEVEL_SHIFT) - 1)}
+                self.__usages = {subvolume_id: usage for subvolume_id, usage in self.__usages.items()
+                                 if subvolume_id in subvolume_ids}
+            self.__generation = generation
+        finally:
+            os.close(file_descriptor)
+        return updated
+
+    def __refresh_from_sysfs(self, sysfs_path):
+        """Reads all the quota groups from sysfs. It doesn't need any privilege.
+
+        Arguments:
+            sysfs_path (str): Path of the quota groups in sysfs.
+
+        Returns:
+            int: Number of quota groups updated.
+        """
+        usages = {}
+        for qgroup in os.listdir(sysfs_path):
+            level, _, subvolume_id = qgroup.partition("_")
+            if level != "0" or not subvolume_id.isdigit():
+                continue
+            try:
+                with open(os.path.join(sysfs_path, qgroup, "referenced")) as referenced_file:
+                    referenced = int(referenced_file.read())
+                with open(os.path.join(sysfs_path, qgroup, "exclusive")) as exclusive_file:
+                    exclusive = int(exclusive_file.read())
+            except (OSError, ValueError):
+                continue
+            usages[int(subvolume_id)] = QgroupUsage(int(subvolume_id), referenced, exclusive)
+        self.__usages = usages
+        return len(usages)
+
+    def __refresh_from_command(self):
+        """Reads all the quota groups using 'btrfs qgroup show' command.
+
+        Returns:
+            int: Number of quota groups updated.
+        """
+        result = utils.execute_command_list(BTRFS_QGROUP_SHOW_COMMAND + [self.__filesystem_path], root=True)
+        if result.returncode != 0:
+            raise OSError(errno.ENOENT, result.stderr.strip())
+        usages = {}
+        for line in result.stdout.splitlines():
+            match = QGROUP_SHOW_LINE.match(line.strip())
+            if match:
+                subvolume_id = int(match.group(1))
+                usages[subvolume_id] = QgroupUsage(subvolume_id, int(match.group(2)), int(match.group(3)))
+        self.__usages = usages
+        return len(usages)
+
+    # Public methods
+    def refresh(self):
+        """Refreshes the cache.
+
+        Returns:
+            int: Number of quota groups updated. 0 if quotas are not enabled.
+        """
+        sysfs_path = SYSFS_QGROUPS_PATH.format(uuid=self.__uuid)
+        try:
+            if ioctl.is_privileged():
+                updated = self.__refresh_from_quota_tree()
+            elif os.path.isdir(sysfs_path):
+                updated = self.__refresh_from_sysfs(sysfs_path)
+            else:
+                updated = self.__refresh_from_command()
+            self.__enabled = True
+        except OSError as os_error_exception:
+            # Quotas are not enabled (there is no quota tree)
+            self.__logger.info("Quotas are not enabled in {uuid}: {error}".format(uuid=self.__uuid,
+                                                                                  error=str(os_error_exception)))
+            self.__enabled = False
+            self.__usages = {}
+            self.__generation = 0
+            updated = 0
+        self.__logger.info("{updated} qgroups updated".format(updated=updated))
+        self.__save()
+        return updated
+
+    def get(self, subvolume_id):
+        """Gets the space used by a subvolume.
+
+        Arguments:
+            subvolume_id (int): ID of the subvolume.
+
+        Returns:
+            QgroupUsage: The space used. None if it is unknown.
+        """
+        return self.__usages.get(subvolume_id)
+
+    def rescan(self, progress_callback=None):
+        """Rescans the quota groups of the filesystem and waits until the rescan has finished. Then, the cache
+        is refreshed from scratch.
+
+        Arguments:
+            progress_callback (function): Function invoked periodically with the current key of the rescan.
+        """
+        self.__logger.info("Rescanning qgroups of {uuid}. Please wait...".format(uuid=self.__uuid))
+        if ioctl.is_privileged():
+            try:
+                self.__btrfs_ioctl.start_quota_rescan(self.__filesystem_path)
+            except OSError as os_error_exception:
+                # EINPROGRESS means that there is a rescan running already
+                if os_error_exception.errno != errno.EINPROGRESS:
+                    raise
+            progress = self.__btrfs_ioctl.get_quota_rescan_status(self.__filesystem_path)
+            while progress is not None:
+                if progress_callback is not None:
+                    progress_callback(progress)
+                time.sleep(RESCAN_POLL_INTERVAL)
+                progress = self.__btrfs_ioctl.get_quota_rescan_status(self.__filesystem_path)
+        else:
+            utils.execute_command_list(BTRFS_QUOTA_RESCAN_COMMAND + [self.__filesystem_path], root=True)
+            while True:
+                result = utils.execute_command_list(BTRFS_QUOTA_RESCAN_STATUS_COMMAND + [self.__filesystem_path],
+                                                    root=True)
+                match = RESCAN_STATUS_LINE.search(result.stdout)
+                if match is None:
+                    break
+                if progress_callback is not None:
+                    progress_callback(int(match.group(1)))
+                time.sleep(RESCAN_POLL_INTERVAL)
+        # Everything has been recalculated
+        self.__generation = 0
+        self.__usages = {}
+        self.refresh()
@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to restoring files and directories from a snapshot.
+
+Files are cloned into the subvolume, so they share the extents of the snapshot and no data is copied. If they
+can't be cloned (f.i. the subvolume is within another filesystem), they are copied using copy_file_range by a
+pool of threads. Ownership, modes, extended attributes and timestamps are preserved. Every file is written next
+to its destination first and renamed at the end, so a file is never left half restored.
+It provides also RestoreEntry and RestorePlan classes.
+"""
+from ..util import utils
+from . import diff, fileindex, history, ioctl
+import concurrent.futures
+import errno
+import os
+import shutil
+import stat
+
+# Constants
+# Actions
+NEW = "new"
+CONFLICT = "conflict"
+UNCHANGED = "unchanged"
+# Conflict policies
+OVERWRITE = "overwrite"
+SKIP = "skip"
+BACKUP = "backup"
+CONFLICT_POLICIES = (OVERWRITE, SKIP, BACKUP)
+# Files being restored are hidden until they are complete
+TEMPORARY_PREFIX = ".buttermanager-restore-"
+# Backups are named like 'cp --backup=numbered' does, f.i.: fstab.~1~
+BACKUP_SUFFIX = ".~{number}~"
+CHUNK_SIZE = 1024 * 1024
+# Errors of copy_file_range that mean it can't be used for these files
+COPY_FILE_RANGE_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+CP_ARGUMENTS = ["cp", "--archive", "--reflink=auto", "--no-target-directory"]
+# Missing parent directories are created by cp with the metadata of the snapshot. The source is relative to the
+# snapshot, so cp is run within it
+CP_PARENTS_ARGUMENTS = ["env", "--chdir={snapshot}", "cp", "--archive", "--reflink=auto", "--parents"]
+CP_POLICY_ARGUMENTS = {OVERWRITE: [], SKIP: ["--no-clobber"], BACKUP: ["--backup=numbered"]}
+
+
+# Classes
+class RestoreEntry:
+    """File or directory of a snapshot that will be restored.
+
+    """
+    # Constructor
+    def __init__(self, relative_path, mode, size, mtime, action):
+        """ Constructor.
+
+        Arguments:
+            relative_path (str): Path relative to the snapshot and the subvolume, f.i.: etc/fstab.
+            mode (int): Mode of the entry within the snapshot (type and permissions).
+            size (int): Size in bytes.
+            mtime (int): Modification time in nanoseconds since the epoch.
+            action (str): NEW if it doesn't exist within the subvolume, UNCHANGED if it exists with the same type,
+            size and modification time or CONFLICT otherwise.
+        """
+        self.relative_path = relative_path
+        self.mode = mode
+        self.size = size
+        self.mtime = mtime
+        self.action = action
+
+    # Private attributes
+    # Is it a directory?
+    @property
+    def directory(self):
+        return stat.S_ISDIR(self.mode)
+
+
+class RestorePlan:
+    """Files and directories to restore from a snapshot into its subvolume, and how conflicts are solved.
+
+    Conflicts can be overwritten (OVERWRITE), kept (SKIP) or kept with a numbered backup name (BACKUP) while the
+    version of the snapshot is restored. After applying the plan, the number of files cloned and copied and the
+    errors found can be retrieved from its attributes.
+    """
+    # Constructor
+    def __init__(self, snapshot_full_path, origin, relative_path, entries, conflicts=OVERWRITE):
+        """ Constructor.
+
+        Arguments:
+            snapshot_full_path (str): Full path to the snapshot.
+            origin (str): Full path to the subvolume.
+            relative_path (str): Path of the file or directory to restore relative to both, f.i.: etc/nginx.
+            entries (:obj:`list` of :obj:`RestoreEntry`): Entries to restore, including the parent directories
+            missing within the subvolume. Directories precede their content.
+            conflicts (str): OVERWRITE, SKIP or BACKUP (default OVERWRITE).
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.snapshot_full_path = snapshot_full_path
+        self.origin = origin
+        self.relative_path = relative_path
+        self.entries = entries
+        self.conflicts = conflicts
+        # Results
+        self.cloned = 0
+        self.copied = 0
+        self.errors = {}
+
+    # Private attributes
+    # Entries that already exist and are different within the subvolume
+    @property
+    def conflicting(self):
+        return [entry for entry in self.entries if entry.action == CONFLICT]
+
+    # Parent directories of the file or directory to restore which don't exist within the subvolume
+    @property
+    def missing_parents(self):
+        return [entry for entry in self.entries if len(entry.relative_path) < len(self.relative_path)]
+
+    # Bytes of the files that will be written (cloned or copied)
+    @property
+    def size(self):
+        return sum(entry.size for entry in self.entries if not entry.directory and entry.action != UNCHANGED and
+                   (entry.action != CONFLICT or self.conflicts != SKIP))
+
+    # Methods
+    # Private methods
+    def __apply_with_cp(self):
+        """Restores the entries using 'cp --reflink=auto' with sudo.
+
+        Returns:
+            list (:obj:`list` of :obj:`str`): relative paths of the entries restored.
+        """
+        if self.missing_parents:
+            arguments = [argument.format(snapshot=self.snapshot_full_path) for argument in CP_PARENTS_ARGUMENTS] + \
+                CP_POLICY_ARGUMENTS[self.conflicts] + ["--", self.relative_path, self.origin]
+        else:
+            arguments = CP_ARGUMENTS + CP_POLICY_ARGUMENTS[self.conflicts] + [
+                "--", os.path.join(self.snapshot_full_path, self.relative_path),
+                os.path.join(self.origin, self.relative_path)]
+        result = utils.execute_command_list(arguments, root=True)
+        if result.returncode != 0:
+            self.errors[self.relative_path] = result.stderr.strip()
+            return []
+        return [entry.relative_path for entry in self.entries
+                if entry.action == NEW or (entry.action == CONFLICT and self.conflicts != SKIP)]
+
+    def __restore_file(self, relative_path, btrfs_ioctl):
+        """Restores a file, a symbolic link or a special file.
+
+        Arguments:
+            relative_path (str): Path relative to the snapshot and the subvolume.
+            btrfs_ioctl (filesystem.ioctl.BtrfsIoctl): Interface used to clone the files.
+
+        Returns:
+            bool: True if the file has been cloned; False if its content has been copied (or it has no content).
+        """
+        return restore_file(os.path.join(self.snapshot_full_path, relative_path),
+                            os.path.join(self.origin, relative_path), btrfs_ioctl)
+
+    # Public methods
+    def apply(self, workers=diff.DEFAULT_WORKERS):
+        """Restores the entries. If buttermanager is not running as root, 'cp --reflink=auto' is used with sudo.
+
+        Arguments:
+            workers (int): Number of threads restoring files (default diff.DEFAULT_WORKERS).
+
+        Returns:
+            list (:obj:`list` of :obj:`str`): relative paths of the entries restored.
+        """
+        self.__logger.info("Restoring {path} from {snapshot} into {origin} ({conflicts} conflicts)".format(
+            path=self.relative_path or "/", snapshot=self.snapshot_full_path, origin=self.origin,
+            conflicts=self.conflicts))
+        self.cloned = 0
+        self.copied = 0
+        self.errors = {}
+        if not ioctl.is_privileged():
+            return self.__apply_with_cp()
+
+        restored = []
+        directories = []
+        files = []
+        skipped_directories = []
+        for entry in self.entries:
+            if any(entry.relative_path.startswith(directory + "/") for directory in skipped_directories):
+                continue
+            destination = os.path.join(self.origin, entry.relative_path)
+            try:
+                if entry.action == CONFLICT:
+                    if self.conflicts == SKIP:
+                        if entry.directory:
+                            skipped_directories.append(entry.relative_path)
+                        continue
+                    if self.conflicts == BACKUP:
+                        os.rename(destination, get_backup_path(destination))
+                    elif entry.directory or (os.path.isdir(destination) and not os.path.islink(destination)):
+                        # A directory replaces a file (or vice versa)
+                        remove(destination)
+                if entry.directory:
+                    if not os.path.isdir(destination):
+                        os.mkdir(destination, 0o700)
+                        restored.append(entry.relative_path)
+                    # Metadata of the directories is restored when their content has been restored
+                    directories.append(entry.relative_path)
+                elif entry.action != UNCHANGED:
+                    files.append(entry.relative_path)
+            except OSError as os_error_exception:
+                self.errors[entry.relative_path] = str(os_error_exception)
+                if entry.directory:
+                    skipped_directories.append(entry.relative_path)
+
+        btrfs_ioctl = ioctl.BtrfsIoctl()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(self.__restore_file, relative_path, btrfs_ioctl): relative_path
+                       for relative_path in files}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    if future.result():
+                        self.cloned += 1
+                    else:
+                        self.copied += 1
+                    restored.append(futures[future])
+                except OSError as os_error_exception:
+                    self.errors[futures[future]] = str(os_error_exception)
+
+        for relative_path in reversed(directories):
+            try:
+                copy_metadata(os.path.join(self.snapshot_full_path, relative_path),
+                              os.path.join(self.origin, relative_path))
+            except OSError as os_error_exception:
+                self.errors[relative_path] = str(os_error_exception)
+
+        self.__logger.info("{restored} entries restored: {cloned} files cloned, {copied} copied, {errors} "
+                           "errors".format(restored=len(restored), cloned=self.cloned, copied=self.copied,
+                                           errors=len(self.errors)))
+        return sorted(restored, key=fileindex.get_sort_key)
+
+    def __str__(self):
+        """Reimplementation of the str method inherited from object class.
+
+        Returns:
+            string: The entries to restore and their actions.
+        """
+        lines = ["{action} {path}".format(action=entry.action, path=entry.relative_path)
+                 for entry in self.entries if entry.action != UNCHANGED]
+        lines.append("Conflicts: {conflicts} ({policy}); data to restore: {size}".format(
+            conflicts=len(self.conflicting), policy=self.conflicts, size=utils.convert_from_bytes(self.size)))
+        return "\n".join(lines)
+
+
+# Module's methods
+def plan_restore(snapshot_full_path, origin, relative_path, conflicts=OVERWRITE):
+    """Calculates the entries to restore from a snapshot into its subvolume and which of them are conflicts.
+    Parent directories which don't exist within the subvolume are restored too.
+
+    Arguments:
+        snapshot_full_path (str): Full path to the snapshot, f.i.: /mnt/defvol/_snapshots/root-20201021-0.
+        origin (str): Full path to the subvolume, f.i.: /mnt/defvol/_active/rootvol.
+        relative_path (str): Path of the file or directory to restore relative to both, f.i.: etc/nginx.
+        conflicts (str): OVERWRITE, SKIP or BACKUP (default OVERWRITE).
+
+    Returns:
+        RestorePlan: The plan.
+    """
+    if conflicts not in CONFLICT_POLICIES:
+        raise ValueError("Unknown conflict policy: {conflicts}".format(conflicts=conflicts))
+    relative_path = relative_path.strip("/")
+    source, destination = history.get_file_versions([snapshot_full_path, origin], relative_path)
+    if source is None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                os.path.join(snapshot_full_path, relative_path))
+
+    source_entries = [(relative_path, source.size, source.mtime, source.inode, source.mode)]
+    destination_entries = {}
+    if destination is not None:
+        destination_entries[relative_path] = (relative_path, destination.size, destination.mtime, destination.inode,
+                                              destination.mode)
+    if stat.S_ISDIR(source.mode):
+        source_entries.extend(get_tree_entries(os.path.join(snapshot_full_path, relative_path), relative_path))
+        if destination is not None and stat.S_ISDIR(destination.mode):
+            destination_entries.update((entry[0], entry) for entry in get_tree_entries(
+                os.path.join(origin, relative_path), relative_path))
+    source_entries.sort(key=lambda entry: fileindex.get_sort_key(entry[0]))
+
+    entries = []
+    for path, size, mtime, _, mode in source_entries:
+        destination_entry = destination_entries.get(path)
+        if destination_entry is None:
+            action = NEW
+        elif stat.S_IFMT(mode) != stat.S_IFMT(destination_entry[4]):
+            action = CONFLICT
+        elif stat.S_ISDIR(mode) or (size, mtime) == (destination_entry[1], destination_entry[2]):
+            action = UNCHANGED
+        else:
+            action = CONFLICT
+        entries.append(RestoreEntry(path, mode, size, mtime, action))
+
+    if destination is None:
+        # Every parent directory is looked up until one exists within the subvolume
+        parents = []
+        parent_path = os.path.dirname(relative_path)
+        while parent_path:
+            parent_source, parent_destination = history.get_file_versions([snapshot_full_path, origin], parent_path)
+            if parent_destination is not None and stat.S_ISDIR(parent_destination.mode):
+                break
+            parents.append(RestoreEntry(parent_path, parent_source.mode, parent_source.size, parent_source.mtime,
+                                        NEW if parent_destination is None else CONFLICT))
+            if parent_destination is not None:
+                break
+            parent_path = os.path.dirname(parent_path)
+        entries = parents[::-1] + entries
+    return RestorePlan(snapshot_full_path, origin, relative_path, entries, conflicts)
+
+
+def get_tree_entries(tree_path, relative_path):
+    """Retrieves the metadata of every entry within a directory, walking it directly if buttermanager is running
+    as root or using 'sudo find' otherwise.
+
+    Arguments:
+        tree_path (str): Full path to the directory.
+        relative_path (str): Path of the directory which will prefix the paths of the entries.
+
+    Returns:
+        list (:obj:`list` of :obj:`tuple`): entries as (path, size, mtime, inode, mode) tuples, unsorted.
+    """
+    entries = fileindex.walk_tree(tree_path) if ioctl.is_privileged() else fileindex.find_tree(tree_path)
+    return [(os.path.join(relative_path, entry[0]),) + tuple(entry[1:]) for entry in entries]
+
+
+def restore_file(source, destination, btrfs_ioctl):
+    """Restores a file, a symbolic link or a special file, replacing the destination atomically.
+
+    Arguments:
+        source (str): Full path to the file within the snapshot.
+        destination (str): Full path to the file within the subvolume.
+        btrfs_ioctl (filesystem.ioctl.BtrfsIoctl): Interface used to clone the files.
+
+    Returns:
+        bool: True if the file has been cloned; False if its content has been copied (or it has no content).
+    """
+    source_stat = os.lstat(source)
+    temporary_path = os.path.join(os.path.dirname(destination), TEMPORARY_PREFIX + os.path.basename(destination))
+    if os.path.lexists(temporary_path):
+        # Left by a restore which was interrupted
+        os.remove(temporary_path)
+    cloned = False
+    try:
+        if stat.S_ISREG(source_stat.st_mode):
+            source_descriptor = os.open(source, os.O_RDONLY | os.O_NOFOLLOW)
+            try:
+                destination_descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                                                 0o600)
+                try:
+                    try:
+                        btrfs_ioctl.clone_file(source_descriptor, destination_descriptor)
+                        cloned = True
+                    except OSError:
+                        copy_content(source_descriptor, destination_descriptor, source_stat.st_size)
+                finally:
+                    os.close(destination_descriptor)
+            finally:
+                os.close(source_descriptor)
+        elif stat.S_ISLNK(source_stat.st_mode):
+            os.symlink(os.readlink(source), temporary_path)
+        else:
+            os.mknod(temporary_path, source_stat.st_mode, source_stat.st_rdev)
+        copy_metadata(source, temporary_path, source_stat)
+        os.replace(temporary_path, destination)
+    except OSError:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
+    return cloned
+
+
+def copy_content(source_descriptor, destination_descriptor, size):
+    """Copies the content of a file using copy_file_range, so the kernel copies it without reading it into
+    user space (or clones it, if the filesystem can). If it can't be used, the content is read and written.
+
+    Arguments:
+        source_descriptor (int): File descriptor of the file to copy, at offset 0.
+        destination_descriptor (int): File descriptor of the new file, at offset 0.
+        size (int): Size of the file to copy.
+    """
+    copied = 0
+    try:
+        while copied < size:
+            length = os.copy_file_range(source_descriptor, destination_descriptor, size - copied)
+            if length == 0:
+                break
+            copied += length
+        return
+    except AttributeError:
+        # copy_file_range is available since Python 3.8
+        pass
+    except OSError as os_error_exception:
+        if os_error_exception.errno not in COPY_FILE_RANGE_ERRORS:
+            raise
+    # Both files are at the offset where copy_file_range stopped
+    while True:
+        chunk = os.read(source_descriptor, CHUNK_SIZE)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(destination_descriptor, view):]
+
+
+def copy_metadata(source, destination, source_stat=None):
+    """Copies the ownership, mode, extended attributes and timestamps of a file without following symbolic links.
+
+    Ownership is changed first, because it clears the setuid bit and the file capabilities.
+
+    Arguments:
+        source (str): Full path to the original file.
+        destination (str): Full path to the new file.
+        source_stat (os.stat_result): Metadata of the original file. It will be read if it is not provided.
+    """
+    source_stat = os.lstat(source) if source_stat is None else source_stat
+    os.chown(destination, source_stat.st_uid, source_stat.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(source_stat.st_mode):
+        os.chmod(destination, stat.S_IMODE(source_stat.st_mode))
+    try:
+        for name in os.listxattr(source, follow_symlinks=False):
+            os.setxattr(destination, name, os.getxattr(source, name, follow_symlinks=False), follow_symlinks=False)
+    except OSError as os_error_exception:
+        if os_error_exception.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+    os.utime(destination, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns), follow_symlinks=False)
+
+
+def get_backup_path(path):
+    """Finds the first numbered backup name which is not used yet, like 'cp --backup=numbered' does.
+
+    Arguments:
+        path (str): Full path to the file which will be kept as backup.
+
+    Returns:
+        str: Full path to the backup, f.i.: /etc/fstab.~1~.
+    """
+    number = 1
+    while os.path.lexists(path + BACKUP_SUFFIX.format(number=number)):
+        number += 1
+    return path + BACKUP_SUFFIX.format(number=number)
+
+
+def remove(path):
+    """Removes a file or a whole directory without following symbolic links.
+
+    Arguments:
+        path (str): Full path to the file or directory.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to the time based retention of snapshots.
+
+It provides also RetentionPolicy and RetentionEngine classes.
+"""
+from ..util import utils
+from . import ioctl, snapshot
+import os
+import time
+
+# Constants
+HOURLY = "hourly"
+DAILY = "daily"
+WEEKLY = "weekly"
+MONTHLY = "monthly"
+# Buckets from the finest to the coarsest
+BUCKETS = (HOURLY, DAILY, WEEKLY, MONTHLY)
+
+
+# Classes
+class RetentionPolicy:
+    """Number of snapshots to keep for every time bucket.
+
+    The newest snapshot of each of the last N hours, days, weeks and months is kept. A snapshot is kept if
+    any bucket keeps it. The newest snapshot is always kept.
+    """
+    # Constructor
+    def __init__(self, hourly=0, daily=0, weekly=0, monthly=0):
+        """ Constructor.
+
+        Arguments:
+            hourly (int): Number of hourly snapshots to keep.
+            daily (int): Number of daily snapshots to keep.
+            weekly (int): Number of weekly snapshots to keep.
+            monthly (int): Number of monthly snapshots to keep.
+        """
+        self.hourly = int(hourly)
+        self.daily = int(daily)
+        self.weekly = int(weekly)
+        self.monthly = int(monthly)
+
+    # Methods
+    def get_limit(self, bucket):
+        """Gets the number of snapshots to keep for a bucket.
+
+        Arguments:
+            bucket (str): hourly, daily, weekly or monthly.
+
+        Returns:
+            int: Number of snapshots to keep.
+        """
+        return getattr(self, bucket)
+
+    def __str__(self):
+        """Reimplementation of the str method inherited from object class.
+
+        Returns:
+            string: The policy as it is stored in buttermanager.yaml, f.i.: hourly=24,daily=14,weekly=8,monthly=12.
+        """
+        return ",".join("{bucket}={limit}".format(bucket=bucket, limit=self.get_limit(bucket))
+                        for bucket in BUCKETS if self.get_limit(bucket) > 0)
+
+
+class RetentionEngine:
+    """Applies a retention policy to the snapshots of a subvolume.
+
+    """
+    # Constructor
+    def __init__(self, subvolume, policy, btrfs_ioctl=None):
+        """ Constructor.
+
+        Arguments:
+            subvolume (filesystem.snapshot.Subvolume): Subvolume whose snapshots will be pruned.
+            policy (RetentionPolicy): Retention policy.
+            btrfs_ioctl (filesystem.ioctl.BtrfsIoctl): Interface used to retrieve the creation time of the
+            snapshots (default a new BtrfsIoctl object).
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__subvolume = subvolume
+        self.__policy = policy
+        self.__btrfs_ioctl = btrfs_ioctl if btrfs_ioctl is not None else ioctl.BtrfsIoctl()
+
+    # Methods
+    def get_timestamps(self):
+        """Retrieves the creation time of every snapshot of the subvolume.
+
+        The creation time is read from the subvolume metadata. The modification time of the snapshot
+        directory is used if it can't be retrieved.
+
+        Returns:
+            list (:obj:`list` of :obj:`tuple`): (timestamp, path) of every snapshot.
+        """
+        timestamps = []
+        for snapshot_full_path in self.__subvolume.get_all_snapshots_with_the_same_name():
+            try:
+                info = self.__btrfs_ioctl.get_subvolume_info(snapshot_full_path)
+            except OSError:
+                info = None
+            if info is not None and info.otime is not None:
+                timestamps.append((info.otime, snapshot_full_path))
+            else:
+                timestamps.append((os.path.getmtime(snapshot_full_path), snapshot_full_path))
+        return timestamps
+
+    def plan(self):
+        """Calculates which snapshots have to be kept and which ones have to be deleted.
+
+        Returns:
+            tuple (:obj:`list` of :obj:`str`, :obj:`list` of :obj:`str`): paths of the snapshots to keep and
+            paths of the snapshots to delete (both from the newest to the oldest).
+        """
+        return select_snapshots(self.get_timestamps(), self.__policy)
+
+    def apply(self, dry_run=False):
+        """Deletes the snapshots that are not kept by the retention policy. All of them are deleted at once.
+
+        Arguments:
+            dry_run (bool): Only log the snapshots that would be deleted (default False).
+
+        Returns:
+            list (:obj:`list` of :obj:`str`): paths of the snapshots deleted (or that would be deleted).
+        """
+        snapshots_to_keep, snapshots_to_delete = self.plan()
+        self.__logger.info("Retention policy {policy} for {subvolume}: {keep} snapshots kept, {delete} snapshots "
+                           "to delete".format(policy=self.__policy, subvolume=self.__subvolume.subvolume_origin,
+                                              keep=len(snapshots_to_keep), delete=len(snapshots_to_delete)))
+        if dry_run:
+            for snapshot_full_path in snapshots_to_delete:
+                self.__logger.info("Would delete {snapshot}".format(snapshot=snapshot_full_path))
+            return snapshots_to_delete
+        return snapshot.delete_specific_snapshots(snapshots_to_delete)
+
+
+# Module's methods
+def parse_policy(policy_string):
+    """Parses a retention policy stored in buttermanager.yaml.
+
+    Arguments:
+        policy_string (str): Retention policy, f.i.: hourly=24,daily=14,weekly=8,monthly=12.
+
+    Returns:
+        RetentionPolicy: The retention policy. None if no policy is defined.
+    """
+    if not policy_string or not str(policy_string).strip():
+        return None
+    limits = {}
+    for rule in str(policy_string).split(","):
+        bucket, _, limit = rule.partition("=")
+        bucket = bucket.strip().lower()
+        if bucket not in BUCKETS:
+            raise ValueError("Unknown retention bucket: {bucket}".format(bucket=bucket))
+        limits[bucket] = int(limit)
+    return RetentionPolicy(**limits)
+
+
+def get_bucket_key(bucket, timestamp):
+    """Calculates the key of the bucket a timestamp belongs to.
+
+    Arguments:
+        bucket (str): hourly, daily, weekly or monthly.
+        timestamp (float): Seconds since the epoch.
+
+    Returns:
+        tuple: Key of the bucket, f.i.: (2020, 10, 21) for the daily bucket of 21st October 2020.
+    """
+    local_time = time.localtime(timestamp)
+    if bucket == HOURLY:
+        return local_time.tm_year, local_time.tm_mon, local_time.tm_mday, local_time.tm_hour
+    elif bucket == DAILY:
+        return local_time.tm_year, local_time.tm_mon, local_time.tm_mday
+    elif bucket == WEEKLY:
+        return tuple(time.strftime("%G %V", local_time).split())
+    else:
+        return local_time.tm_year, local_time.tm_mon
+
+
+def select_snapshots(timestamps, policy):
+    """Calculates which snapshots have to be kept according to a retention policy.
+
+    Snapshots are walked only once from the newest to the oldest. For every bucket, a snapshot is kept when
+    it is the first one (the newest) found in a new period and the limit of the bucket hasn't been reached.
+
+    Arguments:
+        timestamps (:obj:`list` of :obj:`tuple`): (timestamp, path) of every snapshot.
+        policy (RetentionPolicy): Retention policy.
+
+    Returns:
+        tuple (:obj:`list` of :obj:`str`, :obj:`list` of :obj:`str`): paths of the snapshots to keep and
+        paths of the snapshots to delete (both from the newest to the oldest).
+    """
+    snapshots_to_keep = []
+    snapshots_to_delete = []
+    remaining = {bucket: policy.get_limit(bucket) for bucket in BUCKETS}
+    last_keys = {bucket: None for bucket in BUCKETS}
+    for index, (timestamp, snapshot_full_path) in enumerate(sorted(timestamps, reverse=True)):
+        keep = index == 0
+        for bucket in BUCKETS:
+            if remaining[bucket] <= 0:
+                continue
+            key = get_bucket_key(bucket, timestamp)
+            if key != last_keys[bucket]:
+                last_keys[bucket] = key
+                remaining[bucket] -= 1
+                keep = True
+        if keep:
+            snapshots_to_keep.append(snapshot_full_path)
+        else:
+            snapshots_to_delete.append(snapshot_full_path)
+    return snapshots_to_keep, snapshots_to_delete
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to the rollback of the system to a snapshot.
+
+It provides also RollbackEngine class.
+"""
+from ..exception import exception
+from ..util import utils
+from . import fstab, ioctl, mountinfo, snapshot
+import ctypes
+import errno
+import os
+import sys
+
+# Constants
+ROLLBACK_SUFFIX = ".buttermanager-rollback"
+PREVIOUS_ROOT_SUFFIX = ".buttermanager-previous"
+BTRFS_LIST_NESTED_COMMAND = ["btrfs", "subvolume", "list", "-o"]
+BTRFS_SET_DEFAULT_COMMAND = ["btrfs", "subvolume", "set-default"]
+MOVE_COMMAND = ["mv", "-T"]
+REMOVE_DIRECTORY_COMMAND = ["rmdir"]
+# Shell script executed with root privileges to swap the subvolumes. The paths are passed as positional
+# arguments, so they are never interpreted by the shell. All of them are within the same directory, so mv only
+# renames them
+PRIVILEGED_SWAP_SCRIPT = 'mv -T "$1" "$3" && mv -T "$2" "$1"'
+FS_TREE_PREFIX = "<FS_TREE>/"
+AT_FDCWD = -100
+RENAME_EXCHANGE = 1 << 1
+
+
+# Classes
+class RollbackEngine:
+    """Rolls back the system to a snapshot.
+
+    The snapshot is cloned next to the root subvolume and both subvolumes are swapped by renaming them
+    within the same parent, so the time needed doesn't depend on how much data has changed. The previous
+    root is never destroyed: it is kept as a new snapshot of the root subvolume, so the rollback can be
+    undone. If it can't be moved to the snapshots directory (f.i. it is in another mount), it is left next
+    to the root subvolume. Subvolumes nested in the previous root are moved into the new one.
+
+    If fstab doesn't specify the subvolume for / (the default subvolume of the filesystem is mounted),
+    the default subvolume is pointed to the new root too.
+    """
+    # Constructor
+    def __init__(self, snapshot_full_path, root_subvolume, btrfs_ioctl=None):
+        """ Constructor.
+
+        Arguments:
+            snapshot_full_path (str): Full path of the snapshot to roll back to.
+            root_subvolume (filesystem.snapshot.Subvolume): Subvolume representing system's root.
+            btrfs_ioctl (filesystem.ioctl.BtrfsIoctl): Interface to BTRFS ioctls (default a new BtrfsIoctl object).
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__btrfs_ioctl = btrfs_ioctl if btrfs_ioctl is not None else ioctl.BtrfsIoctl()
+        self.__snapshot_full_path = snapshot_full_path.rstrip("/")
+        self.__root_subvolume = root_subvolume
+        self.__origin = root_subvolume.subvolume_origin.rstrip("/")
+        self.__new_root = os.path.join(os.path.dirname(self.__origin),
+                                       "." + os.path.basename(self.__origin) + ROLLBACK_SUFFIX)
+        # Where the previous root is left if renameat2 can't exchange both subvolumes
+        self.__parked_root = os.path.join(os.path.dirname(self.__origin),
+                                          "." + os.path.basename(self.__origin) + PREVIOUS_ROOT_SUFFIX)
+        self.__moved_subvolumes = []
+
+    # Methods
+    # Private methods
+    def __move(self, source, destination):
+        """Renames a file or subvolume.
+
+        Arguments:
+            source (str): Current path.
+            destination (str): New path.
+        """
+        if ioctl.is_privileged():
+            os.rename(source, destination)
+        else:
+            result = utils.execute_command_list(MOVE_COMMAND + [source, destination], root=True)
+            if result.returncode != 0:
+                raise OSError(errno.EIO, result.stderr.strip())
+
+    def __remove_directory(self, path):
+        """Removes an empty directory.
+
+        Arguments:
+            path (str): Path of the directory.
+        """
+        if ioctl.is_privileged():
+            os.rmdir(path)
+        else:
+            result = utils.execute_command_list(REMOVE_DIRECTORY_COMMAND + [path], root=True)
+            if result.returncode != 0:
+                raise OSError(errno.EIO, result.stderr.strip())
+
+    def __get_nested_subvolumes(self):
+        """Retrieves the subvolumes directly nested in the root subvolume.
+
+        Returns:
+            list (:obj:`list` of :obj:`str`): paths of the nested subvolumes relative to the root subvolume.
+        """
+        if ioctl.is_privileged():
+            return self.__btrfs_ioctl.get_child_subvolumes(self.__origin)
+
+        origin_info = self.__btrfs_ioctl.get_subvolume_info(self.__origin)
+        if origin_info is None or not origin_info.path:
+            raise OSError(errno.ENOENT, "The subvolume of {origin} couldn't be found".format(origin=self.__origin))
+        origin_path = origin_info.path.strip("/")
+        result = utils.execute_command_list(BTRFS_LIST_NESTED_COMMAND + [self.__origin], root=True)
+        if result.returncode != 0:
+            raise OSError(errno.EIO, result.stderr.strip())
+        nested_subvolumes = []
+        for line in result.stdout.splitlines():
+            # ID 258 gen 2213 top level 256 path _active/rootvol/var/lib/machines
+            _, separator, nested_path = line.partition(" path ")
+            if not separator:
+                continue
+            if nested_path.startswith(FS_TREE_PREFIX):
+                nested_path = nested_path[len(FS_TREE_PREFIX):]
+            if origin_path != "/" and nested_path.startswith(origin_path + "/"):
+                nested_path = nested_path[len(origin_path) + 1:]
+            nested_subvolumes.append(nested_path)
+        return nested_subvolumes
+
+    def __move_nested_subvolumes(self, nested_subvolumes):
+        """Moves the subvolumes nested in the root subvolume into the new root.
+
+        Snapshots are not recursive, so every nested subvolume appears as an empty directory in the new
+        root. That directory is replaced by the subvolume.
+
+        Arguments:
+            nested_subvolumes (:obj:`list` of :obj:`str`): paths of the nested subvolumes relative to the
+            root subvolume.
+        """
+        for nested_subvolume in nested_subvolumes:
+            source = os.path.join(self.__origin, nested_subvolume)
+            destination = os.path.join(self.__new_root, nested_subvolume)
+            self.__logger.info("Moving nested subvolume {source} to {destination}".format(source=source,
+                                                                                         destination=destination))
+            if os.path.isdir(destination):
+                self.__remove_directory(destination)
+            self.__move(source, destination)
+            self.__moved_subvolumes.append(nested_subvolume)
+
+    def __restore_nested_subvolumes(self):
+        """Moves back the nested subvolumes into the previous root after a failure.
+
+        """
+        for nested_subvolume in reversed(self.__moved_subvolumes):
+            try:
+                self.__move(os.path.join(self.__new_root, nested_subvolume),
+                            os.path.join(self.__origin, nested_subvolume))
+            except OSError as os_error_exception:
+                self.__logger.error("Error moving back nested subvolume {subvolume}: {error}".format(
+                    subvolume=nested_subvolume, error=str(os_error_exception)))
+        self.__moved_subvolumes = []
+
+    def __discard_new_root(self):
+        """Deletes the new root after a failure.
+
+        """
+        self.__restore_nested_subvolumes()
+        try:
+            snapshot.delete_subvolume(self.__new_root, console=False)
+        except exception.BtrfsSnapshotDeletion as btrfs_snapshot_exception:
+            self.__logger.error(str(btrfs_snapshot_exception))
+
+    def __swap(self):
+        """Puts the new root in place of the root subvolume. The previous root is left within the same directory.
+
+        Returns:
+            str: Full path where the previous root has been left.
+        """
+        if ioctl.is_privileged():
+            try:
+                exchange(self.__new_root, self.__origin)
+            except OSError as os_error_exception:
+                if os_error_exception.errno not in (errno.ENOSYS, errno.EINVAL):
+                    raise
+                # renameat2 is not supported, so two renames are done
+                os.rename(self.__origin, self.__parked_root)
+                os.rename(self.__new_root, self.__origin)
+                return self.__parked_root
+            return self.__new_root
+        result = utils.execute_command_list(["sh", "-c", PRIVILEGED_SWAP_SCRIPT, "sh", self.__origin,
+                                             self.__new_root, self.__parked_root], root=True)
+        if result.returncode != 0:
+            raise OSError(errno.EIO, result.stderr.strip())
+        return self.__parked_root
+
+    def __store_previous_root(self, left_root, previous_root):
+        """Moves the previous root to the snapshots directory. It is only renamed, so it is never copied into
+        another mount.
+
+        Arguments:
+            left_root (str): Full path where the previous root has been left by the swap.
+            previous_root (str): Full path where the previous root will be stored.
+
+        Returns:
+            str: Full path where the previous root has been stored. left_root if it couldn't be moved.
+        """
+        try:
+            mounts = mountinfo.get_mounts()
+            left_mount = mountinfo.get_mount(os.path.dirname(left_root), mounts)
+            previous_mount = mountinfo.get_mount(os.path.dirname(previous_root), mounts)
+            if left_mount is None or previous_mount is None or left_mount.mount_id != previous_mount.mount_id:
+                raise OSError(errno.EXDEV, "{path} is in another mount".format(path=os.path.dirname(previous_root)))
+            self.__move(left_root, previous_root)
+        except OSError as os_error_exception:
+            self.__logger.warning("The previous root couldn't be moved to {previous}: {error}".format(
+                previous=previous_root, error=str(os_error_exception)))
+            return left_root
+        return previous_root
+
+    def __set_default_subvolume(self, subvolume_id):
+        """Sets the default subvolume of the filesystem.
+
+        Arguments:
+            subvolume_id (int): ID of the new default subvolume.
+        """
+        if ioctl.is_privileged():
+            self.__btrfs_ioctl.set_default_subvolume(self.__origin, subvolume_id)
+        else:
+            result = utils.execute_command_list(BTRFS_SET_DEFAULT_COMMAND + [str(subvolume_id), self.__origin],
+                                                root=True)
+            if result.returncode != 0:
+                raise OSError(errno.EIO, result.stderr.strip())
+
+    # Public methods
+    def rollback(self):
+        """Rolls back the system to the snapshot.
+
+        Returns:
+            str: Full path where the previous root has been stored as a snapshot.
+        """
+        self.__logger.info("Rolling back {origin} to {snapshot}. Please wait...".format(
+            origin=self.__origin, snapshot=self.__snapshot_full_path))
+        origin_info = self.__btrfs_ioctl.get_subvolume_info(self.__origin)
+        if origin_info is None or not origin_info.path:
+            raise exception.BtrfsRollback("The subvolume of {origin} couldn't be found".format(origin=self.__origin))
+
+        # Cloning the snapshot next to the root subvolume
+        for path in (self.__new_root, self.__parked_root):
+            if os.path.exists(path):
+                raise exception.BtrfsRollback("{path} already exists. Please, remove it before rolling back the "
+                                              "system".format(path=path))
+        try:
+            snapshot.create_subvolume_snapshot(self.__snapshot_full_path, self.__new_root, read_only=False)
+        except exception.BtrfsSnapshotCreation as btrfs_snapshot_exception:
+            raise exception.BtrfsRollback(str(btrfs_snapshot_exception))
+
+        # The new root will be mounted from the path of the root subvolume
+        try:
+            new_root_info = self.__btrfs_ioctl.get_subvolume_info(self.__new_root)
+            if new_root_info is None:
+                raise exception.FstabModification("The subvolume of {path} couldn't be found".format(
+                    path=self.__new_root))
+            new_root_fstab = fstab.Fstab(os.path.join(self.__new_root, fstab.FSTAB_RELATIVE_PATH))
+            root_entry = new_root_fstab.get_root_entry()
+            default_mode = root_entry is not None and root_entry.get_option(mountinfo.SUBVOL_OPTION) is None and \
+                root_entry.get_option(mountinfo.SUBVOLID_OPTION) is None
+            if not default_mode:
+                new_root_fstab.set_root_subvolume(origin_info.path, new_root_info.subvolume_id)
+                new_root_fstab.write()
+        except (OSError, exception.FstabModification) as fstab_exception:
+            self.__discard_new_root()
+            raise exception.BtrfsRollback("Error modifying fstab of the new root: {error}".format(
+                error=str(fstab_exception)))
+
+        # Carrying the nested subvolumes across and swapping both subvolumes. Once they are swapped, the new
+        # root is never discarded
+        try:
+            self.__move_nested_subvolumes(self.__get_nested_subvolumes())
+            left_root = self.__swap()
+        except OSError as os_error_exception:
+            if not os.path.exists(self.__origin) and os.path.exists(self.__parked_root):
+                # Only the first rename was done, so the previous root is put back in place
+                self.__move(self.__parked_root, self.__origin)
+            self.__discard_new_root()
+            raise exception.BtrfsRollback("Error swapping {origin} and {snapshot}: {error}".format(
+                origin=self.__origin, snapshot=self.__snapshot_full_path, error=str(os_error_exception)))
+        previous_root = self.__store_previous_root(left_root, os.path.join(
+            self.__root_subvolume.subvolume_dest, self.__root_subvolume.get_new_snapshot_name()))
+        sys.stdout.write("{origin} rolled back to {snapshot}. The previous root has been kept in {previous}\n".format(
+            origin=self.__origin, snapshot=self.__snapshot_full_path, previous=previous_root))
+
+        if default_mode:
+            # fstab doesn't specify the subvolume for /, so the default one is mounted
+            try:
+                self.__set_default_subvolume(new_root_info.subvolume_id)
+            except OSError as os_error_exception:
+                raise exception.BtrfsRollback("Error setting the default subvolume: {error}".format(
+                    error=str(os_error_exception)))
+        else:
+            # The previous root can be booted as any other snapshot
+            try:
+                previous_root_info = self.__btrfs_ioctl.get_subvolume_info(previous_root)
+                if previous_root_info is None:
+                    raise exception.FstabModification("The subvolume of {path} couldn't be found".format(
+                        path=previous_root))
+                previous_root_fstab = fstab.Fstab(os.path.join(previous_root, fstab.FSTAB_RELATIVE_PATH))
+                previous_root_fstab.set_root_subvolume(previous_root_info.path, previous_root_info.subvolume_id)
+                previous_root_fstab.write()
+            except (OSError, exception.FstabModification) as fstab_exception:
+                self.__logger.error("Error modifying fstab of the previous root {path}: {error}".format(
+                    path=previous_root, error=str(fstab_exception)))
+        return previous_root
+
+
+# Module's methods
+def exchange(path1, path2):
+    """Exchanges two paths atomically using renameat2 system call.
+
+    Arguments:
+        path1 (str): First path.
+        path2 (str): Second path.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    renameat2 = getattr(libc, "renameat2", None)
+    if renameat2 is None:
+        raise OSError(errno.ENOSYS, "renameat2 is not available")
+    if renameat2(AT_FDCWD, os.fsencode(path1), AT_FDCWD, os.fsencode(path2), RENAME_EXCHANGE) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to parsing BTRFS send streams.
+
+'btrfs send -p <parent> <snapshot>' describes the operations needed to transform the parent snapshot into the
+sent one (create, unlink, rename, write, chmod...). Using '--no-data' the content of the files is not included,
+so the stream is small and it is produced quickly. Commands are read one by one, so memory doesn't depend on
+the size of the stream. It provides also SendCommand, SendStreamParser, TrackedEntry and ChangeTracker
+classes.
+"""
+from ..exception import exception
+from . import ioctl
+import struct
+
+# Constants
+SEND_STREAM_MAGIC = b"btrfs-stream\0"
+# Magic and version (le32)
+STREAM_HEADER = struct.Struct("<13sI")
+# Length of the attributes (le32), command (le16) and CRC32C (le32)
+COMMAND_HEADER = struct.Struct("<IHI")
+# Attribute type (le16) and length (le16)
+ATTRIBUTE_HEADER = struct.Struct("<HH")
+U32 = struct.Struct("<I")
+U64 = struct.Struct("<Q")
+# Seconds (le64) and nanoseconds (le32)
+TIMESPEC = struct.Struct("<QI")
+
+COMMANDS = {1: "subvol", 2: "snapshot", 3: "mkfile", 4: "mkdir", 5: "mknod", 6: "mkfifo", 7: "mksock",
+            8: "symlink", 9: "rename", 10: "link", 11: "unlink", 12: "rmdir", 13: "set_xattr", 14: "remove_xattr",
+            15: "write", 16: "clone", 17: "truncate", 18: "chmod", 19: "chown", 20: "utimes", 21: "end",
+            22: "update_extent", 23: "fallocate", 24: "fileattr", 25: "encoded_write", 26: "enable_verity"}
+ATTRIBUTES = {1: "uuid", 2: "ctransid", 3: "ino", 4: "size", 5: "mode", 6: "uid", 7: "gid", 8: "rdev",
+              9: "ctime", 10: "mtime", 11: "atime", 12: "otime", 13: "xattr_name", 14: "xattr_data", 15: "path",
+              16: "path_to", 17: "path_link", 18: "file_offset", 19: "data", 20: "clone_uuid",
+              21: "clone_ctransid", 22: "clone_path", 23: "clone_offset", 24: "clone_len", 25: "fallocate_mode",
+              26: "fileattr", 27: "unencoded_file_len", 28: "unencoded_len", 29: "unencoded_offset",
+              30: "compression", 31: "encryption", 32: "verity_algorithm", 33: "verity_block_size",
+              34: "verity_salt_data", 35: "verity_sig_data"}
+DATA_ATTRIBUTE = 19
+UUID_ATTRIBUTES = {"uuid", "clone_uuid"}
+TIME_ATTRIBUTES = {"ctime", "mtime", "atime", "otime"}
+PATH_ATTRIBUTES = {"path", "path_to", "path_link", "clone_path", "xattr_name"}
+U32_ATTRIBUTES = {"fallocate_mode", "compression", "encryption", "verity_algorithm", "verity_block_size"}
+BYTES_ATTRIBUTES = {"xattr_data", "data", "verity_salt_data", "verity_sig_data"}
+# Commands creating a new entry in the path attribute
+CREATE_COMMANDS = {"mkfile", "mkdir", "mknod", "mkfifo", "mksock", "symlink", "link"}
+# Commands changing the content of the file in the path attribute. Metadata changes (chmod, chown, utimes,
+# xattrs) are not considered modifications, as 'diff -qr' does
+CONTENT_COMMANDS = {"write", "clone", "truncate", "update_extent", "fallocate", "encoded_write"}
+
+
+# Classes
+class SendCommand:
+    """Command of a send stream with its attributes already decoded.
+
+    """
+    # Constructor
+    def __init__(self, name, attributes):
+        """ Constructor.
+
+        Arguments:
+            name (str): Name of the command, f.i.: rename.
+            attributes (dictionary): Attributes of the command (key: name). Paths are str, times are seconds
+            since the epoch, UUIDs are str and the rest of numbers are int.
+        """
+        self.__name = name
+        self.__attributes = attributes
+
+    # Private attributes
+    # Name of the command
+    @property
+    def name(self):
+        return self.__name
+
+    # Attributes of the command
+    @property
+    def attributes(self):
+        return self.__attributes
+
+    # Path of the entry the command applies to
+    @property
+    def path(self):
+        return self.__attributes.get("path")
+
+    def __str__(self):
+        return "{name} {attributes}".format(name=self.__name, attributes=self.__attributes)
+
+
+class SendStreamParser:
+    """Reads the commands of a send stream from a binary file object (f.i. the stdout of 'btrfs send').
+
+    """
+    # Constructor
+    def __init__(self, stream):
+        """ Constructor.
+
+        Arguments:
+            stream (file object): Binary stream to read from.
+        """
+        self.__stream = stream
+        self.__version = None
+
+    # Private attributes
+    # Version of the send stream protocol. None until the header has been read
+    @property
+    def version(self):
+        return self.__version
+
+    # Methods
+    # Private methods
+    def __read(self, size):
+        """Reads exactly some bytes from the stream.
+
+        Arguments:
+            size (int): Number of bytes.
+
+        Returns:
+            bytes: The bytes read. Empty if the stream has ended before reading anything.
+        """
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = self.__stream.read(remaining)
+            if not chunk:
+                if remaining == size:
+                    return b""
+                raise exception.SendStreamParsing("Send stream truncated")
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks)
+
+    def __decode_attributes(self, payload):
+        """Decodes the attributes of a command.
+
+        Arguments:
+            payload (bytes): Attributes of the command as they are stored in the stream.
+
+        Returns:
+            dictionary: Attributes (key: name).
+        """
+        attributes = {}
+        offset = 0
+        while offset < len(payload):
+            attribute_type, length = ATTRIBUTE_HEADER.unpack_from(payload, offset)
+            offset += ATTRIBUTE_HEADER.size
+            if attribute_type == DATA_ATTRIBUTE and self.__version >= 2:
+                # Since version 2, data has no length and fills the rest of the command
+                length = len(payload) - offset
+            value = payload[offset:offset + length]
+            if len(value) != length:
+                raise exception.SendStreamParsing("Send stream attribute {type} truncated".format(
+                    type=attribute_type))
+            offset += length
+            name = ATTRIBUTES.get(attribute_type, "attribute-{type}".format(type=attribute_type))
+            attributes[name] = decode_attribute(name, value)
+        return attributes
+
+    # Public methods
+    def commands(self):
+        """Reads the commands of the stream. Several streams may be concatenated (one per snapshot sent).
+
+        Returns:
+            generator (:obj:`SendCommand`): commands in the same order they appear in the stream.
+        """
+        while True:
+            header = self.__read(STREAM_HEADER.size)
+            if not header:
+                return
+            magic, self.__version = STREAM_HEADER.unpack(header)
+            if magic != SEND_STREAM_MAGIC:
+                raise exception.SendStreamParsing("Not a BTRFS send stream")
+            while True:
+                command_header = self.__read(COMMAND_HEADER.size)
+                if not command_header:
+                    return
+                length, command, _ = COMMAND_HEADER.unpack(command_header)
+                payload = self.__read(length)
+                if len(payload) != length:
+                    raise exception.SendStreamParsing("Send stream truncated")
+                name = COMMANDS.get(command, "command-{number}".format(number=command))
+                yield SendCommand(name, self.__decode_attributes(payload))
+                if name == "end":
+                    break
+
+
+class TrackedEntry:
+    """Entry of the tree of paths kept by ChangeTracker.
+
+    Only the entries affected by a command (and their parent directories) are in the tree. The rest of the
+    entries of a directory are implicit and they are moved with it.
+    """
+    # Constructor
+    def __init__(self, name, parent):
+        """ Constructor.
+
+        Arguments:
+            name (str): Last component of the current path.
+            parent (TrackedEntry): Directory which contains the entry (None for the root directory).
+        """
+        self.name = name
+        self.parent = parent
+        self.children = {}
+        # The entry doesn't exist in the parent snapshot
+        self.created = False
+        # Path in the parent snapshot of an entry which has been moved. None if it is calculated from its parent
+        self.original_path = None
+        # The content of the file has changed
+        self.modified = False
+
+    # Methods
+    # Public methods
+    def get_path(self):
+        """Calculates the current path of the entry.
+
+        Returns:
+            str: Path relative to the subvolume ('' for the root directory).
+        """
+        components = []
+        entry = self
+        while entry.parent is not None:
+            components.append(entry.name)
+            entry = entry.parent
+        return "/".join(reversed(components))
+
+    def get_original_path(self):
+        """Calculates the path an entry which already existed had in the parent snapshot.
+
+        Returns:
+            str: Path in the parent snapshot. None if the entry (or one of its parents) has been created.
+        """
+        components = []
+        entry = self
+        while entry.parent is not None:
+            if entry.created:
+                return None
+            if entry.original_path is not None:
+                components.append(entry.original_path)
+                break
+            components.append(entry.name)
+            entry = entry.parent
+        return "/".join(reversed(components))
+
+
+class ChangeTracker:
+    """Summarizes the commands of a send stream as the paths created, deleted and modified.
+
+    New inodes and entries replaced during the transformation get temporary names (f.i. o257-12-0) which are
+    renamed later, so the current path of every entry is tracked until the stream ends. Entries are kept in a
+    tree of paths: a rename only detaches an entry from its parent directory and attaches it to the new one, so
+    it costs the depth of the paths whatever the number of entries tracked (temporary names are always children
+    of the root directory). Like 'diff -qr', an entry renamed is reported as deleted in its original path and
+    created in the new one, and the content of a directory which only exists in one of the trees is not reported.
+    """
+    # Constructor
+    def __init__(self):
+        """ Constructor.
+        """
+        self.__root = TrackedEntry("", None)
+        # Paths in the parent snapshot of the entries deleted
+        self.__deleted = set()
+
+    # Methods
+    # Private methods
+    def __get_entry(self, path, create=True):
+        """Finds the entry of a path in the tree.
+
+        Arguments:
+            path (str): Current path of the entry.
+            create (bool): Adds the entry (and its parent directories) if it isn't in the tree (default True).
+
+        Returns:
+            TrackedEntry: The entry. None if it isn't in the tree and create is False.
+        """
+        entry = self.__root
+        for name in path.split("/"):
+            child = entry.children.get(name)
+            if child is None:
+                if not create:
+                    return None
+                child = TrackedEntry(name, entry)
+                entry.children[name] = child
+            entry = child
+        return entry
+
+    def __detach(self, entry):
+        """Removes an entry (and all the entries within it) from its parent directory.
+
+        Arguments:
+            entry (TrackedEntry): Entry to remove.
+        """
+        if entry.parent.children.get(entry.name) is entry:
+            del entry.parent.children[entry.name]
+
+    def __move(self, path, path_to):
+        """Moves an entry and all the entries within it.
+
+        Arguments:
+            path (str): Current path of the entry.
+            path_to (str): New path of the entry.
+        """
+        entry = self.__get_entry(path)
+        if not entry.created and entry.original_path is None:
+            original_path = entry.get_original_path()
+            if original_path is None:
+                # Within a directory created
+                entry.created = True
+            else:
+                entry.original_path = original_path
+        self.__detach(entry)
+        replaced = self.__get_entry(path_to, create=False)
+        if replaced is not None:
+            self.__remove(replaced)
+        parent_path, _, name = path_to.rpartition("/")
+        entry.name = name
+        entry.parent = self.__get_entry(parent_path) if parent_path else self.__root
+        entry.parent.children[name] = entry
+
+    def __remove(self, entry):
+        """Removes an entry.
+
+        Arguments:
+            entry (TrackedEntry): Entry to remove.
+        """
+        original_path = entry.get_original_path()
+        if original_path is not None:
+            self.__deleted.add(original_path)
+        self.__detach(entry)
+
+    # Public methods
+    def track(self, command):
+        """Updates the changes with a command of the stream.
+
+        Arguments:
+            command (SendCommand): Command read from the stream.
+        """
+        path = command.path
+        if path is None:
+            return
+        if command.name in CREATE_COMMANDS:
+            self.__get_entry(path).created = True
+        elif command.name == "rename":
+            self.__move(path, command.attributes["path_to"])
+        elif command.name in ("unlink", "rmdir"):
+            self.__remove(self.__get_entry(path))
+        elif command.name in CONTENT_COMMANDS:
+            self.__get_entry(path).modified = True
+
+    def get_changes(self):
+        """Calculates the changes tracked so far.
+
+        Returns:
+            tuple (:obj:`list` of :obj:`str`, :obj:`list` of :obj:`str`, :obj:`list` of :obj:`str`): paths
+            (sorted and relative to the subvolume) only present in the sent snapshot, only present in the parent
+            snapshot and modified.
+        """
+        created = set()
+        deleted = set(self.__deleted)
+        # Current paths of the files modified which are still in their original paths
+        modified = set()
+        # Entries as (entry, current path, path in the parent snapshot or None if it has been created)
+        pending = [(child, name, name) for name, child in self.__root.children.items()]
+        while pending:
+            entry, path, original_path = pending.pop()
+            if entry.created:
+                created.add(path)
+                original_path = None
+            elif entry.original_path is not None:
+                original_path = entry.original_path
+                if original_path != path:
+                    created.add(path)
+                    deleted.add(original_path)
+            if entry.modified and original_path == path:
+                modified.add(path)
+            for name, child in entry.children.items():
+                pending.append((child, path + "/" + name,
+                                None if original_path is None else original_path + "/" + name))
+        # Entries replaced by others exist in both trees
+        replaced = created & deleted
+        created -= replaced
+        deleted -= replaced
+        modified = set(path for path in modified if not has_parent(path, created)) | replaced
+        return (sorted(path for path in created if not has_parent(path, created)),
+                sorted(path for path in deleted if not has_parent(path, deleted)),
+                sorted(modified))
+
+
+# Module's methods
+def decode_attribute(name, value):
+    """Decodes the value of an attribute of a send stream.
+
+    Arguments:
+        name (str): Name of the attribute.
+        value (bytes): Value as it is stored in the stream.
+
+    Returns:
+        object: The value decoded (str, int, float or bytes).
+    """
+    if name in PATH_ATTRIBUTES:
+        return value.decode("utf-8", "surrogateescape")
+    if name in UUID_ATTRIBUTES:
+        return ioctl.to_uuid(value)
+    if name in TIME_ATTRIBUTES:
+        seconds, nanoseconds = TIMESPEC.unpack(value)
+        return seconds + nanoseconds / 1e9
+    if name in BYTES_ATTRIBUTES or name.startswith("attribute-"):
+        return value
+    if name in U32_ATTRIBUTES and len(value) == U32.size:
+        return U32.unpack(value)[0]
+    if len(value) == U64.size:
+        return U64.unpack(value)[0]
+    return value
+
+
+def has_parent(path, paths):
+    """Checks if any of the parent directories of a path is in a set of paths.
+
+    Arguments:
+        path (str): Path relative to the subvolume, f.i.: etc/pacman.d/mirrorlist.
+        paths (set): Paths.
+
+    Returns:
+        bool: True if a parent directory is in the set.
+
+    >>> has_parent("etc/pacman.d/mirrorlist", {"etc/pacman.d"})
+    True
+    """
+    index = path.rfind("/")
+    while index > 0:
+        if path[:index] in paths:
+            return True
+        index = path.rfind("/", 0, index)
+    return False
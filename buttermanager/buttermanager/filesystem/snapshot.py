@@ -22,22 +22,26 @@ It provides also Snapshot class.
 """
 from ..exception import exception
 from ..util import settings, utils
-from ..window import windows
+from . import catalog, fileindex, fstab, ioctl, mountinfo, retention
+import errno
 import glob
 import os
-import shutil
 import sys
 import subprocess
 import time
-from PyQt5.QtCore import QThread, pyqtSignal
 
 
 # Constants
 BTRFS_CREATE_SNAPSHOT_R_COMMAND = "sudo -S btrfs subvolume snapshot -r"
 BTRFS_CREATE_SNAPSHOT_RW_COMMAND = "sudo -S btrfs subvolume snapshot"
 BTRFS_DELETE_SNAPSHOT_COMMAND = "sudo -S btrfs subvolume delete"
+BTRFS_DELETE_ARGUMENTS = ["btrfs", "subvolume", "delete"]
 BTRFS_FIND_NEW_COMMAND = "sudo -S btrfs subvolume find-new"
-GRUB_BTRFS_COMMAND = "sudo -S grub-mkconfig -o /boot/grub/grub.cfg"
+BTRFS_FIND_NEW_ARGUMENTS = ["btrfs", "subvolume", "find-new"]
+# Fields printed by find-new before the path of every extent
+FIND_NEW_FIELDS = 16
+FIND_NEW_MARKER = "transid marker was"
+MAX_TRANSID = 9999999
 
 
 # Classes
@@ -46,7 +50,8 @@ class Subvolume:
 
     """
     # Constructor
-    def __init__(self, subvolume_origin, subvolume_dest, snapshot_name, snapshots_to_keep):
+    def __init__(self, subvolume_origin, subvolume_dest, snapshot_name, snapshots_to_keep, retention_policy=None,
+                 minimum_snapshots=1):
         """ Constructor.
 
         Arguments:
@@ -55,6 +60,10 @@ class Subvolume:
             to be stored.
             snapshot_name (str): Prefix for all the subvolumes created from origin
             snapshots_to_keep (str): Number of snapshots to keep for this subvolume
+            retention_policy (filesystem.retention.RetentionPolicy): Time based retention policy. If it is defined,
+            snapshots_to_keep will be ignored (default None)
+            minimum_snapshots (int): Minimum number of snapshots that must be kept when snapshots are pruned in
+            order to free space (default 1)
         """
         # Logger
         self.__logger = utils.Logger(self.__class__.__name__).get()
@@ -62,6 +71,8 @@ class Subvolume:
         self.subvolume_dest = subvolume_dest if subvolume_dest[-1] == '/' else subvolume_dest + '/'
         self.snapshot_name = snapshot_name
         self.snapshots_to_keep = int(snapshots_to_keep)
+        self.retention = retention_policy
+        self.minimum_snapshots = int(minimum_snapshots)
         self.__current_date = time.strftime('%Y%m%d')
 
     # Methods
@@ -71,126 +82,72 @@ class Subvolume:
     def create_snapshot(self):
         """Creates a snapshot.
 
+        Raises:
+            exception.BtrfsSnapshotCreation: The snapshot couldn't be created.
         """
         info_message = "Creating a read-only snapshot of {subvolume_origin} in {subvolume_dest}. " \
                        "Please wait...".format(subvolume_origin=self.subvolume_origin,
                                                subvolume_dest=self.subvolume_dest)
         self.__logger.info(info_message)
 
-        # Checking how many snapshots are with the same name
-        snapshot_full_name = "{snapshot_name}-{current_date}".format(snapshot_name=self.snapshot_name,
-                                                                     current_date=self.__current_date)
-        snapshots_with_same_name = [file for file in os.listdir(self.subvolume_dest) if snapshot_full_name in file]
+        # Checks if the subvolume has changed since its last snapshot (only if the user wants to skip
+        # unchanged subvolumes)
+        if settings.skip_unchanged_snapshots and not self.has_changed_since_last_snapshot():
+            info_message = "{subvolume_origin} hasn't changed since its last snapshot. " \
+                           "Skipping...".format(subvolume_origin=self.subvolume_origin)
+            self.__logger.info(info_message)
+            sys.stdout.write(info_message + "\n")
+            return
 
-        # Adding number to the full name
-        snapshot_full_name = "{snapshot_full_name}-{number}".format(snapshot_full_name=snapshot_full_name,
-                                                                    number=len(snapshots_with_same_name))
+        snapshot_full_name = self.get_new_snapshot_name()
         # Checks if grub-btrfs integration is enabled
         if settings.properties_manager.get_property("grub_btrfs"):
             # Checks if /etc/fstab is in subvolume_origin
             fstab_path = self.subvolume_origin + 'etc/fstab'
             if os.path.isfile(fstab_path):
-                everything_ok = True
                 # /etc/fstab is in the subvolume, so it is necessary to
                 # modify it and add the snapshot's name
-                # grep -rnw '/etc/fstab' -e "/_active/rootvol"
                 # First, it is necessary to obtain the original subvolume
                 # for / which is mounted in the system (subvolume_origin_real)
-                subvolume_origin_real = None
-                command_string = """sudo btrfs subvolume show /"""
-                command = [command_string]
-                commandline_output = None
-                try:
-                    commandline_output = subprocess.check_output(command, shell=True)
-                except subprocess.CalledProcessError as called_process_error_exception:
-                    self.__logger.error("Error retrieving the real and mounted subvolume for / . Reason: " +
-                                        str(called_process_error_exception.reason))
-                    everything_ok = False
-                if everything_ok:
-                    commandline_output = commandline_output.decode('utf-8')
-                    for line_output in commandline_output.split("\n"):
-                        # The original subvolume mounted for / will be always the first line
-                        # of the output
-                        subvolume_origin_real = line_output
-                        break
-
+                subvolume_origin_info = ioctl.get_subvolume_info("/")
+                if subvolume_origin_info is not None and subvolume_origin_info.path:
+                    subvolume_origin_real = subvolume_origin_info.path
                     # Creating the snapshot in rw mode
-                    command = "{command} {subvolume_origin} {subvolume_dest}{snapshot_full_name}".format(
-                        command=BTRFS_CREATE_SNAPSHOT_RW_COMMAND,
-                        subvolume_origin=self.subvolume_origin,
-                        subvolume_dest=self.subvolume_dest,
-                        snapshot_full_name=snapshot_full_name
-                    )
-                    utils.execute_command(command, console=True, root=True)
-
-                    # Obtaining the real subvolume for the new snapshot created
-                    subvolume_snapshot_created_real = None
-                    command_string = """sudo btrfs subvolume show {subvolume_dest}{snapshot_full_name}""".format(
+                    snapshot_full_path = "{subvolume_dest}{snapshot_full_name}".format(
                         subvolume_dest=self.subvolume_dest,
                         snapshot_full_name=snapshot_full_name
                     )
-                    command = [command_string]
-                    commandline_output = None
-                    try:
-                        commandline_output = subprocess.check_output(command, shell=True)
-                    except subprocess.CalledProcessError as called_process_error_exception:
-                        self.__logger.error("Error retrieving the real subvolume for snapshot created. Reason: " +
-                                            str(called_process_error_exception.reason))
-
-                    commandline_output = commandline_output.decode('utf-8')
-                    for line_output in commandline_output.split("\n"):
-                        # The original subvolume mounted for / will be always the first line
-                        # of the output
-                        subvolume_snapshot_created_real = line_output
-                        break
-
-                    # Getting the line in fstab where it is necessary to substitute the subvolume which is going to be
-                    # mounted as root. It is necessary to discard all the lines with comments in fstab starting with '#'
-                    command_string = """grep -rnw '{fstab_path}' -e '{subvolume_origin_real}'""".format(
-                        fstab_path=fstab_path, subvolume_origin_real=subvolume_origin_real)
-                    command = [command_string]
-                    commandline_output = None
                     try:
-                        commandline_output = subprocess.check_output(command, shell=True)
-                    except subprocess.CalledProcessError:
-                        pass
-                    commandline_output = commandline_output.decode('utf-8')
-                    # line will be the line where grep has matched subvolume_origin_real. All lines commented with '#'
-                    # will be discarded
-                    line = "0"
-                    for line_output in commandline_output.split("\n"):
-                        line_splitted = line_output.split(':')
-                        # First element of the list will be the line where subvolume_origin_real has been matched by
-                        # grep command. If the second element is '#', this line is commented in fstab and it won't be
-                        # taken into account
-                        if not line_splitted[1].startswith('#'):
-                            line = line_splitted[0]
-                            break
-
-                    command_string = """sudo -S sed -i '{line}s|{subvolume_origin_real}|{subvolume_snapshot_created_real}|g' {subvolume_dest}{snapshot_full_name}/etc/fstab""".format(
-                        line=line,
-                        subvolume_origin_real=subvolume_origin_real,
-                        subvolume_snapshot_created_real=subvolume_snapshot_created_real,
-                        subvolume_dest=self.subvolume_dest,
-                        snapshot_full_name=snapshot_full_name
-                    )
-                    command = [command_string]
+                        create_subvolume_snapshot(self.subvolume_origin, snapshot_full_path, read_only=False)
+                    except exception.BtrfsSnapshotCreation as btrfs_snapshot_exception:
+                        self.__logger.error(str(btrfs_snapshot_exception))
+                        raise
+
+                    # Substituting the subvolume which is going to be mounted as root in the fstab of the
+                    # new snapshot. The file is parsed and written back atomically
                     try:
-                        subprocess.check_output(command, shell=True)
-                    except subprocess.CalledProcessError as called_process_error_exception:
+                        snapshot_created_info = ioctl.get_subvolume_info(snapshot_full_path)
+                        if snapshot_created_info is None or not snapshot_created_info.path:
+                            raise exception.FstabModification("The subvolume of {snapshot} couldn't be found".format(
+                                snapshot=snapshot_full_path))
+                        snapshot_fstab = fstab.Fstab(os.path.join(snapshot_full_path, fstab.FSTAB_RELATIVE_PATH))
+                        snapshot_fstab.set_root_subvolume(snapshot_created_info.path,
+                                                          snapshot_created_info.subvolume_id)
+                        snapshot_fstab.write()
+                        everything_ok = True
+                    except (OSError, exception.FstabModification) as fstab_exception:
                         self.__logger.error("Error trying to substitute the root's path in fstab with the "
-                                            "path of the new snapshot created. Reason: " +
-                                            str(called_process_error_exception.reason))
+                                            "path of the new snapshot created. Reason: " + str(fstab_exception))
                         everything_ok = False
+
                     if everything_ok:
                         # subvolume_origin_real will be stored in configuration file in order to let the
                         # user to consolidate the system's rollback to any snapshot different from the main one
                         settings.properties_manager.set_property('path_to_consolidate_root_snapshot',
                                                                       subvolume_origin_real)
 
-                        # Run grub-btrfs in order to regenerate GRUB entries
-                        self.__logger.info("Regenerating GRUB entries. Please wait...")
-                        utils.execute_command(GRUB_BTRFS_COMMAND, console=True, root=True)
+                        # GRUB entries will be regenerated once the burst of snapshot operations ends
+                        settings.grub_regenerator.mark_dirty()
 
                 else:
                     # The original subvolume mounted for / couldn't be found
@@ -199,22 +156,14 @@ class Subvolume:
                                         "Snapshot won't be created: ")
                     pass
 
-            else:
-                command = "{command} {subvolume_origin} {subvolume_dest}{snapshot_full_name}".format(
-                    command=BTRFS_CREATE_SNAPSHOT_R_COMMAND,
-                    subvolume_origin=self.subvolume_origin,
-                    subvolume_dest=self.subvolume_dest,
-                    snapshot_full_name=snapshot_full_name
-                )
-                utils.execute_command(command, console=True, root=True)
-        else:
-            command = "{command} {subvolume_origin} {subvolume_dest}{snapshot_full_name}".format(
-                command=BTRFS_CREATE_SNAPSHOT_R_COMMAND,
-                subvolume_origin=self.subvolume_origin,
-                subvolume_dest=self.subvolume_dest,
-                snapshot_full_name=snapshot_full_name
-            )
-            utils.execute_command(command, console=True, root=True)
+                return
+
+        # Creating the snapshot in read-only mode
+        try:
+            create_subvolume_snapshot(self.subvolume_origin, self.subvolume_dest + snapshot_full_name)
+        except exception.BtrfsSnapshotCreation as btrfs_snapshot_exception:
+            self.__logger.error(str(btrfs_snapshot_exception))
+            raise
 
     def delete_snapshots(self):
         """Deletes (or not if user has defined it) all the snapshots needed to keep the desired number set by the user.
@@ -226,48 +175,20 @@ class Subvolume:
                                                subvolume_dest=self.subvolume_dest)
         self.__logger.info(info_message)
 
+        # If the user has defined a retention policy, it is used instead of the number of snapshots to keep
+        if self.retention is not None:
+            retention.RetentionEngine(self, self.retention).apply()
+
         # If user has selected not delete any snapshot, this operation won't be done
-        if self.snapshots_to_keep > -1:
+        elif self.snapshots_to_keep > -1:
             # Checking how many snapshots are with the same name ordered by date
             snapshots = self.get_all_snapshots_with_the_same_name()
 
             # Removing all the snapshots needed starting with the oldest one until reach
-            # the limit defined by the user
+            # the limit defined by the user. All of them are deleted at once
             snapshots_to_delete = len(snapshots) - self.snapshots_to_keep
-            index = 0
-            while snapshots_to_delete > 0:
-                # Deletes the snapshot
-                command = "{command} {snapshot}".format(command=BTRFS_DELETE_SNAPSHOT_COMMAND,
-                                                        snapshot=snapshots[index])
-                utils.execute_command(command, console=True, root=True)
-                info_message = "Snapshot {snapshot} deleted.\n".format(snapshot=snapshots[index])
-                self.__logger.info(info_message)
-                # Deletes the log if it exists
-                snapshot_name = snapshots[index].split("/")[-1]
-                log = "{snapshot_name}-{index}.txt".format(snapshot_name=snapshot_name.split("-")[-2],
-                                                           index=snapshot_name.split("-")[-1])
-                log_path = os.path.join(settings.logs_path, log)
-                if os.path.exists(log_path):
-                    try:
-                        os.remove(log_path)
-                        info_message = "Log {log} deleted.\n".format(log=log)
-                        self.__logger.info(info_message)
-                    except OSError as os_error_exception:
-                        info_message = "Error deleting log {log}. Error {exception}\n".format(log=log,
-                                                                                              exception=str(
-                                                                                                  os_error_exception))
-                        self.__logger.info(info_message)
-                else:
-                    info_message = "Log {log} doesn't exist. Skipping...deleted.\n".format(log=log)
-                    self.__logger.info(info_message)
-
-                snapshots_to_delete -= 1
-                index += 1
-
-            # Checks if grub-btrfs integration is enabled
-            if settings.properties_manager.get_property("grub_btrfs"):
-                # Run grub-btrfs in order to regenerate GRUB entries
-                utils.execute_command(GRUB_BTRFS_COMMAND, console=True, root=True)
+            if snapshots_to_delete > 0:
+                delete_specific_snapshots(snapshots[:snapshots_to_delete])
 
     def delete_origin(self):
         """Deletes the original subvolume, i.e. the subvolume in subvolume_origin
@@ -278,6 +199,13 @@ class Subvolume:
         self.__logger.info(info_message)
         errors = False
 
+        if ioctl.is_privileged():
+            # Deletes the subvolume directly. BtrfsSnapshotDeletion will be raised if it is not empty
+            delete_subvolume(self.subvolume_origin)
+            info_message = "Snapshot {snapshot} deleted.\n".format(snapshot=self.subvolume_origin)
+            self.__logger.info(info_message)
+            return
+
         # Deletes the subvolume
         command_string = "{command} {snapshot}".format(command=BTRFS_DELETE_SNAPSHOT_COMMAND,
                                                        snapshot=self.subvolume_origin)
@@ -305,6 +233,58 @@ class Subvolume:
             info_message = "Snapshot {snapshot} deleted.\n".format(snapshot=self.subvolume_origin)
             self.__logger.info(info_message)
 
+    def has_changed_since_last_snapshot(self):
+        """Checks if the subvolume has changed since its last snapshot was taken.
+
+        The generation of the last change of the subvolume (ctransid) is compared with the generation when
+        its latest snapshot was created (otransid). If ctransid is not available, 'btrfs subvolume find-new'
+        is used to look for files written after the snapshot (deletions are not detected in that case).
+
+        Returns:
+            bool: True if the subvolume has changed or it can't be known; False otherwise.
+        """
+        origin_info = ioctl.get_subvolume_info(self.subvolume_origin)
+        if origin_info is None:
+            return True
+
+        # Looking for the latest snapshot taken from the current subvolume
+        latest_snapshot_info = None
+        for snapshot_full_path in reversed(self.get_all_snapshots_with_the_same_name()):
+            snapshot_info = ioctl.get_subvolume_info(snapshot_full_path)
+            if snapshot_info is not None and snapshot_info.parent_uuid == origin_info.uuid:
+                latest_snapshot_info = snapshot_info
+                break
+        if latest_snapshot_info is None or latest_snapshot_info.otransid is None:
+            return True
+
+        if origin_info.ctransid is not None:
+            return origin_info.ctransid > latest_snapshot_info.otransid
+
+        # Files written after the creation of the snapshot
+        result = utils.execute_command_list(BTRFS_FIND_NEW_ARGUMENTS + [self.subvolume_origin,
+                                                                        str(latest_snapshot_info.otransid + 1)],
+                                            root=True)
+        if result.returncode != 0:
+            return True
+        return any(not line.startswith("transid marker") for line in result.stdout.splitlines() if line.strip())
+
+    def get_new_snapshot_name(self):
+        """Calculates the name for a new snapshot, f.i.: root-20201021-2 if the last snapshot taken today is
+        root-20201021-1. Numbers of deleted snapshots are never reused while a later one exists.
+
+        Returns:
+            str: name of the new snapshot.
+        """
+        # Checking the highest number of the snapshots with the same name
+        snapshot_full_name = "{snapshot_name}-{current_date}".format(snapshot_name=self.snapshot_name,
+                                                                     current_date=self.__current_date)
+        numbers = [int(file[len(snapshot_full_name) + 1:]) for file in os.listdir(self.subvolume_dest)
+                   if file.startswith(snapshot_full_name + "-") and file[len(snapshot_full_name) + 1:].isdigit()]
+
+        # Adding number to the full name
+        return "{snapshot_full_name}-{number}".format(snapshot_full_name=snapshot_full_name,
+                                                      number=max(numbers) + 1 if numbers else 0)
+
     def get_all_snapshots_with_the_same_name(self):
         """Retrieves all the snapshots with name self.snapshot_name stored within self.subvolume_dest.
 
@@ -337,58 +317,46 @@ class RootSnapshotChecker:
         """Checks if the current snapshot used for root is the default or the user has booted the system from
         an alternate snapshot.
 
+        The subvolume mounted as root is read from the mounted filesystems and it is looked up by its ID
+        (or path) in the catalog of snapshots managed by buttermanager.
+
         Returns:
-            boolean: true if current snapshot used for root is the default or this paramenter has not been stored yet;
-                     false otherwise.
+            boolean: true if current snapshot used for root is the default, it is not a snapshot managed by
+                     buttermanager or this paramenter has not been stored yet; false otherwise.
         """
         # First, it is necessary to check if path_to_consolidate_root_snapshot is defined
-        if settings.properties_manager.get_property("path_to_consolidate_root_snapshot") != 0:
-            # Obtaining the mounted subvolume for root partition
-            # mount | grep 'on / ' | grep -o 'subvol=/.*' | cut -f2- -d=
-            command_string = """mount | grep 'on / ' | grep -o 'subvol=/.*' | cut -f2- -d="""
-            command = [command_string]
-            mounted_snapshot_raw = None
-            try:
-                mounted_snapshot_raw = subprocess.check_output(command, shell=True)
-            except subprocess.CalledProcessError:
-                pass
-            if mounted_snapshot_raw:
-                # Removing the last two characters (a /n and a ")")
-                mounted_snapshot_raw = mounted_snapshot_raw[:-2]
-                # Converting bytes into string
-                mounted_snapshot_raw = mounted_snapshot_raw.decode("utf-8")
-                # Removing first / if path_to_consolidate_root_snapshot doesn't start with /
-                if not settings.properties_manager.get_property("path_to_consolidate_root_snapshot")\
-                        .startswith("/"):
-                    mounted_snapshot_raw = mounted_snapshot_raw[1:]
-            if mounted_snapshot_raw != settings.properties_manager. \
-                    get_property("path_to_consolidate_root_snapshot"):
-                # If mounted snapshot is different from the supposed default root subvolume
-                # it means that user has booted the system using an alternate snapshot from GRUB.
-                # ButterManager will ask to consolidate the current snapshot as the default root
-                # subvolume
-
-                # Obtaining the snapshot mounted
-                mounted_snapshot_full_path = None
-                while mounted_snapshot_full_path is None:
-                    for subvolume in settings.subvolumes:
-                        snapshots = settings.subvolumes[subvolume].get_all_snapshots_with_the_same_name()
-                        for snapshot in snapshots:
-                            if mounted_snapshot_raw in snapshot:
-                                mounted_snapshot_full_path = snapshot
-                                break
-                        if mounted_snapshot_full_path is not None:
-                            break
-
-                self.__snapshot_to_clone_in_root_full_path = mounted_snapshot_full_path
-                self.__root_subvolume = settings.subvolumes[subvolume]
-                return False
-            else:
-                return True
-        else:
+        path_to_consolidate_root_snapshot = settings.properties_manager.get_property(
+            "path_to_consolidate_root_snapshot")
+        if path_to_consolidate_root_snapshot == 0:
             # Path to consolidate root snapshot hasn't been defined yet so this check is skipped
             return True
 
+        # Obtaining the mounted subvolume for root partition
+        root_mount = mountinfo.get_mount("/")
+        if root_mount is None or root_mount.fs_type != mountinfo.BTRFS:
+            self.__logger.info("Root filesystem is not BTRFS. Skipping the check...")
+            return True
+        mounted_snapshot_path = root_mount.get_option(mountinfo.SUBVOL_OPTION) or root_mount.root
+
+        if mounted_snapshot_path.strip("/") == str(path_to_consolidate_root_snapshot).strip("/"):
+            return True
+
+        # If mounted snapshot is different from the supposed default root subvolume
+        # it means that user has booted the system using an alternate snapshot from GRUB.
+        # ButterManager will ask to consolidate the current snapshot as the default root
+        # subvolume
+        snapshot_catalog = catalog.SnapshotCatalog()
+        snapshot_catalog.refresh()
+        mounted_snapshot = snapshot_catalog.get_by_mount(root_mount)
+        if mounted_snapshot is None:
+            self.__logger.info("Root is mounted from {subvolume}, which is not a snapshot managed by "
+                               "buttermanager".format(subvolume=mounted_snapshot_path))
+            return True
+
+        self.__snapshot_to_clone_in_root_full_path = mounted_snapshot.snapshot_full_path
+        self.__root_subvolume = mounted_snapshot.subvolume
+        return False
+
     def open_consolidate_snapshot_window(self):
         """Checks if the current snapshot used for root is the default or the user has booted the system from
         an alternate snapshot.
@@ -396,200 +364,14 @@ class RootSnapshotChecker:
         Returns:
             QDialog: The dialog window to consolidate the root snapshot.
         """
+        # Windows are imported only when they are needed, so this module can be used without PyQt5
+        from ..window import windows
         info_window = windows.ConsolidateSnapshotWindow(self.__parent_window,
                                                                self.__snapshot_to_clone_in_root_full_path,
                                                                self.__root_subvolume)
         return info_window
 
 
-class Differentiator(QThread):
-    """Independent thread that will calculate the differences between a snapshot and its current state.
-
-    """
-    # Constants
-    DIFFS_DIR = "diffs"
-    DIFF_COMMAND = "sudo -S diff -qr"
-    MODIFIED_FILE = "modified.txt"
-    OPERATION_FULL = "full_operation"
-    OPERATION_PARTIAL = "partial_operation"
-
-    # Attributes
-    # pyqtSignal that will be emitted when this class requires to display
-    # a single information window on the screen
-    show_one_window = pyqtSignal('bool')
-
-    # Constructor
-    def __init__(self, snapshot_full_path, operation_type):
-        QThread.__init__(self)
-        self.__snapshot_full_path = snapshot_full_path
-        self.__snapshot_name = snapshot_full_path.split("/")[-1]
-        self.__operation_type = operation_type
-
-    # Methods
-    def run(self):
-        # Main window will be hidden
-        self.on_show_one_window(True)
-        info_dialog = windows.InfoWindow(None, "Calculating differences in\n"
-                                                      "'{snapshot_name}'.\n"
-                                                      "Please, be patient. This process\n"
-                                                      "can take several minutes. This\n"
-                                                      "window will be closed when the\n"
-                                                      "operation is done. Calculating..."
-                                                      .format(snapshot_name=self.__snapshot_full_path))
-        # Displaying info window
-        info_dialog.show()
-
-        # Calculates differences
-        self.__calculate_differences()
-
-        # Hiding info window
-        info_dialog.hide()
-
-        # Main window will be shown again
-        self.on_show_one_window(False)
-
-    def __calculate_differences(self):
-        """Wraps all the operations to calculate differences.
-
-        """
-        # Gets the subvolume of the snapshot
-        subvolume = get_subvolume_by_snapshot_name(self.__snapshot_full_path)
-
-        if subvolume:
-            # Creating a directory to store all the diff files generated if it doesn't exist
-            # or removing and creating it if it existed
-            diffs_path = os.path.join(settings.application_path, self.DIFFS_DIR, self.__snapshot_name)
-
-            if os.path.exists(diffs_path):
-                shutil.rmtree(diffs_path)
-
-            os.makedirs(diffs_path)
-
-            # Getting the current subvolune name. This subvolume is the current one which is going to be
-            # used for the comparison. It is needed to remove all the empty strings within the list
-            subvolume_name_list = subvolume.subvolume_origin.split("/")
-            cleaned_subvolume_name_list = list(filter(None, subvolume_name_list))
-            if not cleaned_subvolume_name_list:
-                subvolume_name = "original"
-            else:
-                subvolume_name = cleaned_subvolume_name_list[-1]
-
-            if self.__operation_type == self.OPERATION_FULL:
-                # Full operation
-                # Creating 3 different files to store differences
-                files_only_in_dir1_path = os.path.join(diffs_path, "{file_name}.txt".format(file_name=subvolume_name))
-                files_only_in_dir2_path = os.path.join(diffs_path, "{file_name}.txt".format(
-                    file_name=self.__snapshot_name))
-                files_in_both_modified_path = os.path.join(diffs_path, self.MODIFIED_FILE)
-                files_only_in_dir1 = open(files_only_in_dir1_path, "w+")
-                files_only_in_dir2 = open(files_only_in_dir2_path, "w+")
-                files_in_both_modified = open(files_in_both_modified_path, "w+")
-
-                files_in_both_modified.write("Files in both snapshots that have been modified" + "\r\n\r\n")
-                files_only_in_dir1.write("Files only in ${dir}".format(dir=subvolume.subvolume_origin) + "\r\n\r\n")
-                files_only_in_dir2.write("Files only in ${dir}".format(dir=self.__snapshot_full_path) + "\r\n\r\n")
-
-                # Calculating differences
-                command = "{command} {dir1} {dir2}".format(command=self.DIFF_COMMAND, dir1=subvolume.subvolume_origin,
-                                                           dir2=self.__snapshot_full_path)
-                echo = subprocess.Popen(['echo', settings.user_password], stdout=subprocess.PIPE)
-                result = subprocess.Popen(command.split(), stdin=echo.stdout, stdout=subprocess.PIPE)
-
-                for line in iter(result.stdout.readline, b''):
-                    line_decoded = line.decode('utf-8')
-                    if " differ" in line_decoded:
-                        file_modified_splitted = line_decoded.split(
-                            "Files {path}".format(path=subvolume.subvolume_origin))
-                        file_modified = "/" + file_modified_splitted[1].split(" ")[0]
-                        files_in_both_modified.write(file_modified + "\r\n")
-                    elif "Only in {dir1}".format(dir1=subvolume.subvolume_origin) in line_decoded:
-                        file_only_in_dir1_splitted = line_decoded.split("Only in {path}".format(
-                            path=subvolume.subvolume_origin))
-                        file_only_in_dir1_splitted = file_only_in_dir1_splitted[1].split(":")
-                        file_name = file_only_in_dir1_splitted[1].strip()
-                        file_only_in_dir1 = "/" + file_only_in_dir1_splitted[0] + "/" + file_name
-                        files_only_in_dir1.write(file_only_in_dir1 + "\r\n")
-                    elif "Only in {dir2}".format(dir2=self.__snapshot_full_path) in line_decoded:
-                        file_only_in_dir2_splitted = line_decoded.split("Only in {path}".format(
-                            path=self.__snapshot_full_path))
-                        file_only_in_dir2_splitted = file_only_in_dir2_splitted[1].split(":")
-                        file_name = file_only_in_dir2_splitted[1].strip()
-                        file_only_in_dir2 = file_only_in_dir2_splitted[0] + "/" + file_name
-                        files_only_in_dir2.write(file_only_in_dir2 + "\r\n")
-                # Closing files
-                files_only_in_dir1.close()
-                files_only_in_dir2.close()
-                files_in_both_modified.close()
-
-                # Opening the file with the default application installed in the OS
-                # Warning, xdg-open is not working executing the code from PyCharm so
-                # it seems it doesn't work but it is really working
-                subprocess.call(['xdg-open', files_only_in_dir1_path])
-                subprocess.call(['xdg-open', files_only_in_dir2_path])
-                subprocess.call(['xdg-open', files_in_both_modified_path])
-
-            else:
-                # Partial operation
-                # Creating only one file to store differences
-                temp_sorted_modified_path = os.path.join(diffs_path, "tmp.txt")
-                temp_sorted_modified = open(temp_sorted_modified_path, "w+")
-
-                # Calculating differences
-                # sudo btrfs subvolume find-new /mnt/defvol/_snapshots/root-20201021-0/  '9999999'
-                # sudo btrfs subvolume find-new /mnt/defvol/_active/rootvol/ 463579 | sed '$d' | cut -f17- -d' ' |
-                # sort | uniq
-
-                # First, old transid is calculated. This ID will be used as a reference for the comparison
-                transid = "9999999"
-                command = "{command} {dir1} {transid}".format(command=BTRFS_FIND_NEW_COMMAND,
-                                                              dir1=self.__snapshot_full_path, transid=transid)
-                echo = subprocess.Popen(['echo', settings.user_password], stdout=subprocess.PIPE)
-                result = subprocess.Popen(command.split(), stdin=echo.stdout, stdout=subprocess.PIPE)
-
-                for line in iter(result.stdout.readline, b''):
-                    line_decoded = line.decode('utf-8')
-                    line_splitted = line_decoded.split(" ")
-                    transid = line_splitted[-1].strip()
-
-                # Then, the differences are obtained using transid
-                command = "{command} {dir1} {transid}".format(
-                    command=BTRFS_FIND_NEW_COMMAND,
-                    dir1=subvolume.subvolume_origin,
-                    transid=transid)
-                echo = subprocess.Popen(['echo', settings.user_password], stdout=subprocess.PIPE)
-                result = subprocess.Popen(command.split(), stdin=echo.stdout, stdout=subprocess.PIPE)
-
-                temp_sorted_modified.write("- Files in both snapshots that have been modified" + "\r\n")
-
-                for line in iter(result.stdout.readline, b''):
-                    line_decoded = line.decode('utf-8')
-                    line_splitted = line_decoded.split(" ")
-                    file_modified = "/" + line_splitted[-1].strip()
-                    temp_sorted_modified.write(file_modified + "\r\n")
-
-                # Closing file
-                temp_sorted_modified.close()
-
-                # Sorting file
-                files_in_both_modified_path = os.path.join(diffs_path, self.MODIFIED_FILE)
-                files_in_both_modified = open(files_in_both_modified_path, "w+")
-                command = "sort {file}".format(file=temp_sorted_modified_path)
-                subprocess.Popen(command.split(), stdout=files_in_both_modified)
-
-                # Opening the file with the default application installed in the OS
-                # Warning, xdg-open is not working executing the code from PyCharm so
-                # it seems it doesn't work but it is really working
-                subprocess.call(['xdg-open', files_in_both_modified_path])
-
-    def on_show_one_window(self, one_window):
-        """Emits a QT Signal to hide or show the rest of application windows.
-
-        Arguments:
-            one_window (boolean): Information window should be unique?.
-        """
-        self.show_one_window.emit(one_window)
-
-
 # Module's methods
 def delete_specific_snapshot(snapshot_full_path):
     """Deletes a specific snapshot.
@@ -599,25 +381,53 @@ def delete_specific_snapshot(snapshot_full_path):
         snapshot_full_path (string): path to the snapshot that user wants to delete.
 
     """
+    delete_specific_snapshots([snapshot_full_path], console=False)
+
+
+def delete_specific_snapshots(snapshots_full_paths, console=True):
+    """Deletes several snapshots at once.
+    It will delete the specific logs and file indexes related if they exist too.
+
+    Arguments:
+        snapshots_full_paths (:obj:`list` of :obj:`str`): paths to the snapshots that user wants to delete.
+        console (boolean): the output needs to be redirected to the console (default True).
+
+    Returns:
+        list (:obj:`list` of :obj:`str`): paths to the snapshots deleted.
+    """
     # Logger
     logger = utils.Logger(sys.modules['__main__'].__file__).get()
-    info_message = "Deleting snapshot {snapshot}".format(snapshot=snapshot_full_path)
+    info_message = "Deleting snapshots {snapshots}".format(snapshots=", ".join(snapshots_full_paths))
     logger.info(info_message)
 
-    command = "{command} {snapshot}".format(command=BTRFS_DELETE_SNAPSHOT_COMMAND, snapshot=snapshot_full_path)
-    utils.execute_command(command, root=True)
-    info_message = "Snapshot {snapshot} deleted.\n".format(snapshot=snapshot_full_path)
-    logger.info(info_message)
-
-    # Checks if grub-btrfs integration is enabled
-    if settings.properties_manager.get_property("grub_btrfs"):
-        # Run grub-btrfs in order to regenerate GRUB entries
-        utils.execute_command(GRUB_BTRFS_COMMAND, console=True, root=True)
-        info_message = "Regenerating GRUB entries. Please wait..."
+    # Indexes are named after the UUIDs of the snapshots, so they are located before deleting them
+    index_paths = {snapshot_full_path: fileindex.get_stored_index_path(snapshot_full_path)
+                   for snapshot_full_path in snapshots_full_paths}
+    snapshots_deleted = delete_subvolumes(snapshots_full_paths, console=console)
+    for snapshot_full_path in snapshots_deleted:
+        info_message = "Snapshot {snapshot} deleted.\n".format(snapshot=snapshot_full_path)
         logger.info(info_message)
+        delete_snapshot_log(snapshot_full_path)
+        if index_paths.get(snapshot_full_path) is not None:
+            fileindex.delete_index(index_paths[snapshot_full_path])
+
+    if snapshots_deleted:
+        # GRUB entries will be regenerated once the burst of snapshot operations ends
+        # (only if grub-btrfs integration is enabled)
+        settings.grub_regenerator.mark_dirty()
+    return snapshots_deleted
+
 
-    # Deletes the log if it exists
-    snapshot_name = snapshot_full_path.split("/")[-1]
+def delete_snapshot_log(snapshot_full_path):
+    """Deletes the log related to a specific snapshot if it exists.
+
+    Arguments:
+        snapshot_full_path (string): path to the snapshot.
+
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    snapshot_name = snapshot_full_path.rstrip("/").split("/")[-1]
     log = "{snapshot_name}-{index}.txt".format(snapshot_name=snapshot_name.split("-")[-2],
                                                index=snapshot_name.split("-")[-1])
     log_path = os.path.join(settings.logs_path, log)
@@ -635,6 +445,107 @@ def delete_specific_snapshot(snapshot_full_path):
         logger.info(info_message)
 
 
+def create_subvolume_snapshot(subvolume_origin, snapshot_full_path, read_only=True):
+    """Creates a snapshot of a subvolume.
+
+    If buttermanager is running as root, the snapshot is created directly using BTRFS ioctls, so no
+    process is spawned. Otherwise, btrfs command is executed using sudo.
+
+    Arguments:
+        subvolume_origin (string): path to the subvolume.
+        snapshot_full_path (string): path to the new snapshot.
+        read_only (boolean): the snapshot will be read-only (default True).
+    """
+    if ioctl.is_privileged():
+        try:
+            ioctl.BtrfsIoctl().create_snapshot(subvolume_origin, snapshot_full_path, read_only)
+        except OSError as os_error_exception:
+            raise exception.BtrfsSnapshotCreation("Error creating snapshot {snapshot} of {subvolume}: {error}".format(
+                snapshot=snapshot_full_path, subvolume=subvolume_origin, error=os_error_exception.strerror))
+        # Same output as btrfs command, so it is displayed in the GUI terminal of the application
+        sys.stdout.write("Create a {mode}snapshot of '{subvolume}' in '{snapshot}'\n".format(
+            mode="readonly " if read_only else "", subvolume=subvolume_origin.rstrip("/"),
+            snapshot=snapshot_full_path.rstrip("/")))
+    else:
+        command = "{command} {subvolume_origin} {snapshot}".format(
+            command=BTRFS_CREATE_SNAPSHOT_R_COMMAND if read_only else BTRFS_CREATE_SNAPSHOT_RW_COMMAND,
+            subvolume_origin=subvolume_origin,
+            snapshot=snapshot_full_path
+        )
+        utils.execute_command(command, console=True, root=True)
+        # The exit status of btrfs command is not available
+        if not os.path.isdir(snapshot_full_path):
+            raise exception.BtrfsSnapshotCreation("Error creating snapshot {snapshot} of {subvolume}".format(
+                snapshot=snapshot_full_path, subvolume=subvolume_origin))
+
+
+def delete_subvolume(subvolume_full_path, console=True):
+    """Deletes a subvolume (or snapshot).
+
+    If buttermanager is running as root, the subvolume is deleted directly using BTRFS ioctls, so no
+    process is spawned. Otherwise, btrfs command is executed using sudo.
+
+    Arguments:
+        subvolume_full_path (string): path to the subvolume.
+        console (boolean): the output needs to be redirected to the console (default True).
+    """
+    if ioctl.is_privileged():
+        try:
+            ioctl.BtrfsIoctl().delete_subvolume(subvolume_full_path)
+        except OSError as os_error_exception:
+            if os_error_exception.errno == errno.ENOTEMPTY:
+                raise exception.BtrfsSnapshotDeletion("Error: {snapshot} is not empty.\n".format(
+                    snapshot=subvolume_full_path))
+            raise exception.BtrfsSnapshotDeletion("Error deleting {snapshot}: {error}\n".format(
+                snapshot=subvolume_full_path, error=os_error_exception.strerror))
+        if console:
+            # Same output as btrfs command, so it is displayed in the GUI terminal of the application
+            sys.stdout.write("Delete subvolume (no-commit): '{snapshot}'\n".format(
+                snapshot=subvolume_full_path.rstrip("/")))
+    else:
+        command = "{command} {snapshot}".format(command=BTRFS_DELETE_SNAPSHOT_COMMAND, snapshot=subvolume_full_path)
+        utils.execute_command(command, console=console, root=True)
+
+
+def delete_subvolumes(subvolumes_full_paths, console=True):
+    """Deletes several subvolumes (or snapshots) at once.
+
+    If buttermanager is running as root, the subvolumes are deleted one after another using BTRFS ioctls.
+    Otherwise, only one btrfs command is executed using sudo for all of them.
+
+    Arguments:
+        subvolumes_full_paths (:obj:`list` of :obj:`str`): paths to the subvolumes.
+        console (boolean): the output needs to be redirected to the console (default True).
+
+    Returns:
+        list (:obj:`list` of :obj:`str`): paths to the subvolumes deleted.
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    subvolumes_deleted = []
+    if not subvolumes_full_paths:
+        return subvolumes_deleted
+
+    if ioctl.is_privileged():
+        for subvolume_full_path in subvolumes_full_paths:
+            try:
+                delete_subvolume(subvolume_full_path, console=console)
+                subvolumes_deleted.append(subvolume_full_path)
+            except exception.BtrfsSnapshotDeletion as btrfs_snapshot_exception:
+                logger.error(str(btrfs_snapshot_exception))
+    else:
+        result = utils.execute_command_list(BTRFS_DELETE_ARGUMENTS + list(subvolumes_full_paths), root=True)
+        if console:
+            sys.stdout.write(result.stdout)
+        if result.returncode != 0:
+            logger.error("Error deleting subvolumes: {error}".format(error=result.stderr.strip()))
+            if console:
+                sys.stdout.write(result.stderr)
+        subvolumes_deleted = [subvolume_full_path for subvolume_full_path in subvolumes_full_paths
+                              if not os.path.lexists(subvolume_full_path)]
+    return subvolumes_deleted
+
+
 def get_subvolume_by_snapshot_name(snapshot_name):
     """Gets a subvolume object using the name of the snapshot.
 
@@ -661,3 +572,98 @@ def get_subvolume_by_snapshot_name(snapshot_name):
             logger.info(info_message)
             subvolume_found = subvolume
     return subvolume_found
+
+
+def get_modified_files(snapshot_full_path, subvolume_origin):
+    """Retrieves the files of a subvolume that have been written since a snapshot was taken, using
+    'btrfs subvolume find-new'. Deleted files are not detected.
+
+    Arguments:
+        snapshot_full_path (str): Full path to the snapshot, f.i.: /mnt/defvol/_snapshots/root-20201021-0.
+        subvolume_origin (str): Full path to the subvolume the snapshot was taken from.
+
+    Returns:
+        list (:obj:`list` of :obj:`str`): paths of the files modified relative to the subvolume, sorted.
+    """
+    return sorted(get_changed_bytes(snapshot_full_path, subvolume_origin))
+
+
+def get_changed_bytes(snapshot_full_path, subvolume_origin):
+    """Retrieves the files of a subvolume that have been written since a snapshot was taken and the number of
+    bytes written in every one of them, using 'btrfs subvolume find-new'. Deleted files are not detected.
+
+    Arguments:
+        snapshot_full_path (str): Full path to the snapshot, f.i.: /mnt/defvol/_snapshots/root-20201021-0.
+        subvolume_origin (str): Full path to the subvolume the snapshot was taken from.
+
+    Returns:
+        dictionary (key=:obj:'str', value=:obj:'int'): bytes of the extents written after the snapshot was
+        taken (key: path of the file relative to the subvolume, f.i.: /etc/fstab).
+    """
+    changed_bytes = {}
+    for file_path, length in get_new_extents(subvolume_origin, get_snapshot_transid(snapshot_full_path)):
+        changed_bytes[file_path] = changed_bytes.get(file_path, 0) + length
+    return changed_bytes
+
+
+def get_snapshot_transid(snapshot_full_path):
+    """Calculates the first generation (transid) whose changes are not included in a snapshot.
+
+    Arguments:
+        snapshot_full_path (str): Full path to the snapshot.
+
+    Returns:
+        int: The generation following the one the snapshot was created in.
+    """
+    snapshot_info = ioctl.get_subvolume_info(snapshot_full_path)
+    if snapshot_info is not None and snapshot_info.otransid:
+        return snapshot_info.otransid + 1
+
+    # Asking for a generation that doesn't exist yet, find-new only prints the last one: 'transid marker was 463579'.
+    # It is the generation of the snapshot, which is read-only
+    transid = 0
+    result = utils.execute_command_list(BTRFS_FIND_NEW_ARGUMENTS + [snapshot_full_path, str(MAX_TRANSID)],
+                                        root=True)
+    for line in result.stdout.splitlines():
+        if line.startswith(FIND_NEW_MARKER):
+            transid = int(line.split(" ")[-1])
+    return transid + 1
+
+
+def get_new_extents(subvolume_origin, transid):
+    """Retrieves the extents of a subvolume written since a specific generation, using
+    'btrfs subvolume find-new'. Its output is parsed while it is generated, so memory doesn't depend on the
+    number of extents.
+
+    Arguments:
+        subvolume_origin (str): Full path to the subvolume.
+        transid (int): First generation to consider.
+
+    Returns:
+        generator (:obj:`tuple`): extents as (path, length) tuples. A file is found once per extent written.
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    arguments = BTRFS_FIND_NEW_ARGUMENTS + [subvolume_origin, str(transid)]
+    privileged = ioctl.is_privileged()
+    result = subprocess.Popen(arguments if privileged else ["sudo", "-S"] + arguments, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+                              errors="surrogateescape")
+    if not privileged:
+        result.stdin.write(settings.user_password + "\n")
+    result.stdin.close()
+    try:
+        for line in result.stdout:
+            # inode 257 file offset 0 len 4096 disk start 0 offset 0 gen 10 flags NONE etc/fstab
+            fields = line.rstrip("\n").split(" ", FIND_NEW_FIELDS)
+            if len(fields) > FIND_NEW_FIELDS and fields[0] == "inode":
+                try:
+                    length = int(fields[6])
+                except ValueError:
+                    length = 0
+                yield "/" + fields[FIND_NEW_FIELDS], length
+    finally:
+        result.stdout.close()
+        if result.wait() != 0:
+            logger.error("Error retrieving the files written in {subvolume} since generation {transid}".format(
+                subvolume=subvolume_origin, transid=transid))
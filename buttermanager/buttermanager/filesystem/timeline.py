@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to taking timeline snapshots periodically.
+
+It doesn't need PyQt5, so it can be run from a systemd timer or service. It provides also TimelineScheduler class.
+"""
+from ..util import settings, utils
+import json
+import os
+import time
+
+# Constants
+# The state is read by bm_timeline.py before importing anything else, so the name must be kept in sync
+STATE_FILE = "timeline.json"
+DEFAULT_INTERVAL = 60
+# Runs are deferred while the load average per CPU or the I/O pressure are above these values
+MAX_LOAD_PER_CPU = 1.0
+MAX_IO_PRESSURE = 10.0
+PSI_IO_PATH = "/proc/pressure/io"
+# Seconds to wait before trying again a deferred run
+RETRY_DELAY = 300
+
+
+# Classes
+class TimelineScheduler:
+    """Takes a snapshot of every subvolume when the timeline interval has elapsed and prunes the old ones.
+
+    Snapshots are taken using Subvolume.create_snapshot and pruned using Subvolume.delete_snapshots, so the
+    number of snapshots to keep and the retention policies defined in buttermanager.yaml are honored.
+    The time of the next run is stored in the application directory, so every tick is cheap.
+    """
+    # Constructor
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        """ Constructor.
+
+        Arguments:
+            interval (int): Minutes between two timeline snapshots.
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__interval = interval * 60
+        self.__state_path = os.path.join(settings.application_path, STATE_FILE)
+        # deferred_since is the time of the first run deferred since the last one taken
+        self.__state = {"last_run": 0, "next_run": 0, "deferred_since": 0}
+        self.__load()
+
+    # Methods
+    # Private methods
+    def __load(self):
+        """Loads the state stored in the application directory.
+
+        """
+        try:
+            with open(self.__state_path, 'r') as state_file:
+                self.__state.update(json.load(state_file))
+        except (OSError, ValueError, TypeError):
+            pass
+
+    def __save(self):
+        """Stores the state in the application directory.
+
+        """
+        try:
+            temporary_path = self.__state_path + ".tmp"
+            with open(temporary_path, 'w') as state_file:
+                json.dump(self.__state, state_file)
+            os.replace(temporary_path, self.__state_path)
+        except OSError as os_error_exception:
+            self.__logger.error("Error storing timeline state: {error}".format(error=str(os_error_exception)))
+
+    # Public methods
+    def is_due(self, now=None):
+        """Checks if the timeline interval has elapsed.
+
+        Arguments:
+            now (float): Current time (default time.time()).
+
+        Returns:
+            bool: True if a timeline snapshot has to be taken.
+        """
+        now = time.time() if now is None else now
+        return now >= self.__state["next_run"] and now - self.__state["last_run"] >= self.__interval
+
+    def must_defer(self, now=None):
+        """Checks if the run has to be deferred because the system is busy. A run is never deferred if the
+        previous one was taken or the first deferred run was due more than two intervals ago.
+
+        Arguments:
+            now (float): Current time (default time.time()).
+
+        Returns:
+            bool: True if the run has to be deferred.
+        """
+        now = time.time() if now is None else now
+        for since in (self.__state["last_run"], self.__state["deferred_since"]):
+            if since != 0 and now - since >= 2 * self.__interval:
+                return False
+        load_per_cpu = os.getloadavg()[0] / (os.cpu_count() or 1)
+        io_pressure = get_io_pressure()
+        if load_per_cpu > MAX_LOAD_PER_CPU or io_pressure > MAX_IO_PRESSURE:
+            self.__logger.info("Deferring timeline snapshots. Load per CPU: {load:.2f}; I/O pressure: "
+                               "{pressure:.2f}%".format(load=load_per_cpu, pressure=io_pressure))
+            return True
+        return False
+
+    def tick(self):
+        """Takes the timeline snapshots if they are due and the system is not busy.
+
+        Returns:
+            bool: True if the snapshots have been taken.
+        """
+        now = time.time()
+        if not self.is_due(now):
+            return False
+        if self.must_defer(now):
+            self.__state["next_run"] = now + RETRY_DELAY
+            if self.__state["deferred_since"] == 0:
+                self.__state["deferred_since"] = now
+            self.__save()
+            return False
+
+        self.__logger.info("Taking timeline snapshots. Please wait...")
+        # GRUB entries will be regenerated only once, when all the snapshots have been taken
+        settings.grub_regenerator.hold()
+        errors = False
+        try:
+            for subvolume_key in settings.subvolumes:
+                subvolume = settings.subvolumes[subvolume_key]
+                try:
+                    subvolume.create_snapshot()
+                    subvolume.delete_snapshots()
+                except Exception as general_exception:
+                    errors = True
+                    self.__logger.error("Error taking timeline snapshot of {subvolume}: {error}".format(
+                        subvolume=subvolume.subvolume_origin, error=str(general_exception)))
+        finally:
+            settings.grub_regenerator.release()
+            settings.grub_regenerator.flush()
+
+        if errors:
+            # The run is not recorded, so it is tried again later
+            self.__state["next_run"] = now + RETRY_DELAY
+            self.__save()
+            return False
+
+        self.__state["last_run"] = now
+        self.__state["next_run"] = now + self.__interval
+        self.__state["deferred_since"] = 0
+        self.__save()
+        return True
+
+
+# Module's methods
+def get_io_pressure(psi_path=PSI_IO_PATH):
+    """Reads the percentage of time some tasks were stalled on I/O during the last 10 seconds.
+
+    Arguments:
+        psi_path (str): Path of the pressure stall information file (default /proc/pressure/io).
+
+    Returns:
+        float: Percentage of time stalled. 0 if the kernel doesn't provide pressure stall information.
+    """
+    try:
+        with open(psi_path, 'r') as psi_file:
+            for line in psi_file:
+                # some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+                fields = line.split()
+                if fields and fields[0] == "some":
+                    for field in fields[1:]:
+                        name, _, value = field.partition("=")
+                        if name == "avg10":
+                            return float(value)
+    except (OSError, ValueError):
+        pass
+    return 0.0
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to watching the space left in BTRFS filesystems.
+
+When the space allocated crosses the thresholds defined by the user, the watchdog escalates step by step:
+it prunes the snapshots according to their retention, waits for the cleaner to free the space of the deleted
+snapshots, balances the data chunks less used and, if the filesystem is still full, notifies the user.
+It provides also SpaceUsage and SpaceWatchdog classes.
+"""
+from ..util import settings, utils
+from . import ioctl, mountinfo
+import json
+import os
+import sys
+import time
+
+# Constants
+SYSFS_FILESYSTEM_PATH = "/sys/fs/btrfs/{uuid}"
+ALLOCATION_DIR = "allocation"
+DEVICES_DIR = "devices"
+BLOCK_GROUP_TYPES = ("data", "metadata", "system")
+# Size of the block devices in sysfs is expressed in 512 bytes sectors
+SECTOR_SIZE = 512
+DEFAULT_WARNING_THRESHOLD = 70
+DEFAULT_CRITICAL_THRESHOLD = 85
+NORMAL = 0
+WARNING = 1
+CRITICAL = 2
+PRUNE = "prune"
+CLEANER = "cleaner"
+BALANCE = "balance"
+NOTIFY = "notify"
+# Minimum number of seconds between two executions of every step
+RATE_LIMITS = {PRUNE: 3600, CLEANER: 600, BALANCE: 6 * 3600, NOTIFY: 3600}
+# Data chunks used less than these percentages are balanced (one after the other)
+BALANCE_DATA_USAGE_STEPS = (0, 5, 10)
+BTRFS_SUBVOLUME_SYNC_COMMAND = ["btrfs", "subvolume", "sync"]
+BTRFS_BALANCE_START_COMMAND = ["btrfs", "balance", "start"]
+NOTIFY_SEND_COMMAND = "notify-send"
+STATE_FILE = "watchdog-{uuid}.json"
+HISTORY_SIZE = 100
+
+
+# Classes
+class SpaceUsage:
+    """Space used by a BTRFS filesystem according to the allocation counters exposed in sysfs.
+
+    """
+    # Constructor
+    def __init__(self, total, allocated, data_total, data_used, metadata_total, metadata_used):
+        """ Constructor.
+
+        Arguments:
+            total (int): Bytes of all the devices of the filesystem.
+            allocated (int): Bytes allocated in chunks in all the devices.
+            data_total (int): Bytes of the data chunks.
+            data_used (int): Bytes used within the data chunks.
+            metadata_total (int): Bytes of the metadata chunks.
+            metadata_used (int): Bytes used within the metadata chunks.
+        """
+        self.total = total
+        self.allocated = allocated
+        self.data_total = data_total
+        self.data_used = data_used
+        self.metadata_total = metadata_total
+        self.metadata_used = metadata_used
+
+    # Private attributes
+    # Bytes not allocated in any chunk
+    @property
+    def unallocated(self):
+        return max(0, self.total - self.allocated)
+
+    # Percentage of the devices allocated (the same percentage displayed in the main window)
+    @property
+    def allocated_percentage(self):
+        return int(self.allocated * 100 / self.total) if self.total else 0
+
+    # Percentage of the metadata chunks used
+    @property
+    def metadata_percentage(self):
+        return int(self.metadata_used * 100 / self.metadata_total) if self.metadata_total else 0
+
+    def __str__(self):
+        """Reimplementation of the str method inherited from object class.
+
+        Returns:
+            string: String representation of the SpaceUsage object.
+        """
+        return "Allocated: {0} of {1} ({2}%); Metadata used: {3} of {4} ({5}%)".format(
+            utils.convert_from_bytes(self.allocated), utils.convert_from_bytes(self.total), self.allocated_percentage,
+            utils.convert_from_bytes(self.metadata_used), utils.convert_from_bytes(self.metadata_total),
+            self.metadata_percentage)
+
+
+class SpaceWatchdog:
+    """Watches the space left in a BTRFS filesystem and frees space when it is needed.
+
+    The last time every step was run and the history of the steps are stored in the application directory,
+    so the rate limits are honored between different executions.
+    """
+    # Constructor
+    def __init__(self, uuid, mount_point, warning_threshold=DEFAULT_WARNING_THRESHOLD,
+                 critical_threshold=DEFAULT_CRITICAL_THRESHOLD):
+        """ Constructor.
+
+        Arguments:
+            uuid (str): UUID of the filesystem.
+            mount_point (str): Any mount point of the filesystem.
+            warning_threshold (int): Percentage of space allocated that triggers the pruning and the balance.
+            critical_threshold (int): Percentage of space allocated (or metadata used) that triggers the
+            notification.
+        """
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__uuid = uuid
+        self.__mount_point = mount_point
+        self.__warning_threshold = warning_threshold
+        self.__critical_threshold = critical_threshold
+        self.__state_path = os.path.join(settings.application_path, STATE_FILE.format(uuid=uuid))
+        self.__state = {"last_runs": {}, "history": []}
+        self.__load()
+
+    # Private attributes
+    # History of the steps run
+    @property
+    def history(self):
+        return self.__state["history"]
+
+    # Methods
+    # Private methods
+    def __load(self):
+        """Loads the state stored in the application directory.
+
+        """
+        try:
+            with open(self.__state_path, 'r') as state_file:
+                state = json.load(state_file)
+            self.__state["last_runs"] = dict(state.get("last_runs", {}))
+            self.__state["history"] = list(state.get("history", []))
+        except (OSError, ValueError, TypeError):
+            pass
+
+    def __save(self):
+        """Stores the state in the application directory.
+
+        """
+        try:
+            temporary_path = self.__state_path + ".tmp"
+            with open(temporary_path, 'w') as state_file:
+                json.dump(self.__state, state_file)
+            os.replace(temporary_path, self.__state_path)
+        except OSError as os_error_exception:
+            self.__logger.error("Error storing watchdog state: {error}".format(error=str(os_error_exception)))
+
+    def __run_step(self, step, action, usage):
+        """Runs a step if its rate limit allows it and records it.
+
+        Arguments:
+            step (str): prune, cleaner, balance or notify.
+            action (function): Function that runs the step. It receives the space usage and returns a description
+            of the result.
+            usage (SpaceUsage): Space usage when the step is requested.
+
+        Returns:
+            bool: True if the step has been run; False if it has been skipped because of its rate limit.
+        """
+        now = time.time()
+        last_run = self.__state["last_runs"].get(step, 0)
+        if now - last_run < RATE_LIMITS[step]:
+            self.__logger.info("Skipping {step} in {uuid}: it was run {seconds} seconds ago".format(
+                step=step, uuid=self.__uuid, seconds=int(now - last_run)))
+            return False
+        self.__logger.info("Running {step} in {uuid}. {usage}".format(step=step, uuid=self.__uuid, usage=usage))
+        try:
+            result = action(usage)
+        except Exception as general_exception:
+            result = "Error: {error}".format(error=str(general_exception))
+            self.__logger.error("Error running {step} in {uuid}: {error}".format(step=step, uuid=self.__uuid,
+                                                                                 error=str(general_exception)))
+        self.__state["last_runs"][step] = now
+        self.__state["history"] = (self.__state["history"] + [{"time": now, "step": step,
+                                                               "allocated_percentage": usage.allocated_percentage,
+                                                               "result": result}])[-HISTORY_SIZE:]
+        self.__save()
+        return True
+
+    def __prune(self, usage):
+        """Deletes the snapshots of the subvolumes stored in the filesystem according to their retention.
+
+        Arguments:
+            usage (SpaceUsage): Current space usage.
+
+        Returns:
+            str: Description of the result.
+        """
+        subvolumes = []
+        btrfs_ioctl = ioctl.BtrfsIoctl()
+        for subvolume_key in settings.subvolumes:
+            subvolume = settings.subvolumes[subvolume_key]
+            try:
+                if btrfs_ioctl.get_filesystem_uuid(subvolume.subvolume_dest) == self.__uuid:
+                    subvolumes.append(subvolume)
+            except OSError:
+                continue
+        for subvolume in subvolumes:
+            subvolume.delete_snapshots()
+        return "{number} subvolumes pruned".format(number=len(subvolumes))
+
+    def __wait_for_cleaner(self, usage):
+        """Waits until the space of all the deleted subvolumes has been freed.
+
+        Arguments:
+            usage (SpaceUsage): Current space usage.
+
+        Returns:
+            str: Description of the result.
+        """
+        result = utils.execute_command_list(BTRFS_SUBVOLUME_SYNC_COMMAND + [self.__mount_point], root=True)
+        return "Cleaner finished" if result.returncode == 0 else result.stderr.strip()
+
+    def __balance(self, usage):
+        """Balances the data chunks less used, raising the usage filter until the filesystem is below the warning
+        threshold.
+
+        Arguments:
+            usage (SpaceUsage): Current space usage.
+
+        Returns:
+            str: Description of the result.
+        """
+        for data_usage in BALANCE_DATA_USAGE_STEPS:
+            result = utils.execute_command_list(BTRFS_BALANCE_START_COMMAND +
+                                                ["-dusage={usage}".format(usage=data_usage), self.__mount_point],
+                                                root=True)
+            self.__logger.info(result.stdout.strip() or result.stderr.strip())
+            if result.returncode != 0:
+                return "Balance with dusage={usage} failed: {error}".format(usage=data_usage,
+                                                                           error=result.stderr.strip())
+            if self.get_level(self.get_space_usage()) == NORMAL:
+                break
+        return "Balanced up to dusage={usage}".format(usage=data_usage)
+
+    def __notify(self, usage):
+        """Notifies the user that the filesystem is still running out of space.
+
+        Arguments:
+            usage (SpaceUsage): Current space usage.
+
+        Returns:
+            str: Description of the result.
+        """
+        message = "{mount_point} is running out of space. {usage}".format(mount_point=self.__mount_point,
+                                                                          usage=usage)
+        self.__logger.warning(message)
+        if utils.exist_program(NOTIFY_SEND_COMMAND):
+            utils.execute_command_list([NOTIFY_SEND_COMMAND, "-u", "critical", "ButterManager", message])
+        return message
+
+    # Public methods
+    def get_space_usage(self):
+        """Reads the space usage of the filesystem from sysfs.
+
+        Returns:
+            SpaceUsage: The space usage.
+        """
+        return read_space_usage(self.__uuid)
+
+    def get_level(self, usage):
+        """Calculates how full the filesystem is.
+
+        Arguments:
+            usage (SpaceUsage): Space usage.
+
+        Returns:
+            int: NORMAL, WARNING or CRITICAL.
+        """
+        if usage.allocated_percentage > self.__critical_threshold or \
+                (usage.allocated_percentage > self.__warning_threshold and
+                 usage.metadata_percentage > self.__critical_threshold):
+            return CRITICAL
+        elif usage.allocated_percentage > self.__warning_threshold:
+            return WARNING
+        return NORMAL
+
+    def check(self):
+        """Checks the space usage and escalates step by step while the filesystem is above the warning threshold.
+
+        Returns:
+            list (:obj:`list` of :obj:`str`): steps that have been run.
+        """
+        steps = []
+        usage = self.get_space_usage()
+        if self.get_level(usage) == NORMAL:
+            return steps
+        for step, action in ((PRUNE, self.__prune), (CLEANER, self.__wait_for_cleaner),
+                             (BALANCE, self.__balance)):
+            if self.__run_step(step, action, usage):
+                steps.append(step)
+                usage = self.get_space_usage()
+                if self.get_level(usage) == NORMAL:
+                    return steps
+        if self.get_level(usage) == CRITICAL and self.__run_step(NOTIFY, self.__notify, usage):
+            steps.append(NOTIFY)
+        return steps
+
+
+# Module's methods
+def read_sysfs_integer(path):
+    """Reads a number from a sysfs file.
+
+    Arguments:
+        path (str): Path of the file.
+
+    Returns:
+        int: The number.
+    """
+    with open(path, 'r') as sysfs_file:
+        return int(sysfs_file.read().strip())
+
+
+def read_space_usage(uuid):
+    """Reads the space usage of a BTRFS filesystem from the allocation counters exposed in sysfs. No external
+    process nor privilege is needed.
+
+    Arguments:
+        uuid (str): UUID of the filesystem.
+
+    Returns:
+        SpaceUsage: The space usage.
+    """
+    filesystem_path = SYSFS_FILESYSTEM_PATH.format(uuid=uuid)
+    total = 0
+    devices_path = os.path.join(filesystem_path, DEVICES_DIR)
+    for device in os.listdir(devices_path):
+        total += read_sysfs_integer(os.path.join(devices_path, device, "size")) * SECTOR_SIZE
+    allocated = 0
+    for block_group_type in BLOCK_GROUP_TYPES:
+        allocated += read_sysfs_integer(os.path.join(filesystem_path, ALLOCATION_DIR, block_group_type,
+                                                     "disk_total"))
+    allocation_path = os.path.join(filesystem_path, ALLOCATION_DIR)
+    return SpaceUsage(total, allocated,
+                      read_sysfs_integer(os.path.join(allocation_path, "data", "total_bytes")),
+                      read_sysfs_integer(os.path.join(allocation_path, "data", "bytes_used")),
+                      read_sysfs_integer(os.path.join(allocation_path, "metadata", "total_bytes")),
+                      read_sysfs_integer(os.path.join(allocation_path, "metadata", "bytes_used")))
+
+
+def get_mount_points():
+    """Retrieves a mount point of every mounted BTRFS filesystem.
+
+    Returns:
+        dictionary (key=:obj:'str', value=:obj:'str'): mount point of every filesystem (key: UUID).
+    """
+    mount_points = {}
+    btrfs_ioctl = ioctl.BtrfsIoctl()
+    for mount in mountinfo.get_mounts():
+        if mount.fs_type != mountinfo.BTRFS:
+            continue
+        try:
+            uuid = btrfs_ioctl.get_filesystem_uuid(mount.mount_point)
+        except OSError:
+            continue
+        mount_points.setdefault(uuid, mount.mount_point)
+    return mount_points
+
+
+def check_filesystems():
+    """Checks the space usage of all the mounted BTRFS filesystems if the user has enabled the watchdog.
+
+    Returns:
+        dictionary (key=:obj:'str', value=:obj:'list'): steps that have been run for every filesystem (key: UUID).
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    steps = {}
+    if not settings.space_watchdog:
+        return steps
+    for uuid, mount_point in get_mount_points().items():
+        try:
+            watchdog = SpaceWatchdog(uuid, mount_point, settings.space_watchdog_warning,
+                                     settings.space_watchdog_critical)
+            steps[uuid] = watchdog.check()
+        except OSError as os_error_exception:
+            logger.error("Error checking the space of {mount_point}: {error}".format(mount_point=mount_point,
+                                                                                   error=str(os_error_exception)))
+    return steps
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to calculating the differences between a snapshot and the
+current state of its subvolume.
+
+It provides also Differentiator class.
+"""
+from ..filesystem import diff, diffcache, diffresults, snapshot
+from ..util import settings
+from ..window import windows
+import os
+import shutil
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+# Classes
+class Differentiator(QThread):
+    """Independent thread that will calculate the differences between a snapshot and its current state.
+
+    """
+    # Constants
+    DIFFS_DIR = "diffs"
+    OPERATION_FULL = "full_operation"
+    OPERATION_PARTIAL = "partial_operation"
+    OPERATION_SEND = "send_operation"
+    OPERATION_SNAPSHOTS = "snapshots_operation"
+    CACHE_MODES = {OPERATION_FULL: diffcache.FULL, OPERATION_PARTIAL: diffcache.PARTIAL,
+                   OPERATION_SEND: diffcache.SEND, OPERATION_SNAPSHOTS: diffcache.INDEX}
+
+    # Attributes
+    # pyqtSignal that will be emitted when this class requires to display
+    # a single information window on the screen
+    show_one_window = pyqtSignal('bool')
+    # pyqtSignal that will be emitted when the differences have been stored, so they can be browsed.
+    # The full path to the file which stores them is sent
+    differences_found = pyqtSignal('QString')
+    # pyqtSignal that will be emitted when the differences couldn't be calculated. The error is sent
+    differences_failed = pyqtSignal('QString')
+
+    # Constructor
+    def __init__(self, snapshot_full_path, operation_type, other_snapshot_full_path=None):
+        """ Constructor.
+
+        Arguments:
+            snapshot_full_path (str): Full path to the snapshot.
+            operation_type (str): OPERATION_FULL, OPERATION_PARTIAL, OPERATION_SEND or OPERATION_SNAPSHOTS.
+            other_snapshot_full_path (str): Full path to the snapshot compared with the first one. Only for
+            OPERATION_SNAPSHOTS (default None).
+        """
+        QThread.__init__(self)
+        self.__snapshot_full_path = snapshot_full_path
+        self.__snapshot_name = snapshot_full_path.split("/")[-1]
+        self.__operation_type = operation_type
+        self.__other_snapshot_full_path = other_snapshot_full_path
+
+    # Methods
+    def run(self):
+        # Main window will be hidden
+        self.on_show_one_window(True)
+        info_dialog = windows.InfoWindow(None, "Calculating differences in\n"
+                                                      "'{snapshot_name}'.\n"
+                                                      "Please, be patient. This process\n"
+                                                      "can take several minutes. This\n"
+                                                      "window will be closed when the\n"
+                                                      "operation is done. Calculating..."
+                                                      .format(snapshot_name=self.__snapshot_full_path))
+        # Displaying info window
+        info_dialog.show()
+
+        # Calculates differences. The main window is shown again even if they couldn't be calculated
+        try:
+            self.__calculate_differences()
+        except Exception as general_exception:
+            self.on_differences_failed(str(general_exception))
+        finally:
+            # Hiding info window
+            info_dialog.hide()
+
+            # Main window will be shown again
+            self.on_show_one_window(False)
+
+    def __calculate_differences(self):
+        """Wraps all the operations to calculate differences.
+
+        """
+        # Gets the subvolume of the snapshot (or the other snapshot if two snapshots are compared)
+        if self.__operation_type == self.OPERATION_SNAPSHOTS:
+            origin = self.__other_snapshot_full_path
+        else:
+            subvolume = snapshot.get_subvolume_by_snapshot_name(self.__snapshot_full_path)
+            origin = subvolume.subvolume_origin if subvolume else None
+
+        if origin:
+            # Creating a directory to store the differences if it doesn't exist
+            # or removing and creating it if it existed
+            diffs_path = os.path.join(settings.application_path, self.DIFFS_DIR, self.__snapshot_name)
+
+            if os.path.exists(diffs_path):
+                shutil.rmtree(diffs_path)
+
+            os.makedirs(diffs_path)
+
+            # Calculating differences (or retrieving them from the diff cache)
+            mode = self.CACHE_MODES[self.__operation_type]
+            differences = diff.get_differences(origin, self.__snapshot_full_path, mode)
+
+            # Differences are stored sorted, so they can be browsed within the application without loading them
+            results_path = os.path.join(diffs_path, diffresults.RESULTS_FILE)
+            diffresults.write_results(differences, results_path, {"origin": origin,
+                                                                  "snapshot": self.__snapshot_full_path,
+                                                                  "mode": mode})
+            self.on_differences_found(results_path)
+
+    def on_show_one_window(self, one_window):
+        """Emits a QT Signal to hide or show the rest of application windows.
+
+        Arguments:
+            one_window (boolean): Information window should be unique?.
+        """
+        self.show_one_window.emit(one_window)
+
+    def on_differences_found(self, results_path):
+        """Emits a QT Signal to browse the differences found.
+
+        Arguments:
+            results_path (str): Full path to the file which stores the differences.
+        """
+        self.differences_found.emit(results_path)
+
+    def on_differences_failed(self, error):
+        """Emits a QT Signal to report that the differences couldn't be calculated.
+
+        Arguments:
+            error (str): Error found.
+        """
+        self.differences_failed.emit(error)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to indexing snapshots in background from the GUI.
+
+It provides also Indexer class.
+"""
+from ..filesystem import fileindex
+from ..util import utils
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+# Classes
+class Indexer(QThread):
+    """Independent thread that will build the indexes of the read-only snapshots which are not indexed yet.
+
+    Snapshots never change, so an index is never rebuilt once it has been stored. The snapshots given are all the
+    snapshots of the subvolumes defined, so the rest of the indexes stored are deleted.
+    """
+    # Attributes
+    # pyqtSignal that will be emitted every time a snapshot has been indexed (or it was already indexed).
+    # The full path to the snapshot is sent
+    snapshot_indexed = pyqtSignal('QString')
+
+    # Constructor
+    def __init__(self, snapshots_full_paths, parent=None):
+        """ Constructor.
+
+        Arguments:
+            snapshots_full_paths (:obj:`list` of :obj:`str`): Full paths to the snapshots.
+            parent (QObject): Owner of the thread (default None).
+        """
+        QThread.__init__(self, parent)
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+        self.__snapshots_full_paths = list(snapshots_full_paths)
+        self.__stopped = False
+
+    # Methods
+    def run(self):
+        index_paths = {snapshot_full_path: fileindex.get_stored_index_path(snapshot_full_path)
+                       for snapshot_full_path in self.__snapshots_full_paths}
+        # Indexes of the snapshots which no longer exist (f.i.: deleted outside ButterManager) are deleted
+        fileindex.prune_indexes(set(index_paths.values()))
+        for snapshot_full_path in self.__snapshots_full_paths:
+            if self.__stopped:
+                break
+            index_path = index_paths[snapshot_full_path]
+            if index_path is not None and not fileindex.is_index_stored(index_path):
+                try:
+                    fileindex.store_index(snapshot_full_path, index_path)
+                except OSError as os_error_exception:
+                    self.__logger.error("Error indexing {snapshot}: {error}".format(
+                        snapshot=snapshot_full_path, error=str(os_error_exception)))
+                    continue
+            self.snapshot_indexed.emit(snapshot_full_path)
+
+    def stop(self):
+        """Stops indexing once the snapshot being indexed is done.
+
+        """
+        self.__stopped = True
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to upgrading the packages of the system.
+
+It doesn't need PyQt5, so the system can be upgraded from the command line too.
+"""
+from ..filesystem import watchdog
+from ..util import settings, utils
+import sys
+
+
+# Constants
+ARCH_PACMAN_REFRESH_REPOSITORIES = "sudo -S pacman -Sy"
+ARCH_PACMAN_CHECK_UPDATES = "sudo -S pacman -Qu"
+ARCH_PACMAN_UPGRADE_COMMAND = "sudo -S pacman -Syu --noconfirm"
+DEBIAN_APT_UPDATE_COMMAND = "sudo -S apt update"
+DEBIAN_APT_UPGRADE_COMMAND = "sudo -S apt upgrade -y"
+DEBIAN_APT_CHECK_UPDATES = "sudo -S apt list --upgradable"
+ARCH_YAOURT_UPGRADE_COMMAND = "yaourt -Syua --noconfirm"
+ARCH_YAOURT_COMMAND = "yaourt"
+ARCH_YAY_UPGRADE_COMMAND = "yay -Syua --noconfirm"
+ARCH_YAY_COMMAND = "yay"
+ARCH_TRIZEN_UPGRADE_COMMAND = "trizen -Syua --noconfirm"
+ARCH_TRIZEN_COMMAND = "trizen"
+SNAP_COMMAND = "snap"
+FLATPAK_COMMAND = "flatpak"
+SNAP_UPGRADE_COMMAND = "sudo -S snap refresh"
+FLATPAK_UPGRADE_COMMAND = "flatpak update -y"
+SUSE_ZYPPER_UPGRADE_COMMAND = "sudo -S zypper -n update"
+SUSE_ZYPPER_CHECK_UPDATES = "sudo -S zypper list-updates"
+FEDORA_DNF_UPGRADE_COMMAND = "sudo -S dnf upgrade --refresh --assumeyes"
+FEDORA_DNF_CHECK_UPDATES = "sudo -S dnf check-update"
+
+
+# Module's methods
+def upgrade_system(include_aur, include_snap, include_flatpak, snapshots):
+    """Upgrades the system if there are updates. Snapshots are created before upgrading and old snapshots are
+    removed after upgrading if it is needed.
+
+    Arguments:
+        include_aur (boolean): Upgrade AUR packages (only ArchLinux and derivatives).
+        include_snap (boolean): Upgrade snap packages.
+        include_flatpak (boolean): Upgrade flatpak packages.
+        snapshots (boolean): Create and delete snapshots.
+
+    Returns:
+        boolean: true if the system has been upgraded; false if it was up to date.
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    # Check for updates
+    if check_updates():
+        # There are system updates
+        sys.stdout.write("\n")
+        sys.stdout.write("--------")
+        sys.stdout.write("\n")
+        logger.info("Starting system upgrading process.")
+        sys.stdout.write("Starting system upgrading process. Please wait...")
+        sys.stdout.write("\n")
+
+        # GRUB entries will be regenerated only once, when the whole upgrading process has finished
+        settings.grub_regenerator.hold()
+        try:
+            # Frees space before upgrading if the user has enabled the space watchdog, so the upgrade
+            # doesn't run out of space
+            watchdog.check_filesystems()
+
+            # Creates all the snapshots needed before upgrading the system
+            # only if it is needed
+            if snapshots:
+                sys.stdout.write("\n")
+                sys.stdout.write("--------")
+                sys.stdout.write("\n")
+                sys.stdout.write("Creating snapshots and updating GRUB entries if it is necessary...")
+                sys.stdout.write("\n")
+                sys.stdout.write("--------")
+                sys.stdout.write("\n")
+                for snapshot in settings.subvolumes:
+                    try:
+                        settings.subvolumes[snapshot].create_snapshot()
+                    except Exception as exception:
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Error creating the snapshot " +
+                                         settings.subvolumes[snapshot].subvolume_origin)
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Error: " + str(exception))
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+
+            # Upgrades the system
+            upgrading_command = ""
+            if settings.user_os == utils.OS_ARCH:
+                upgrading_command = ARCH_PACMAN_UPGRADE_COMMAND
+            elif settings.user_os == utils.OS_DEBIAN:
+                # First, it is necessary to update the system
+                sys.stdout.write("\n")
+                sys.stdout.write("--------")
+                sys.stdout.write("\n")
+                sys.stdout.write("Updating the system. Please wait...")
+                sys.stdout.write("\n")
+                utils.execute_command(DEBIAN_APT_UPDATE_COMMAND, console=True)
+                sys.stdout.write("\n")
+                upgrading_command = DEBIAN_APT_UPGRADE_COMMAND
+            elif settings.user_os == utils.OS_SUSE:
+                upgrading_command = SUSE_ZYPPER_UPGRADE_COMMAND
+            elif settings.user_os == utils.OS_FEDORA:
+                upgrading_command = FEDORA_DNF_UPGRADE_COMMAND
+
+            if upgrading_command:
+                try:
+                    sys.stdout.write("Upgrading the system. Please wait...")
+                    sys.stdout.write("\n")
+                    utils.execute_command(upgrading_command, console=True)
+                except Exception as exception:
+                    sys.stdout.write("\n")
+                    sys.stdout.write("--------")
+                    sys.stdout.write("\n")
+                    sys.stdout.write("Error upgrading the system")
+                    sys.stdout.write("\n")
+                    sys.stdout.write("Error: " + str(exception))
+                    sys.stdout.write("\n")
+                    sys.stdout.write("--------")
+                    sys.stdout.write("\n")
+
+            # Upgrades AUR if distro is ArchLinux or derivatives
+            if settings.user_os == utils.OS_ARCH:
+                if include_aur:
+                    try:
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Updating AUR packages if it is needed. Please wait...")
+                        sys.stdout.write("\n")
+                        if utils.exist_program(ARCH_YAY_COMMAND):
+                            utils.execute_command(ARCH_YAY_UPGRADE_COMMAND, console=True)
+                        elif utils.exist_program(ARCH_TRIZEN_COMMAND):
+                            utils.execute_command(ARCH_TRIZEN_UPGRADE_COMMAND, console=True)
+                        elif utils.exist_program(ARCH_YAOURT_COMMAND):
+                            utils.execute_command(ARCH_YAOURT_UPGRADE_COMMAND, console=True)
+                    except Exception as exception:
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Error upgrading AUR packages")
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Error: " + str(exception))
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+
+            # Upgrades snap packages
+            if include_snap:
+                if utils.exist_program(SNAP_COMMAND):
+                    try:
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Updating snap applications. Please wait...")
+                        sys.stdout.write("\n")
+                        utils.execute_command(SNAP_UPGRADE_COMMAND, console=True)
+                    except Exception as exception:
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Error upgrading snap packages")
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Error: " + str(exception))
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+
+            # Upgrades flatpak packages
+            if include_flatpak:
+                if utils.exist_program(FLATPAK_COMMAND):
+                    try:
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Updating flatpak applications. Please wait...")
+                        sys.stdout.write("\n")
+                        utils.execute_command(FLATPAK_UPGRADE_COMMAND, console=True)
+                    except Exception as exception:
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Error upgrading flatpak packages")
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Error: " + str(exception))
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+
+            # Removes all the snapshots not needed any more it is needed
+            if snapshots:
+                sys.stdout.write("\n")
+                sys.stdout.write("--------")
+                sys.stdout.write("\n")
+                sys.stdout.write("Removing old snapshots if it is needed and updating GRUB entries. Please wait...")
+                sys.stdout.write("\n")
+                for snapshot in settings.subvolumes:
+                    try:
+                        settings.subvolumes[snapshot].delete_snapshots()
+                    except Exception as exception:
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Error deleting the snapshot " +
+                                         settings.subvolumes[snapshot].subvolume_origin)
+                        sys.stdout.write("\n")
+                        sys.stdout.write("Error: " + str(exception))
+                        sys.stdout.write("\n")
+                        sys.stdout.write("--------")
+                        sys.stdout.write("\n")
+        finally:
+            # Regenerating GRUB entries if some snapshot operation has marked the boot menu as dirty
+            settings.grub_regenerator.release()
+            settings.grub_regenerator.flush()
+
+        sys.stdout.write("\n")
+        sys.stdout.write("--------")
+        sys.stdout.write("\n")
+        logger.info("System upgrading process finished.")
+        sys.stdout.write("System upgrading process finished. You can close the terminal output now.")
+        sys.stdout.write("\n")
+        sys.stdout.write("\n")
+        return True
+    else:
+        # There are not system updates
+        logger.info("Your system is up to date.")
+        sys.stdout.write("Your system is up to date. You can close the terminal output now.")
+        sys.stdout.write("\n")
+        sys.stdout.write("\n")
+        return False
+
+
+def check_updates():
+    """Checks for updates.
+
+    Returns:
+        boolean: true if there are updates; false otherwise.
+    """
+    # Logger
+    logger = utils.Logger(sys.modules['__main__'].__file__).get()
+    logger.info("Checking for system updates.")
+    sys.stdout.write("Checking for system updates.")
+    sys.stdout.write("\n")
+    sys.stdout.write("--------")
+    sys.stdout.write("\n")
+
+    updates = False
+    if settings.user_os == utils.OS_ARCH:
+        refresh_repositories_command = ARCH_PACMAN_REFRESH_REPOSITORIES
+        utils.execute_command(refresh_repositories_command)
+        check_for_updates_command = ARCH_PACMAN_CHECK_UPDATES
+        commandline_output = utils.execute_command(check_for_updates_command)
+
+        for line in commandline_output.split("\n"):
+            if line:
+                updates = True
+
+    elif settings.user_os == utils.OS_DEBIAN:
+        check_for_updates_command = DEBIAN_APT_CHECK_UPDATES
+        commandline_output = utils.execute_command(check_for_updates_command)
+        lines = commandline_output.split("\n")
+        if len(lines) > 2:
+            updates = True
+
+    elif settings.user_os == utils.OS_SUSE:
+        check_for_updates_command = SUSE_ZYPPER_CHECK_UPDATES
+        commandline_output = utils.execute_command(check_for_updates_command)
+        lines = commandline_output.split("\n")
+        if len(lines) > 4:
+            updates = True
+
+    elif settings.user_os == utils.OS_FEDORA:
+        check_for_updates_command = FEDORA_DNF_CHECK_UPDATES
+        commandline_output = utils.execute_command(check_for_updates_command)
+        lines = commandline_output.split("\n")
+        if len(lines) > 2:
+            updates = True
+
+    else:
+        updates = True
+
+    return updates
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module gathers all the operations related to searching files within the indexes of the snapshots in
+background from the GUI.
+
+It provides also Searcher class.
+"""
+from ..filesystem import fileindex
+import re
+import time
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+# Classes
+class Searcher(QThread):
+    """Independent thread that will search files across the indexes of several snapshots, so the GUI is not
+    blocked while the indexes are scanned.
+
+    """
+    # Attributes
+    # pyqtSignal that will be emitted when the search finishes. The files found, the snapshots which are not
+    # indexed yet and the milliseconds elapsed are sent (see fileindex.search_snapshots)
+    search_finished = pyqtSignal(dict, list, float)
+
+    # pyqtSignal that will be emitted if the query is not a valid regular expression. The error is sent
+    search_failed = pyqtSignal('QString')
+
+    # Constructor
+    def __init__(self, snapshots_full_paths, query, regex, parent=None):
+        """ Constructor.
+
+        Arguments:
+            snapshots_full_paths (:obj:`list` of :obj:`str`): Full paths to the snapshots.
+            query (str): Glob or regular expression.
+            regex (bool): The query is a regular expression.
+            parent (QObject): Owner of the thread (default None).
+        """
+        QThread.__init__(self, parent)
+        self.__snapshots_full_paths = list(snapshots_full_paths)
+        self.__query = query
+        self.__regex = regex
+
+    # Methods
+    def run(self):
+        start = time.time()
+        try:
+            found, not_indexed = fileindex.search_snapshots(self.__snapshots_full_paths, self.__query, self.__regex)
+        except re.error as regex_exception:
+            self.search_failed.emit(str(regex_exception))
+            return
+        self.search_finished.emit(found, not_indexed, (time.time() - start) * 1000)
@@ -57,12 +57,33 @@ path_to_consolidate_root_snapshot = "0"
 grub_btrfs = 0
 # Do user want to save log automatically after upgrading system? 0=False 1=True
 save_log = 1
+# Do user want to skip snapshots of subvolumes that haven't changed since their last snapshot? 0=False 1=True
+skip_unchanged_snapshots = 0
+# Do user want to prune snapshots and balance filesystems automatically when they run out of space? 0=False 1=True
+space_watchdog = 0
+# Percentage of space allocated that makes the space watchdog prune snapshots and balance the filesystem
+space_watchdog_warning = 70
+# Percentage of space allocated that makes the space watchdog notify the user
+space_watchdog_critical = 85
+# Do user want to take timeline snapshots periodically? 0=False 1=True
+timeline = 0
+# Minutes between two timeline snapshots
+timeline_interval = 60
+# Do user want to take snapshots when packages are installed, upgraded or removed using the package manager
+# (pacman, apt, dnf or zypper hooks)? 0=False 1=True
+package_manager_hooks = 0
+# Days a diff of a subvolume which is not read-only is kept in the diff cache
+diff_cache_max_age = 30
+# Maximum size of the diff cache in MiB
+diff_cache_max_size = 64
 # Subvolumes managed by the application
 # It will be a dictionary:
 # Key=origin path for the subvolume; Value=Subvolume object
 subvolumes = {}
 # Properties Manager
 properties_manager = None
+# GRUB regenerator (it coalesces all the GRUB regenerations requested by snapshot operations)
+grub_regenerator = None
 # Base fot size for all the UI elements (it is dynamically calculated during application start up)
 base_font_size = 10
 # Fot size increment defined by the user
@@ -178,6 +199,8 @@ class PropertiesManager:
         subvolumes_dest = ""
         subvolumes_prefix = ""
         subvolumes_snapshost_to_keep = ""
+        subvolumes_retention = ""
+        subvolumes_minimum_snapshots = ""
         index = 0
 
         for subvolume in subvolumes:
@@ -185,17 +208,24 @@ class PropertiesManager:
             subvolumes_dest += subvolumes[subvolume].subvolume_dest
             subvolumes_prefix += subvolumes[subvolume].snapshot_name
             subvolumes_snapshost_to_keep += str(subvolumes[subvolume].snapshots_to_keep)
+            if subvolumes[subvolume].retention is not None:
+                subvolumes_retention += str(subvolumes[subvolume].retention)
+            subvolumes_minimum_snapshots += str(subvolumes[subvolume].minimum_snapshots)
             if index + 1 < len(subvolumes):
                 subvolumes_orig += "|"
                 subvolumes_dest += "|"
                 subvolumes_prefix += "|"
                 subvolumes_snapshost_to_keep += "|"
+                subvolumes_retention += "|"
+                subvolumes_minimum_snapshots += "|"
             index += 1
 
         self.__user_settings['subvolumes_orig'] = subvolumes_orig
         self.__user_settings['subvolumes_dest'] = subvolumes_dest
         self.__user_settings['subvolumes_prefix'] = subvolumes_prefix
         self.__user_settings['subvolumes_snapshots_to_keep'] = subvolumes_snapshost_to_keep
+        self.__user_settings['subvolumes_retention'] = subvolumes_retention
+        self.__user_settings['subvolumes_minimum_snapshots'] = subvolumes_minimum_snapshots
 
         # Setting property in buttermanager.yaml file
         self.__store_configuration()
@@ -21,11 +21,7 @@
 """
 from . import settings
 from ..exception import exception
-from ..filesystem import snapshot
-from ..window import windows
-from PyQt5.QtWidgets import QFileDialog
-from tkinter import Tk
-from tkinter.filedialog import askdirectory
+from ..filesystem import grub, retention, snapshot
 import logging
 import logging.handlers
 import os
@@ -33,8 +29,6 @@ import pathlib
 import shutil
 import subprocess
 import sys
-import urllib.request
-import urllib.error
 import yaml
 
 # Constants
@@ -53,6 +47,8 @@ OS_DEBIAN = "DEBIAN"
 OS_SUSE = "SUSE"
 OS_FEDORA = "FEDORA"
 VERSION_URL = "https://raw.githubusercontent.com/egara/buttermanager/master/version.txt"
+# Programs already found by exist_program. They are not checked again, so sudo and which are run only once
+programs_found = set()
 
 
 class ConfigManager:
@@ -84,11 +80,22 @@ class ConfigManager:
                 flatpak_packages: 0
                 save_log: 1
                 grub_btrfs: 0
+                skip_unchanged_snapshots: 0
+                space_watchdog: 0
+                space_watchdog_warning: 70
+                space_watchdog_critical: 85
+                timeline: 0
+                timeline_interval: 60
+                package_manager_hooks: 0
+                diff_cache_max_age: 30
+                diff_cache_max_size: 64
                 path_to_consolidate_root_snapshot: 0
                 subvolumes_dest:
                 subvolumes_orig:
                 subvolumes_prefix:
                 subvolumes_snapshots_to_keep:
+                subvolumes_retention:
+                subvolumes_minimum_snapshots:
                 font_size_increment: 0
             '''
             config_file_dictionary = yaml.safe_load(config_file_as_dictionary)
@@ -142,6 +149,14 @@ class ConfigManager:
             settings.installation_type = "venv"
         self.__logger.info("Installation type: {installation}".format(installation=settings.installation_type))
 
+        # Loading the configuration
+        self.load_settings()
+
+    def load_settings(self):
+        """Loads the configuration stored in buttermanager.yaml. It doesn't check the environment (OS, desktop
+        environment...), so it can be used by headless tools like the timeline scheduler.
+
+        """
         # Creating a properties manager to manage all the application properties
         self.__logger.info("Creating PropertiesManager...")
         settings.properties_manager = settings.PropertiesManager()
@@ -149,6 +164,10 @@ class ConfigManager:
         # Triggering migration process
         self.migrate_properties()
 
+        # Creating a GRUB regenerator to coalesce all the GRUB regenerations
+        self.__logger.info("Creating GrubRegenerator...")
+        settings.grub_regenerator = grub.GrubRegenerator()
+
         # Retrieving configuration...
         self.__logger.info("Retrieving user's configuration from buttermanager.yaml file and loading it in memory...")
 
@@ -167,6 +186,31 @@ class ConfigManager:
         # Do user want to boot the system from GRUB using snapshots
         settings.grub_btrfs = int(settings.properties_manager.get_property('grub_btrfs'))
 
+        # Do user want to skip snapshots of subvolumes that haven't changed since their last snapshot
+        settings.skip_unchanged_snapshots = int(settings.properties_manager.get_property('skip_unchanged_snapshots'))
+
+        # Do user want to prune snapshots and balance filesystems automatically when they run out of space
+        # Thresholds are optional, so default values are used if they are not defined
+        settings.space_watchdog = int(settings.properties_manager.get_property('space_watchdog'))
+        settings.space_watchdog_warning = int(settings.properties_manager.get_property('space_watchdog_warning')) \
+            or settings.space_watchdog_warning
+        settings.space_watchdog_critical = int(settings.properties_manager.get_property('space_watchdog_critical')) \
+            or settings.space_watchdog_critical
+
+        # Do user want to take timeline snapshots periodically and how often (in minutes)
+        settings.timeline = int(settings.properties_manager.get_property('timeline'))
+        settings.timeline_interval = int(settings.properties_manager.get_property('timeline_interval')) \
+            or settings.timeline_interval
+
+        # Do user want to take snapshots from the package manager hooks
+        settings.package_manager_hooks = int(settings.properties_manager.get_property('package_manager_hooks'))
+
+        # How long (in days) and how much space (in MiB) diff results can be cached
+        settings.diff_cache_max_age = int(settings.properties_manager.get_property('diff_cache_max_age')) \
+            or settings.diff_cache_max_age
+        settings.diff_cache_max_size = int(settings.properties_manager.get_property('diff_cache_max_size')) \
+            or settings.diff_cache_max_size
+
         # The path of the root snapshot that must be within /etc/fstab as / mount point
         # It will be 0 if this property is not defined yet or it is empty
         settings.path_to_consolidate_root_snapshot = settings.properties_manager.\
@@ -239,11 +283,13 @@ class Logger(object):
         logger = logging.getLogger(class_name)
         logger.setLevel(logging.DEBUG)
 
-        # Add the log message handler to the logger
-        handler = logging.handlers.RotatingFileHandler(name, maxBytes=1048576, backupCount=5)
-        formatter = logging.Formatter('%(asctime)s %(levelname)s:%(name)s. %(message)s')
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        # Add the log message handler to the logger (only once, so long running processes don't write
+        # every message several times)
+        if not logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(name, maxBytes=1048576, backupCount=5)
+            formatter = logging.Formatter('%(asctime)s %(levelname)s:%(name)s. %(message)s')
+            handler.setFormatter(formatter)
+            logger.addHandler(handler)
         self.__logger = logger
 
     def get(self):
@@ -265,6 +311,10 @@ class VersionChecker:
         """Checks if there is a newest version of ButterManager available.
 
         """
+        # urllib is only imported here, so the command line interface starts faster
+        import urllib.error
+        import urllib.request
+
         try:
             # Retrieving the last version from GitHub
             response = urllib.request.urlopen(self.__version_url)
@@ -279,6 +329,8 @@ class VersionChecker:
                                settings.application_version)
 
             if last_version != settings.application_version:
+                # Windows are imported only when they are needed, so this module can be used without PyQt5
+                from ..window import windows
                 if settings.user_os == OS_ARCH:
                     info_window = windows.GeneralInfoWindow(self.__parent_window, "New version " +
                                                                    last_version + " is available. Update ButterManager "
@@ -337,6 +389,27 @@ def execute_command(command, console=False, root=False):
         raise exception.NoCommandFound()
 
 
+def execute_command_list(arguments, root=False):
+    """Executes a command given as a list of arguments.
+
+    Unlike execute_command, the arguments are never split or interpreted by a shell, so paths with
+    spaces or special characters are safe.
+
+    Arguments:
+        arguments (:obj:`list` of :obj:`str`): Command and its arguments.
+        root (boolean): The command needs root privileges. sudo will be used if the current user is not root
+
+    Returns:
+        subprocess.CompletedProcess: Result of the command. stdout and stderr are decoded in UTF-8.
+    """
+    user_input = None
+    if root and os.geteuid() != 0:
+        arguments = ["sudo", "-S"] + list(arguments)
+        user_input = settings.user_password + "\n"
+    return subprocess.run(arguments, input=user_input, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
 def get_percentage(total, parcial):
     """Calculates the percentage between total amount and parcial amount.
 
@@ -407,6 +480,25 @@ def convert_to_bytes(number_unit):
     return number_unit['number'] * factor
 
 
+def convert_from_bytes(number):
+    """Converts a number of bytes into a string with the most suitable unit.
+
+    Arguments:
+        number (int): Number of bytes
+
+    Returns:
+        str: Number and unit, f.i.: 30.00GiB
+
+    >>> convert_from_bytes(32212254720)
+    '30.00GiB'
+    """
+    for unit, exponent in ((GB, 3), (MB, 2), (KB, 1)):
+        factor = BYTE_SIZE ** exponent
+        if abs(number) >= factor:
+            return "{number:.2f}{unit}".format(number=number / factor, unit=unit)
+    return "{number}{unit}".format(number=number, unit=B)
+
+
 def exist_program(program, root=False):
     """Checks if a program is installed on the system.
 
@@ -415,7 +507,8 @@ def exist_program(program, root=False):
     if sudo which is used instead of simply which from current user.
     Because of that, root variable has been declared above. By default, root value
     will be False, i.e. for those commands which are discoverable simply by using
-    which without sudo.
+    which without sudo. If the current user is already root, sudo is not needed.
+    Programs found are remembered, so they are checked only once.
 
     Arguments:
         program (string): Program to check
@@ -427,7 +520,10 @@ def exist_program(program, root=False):
     >>> exist_program('ls')
     True
     """
-    if root:
+    if program in programs_found:
+        return True
+
+    if root and os.geteuid() != 0:
         command = "sudo -S which " + program
         # Checking if the program executed by the command is installed in the system
         echo = subprocess.Popen(['echo', settings.user_password], stdout=subprocess.PIPE)
@@ -438,10 +534,12 @@ def exist_program(program, root=False):
         # result is Bytes type, so it is needed to decode Unicode string using UTF-8
         commandline_output = result.stdout.read().decode('utf-8')
         exist = not commandline_output.startswith("which:")
-        return exist
     else:
-        path = shutil.which(program)
-        return path is not None
+        exist = shutil.which(program) is not None
+
+    if exist:
+        programs_found.add(program)
+    return exist
 
 
 def get_subvolumes():
@@ -455,14 +553,32 @@ def get_subvolumes():
     subvolumes_dest_raw = settings.properties_manager.get_property('subvolumes_dest')
     subvolumes_prefix_raw = settings.properties_manager.get_property('subvolumes_prefix')
     subvolumes_snapshots_to_keep_raw = settings.properties_manager.get_property('subvolumes_snapshots_to_keep')
+    # Retention policies and minimums are optional (they were introduced later), so these properties can be missing
+    subvolumes_retention_raw = settings.properties_manager.get_property('subvolumes_retention')
+    subvolumes_minimum_snapshots_raw = settings.properties_manager.get_property('subvolumes_minimum_snapshots')
     if subvolumes_orig_raw is not None and subvolumes_orig_raw != "":
         subvolumes_orig = subvolumes_orig_raw.split("|")
         subvolumes_dest = subvolumes_dest_raw.split("|")
         subvolumes_prefix = subvolumes_prefix_raw.split("|")
         subvolumes_snapshots_to_keep = subvolumes_snapshots_to_keep_raw.split("|")
+        subvolumes_retention = subvolumes_retention_raw.split("|") if subvolumes_retention_raw else []
+        subvolumes_minimum_snapshots = str(subvolumes_minimum_snapshots_raw).split("|") \
+            if subvolumes_minimum_snapshots_raw else []
         for index, subvolume_orig in enumerate(subvolumes_orig):
+            retention_policy = None
+            if index < len(subvolumes_retention):
+                try:
+                    retention_policy = retention.parse_policy(subvolumes_retention[index])
+                except ValueError as value_error_exception:
+                    # Logger
+                    logger = Logger(sys.modules['__main__'].__file__).get()
+                    logger.error("Wrong retention policy for {subvolume}: {error}".format(
+                        subvolume=subvolume_orig, error=str(value_error_exception)))
+            minimum_snapshots = 1
+            if index < len(subvolumes_minimum_snapshots) and subvolumes_minimum_snapshots[index].isdigit():
+                minimum_snapshots = int(subvolumes_minimum_snapshots[index])
             subvolume = snapshot.Subvolume(subvolume_orig, subvolumes_dest[index], subvolumes_prefix[index],
-                                           subvolumes_snapshots_to_keep[index])
+                                           subvolumes_snapshots_to_keep[index], retention_policy, minimum_snapshots)
             subvolumes.append(subvolume)
 
     return subvolumes
@@ -517,13 +633,17 @@ def open_file_browser_directory(parent_window):
     # Creating a QFileDialog or Tkinter file browser to select the directory
     # Only directories will be allowed
     selected_path = ""
+    # File browsers are imported only when they are needed, so this module can be used without PyQt5 or Tkinter
     if settings.desktop_environment == 'kde' and settings.installation_type == 'native':
+        from tkinter import Tk
+        from tkinter.filedialog import askdirectory
         Tk().withdraw()
         filename = askdirectory()
 
         if filename:
             selected_path = filename
     else:
+        from PyQt5.QtWidgets import QFileDialog
         file_dialog = QFileDialog(parent_window)
         file_dialog.setFileMode(QFileDialog.Directory)
         file_dialog.setOption(QFileDialog.ShowDirsOnly, True)
@@ -20,15 +20,19 @@
 
 """
 from ..exception import exception
-from ..filesystem import snapshot
+from ..filesystem import diff, diffresults, history, pruning, restore, rollback, snapshot
+from ..manager import indexer, searcher
 from ..util import settings, utils
+import itertools
 import os
-import subprocess
 import sys
-from PyQt5.QtWidgets import QDesktopWidget, QDialog, QMainWindow, QPushButton, QVBoxLayout, QLabel
+import time
+from PyQt5.QtWidgets import QDesktopWidget, QDialog, QDialogButtonBox, QDoubleSpinBox, QHBoxLayout, QListWidget, \
+    QMainWindow, QPushButton, QVBoxLayout, QLabel, QLineEdit, QCheckBox, QTreeWidget, QTreeWidgetItem, QPlainTextEdit, \
+    QComboBox, QTreeView, QFileDialog
 from PyQt5 import uic, QtCore, QtTest
-from PyQt5.QtCore import pyqtSignal, QSize
-from PyQt5.QtGui import QIcon, QTextCursor
+from PyQt5.QtCore import pyqtSignal, QSize, QAbstractItemModel, QModelIndex
+from PyQt5.QtGui import QIcon, QTextCursor, QFontDatabase
 
 
 class InfoWindow(QDialog):
@@ -227,83 +231,23 @@ class ConsolidateSnapshotWindow(QDialog):
         self.__logger.info("Consolidating default root snapshot. The system has booted in " +
                            self.__snapshot_to_clone_in_root_full_path + " and it will be consolidated into " +
                            self.__root_subvolume.subvolume_origin[:-1])
-        # Removes root snapshot
+        # Swaps the root subvolume and a new clone of the snapshot. The previous root is kept as a snapshot
         try:
-            self.__root_subvolume.delete_origin()
-            # Creates a new snapshot for root
-            command = "{command} {subvolume_origin} {subvolume_dest}".format(
-                command=snapshot.BTRFS_CREATE_SNAPSHOT_RW_COMMAND,
-                subvolume_origin=self.__snapshot_to_clone_in_root_full_path,
-                subvolume_dest=self.__root_subvolume.subvolume_origin[:-1]
-            )
-            utils.execute_command(command, console=True, root=True)
-            # Replace /etc/fstab with the default snapshot
-            # Substitute the entry in fstab for root
-
-            # Obtaining the real subvolumes for changing paths in fstab
-            subvolume_origin = self.__snapshot_to_clone_in_root_full_path
-            command_string = """sudo btrfs subvolume show {subvolume_origin}""".format(
-                subvolume_origin=subvolume_origin
-            )
-            command = [command_string]
-            commandline_output = None
-            try:
-                commandline_output = subprocess.check_output(command, shell=True)
-            except subprocess.CalledProcessError as called_process_error_exception:
-                self.__logger.error("Error retrieving the real subvolume. Reason: " +
-                                    str(called_process_error_exception.reason))
-
-            commandline_output = commandline_output.decode('utf-8')
-            for line_output in commandline_output.split("\n"):
-                # The original subvolume mounted for / will be always the first line
-                # of the output
-                subvolume_origin_real = line_output
-                break
-
-            subvolume_dest_real = self.__root_subvolume.subvolume_origin[:-1]
-            command_string = """sudo btrfs subvolume show {subvolume_dest_real}""".format(
-                subvolume_dest_real=subvolume_dest_real
-            )
-            command = [command_string]
-            commandline_output = None
-            try:
-                commandline_output = subprocess.check_output(command, shell=True)
-            except subprocess.CalledProcessError as called_process_error_exception:
-                self.__logger.error("Error retrieving the real subvolume. Reason: " +
-                                    str(called_process_error_exception.reason))
-
-            commandline_output = commandline_output.decode('utf-8')
-            for line_output in commandline_output.split("\n"):
-                # The original subvolume mounted for / will be always the first line
-                # of the output
-                subvolume_dest_real = line_output
-                break
-
-            command_string = """sudo -S sed -i 's|{subvolume_origin_real}|{subvolume_dest_real}|g' {subvolume_dest}/etc/fstab""".format(
-                subvolume_origin_real=subvolume_origin_real,
-                subvolume_dest=self.__root_subvolume.subvolume_origin[:-1],
-                subvolume_dest_real=subvolume_dest_real
-            )
-            command = [command_string]
-            try:
-                subprocess.check_output(command, shell=True)
-                # Checks if grub-btrfs integration is enabled
-                if settings.properties_manager.get_property("grub_btrfs"):
-                    # Run grub-btrfs in order to regenerate GRUB entries
-                    utils.execute_command(snapshot.GRUB_BTRFS_COMMAND, console=True, root=True)
-                # The consolidation process was OK so this QDialong window is closed and returns integer 1
-                self.done(1)
-            except subprocess.CalledProcessError as subprocess_exception:
-                self.__logger.error("Error trying to substitute the root's path in fstab with the "
-                                    "path of the new snapshot created. Reason: " + str(subprocess_exception.reason))
-                # The consolidation process was KO so this QDialong window is closed and returns integer 2
-                self.done(2)
-        except exception.BtrfsSnapshotDeletion as btrfs_snapshot_exception:
-            self.__logger.error("Error removing root snapshot {root_snapshot} because it is not empty and there are "
-                                "subvolumes within it "
-                                .format(root_snapshot=self.__root_subvolume.subvolume_origin[:-1]))
-            # The consolidation process was KO so this QDialong window is closed and returns integer 3
-            self.done(3)
+            rollback_engine = rollback.RollbackEngine(self.__snapshot_to_clone_in_root_full_path,
+                                                      self.__root_subvolume)
+            previous_root = rollback_engine.rollback()
+            self.__logger.info("Previous root has been kept in {previous_root}".format(previous_root=previous_root))
+            # Checks if grub-btrfs integration is enabled. The system must be rebooted right after the
+            # consolidation, so GRUB entries are regenerated now instead of waiting for the burst of
+            # snapshot operations to end
+            settings.grub_regenerator.mark_dirty()
+            settings.grub_regenerator.flush()
+            # The consolidation process was OK so this QDialong window is closed and returns integer 1
+            self.done(1)
+        except exception.BtrfsRollback as btrfs_rollback_exception:
+            self.__logger.error("Error consolidating root snapshot. Reason: " + str(btrfs_rollback_exception))
+            # The consolidation process was KO so this QDialong window is closed and returns integer 2
+            self.done(2)
 
     def cancel(self):
         """Rejects root snapshot consolidation.
@@ -414,11 +358,15 @@ class SnapshotWindow(QMainWindow):
         QtTest.QTest.qWait(10)
 
         if self.radiobutton_all_subvolumes.isChecked():
-            for subvolume in settings.subvolumes:
-                settings.subvolumes[subvolume].create_snapshot()
+            subvolumes_selected = list(settings.subvolumes)
         else:
-            subvolume_selected = self.combobox_subvolumes.currentText()
-            settings.subvolumes[subvolume_selected].create_snapshot()
+            subvolumes_selected = [self.combobox_subvolumes.currentText()]
+        for subvolume in subvolumes_selected:
+            try:
+                settings.subvolumes[subvolume].create_snapshot()
+            except exception.BtrfsSnapshotCreation:
+                # The error has been logged when the snapshot was created
+                pass
 
         # Refreshing GUI
         self.on_refresh_gui()
@@ -778,10 +726,12 @@ class ProblemsFoundWindow(QMainWindow):
         self.button_ok.clicked.connect(self.exit)
 
     def exit(self):
-        """Exits the application.
+        """Exits the application. Main window is closed first, so its background threads are stopped.
 
         """
         self.close()
+        if self.parent is not None:
+            self.parent.close()
         sys.exit()
 
 
@@ -853,7 +803,8 @@ class DiffWindow(QDialog):
     If user choose Yes, ButterManager will perform a full process to obtain diferences, so it will take a lot
     of time to complete but it will obtain files with differences in bot subolumes and files which are present
     only in one subvolume or the other. If user chooses No, ButterManager will only obtain those files which
-    have been modified but this operation will be done quickly.
+    have been modified but this operation will be done quickly. Send stream diff obtains the same files as the
+    full process reading only the metadata BTRFS sends between both subvolumes.
 
     """
     # Constructor
@@ -880,11 +831,13 @@ class DiffWindow(QDialog):
 
         self.__button_partial = QPushButton('Partial diff')
         self.__button_full = QPushButton('Full diff')
+        self.__button_send = QPushButton('Send stream diff')
 
         layout = QVBoxLayout()
         layout.addWidget(self.__label_info)
         layout.addWidget(self.__button_partial)
         layout.addWidget(self.__button_full)
+        layout.addWidget(self.__button_send)
 
         self.setLayout(layout)
 
@@ -902,15 +855,15 @@ class DiffWindow(QDialog):
 
         # Adjusting font scale
         # UI elements
-        self.__ui_elements = [self.__label_info, self.__button_partial, self.__button_full]
+        self.__ui_elements = [self.__label_info, self.__button_partial, self.__button_full, self.__button_send]
         utils.scale_fonts(self.__ui_elements)
         # Tooltips
         self.setStyleSheet(" QToolTip{font: " + str(settings.base_font_size) + "pt}")
 
         # Setting maximum and minimum  size for the main window
-        self.setMinimumHeight(285)
+        self.setMinimumHeight(345)
         self.setMinimumWidth(420)
-        self.setMaximumHeight(285)
+        self.setMaximumHeight(345)
         self.setMaximumWidth(420)
 
         # Centering the window
@@ -923,12 +876,15 @@ class DiffWindow(QDialog):
         information = "Partial diff will calculate only modified files. \n " \
                       "This operation will be done quickly. Full diff \n " \
                       "will take long but it will obtain modified files \n " \
-                      "and those which are only in one of the subvolumes."
+                      "and those which are only in one of the subvolumes. \n " \
+                      "Send stream diff will obtain the same files \n " \
+                      "reading only metadata, so it is much faster."
         self.__label_info.setText(information)
 
         # Buttons
         self.__button_full.clicked.connect(self.full_operation)
         self.__button_partial.clicked.connect(self.partial_operation)
+        self.__button_send.clicked.connect(self.send_operation)
 
     def full_operation(self):
         """User selects Full diff, so a full diff operation will be done.
@@ -943,3 +899,1007 @@ class DiffWindow(QDialog):
         """
         self.__logger.info("Starting the process to obtain partial differences between subvolumes. Please wait...")
         self.done(2)
+
+    def send_operation(self):
+        """User selects Send stream diff, so a full diff operation will be done parsing the send stream.
+
+        """
+        self.__logger.info("Starting the process to obtain differences between subvolumes using send stream. "
+                           "Please wait...")
+        self.done(3)
+
+
+class DiffNode:
+    """Path of a DiffTreeModel and the rows of the differences within it.
+
+    """
+    # Constructor
+    def __init__(self, name, path, parent, ranges, category):
+        """ Constructor.
+
+        Arguments:
+            name (str): Last component of the path.
+            path (str): Path, f.i.: /etc/fstab ('' for the root directory).
+            parent (DiffNode): Directory which contains the path (None for the root directory).
+            ranges (dictionary): rows within the path (including itself) by category as (first, after last) tuples.
+            category (str): Category of the path itself. None if it only contains other paths.
+        """
+        self.name = name
+        self.path = path
+        self.parent = parent
+        self.ranges = ranges
+        self.category = category
+        # Position within its parent
+        self.row = 0
+        # Children fetched so far and the generator of the rest of them (None when all have been fetched)
+        self.children = []
+        self.pending = None
+
+    # Private attributes
+    # Number of paths within this path (excluding itself) by category
+    @property
+    def counts(self):
+        counts = {category: end - start for category, (start, end) in self.ranges.items()}
+        if self.category is not None:
+            counts[self.category] -= 1
+        return counts
+
+
+class DiffTreeModel(QAbstractItemModel):
+    """Tree of the differences stored in a DiffResults file, grouped by directory.
+
+    Children of a directory are fetched in batches when the view needs them, so only the directories expanded
+    are read and memory doesn't depend on the number of differences.
+    """
+    # Constants
+    FETCH_SIZE = 256
+    COLUMNS = ["Path", "Change", "Content"]
+
+    # Constructor
+    def __init__(self, results, labels, categories, directory="", parent=None):
+        """ Constructor.
+
+        Arguments:
+            results (filesystem.diffresults.DiffResults): Differences to show.
+            labels (dictionary): Text shown for every category.
+            categories (:obj:`list` of :obj:`str`): Categories to show.
+            directory (str): Only the paths within this directory are shown ('' for all of them) (default '').
+            parent (QObject): Owner of the model (default None).
+        """
+        QAbstractItemModel.__init__(self, parent)
+        self.__results = results
+        self.__labels = labels
+        self.__root = DiffNode(directory, directory, None, {category: results.get_range(category, directory)
+                                                             for category in categories}, None)
+
+    # Private attributes
+    # Root directory shown
+    @property
+    def root(self):
+        return self.__root
+
+    # Methods
+    # Private methods
+    def __get_node(self, index):
+        """Gets the node of an index.
+
+        Arguments:
+            index (QModelIndex): Index of the node.
+
+        Returns:
+            DiffNode: The node (the root node if the index is not valid).
+        """
+        return index.internalPointer() if index.isValid() else self.__root
+
+    # Public methods
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(row, column, self.__get_node(parent).children[row])
+
+    def parent(self, index):
+        node = self.__get_node(index)
+        if node.parent is None or node.parent is self.__root:
+            return QModelIndex()
+        return self.createIndex(node.parent.row, 0, node.parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        return len(self.__get_node(parent).children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.COLUMNS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        return sum(self.__get_node(parent).counts.values()) > 0
+
+    def canFetchMore(self, parent):
+        node = self.__get_node(parent)
+        if node.pending is None and not node.children and self.hasChildren(parent):
+            node.pending = self.__results.get_children(node.path, node.ranges)
+        return node.pending is not None
+
+    def fetchMore(self, parent):
+        node = self.__get_node(parent)
+        children = [DiffNode(name, "{path}/{name}".format(path=node.path, name=name), node, ranges, category)
+                    for name, ranges, category in itertools.islice(node.pending, self.FETCH_SIZE)]
+        if len(children) < self.FETCH_SIZE:
+            node.pending = None
+        if not children:
+            return
+        self.beginInsertRows(parent, len(node.children), len(node.children) + len(children) - 1)
+        for child in children:
+            child.row = len(node.children)
+            node.children.append(child)
+        self.endInsertRows()
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        if role == QtCore.Qt.ToolTipRole:
+            return node.path
+        if role != QtCore.Qt.DisplayRole:
+            return None
+        if index.column() == 0:
+            return node.name
+        if index.column() == 1:
+            return self.__labels[node.category] if node.category is not None else ""
+        if node.category is not None and node.ranges[node.category][1] - node.ranges[node.category][0] == 1:
+            # Bytes written in partial comparisons
+            value = self.__results.get_value(node.category, node.ranges[node.category][0])
+            return utils.convert_from_bytes(value) + " written" if value else ""
+        return ", ".join("{count} {label}".format(count=count, label=self.__labels[category].lower())
+                         for category, count in node.counts.items() if count)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+
+class DiffViewerWindow(QDialog):
+    """Window to browse the differences found between a snapshot and its subvolume (or another snapshot).
+
+    Differences are shown as a tree of directories which can be filtered by category and directory, and exported
+    to a text file. The file which stores them is only mapped in memory, so the window is opened at once even if
+    there are millions of differences.
+
+    """
+    # Constructor
+    def __init__(self, parent, results_path):
+        """ Constructor.
+
+        Arguments:
+            parent (QMainWindow): Parent window.
+            results_path (str): Full path to the file which stores the differences.
+        """
+        QDialog.__init__(self, parent)
+        self.parent = parent
+
+        # UI elements
+        self.__ui_elements = []
+
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+
+        self.__results = diffresults.DiffResults(results_path)
+        metadata = self.__results.metadata
+        self.__labels = {
+            diff.ONLY_IN_ORIGIN: "Only in {name}".format(name=os.path.basename(metadata.get("origin", "").rstrip("/"))),
+            diff.ONLY_IN_SNAPSHOT: "Only in {name}".format(name=os.path.basename(metadata.get("snapshot", ""))),
+            diff.MODIFIED: "Modified"}
+        self.__model = None
+
+        self.__label_info = QLabel()
+        self.__checkboxes_categories = {category: QCheckBox("{label} ({count})".format(
+            label=self.__labels[category], count=self.__results.count(category)))
+            for category in diffresults.CATEGORIES}
+        self.__line_edit_directory = QLineEdit()
+        self.__button_filter = QPushButton('Filter')
+        self.__tree_view = QTreeView()
+        self.__label_status = QLabel()
+        self.__button_export = QPushButton('Export')
+        self.__button_box = QDialogButtonBox(QDialogButtonBox.Close)
+
+        categories_layout = QHBoxLayout()
+        for category in diffresults.CATEGORIES:
+            categories_layout.addWidget(self.__checkboxes_categories[category])
+        directory_layout = QHBoxLayout()
+        directory_layout.addWidget(self.__line_edit_directory)
+        directory_layout.addWidget(self.__button_filter)
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addWidget(self.__button_export)
+        buttons_layout.addWidget(self.__button_box)
+        layout = QVBoxLayout()
+        layout.addWidget(self.__label_info)
+        layout.addLayout(categories_layout)
+        layout.addLayout(directory_layout)
+        layout.addWidget(self.__tree_view)
+        layout.addWidget(self.__label_status)
+        layout.addLayout(buttons_layout)
+
+        self.setLayout(layout)
+
+        # Initializing the window
+        self.init_ui()
+        self.filter()
+
+    def init_ui(self):
+        """Initializes the Graphic User Interface.
+
+        """
+        # Setting the window icon
+        buttermanager_icon = os.path.join(settings.images_dir, 'buttermanager50.png')
+        self.setWindowIcon(QIcon(buttermanager_icon))
+        self.setWindowTitle('Differences')
+
+        # Adjusting font scale
+        # UI elements
+        self.__ui_elements = [self.__label_info, self.__line_edit_directory, self.__button_filter, self.__tree_view,
+                              self.__label_status, self.__button_export, self.__button_box]
+        self.__ui_elements.extend(self.__checkboxes_categories.values())
+        utils.scale_fonts(self.__ui_elements)
+        # Tooltips
+        self.setStyleSheet(" QToolTip{font: " + str(settings.base_font_size) + "pt}")
+
+        # Setting size for the window
+        self.resize(800, 600)
+
+        # Centering the window
+        qt_rectangle = self.frameGeometry()
+        center_point = QDesktopWidget().availableGeometry().center()
+        qt_rectangle.moveCenter(center_point)
+        self.move(qt_rectangle.topLeft())
+
+        # Setting information
+        metadata = self.__results.metadata
+        information = "Differences between {snapshot} \n " \
+                      "and {origin}".format(snapshot=metadata.get("snapshot", ""),
+                                            origin=metadata.get("origin", ""))
+        self.__label_info.setText(information)
+        for category in diffresults.CATEGORIES:
+            self.__checkboxes_categories[category].setChecked(True)
+            self.__checkboxes_categories[category].setEnabled(self.__results.count(category) > 0)
+            self.__checkboxes_categories[category].stateChanged.connect(self.filter)
+        self.__line_edit_directory.setPlaceholderText("Directory to show, f.i.: /etc (all of them if it is empty)")
+        self.__tree_view.setUniformRowHeights(True)
+
+        # Buttons
+        self.__button_filter.clicked.connect(self.filter)
+        self.__line_edit_directory.returnPressed.connect(self.filter)
+        self.__button_export.clicked.connect(self.export)
+        self.__button_box.rejected.connect(self.reject)
+        self.finished.connect(self.close_results)
+
+    def __get_filter(self):
+        """Gets the categories checked and the directory introduced.
+
+        Returns:
+            tuple (:obj:`list` of :obj:`str`, str): categories and directory ('' for the root directory).
+        """
+        categories = [category for category in diffresults.CATEGORIES
+                      if self.__checkboxes_categories[category].isChecked()]
+        directory = self.__line_edit_directory.text().strip().strip("/")
+        return categories, "/" + directory if directory else ""
+
+    def filter(self):
+        """Shows the differences of the categories checked within the directory introduced.
+
+        """
+        categories, directory = self.__get_filter()
+        self.__model = DiffTreeModel(self.__results, self.__labels, categories, directory, self)
+        self.__tree_view.setModel(self.__model)
+        self.__tree_view.setColumnWidth(0, 380)
+        self.__tree_view.setColumnWidth(1, 160)
+        counts = self.__model.root.counts
+        self.__label_status.setText("{total} differences shown".format(total=sum(counts.values())))
+
+    def export(self):
+        """Writes the differences shown to a text file.
+
+        """
+        categories, directory = self.__get_filter()
+        output_path, _ = QFileDialog.getSaveFileName(self, "Export differences",
+                                                     os.path.join(os.path.expanduser("~"), "differences.txt"))
+        if not output_path:
+            return
+        try:
+            exported = self.__results.export(output_path, categories, directory)
+        except OSError as os_error_exception:
+            self.__logger.error("Error exporting the differences: {error}".format(error=str(os_error_exception)))
+            self.__label_status.setText("The differences couldn't be exported to {path}".format(path=output_path))
+            return
+        self.__label_status.setText("{exported} differences exported to {path}".format(exported=exported,
+                                                                                     path=output_path))
+
+    def close_results(self, result):
+        """Unmaps the differences when the window is closed.
+
+        Arguments:
+            result (int): Result of the window.
+        """
+        self.__tree_view.setModel(None)
+        self.__model = None
+        self.__results.close()
+
+
+class PruningWindow(QDialog):
+    """Window to free a specific amount of space by deleting snapshots.
+
+    The user introduces the space to free and ButterManager shows the smallest set of snapshots whose deletion
+    frees it, according to their exclusive size. If the user accepts the plan, the window is closed returning
+    integer 1 and the plan can be retrieved from pruning_plan attribute.
+
+    """
+    # Constructor
+    def __init__(self, parent):
+        """ Constructor.
+
+        Arguments:
+            parent (QMainWindow): Parent window.
+        """
+        QDialog.__init__(self, parent)
+
+        self.setWindowFlags(
+            QtCore.Qt.Window |
+            QtCore.Qt.CustomizeWindowHint |
+            QtCore.Qt.WindowTitleHint |
+            QtCore.Qt.WindowStaysOnTopHint
+        )
+        self.parent = parent
+
+        # UI elements
+        self.__ui_elements = []
+
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+
+        # Plan calculated
+        self.pruning_plan = None
+
+        self.__label_info = QLabel()
+        self.__spinbox_target = QDoubleSpinBox()
+        self.__button_plan = QPushButton('Plan')
+        self.__list_plan = QListWidget()
+        self.__label_plan = QLabel()
+        self.__button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+
+        target_layout = QHBoxLayout()
+        target_layout.addWidget(self.__spinbox_target)
+        target_layout.addWidget(self.__button_plan)
+        layout = QVBoxLayout()
+        layout.addWidget(self.__label_info)
+        layout.addLayout(target_layout)
+        layout.addWidget(self.__list_plan)
+        layout.addWidget(self.__label_plan)
+        layout.addWidget(self.__button_box)
+
+        self.setLayout(layout)
+
+        # Initializing the window
+        self.init_ui()
+
+    def init_ui(self):
+        """Initializes the Graphic User Interface.
+
+        """
+        # Setting the window icon
+        buttermanager_icon = os.path.join(settings.images_dir, 'buttermanager50.png')
+        self.setWindowIcon(QIcon(buttermanager_icon))
+        self.setWindowTitle('Freeing space')
+
+        # Adjusting font scale
+        # UI elements
+        self.__ui_elements = [self.__label_info, self.__spinbox_target, self.__button_plan, self.__list_plan,
+                              self.__label_plan, self.__button_box]
+        utils.scale_fonts(self.__ui_elements)
+        # Tooltips
+        self.setStyleSheet(" QToolTip{font: " + str(settings.base_font_size) + "pt}")
+
+        # Setting size for the window
+        self.resize(560, 420)
+
+        # Centering the window
+        qt_rectangle = self.frameGeometry()
+        center_point = QDesktopWidget().availableGeometry().center()
+        qt_rectangle.moveCenter(center_point)
+        self.move(qt_rectangle.topLeft())
+
+        # Setting information
+        information = "How much space do you want to free? The newest snapshot \n " \
+                      "of every subvolume, the snapshot used for root and the \n " \
+                      "minimum number of snapshots of every subvolume are kept."
+        self.__label_info.setText(information)
+        self.__spinbox_target.setSuffix(" " + utils.GB)
+        self.__spinbox_target.setDecimals(1)
+        self.__spinbox_target.setRange(0.1, 1024 * 1024)
+        self.__spinbox_target.setValue(10)
+
+        # Buttons
+        self.__button_box.button(QDialogButtonBox.Ok).setEnabled(False)
+        self.__button_plan.clicked.connect(self.calculate_plan)
+        self.__spinbox_target.valueChanged.connect(self.discard_plan)
+        self.__button_box.accepted.connect(self.prune)
+        self.__button_box.rejected.connect(self.cancel)
+
+    def calculate_plan(self):
+        """Calculates the snapshots to delete and shows them.
+
+        """
+        self.__list_plan.clear()
+        target = int(self.__spinbox_target.value() * utils.BYTE_SIZE * utils.BYTE_SIZE * utils.BYTE_SIZE)
+        try:
+            self.pruning_plan = pruning.PruningPlanner().plan(target)
+        except OSError as os_error_exception:
+            self.__logger.error("Error calculating the snapshots to delete: {error}".format(
+                error=str(os_error_exception)))
+            self.pruning_plan = None
+            self.__label_plan.setText("The size of the snapshots couldn't be retrieved.")
+            return
+        for candidate in self.pruning_plan.candidates:
+            self.__list_plan.addItem("{snapshot} ({exclusive})".format(
+                snapshot=candidate.snapshot_full_path, exclusive=utils.convert_from_bytes(candidate.exclusive)))
+        if not self.pruning_plan.candidates:
+            self.__label_plan.setText("There are no snapshots to delete. Please, check that quotas are enabled.")
+        else:
+            information = "Expected space freed: {reclaimed}".format(
+                reclaimed=utils.convert_from_bytes(self.pruning_plan.reclaimed))
+            if not self.pruning_plan.reached:
+                information += " (the target can't be reached)"
+            self.__label_plan.setText(information)
+        self.__button_box.button(QDialogButtonBox.Ok).setEnabled(bool(self.pruning_plan.candidates))
+
+    def discard_plan(self):
+        """Discards the plan calculated when the target changes.
+
+        """
+        self.pruning_plan = None
+        self.__list_plan.clear()
+        self.__label_plan.setText("")
+        self.__button_box.button(QDialogButtonBox.Ok).setEnabled(False)
+
+    def prune(self):
+        """Accepts the plan.
+
+        """
+        self.__logger.info("Pruning plan accepted:\n{plan}".format(plan=str(self.pruning_plan)))
+        self.done(1)
+
+    def cancel(self):
+        """Rejects the plan.
+
+        """
+        self.done(4)
+
+
+class RestoreWindow(QDialog):
+    """Window to restore a file or a directory from a snapshot into its subvolume.
+
+    The user introduces the path to restore and how conflicts are solved, and ButterManager shows the entries that
+    will be restored. If the user accepts the plan, the window is closed returning integer 1 and the plan can be
+    retrieved from restore_plan attribute.
+
+    """
+    # Constructor
+    def __init__(self, parent, snapshot_full_path, subvolume):
+        """ Constructor.
+
+        Arguments:
+            parent (QMainWindow): Parent window.
+            snapshot_full_path (str): Full path to the snapshot.
+            subvolume (filesystem.snapshot.Subvolume): Subvolume the snapshot was taken from.
+        """
+        QDialog.__init__(self, parent)
+
+        self.setWindowFlags(
+            QtCore.Qt.Window |
+            QtCore.Qt.CustomizeWindowHint |
+            QtCore.Qt.WindowTitleHint |
+            QtCore.Qt.WindowStaysOnTopHint
+        )
+        self.parent = parent
+
+        # UI elements
+        self.__ui_elements = []
+
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+
+        self.__snapshot_full_path = snapshot_full_path
+        self.__subvolume = subvolume
+
+        # Plan calculated
+        self.restore_plan = None
+
+        self.__label_info = QLabel()
+        self.__line_edit_path = QLineEdit()
+        self.__combobox_conflicts = QComboBox()
+        self.__button_preview = QPushButton('Preview')
+        self.__tree_plan = QTreeWidget()
+        self.__label_plan = QLabel()
+        self.__button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+
+        path_layout = QHBoxLayout()
+        path_layout.addWidget(self.__line_edit_path)
+        path_layout.addWidget(self.__combobox_conflicts)
+        path_layout.addWidget(self.__button_preview)
+        layout = QVBoxLayout()
+        layout.addWidget(self.__label_info)
+        layout.addLayout(path_layout)
+        layout.addWidget(self.__tree_plan)
+        layout.addWidget(self.__label_plan)
+        layout.addWidget(self.__button_box)
+
+        self.setLayout(layout)
+
+        # Initializing the window
+        self.init_ui()
+
+    def init_ui(self):
+        """Initializes the Graphic User Interface.
+
+        """
+        # Setting the window icon
+        buttermanager_icon = os.path.join(settings.images_dir, 'buttermanager50.png')
+        self.setWindowIcon(QIcon(buttermanager_icon))
+        self.setWindowTitle('Restoring files')
+
+        # Adjusting font scale
+        # UI elements
+        self.__ui_elements = [self.__label_info, self.__line_edit_path, self.__combobox_conflicts,
+                              self.__button_preview, self.__tree_plan, self.__label_plan, self.__button_box]
+        utils.scale_fonts(self.__ui_elements)
+        # Tooltips
+        self.setStyleSheet(" QToolTip{font: " + str(settings.base_font_size) + "pt}")
+
+        # Setting size for the window
+        self.resize(640, 480)
+
+        # Centering the window
+        qt_rectangle = self.frameGeometry()
+        center_point = QDesktopWidget().availableGeometry().center()
+        qt_rectangle.moveCenter(center_point)
+        self.move(qt_rectangle.topLeft())
+
+        # Setting information
+        information = "Which file or directory of {snapshot} \n " \
+                      "do you want to restore into {origin}? (f.i.: /etc/nginx) \n " \
+                      "Files are cloned, so no data is copied.".format(
+                          snapshot=os.path.basename(self.__snapshot_full_path),
+                          origin=self.__subvolume.subvolume_origin)
+        self.__label_info.setText(information)
+        self.__combobox_conflicts.addItem("Overwrite conflicts", restore.OVERWRITE)
+        self.__combobox_conflicts.addItem("Keep conflicts", restore.SKIP)
+        self.__combobox_conflicts.addItem("Keep a backup of conflicts", restore.BACKUP)
+        self.__combobox_conflicts.setToolTip("What to do with the files which exist and are different "
+                                             "within the subvolume")
+        self.__tree_plan.setHeaderLabels(["Action", "Path", "Size"])
+        self.__tree_plan.setRootIsDecorated(False)
+        self.__tree_plan.setColumnWidth(1, 400)
+
+        # Buttons
+        self.__button_box.button(QDialogButtonBox.Ok).setEnabled(False)
+        self.__button_preview.clicked.connect(self.calculate_plan)
+        self.__line_edit_path.returnPressed.connect(self.calculate_plan)
+        self.__line_edit_path.textChanged.connect(self.discard_plan)
+        self.__combobox_conflicts.currentIndexChanged.connect(self.discard_plan)
+        self.__button_box.accepted.connect(self.restore)
+        self.__button_box.rejected.connect(self.cancel)
+
+    def calculate_plan(self):
+        """Calculates the entries to restore and shows them.
+
+        """
+        self.discard_plan()
+        path = self.__line_edit_path.text().strip()
+        if not path.strip("/"):
+            self.__label_plan.setText("Please, introduce the path of a file or directory.")
+            return
+        try:
+            self.restore_plan = restore.plan_restore(self.__snapshot_full_path, self.__subvolume.subvolume_origin,
+                                                     path, self.__combobox_conflicts.currentData())
+        except OSError as os_error_exception:
+            self.__logger.error("Error calculating the entries to restore: {error}".format(
+                error=str(os_error_exception)))
+            self.__label_plan.setText("{path} couldn't be found within the snapshot.".format(path=path))
+            return
+        pending = [entry for entry in self.restore_plan.entries if entry.action != restore.UNCHANGED]
+        for entry in pending:
+            self.__tree_plan.addTopLevelItem(QTreeWidgetItem([
+                entry.action, "/" + entry.relative_path, "" if entry.directory else utils.convert_from_bytes(
+                    entry.size)]))
+        if not pending:
+            self.__label_plan.setText("Nothing to restore: the subvolume has the same files.")
+        else:
+            self.__label_plan.setText("{entries} entries to restore ({size}), {conflicts} conflicts".format(
+                entries=len(pending), size=utils.convert_from_bytes(self.restore_plan.size),
+                conflicts=len(self.restore_plan.conflicting)))
+        self.__button_box.button(QDialogButtonBox.Ok).setEnabled(bool(pending))
+
+    def discard_plan(self):
+        """Discards the plan calculated when the path or the conflict policy change.
+
+        """
+        self.restore_plan = None
+        self.__tree_plan.clear()
+        self.__label_plan.setText("")
+        self.__button_box.button(QDialogButtonBox.Ok).setEnabled(False)
+
+    def restore(self):
+        """Accepts the plan.
+
+        """
+        self.__logger.info("Restore plan accepted:\n{plan}".format(plan=str(self.restore_plan)))
+        self.done(1)
+
+    def cancel(self):
+        """Rejects the plan.
+
+        """
+        self.done(4)
+
+
+class SearchWindow(QDialog):
+    """Window to search files by name across all the snapshots.
+
+    Snapshots are indexed in background the first time the window is opened, so the searches only read their
+    indexes. Every file found is shown with the snapshots which contain it, their size and modification time.
+
+    """
+    # Constructor
+    def __init__(self, parent, snapshots_full_paths):
+        """ Constructor.
+
+        Arguments:
+            parent (QMainWindow): Parent window.
+            snapshots_full_paths (:obj:`list` of :obj:`str`): Full paths to the snapshots to search.
+        """
+        QDialog.__init__(self, parent)
+        self.parent = parent
+
+        # UI elements
+        self.__ui_elements = []
+
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+
+        self.__snapshots_full_paths = list(snapshots_full_paths)
+        self.__snapshots_indexed = set()
+        # Searcher running the current search (None if no search is running)
+        self.__searcher = None
+
+        self.__label_info = QLabel()
+        self.__line_edit_query = QLineEdit()
+        self.__checkbox_regex = QCheckBox('Regular expression')
+        self.__button_search = QPushButton('Search')
+        self.__button_history = QPushButton('File history')
+        self.__tree_results = QTreeWidget()
+        self.__label_status = QLabel()
+        self.__button_box = QDialogButtonBox(QDialogButtonBox.Close)
+
+        query_layout = QHBoxLayout()
+        query_layout.addWidget(self.__line_edit_query)
+        query_layout.addWidget(self.__checkbox_regex)
+        query_layout.addWidget(self.__button_search)
+        query_layout.addWidget(self.__button_history)
+        layout = QVBoxLayout()
+        layout.addWidget(self.__label_info)
+        layout.addLayout(query_layout)
+        layout.addWidget(self.__tree_results)
+        layout.addWidget(self.__label_status)
+        layout.addWidget(self.__button_box)
+
+        self.setLayout(layout)
+
+        # Snapshots not indexed yet are indexed in background. The thread belongs to the parent window, so the
+        # snapshot being indexed when this window is closed can be finished
+        self.__indexer = indexer.Indexer(self.__snapshots_full_paths, parent)
+        self.__indexer.snapshot_indexed.connect(self.on_snapshot_indexed)
+
+        # Initializing the window
+        self.init_ui()
+        self.__indexer.start()
+
+    def init_ui(self):
+        """Initializes the Graphic User Interface.
+
+        """
+        # Setting the window icon
+        buttermanager_icon = os.path.join(settings.images_dir, 'buttermanager50.png')
+        self.setWindowIcon(QIcon(buttermanager_icon))
+        self.setWindowTitle('Searching files')
+
+        # Adjusting font scale
+        # UI elements
+        self.__ui_elements = [self.__label_info, self.__line_edit_query, self.__checkbox_regex, self.__button_search,
+                              self.__button_history, self.__tree_results, self.__label_status, self.__button_box]
+        utils.scale_fonts(self.__ui_elements)
+        # Tooltips
+        self.setStyleSheet(" QToolTip{font: " + str(settings.base_font_size) + "pt}")
+
+        # Setting size for the window
+        self.resize(760, 480)
+
+        # Centering the window
+        qt_rectangle = self.frameGeometry()
+        center_point = QDesktopWidget().availableGeometry().center()
+        qt_rectangle.moveCenter(center_point)
+        self.move(qt_rectangle.topLeft())
+
+        # Setting information
+        information = "Search files by name (f.i.: *.conf) or by path (f.i.: etc/pacman.d/*) \n " \
+                      "across all the snapshots. Check 'Regular expression' to \n " \
+                      "search the paths using a regular expression instead."
+        self.__label_info.setText(information)
+        self.__tree_results.setHeaderLabels(["File", "Snapshot", "Size", "Modified"])
+        self.__tree_results.setColumnWidth(0, 300)
+        self.__tree_results.setColumnWidth(1, 220)
+        self.__update_status()
+
+        # Buttons
+        self.__button_search.clicked.connect(self.search)
+        self.__line_edit_query.returnPressed.connect(self.search)
+        self.__button_history.clicked.connect(self.show_history)
+        self.__tree_results.itemDoubleClicked.connect(self.show_history)
+        self.__button_box.rejected.connect(self.reject)
+        self.finished.connect(self.stop_indexing)
+
+    def __update_status(self, information=""):
+        """Shows how many snapshots have been indexed.
+
+        Arguments:
+            information (str): Information to show before the number of snapshots indexed (default '').
+        """
+        status = "{indexed} of {total} snapshots indexed".format(indexed=len(self.__snapshots_indexed),
+                                                                 total=len(self.__snapshots_full_paths))
+        self.__label_status.setText(information + status if information else status)
+
+    def on_snapshot_indexed(self, snapshot_full_path):
+        """Updates the status when a snapshot has been indexed.
+
+        Arguments:
+            snapshot_full_path (str): Full path to the snapshot.
+        """
+        self.__snapshots_indexed.add(snapshot_full_path)
+        self.__update_status()
+
+    def search(self):
+        """Searches the query within the indexes in background. The files found are shown once the search
+        finishes.
+
+        """
+        query = self.__line_edit_query.text().strip()
+        if self.__searcher is not None:
+            return
+        self.__tree_results.clear()
+        if not query:
+            return
+        self.__button_search.setEnabled(False)
+        self.__update_status("Searching... ")
+        # The thread belongs to the parent window, so it can be finished if this window is closed meanwhile
+        self.__searcher = searcher.Searcher(self.__snapshots_full_paths, query, self.__checkbox_regex.isChecked(),
+                                            self.parent)
+        self.__searcher.search_finished.connect(self.on_search_finished)
+        self.__searcher.search_failed.connect(self.on_search_failed)
+        self.__searcher.finished.connect(self.on_searcher_finished)
+        self.__searcher.start()
+
+    def on_search_finished(self, found, not_indexed, elapsed):
+        """Shows the files found.
+
+        Arguments:
+            found (dictionary): Snapshots which contain every file found (see fileindex.search_snapshots).
+            not_indexed (:obj:`list` of :obj:`str`): Snapshots which have not been searched.
+            elapsed (float): Milliseconds elapsed.
+        """
+        for file_path in sorted(found):
+            file_item = QTreeWidgetItem([file_path, "{snapshots} snapshots".format(
+                snapshots=len(found[file_path])), "", ""])
+            for snapshot_full_path, size, mtime, _ in found[file_path]:
+                QTreeWidgetItem(file_item, [file_path, snapshot_full_path, utils.convert_from_bytes(size),
+                                            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime / 1e9))])
+            self.__tree_results.addTopLevelItem(file_item)
+        information = "{files} files found in {elapsed:.0f} ms".format(files=len(found), elapsed=elapsed)
+        if not_indexed:
+            information += " ({pending} snapshots not indexed yet)".format(pending=len(not_indexed))
+        self.__update_status(information + ". ")
+
+    def on_search_failed(self, error):
+        """Shows why the query couldn't be searched.
+
+        Arguments:
+            error (str): Error of the regular expression.
+        """
+        self.__update_status("Invalid regular expression: {error}. ".format(error=error))
+
+    def on_searcher_finished(self):
+        """Allows searching again once the current search has finished.
+
+        """
+        self.__searcher = None
+        self.__button_search.setEnabled(True)
+
+    def show_history(self):
+        """Shows the versions of the file selected across the snapshots of its subvolume.
+
+        """
+        item = self.__tree_results.currentItem()
+        if item is None:
+            history_window = HistoryWindow(self)
+        else:
+            # Top level items are files and their children are the snapshots which contain them
+            snapshot_item = item if item.parent() is not None else item.child(0)
+            subvolume = snapshot.get_subvolume_by_snapshot_name(snapshot_item.text(1))
+            history_window = HistoryWindow(self, item.text(0), subvolume)
+        history_window.exec_()
+
+    def stop_indexing(self, result):
+        """Stops indexing when the window is closed. The snapshot being indexed is finished in background.
+
+        Arguments:
+            result (int): Result of the window.
+        """
+        self.__indexer.stop()
+
+
+class HistoryWindow(QDialog):
+    """Window to show every distinct version of a file across the snapshots of its subvolume.
+
+    The file is only looked up in every snapshot, so the history is shown quickly even if there are hundreds
+    of snapshots. Selecting a version shows the differences with the previous one.
+
+    """
+    # Constructor
+    def __init__(self, parent, path="", subvolume=None):
+        """ Constructor.
+
+        Arguments:
+            parent (QWidget): Parent window.
+            path (str): Path of the file. If subvolume is provided, it is relative to it, f.i.: /etc/fstab
+            (default '').
+            subvolume (filesystem.snapshot.Subvolume): Subvolume which contains the file. It will be found
+            using the path if it is not provided (default None).
+        """
+        QDialog.__init__(self, parent)
+        self.parent = parent
+
+        # UI elements
+        self.__ui_elements = []
+
+        # Logger
+        self.__logger = utils.Logger(self.__class__.__name__).get()
+
+        self.__subvolume = subvolume
+        self.__versions = []
+
+        self.__label_info = QLabel()
+        self.__line_edit_path = QLineEdit(path)
+        self.__button_show = QPushButton('Show history')
+        self.__tree_versions = QTreeWidget()
+        self.__text_edit_diff = QPlainTextEdit()
+        self.__label_status = QLabel()
+        self.__button_box = QDialogButtonBox(QDialogButtonBox.Close)
+
+        path_layout = QHBoxLayout()
+        path_layout.addWidget(self.__line_edit_path)
+        path_layout.addWidget(self.__button_show)
+        layout = QVBoxLayout()
+        layout.addWidget(self.__label_info)
+        layout.addLayout(path_layout)
+        layout.addWidget(self.__tree_versions)
+        layout.addWidget(self.__text_edit_diff)
+        layout.addWidget(self.__label_status)
+        layout.addWidget(self.__button_box)
+
+        self.setLayout(layout)
+
+        # Initializing the window
+        self.init_ui()
+        if path:
+            self.show_history()
+
+    def init_ui(self):
+        """Initializes the Graphic User Interface.
+
+        """
+        # Setting the window icon
+        buttermanager_icon = os.path.join(settings.images_dir, 'buttermanager50.png')
+        self.setWindowIcon(QIcon(buttermanager_icon))
+        self.setWindowTitle('File history')
+
+        # Adjusting font scale
+        # UI elements
+        self.__ui_elements = [self.__label_info, self.__line_edit_path, self.__button_show, self.__tree_versions,
+                              self.__label_status, self.__button_box]
+        utils.scale_fonts(self.__ui_elements)
+        # Differences are shown using a monospaced font
+        diff_font = QFontDatabase.systemFont(QFontDatabase.FixedFont)
+        diff_font.setPointSize(settings.base_font_size)
+        self.__text_edit_diff.setFont(diff_font)
+        self.__text_edit_diff.setReadOnly(True)
+        self.__text_edit_diff.setLineWrapMode(QPlainTextEdit.NoWrap)
+        # Tooltips
+        self.setStyleSheet(" QToolTip{font: " + str(settings.base_font_size) + "pt}")
+
+        # Setting size for the window
+        self.resize(760, 600)
+
+        # Centering the window
+        qt_rectangle = self.frameGeometry()
+        center_point = QDesktopWidget().availableGeometry().center()
+        qt_rectangle.moveCenter(center_point)
+        self.move(qt_rectangle.topLeft())
+
+        # Setting information
+        information = "Type the path of a file (f.i.: /etc/fstab) to list its versions across \n " \
+                      "all the snapshots of its subvolume. Select a version to see \n " \
+                      "the differences with the previous one."
+        self.__label_info.setText(information)
+        self.__tree_versions.setHeaderLabels(["Modified", "Size", "First snapshot", "Last snapshot", "Snapshots"])
+        self.__tree_versions.setRootIsDecorated(False)
+        self.__tree_versions.setColumnWidth(0, 160)
+        self.__tree_versions.setColumnWidth(2, 200)
+        self.__tree_versions.setColumnWidth(3, 200)
+
+        # Buttons
+        self.__button_show.clicked.connect(self.show_history)
+        self.__line_edit_path.returnPressed.connect(self.show_history)
+        self.__tree_versions.currentItemChanged.connect(self.show_diff)
+        self.__button_box.rejected.connect(self.reject)
+
+    def show_history(self):
+        """Looks up the file in every snapshot and shows its versions, newest first.
+
+        """
+        path = self.__line_edit_path.text().strip()
+        self.__tree_versions.clear()
+        self.__text_edit_diff.clear()
+        self.__versions = []
+        if not path:
+            return
+        if self.__subvolume is not None:
+            subvolume, relative_path = self.__subvolume, path.strip("/")
+        else:
+            subvolume, relative_path = history.get_relative_path(path)
+        if subvolume is None:
+            self.__label_status.setText("{path} is not within any subvolume defined in ButterManager".format(
+                path=path))
+            return
+        start = time.time()
+        snapshots_full_paths = subvolume.get_all_snapshots_with_the_same_name()
+        self.__versions = history.get_file_history(snapshots_full_paths, relative_path,
+                                                   subvolume.subvolume_origin)
+        for position in reversed(range(len(self.__versions))):
+            version = self.__versions[position]
+            version_item = QTreeWidgetItem([
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(version.mtime / 1e9)),
+                utils.convert_from_bytes(version.size), os.path.basename(version.snapshots[0]),
+                os.path.basename(version.snapshots[-1]), str(len(version.snapshots))])
+            version_item.setData(0, QtCore.Qt.UserRole, position)
+            self.__tree_versions.addTopLevelItem(version_item)
+        self.__label_status.setText("{versions} versions of {path} found in {snapshots} snapshots in {elapsed:.0f} "
+                                    "ms".format(versions=len(self.__versions), path=relative_path,
+                                                snapshots=len(snapshots_full_paths),
+                                                elapsed=(time.time() - start) * 1000))
+
+    def show_diff(self, current_item, previous_item):
+        """Shows the differences between the version selected and the previous one.
+
+        Arguments:
+            current_item (QTreeWidgetItem): Version selected.
+            previous_item (QTreeWidgetItem): Version selected before.
+        """
+        self.__text_edit_diff.clear()
+        if current_item is None:
+            return
+        position = current_item.data(0, QtCore.Qt.UserRole)
+        if position == 0:
+            self.__text_edit_diff.setPlainText("First version found")
+            return
+        differences = history.get_version_diff(self.__versions[position - 1], self.__versions[position])
+        if differences is None:
+            self.__text_edit_diff.setPlainText("Binary or too big to be compared")
+        else:
+            self.__text_edit_diff.setPlainText("\n".join(differences) if differences else "Same content")
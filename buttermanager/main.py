@@ -1,5 +1,4 @@
-from buttermanager.buttermanager import PasswordWindow
-from PyQt5.QtWidgets import QApplication
+from buttermanager import cli
 import sys
 
 
@@ -7,6 +6,12 @@ def main():
     """Main wrapper for starting the program
 
     """
+    if cli.is_command_line(sys.argv[1:]):
+        sys.exit(cli.main(sys.argv[1:]))
+
+    from buttermanager.buttermanager import PasswordWindow
+    from PyQt5.QtWidgets import QApplication
+
     # Creating application instance
     application = QApplication(sys.argv)
     # Creating main window instance
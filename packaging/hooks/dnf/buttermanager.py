@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018-2019 Eloy García Almadén <eloy.garcia.pca@gmail.com>
+#
+# This file is part of buttermanager.
+#
+# This program is free software: you can redistribute it and / or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dnf plugin that takes a snapshot of every subvolume defined in ButterManager before a transaction. Old
+snapshots are deleted and GRUB entries regenerated after the transaction.
+
+Install it in the dnf-plugins directory of the system python (f.i.: /usr/lib/python3.12/site-packages/dnf-plugins/)
+together with buttermanager.conf in /etc/dnf/plugins/.
+"""
+import dnf
+import subprocess
+
+# Constants
+HOOK_COMMAND = ["/usr/bin/buttermanager", "hook", "dnf"]
+POST_HOOK_COMMAND = HOOK_COMMAND + ["--post"]
+
+
+# Classes
+class ButterManager(dnf.Plugin):
+    """Runs buttermanager hook command before dnf changes any package and once it has changed them.
+
+    """
+    name = "buttermanager"
+
+    def pre_transaction(self):
+        # The transaction goes on even if the snapshots couldn't be taken
+        try:
+            subprocess.call(HOOK_COMMAND)
+        except OSError:
+            pass
+
+    def transaction(self):
+        # Run once the transaction has finished
+        try:
+            subprocess.call(POST_HOOK_COMMAND)
+        except OSError:
+            pass
@@ -10,6 +10,7 @@ Source0:        %{url}/archive/%{version}/%{name}-%{version}.tar.gz
 BuildArch:      noarch
 BuildRequires:  python3-devel
 BuildRequires:  python3dist(setuptools)
+BuildRequires:  systemd-rpm-macros
 Requires:       btrfs-progs
 Recommends:     grub2-btrfs
 
@@ -30,6 +31,11 @@ and upgrading the system safely.
 
 install -Dpm 644 packaging/%{name}.desktop %{buildroot}%{_datadir}/applications/%{name}.desktop
 install -Dpm 644 packaging/%{name}.svg %{buildroot}%{_datadir}/icons/hicolor/scalable/%{name}.svg
+install -Dpm 644 packaging/systemd/%{name}-timeline.service %{buildroot}%{_unitdir}/%{name}-timeline.service
+install -Dpm 644 packaging/systemd/%{name}-timeline.timer %{buildroot}%{_unitdir}/%{name}-timeline.timer
+install -Dpm 644 packaging/hooks/dnf/%{name}.py %{buildroot}%{python3_sitelib}/dnf-plugins/%{name}.py
+install -Dpm 644 packaging/hooks/dnf/%{name}.conf %{buildroot}%{_sysconfdir}/dnf/plugins/%{name}.conf
+install -Dpm 755 packaging/hooks/zypper/%{name} %{buildroot}%{_prefix}/lib/zypp/plugins/commit/%{name}
 
 # Fix the desktop file
 sed -e "s/^Exec=.*/Exec=%{name}/" \
@@ -42,6 +48,12 @@ sed -e "s/^Exec=.*/Exec=%{name}/" \
 %license LICENSE
 %doc README.md doc
 %{_bindir}/buttermanager
+%{_bindir}/buttermanager-timeline
+%{_unitdir}/%{name}-timeline.service
+%{_unitdir}/%{name}-timeline.timer
+%{python3_sitelib}/dnf-plugins/%{name}.py
+%config(noreplace) %{_sysconfdir}/dnf/plugins/%{name}.conf
+%{_prefix}/lib/zypp/plugins/commit/%{name}
 %{python3_sitelib}/buttermanager*
 %{_datadir}/applications/%{name}.desktop
 %{_datadir}/icons/hicolor/scalable/%{name}.svg
@@ -31,6 +31,7 @@ setuptools.setup(
     entry_points={
         "console_scripts": [
             "buttermanager = buttermanager.bm_main:main",
+            "buttermanager-timeline = buttermanager.bm_timeline:main",
         ],
     },
 